@@ -13,6 +13,9 @@ class SymbolSlip(Elaboratable): # From Yumewatari
 
 	If the input word contains multiple commas, the behavior is undefined.
 
+	With an alignment smaller than the word size, a comma is only shifted to the next multiple of alignment symbols,
+	so commas which arrive at different multiples of it don't change the alignment.
+
 	Parameters
 	----------
 	symbol_size : int
@@ -21,6 +24,8 @@ class SymbolSlip(Elaboratable): # From Yumewatari
 		Word size, in symbols.
 	comma : int
 		Comma symbol, ``symbol_size`` bit wide.
+	alignment : int
+		Commas are placed at a multiple of this many symbols, by default at the start of a word.
 
 	Attributes
 	----------
@@ -32,8 +37,10 @@ class SymbolSlip(Elaboratable): # From Yumewatari
 		Enable input. If asserted (the default), comma symbol affects alignment. Otherwise,
 		comma symbol does nothing.
 	"""
-	def __init__(self, symbol_size, word_size, comma):
+	def __init__(self, symbol_size, word_size, comma, alignment = None):
 		width = symbol_size * word_size
+		alignment = word_size if alignment is None else alignment
+		assert word_size % alignment == 0
 
 		self.i = Signal(width)
 		self.o = Signal(width)
@@ -45,6 +52,7 @@ class SymbolSlip(Elaboratable): # From Yumewatari
 		self.__word_size = word_size
 		self.__symbol_size = symbol_size
 		self.__comma = comma
+		self.__alignment = alignment
 
 		self.debug = Signal(8)
 	
@@ -53,26 +61,26 @@ class SymbolSlip(Elaboratable): # From Yumewatari
 		width = self.__width
 		word_size = self.__word_size
 		symbol_size = self.__symbol_size
+		alignment = self.__alignment
 
 		symbol_buffer = Signal(width * 2) # Holds current symbols and symbols from last clock cycle
 		m.d.rx += symbol_buffer.eq(Cat(symbol_buffer[width:], self.i))
-		offset = Signal(range(word_size))
+		offset = Signal(range(alignment))
 
 		m.d.comb += self.debug.eq(offset)
 
 		offset_rand = Signal(3, reset=1) # Random 3 bit value generated by an LFSR
-		assert len(offset) == 2
 		#m.d.comb += offset.eq(offset_rand[0:2])
 
 		# This is way faster than a bit_select since that requires multiplication by 10.
 		with m.Switch(offset):
-			for i in range(word_size):
+			for i in range(alignment):
 				with m.Case(i):
 					m.d.rx += self.o.eq(symbol_buffer[symbol_size * i : symbol_size * i + width]) 
 
 		for i in range(word_size):
 			with m.If(self.i[i * symbol_size : (i + 1) * symbol_size] == self.__comma):
-				m.d.rx += offset.eq(Mux(self.en, i, 0)) # Set offset to specific value, but only if comma symbol is received. Otherwise let offset stay like before.
+				m.d.rx += offset.eq(Mux(self.en, i % alignment, 0)) # Set offset to specific value, but only if comma symbol is received. Otherwise let offset stay like before.
 				#m.d.rx += offset_rand.eq(((offset_rand & 0x4) >> 2) ^ ((offset_rand & 0x2) >> 1) ^ ((offset_rand << 1) & 0b111)) # Set offset to random value, but only if comma symbol is received. Otherwise let offset stay like before.
 		
 		return m
\ No newline at end of file
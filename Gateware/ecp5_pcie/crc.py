@@ -1,6 +1,80 @@
 from amaranth import *
 from amaranth.build import *
 
+def crc_matrix(polynomial, crc_size, data_bits):
+	"""
+	Update of a CRC after shifting in a number of data bits, as a matrix over GF(2).
+	Shifting in a bit is linear in the last CRC value and the data bit, so shifting in many bits is too.
+
+	Parameters
+	----------
+	polynomial : int
+		CRC polynomial
+	crc_size : int
+		CRC size, for example 16 for CRC16.
+	data_bits : int
+		Number of data bits shifted in, starting with bit 0
+
+	Returns
+	-------
+	list of (int, int)
+		For each bit of the new CRC value, a mask of the bits of the last CRC value and a mask of the data bits it is the XOR of
+	"""
+	crc = [(1 << i, 0) for i in range(crc_size)]
+
+	for i in range(data_bits):
+		# The input value is the input data XORed with the last bit of the CRC
+		in_state, in_data = crc[crc_size - 1][0], crc[crc_size - 1][1] ^ (1 << i)
+
+		# Shift the last CRC value and XOR all bits of it which are 1 in the polynomial with the input value
+		current = []
+		for j in range(crc_size):
+			state, data = crc[j - 1] if j > 0 else (0, 0)
+
+			if polynomial & (1 << j):
+				state ^= in_state
+				data ^= in_data
+
+			current.append((state, data))
+
+		crc = current
+
+	return crc
+
+def crc_update(crc, data, polynomial, data_bits = None):
+	"""
+	Next CRC value after shifting in data, with a single XOR per CRC bit
+
+	Parameters
+	----------
+	crc : Value or int
+		Last CRC value, constant values are folded in
+	data : Value or None
+		Data to shift in, bit 0 first. None leaves out the data part of the update.
+	polynomial : int
+		CRC polynomial
+	data_bits : int
+		Number of data bits to shift in, by default all of them
+	"""
+	crc_size = len(crc) if isinstance(crc, Value) else polynomial.bit_length() - 1
+	data_bits = len(data) if data_bits is None else data_bits
+
+	bits = []
+	for state_mask, data_mask in crc_matrix(polynomial, crc_size, data_bits):
+		terms = []
+
+		if isinstance(crc, Value):
+			terms += [crc[i] for i in range(crc_size) if state_mask & (1 << i)]
+		elif bin(state_mask & crc).count("1") % 2 == 1:
+			terms.append(Const(1))
+
+		if data is not None:
+			terms += [data[i] for i in range(data_bits) if data_mask & (1 << i)]
+
+		bits.append(Cat(terms).xor() if terms else Const(0))
+
+	return Cat(bits)
+
 class SingleCRC(Elaboratable):
 	"""
 	CRC generator for a variable number of data bits, calculates CRC of inputted data bits combinatorially
@@ -26,31 +100,98 @@ class SingleCRC(Elaboratable):
 		self.init	   = init
 		self.polynomial = polynomial
 		self.crc_size   = crc_size
-	
+
 	def elaborate(self, platform):
 		m = Module()
 
-		last = Const(self.init)
-		for i in range(len(self.input)):
-			# The input value is the input data XORed with the last bit of the CRC
-			in_val = self.input[i] ^ last[self.crc_size - 1]
-
-			# All values to XOR
-			in_vals = [None] * self.crc_size
-			for j in range(self.crc_size):
-				# If the polynomial is 1 at a bit, XOR it with that bit in the input value
-				if (self.polynomial & (1 << j)) == 0:
-					in_vals[j] = 0
-				else:
-					in_vals[j] = in_val
-
-			# Current CRC value
-			current = Signal(self.crc_size) # This needs to be a signal, otherwise the simulation doesn't work
-			# Shift the last CRC value and XOR all bits of it which are 1 in the polynomial with the input value
-			m.d.comb += current.eq((Cat(last) << 1)[0:self.crc_size] ^ Cat(in_vals))
-			last = current
-	
-		m.d.comb += self.output.eq(last)
+		# The polynomial is given without the highest bit
+		m.d.comb += self.output.eq(crc_update(self.init, self.input, self.polynomial | (1 << self.crc_size)))
+
+		return m
+
+class ParallelCRC(Elaboratable):
+	"""
+	CRC generator which processes a whole word per clock cycle.
+	The update matrix is computed when elaborating, so every CRC bit is one flat XOR of the bits it depends on
+	instead of a chain of one XOR stage per data bit.
+
+	Parameters
+	----------
+	input : Signal()
+		Data input, bit 0 is shifted in first
+	init : int
+		Initial CRC value
+	polynomial : int
+		CRC polynomial
+	crc_size : int
+		CRC size, for example 16 for CRC16.
+	reset : Signal()
+		Reset CRC Generator
+	partial_widths : list of int
+		Numbers of bits which can be shifted in instead of the whole input, for example for the first or last word of a packet
+	pipeline : bool
+		Register the part of the update which only depends on the data, which leaves a single XOR per bit in the feedback path.
+		The input, reset and width are used one clock cycle later.
+
+	Attributes
+	----------
+	output : Signal(crc_size)
+		CRC value
+	width : Signal()
+		0 shifts in the whole input, i shifts in the first partial_widths[i - 1] bits
+	restart : Signal()
+		Shift the input into the initial value instead of the last CRC value, so a packet can start right after the last one without a reset in between
+	"""
+	def __init__(self, input, init, polynomial, crc_size, reset, partial_widths = [], pipeline = False):
+		self.input	  = input
+		self.output	 = Signal(crc_size, reset = init)
+		self.init	   = init
+		self.polynomial = polynomial
+		self.crc_size   = crc_size
+		self.reset	  = reset
+		self.widths	 = [len(input)] + list(partial_widths)
+		self.pipeline   = pipeline
+		self.width	  = Signal(range(len(self.widths)))
+		self.restart	= Signal()
+
+		assert all(0 < width <= len(input) for width in self.widths)
+
+	def elaborate(self, platform):
+		m = Module()
+
+		polynomial = self.polynomial | (1 << self.crc_size)
+
+		if self.pipeline:
+			reset = Signal(reset = 1)
+			width = Signal.like(self.width)
+			restart = Signal()
+			m.d.sync += reset.eq(self.reset)
+			m.d.sync += width.eq(self.width)
+			m.d.sync += restart.eq(self.restart)
+
+			state = Mux(restart, Const(self.init, self.crc_size), self.output)
+
+			updates = []
+			for i, bits in enumerate(self.widths):
+				data_part = Signal(self.crc_size, name = f"data_part_{i}")
+				m.d.sync += data_part.eq(crc_update(0, self.input, polynomial, bits))
+				updates.append(crc_update(state, None, polynomial, bits) ^ data_part)
+
+		else:
+			reset = self.reset
+			width = self.width
+			state = Mux(self.restart, Const(self.init, self.crc_size), self.output)
+			updates = [crc_update(state, self.input, polynomial, bits) for bits in self.widths]
+
+		# Setting the output to the initial value resets it
+		with m.If(reset):
+			m.d.sync += self.output.eq(self.init)
+
+		with m.Else():
+			with m.Switch(width):
+				for i, update in enumerate(updates):
+					with m.Case(i):
+						m.d.sync += self.output.eq(update)
 
 		return m
 
@@ -75,46 +216,26 @@ class CRC(Elaboratable):
 	"""
 	def __init__(self, input, init, polynomial, crc_size, reset):
 		self.input	  = input
-		self.output	 = Signal(crc_size, reset = init)
 		self.init	   = init
 		self.polynomial = polynomial
 		self.crc_size   = crc_size
 		self.reset	  = reset
-	
-	def elaborate(self, platform): # TODO: Apparently this generates 512 wires, look at new amaranth CRC gen when it is upstream
+		self.crc		= ParallelCRC(input, init, polynomial, crc_size, reset)
+		self.output	 = self.crc.output
+
+	def elaborate(self, platform):
 		m = Module()
 
-		last = self.output
-		for i in range(len(self.input)):
-			# The input value is the input data XORed with the last bit of the CRC
-			in_val = self.input[i] ^ last[self.crc_size - 1]
-
-			# All values to XOR
-			in_vals = [None] * self.crc_size
-			for j in range(self.crc_size):
-				# If the polynomial is 1 at a bit, XOR it with that bit in the input value
-				if (self.polynomial & (1 << j)) == 0:
-					in_vals[j] = 0
-				else:
-					in_vals[j] = in_val
-
-			# Current CRC value
-			current = Signal(self.crc_size) # This needs to be a signal, otherwise the simulation doesn't work
-			# Shift the last CRC value and XOR all bits of it which are 1 in the polynomial with the input value
-			m.d.comb += current.eq((Cat(last) << 1)[0:self.crc_size] ^ Cat(in_vals))
-			last = current
-		
-		# Setting the output to the initial value resets it
-		with m.If(self.reset):
-			m.d.sync += self.output.eq(self.init)
-		with m.Else():
-			m.d.sync += self.output.eq(last)
+		m.submodules.crc = self.crc
 
 		return m
 
 class LCRC(Elaboratable):
 	"""
-	LCRC generator for a variable number of data bits, currently 16 and 32 while 32 is best supported
+	LCRC generator for a variable number of data bits, currently 16, 32 and 64 while 32 and 64 are best supported
+
+	With 32 or 64 data bits, only the first 16 bits are used in the first cycle after reset, since a TLP starts with the
+	two bytes of its sequence number.
 
 	Parameters
 	----------
@@ -122,118 +243,52 @@ class LCRC(Elaboratable):
 		Data input
 	output : Signal()
 		Data output
-	crc_size : int
-		CRC size, for example 16 for CRC16.
 	reset : Signal()
 		Reset CRC Generator
+	pipeline : bool
+		Register the data part of the CRC update, see ParallelCRC. Delays the output by one clock cycle.
+	partial_widths : list of int
+		Numbers of bits which can be shifted in instead of the whole input, see ParallelCRC. The first one is used in the first cycle after reset.
+		By default 16 and with 64 data bits also 32, for the last word of a TLP with an odd number of DW.
+
+	Attributes
+	----------
+	width : Signal()
+		0 shifts in the whole input, i shifts in the first partial_widths[i - 1] bits. Except in the first cycle after reset.
+	restart : Signal()
+		Shift the input into the initial value, see ParallelCRC
 	"""
-	def __init__(self, input, reset):
+	def __init__(self, input, reset, pipeline = False, partial_widths = None):
 		self.input      = input
 		self.init       = 0xFFFFFFFF
 		self.polynomial = 0x04C11DB7
 		self.crc_size   = 32
 		self.reset      = reset
+		self.pipeline   = pipeline
 		self.output     = Signal(self.crc_size, reset = self.init)
-	
-	def elaborate(self, platform): # TODO: Apparently this generates 512 wires
+
+		if partial_widths is None:
+			partial_widths = {32: [16], 64: [16, 32]}.get(len(input), [])
+
+		self.partial_widths = partial_widths
+		self.width      = Signal(range(len(partial_widths) + 1))
+		self.restart    = Signal()
+
+	def elaborate(self, platform):
 		m = Module()
 
-		last_reset = Signal()
-		m.d.sync += last_reset.eq(self.reset)
-
-		self.intermediate = Signal(self.crc_size, reset = self.init)
-
-		if len(self.input) == 32:
-			with m.If(last_reset & ~self.reset):
-				last = self.intermediate
-				for i in range(16):
-					# The input value is the input data XORed with the last bit of the CRC
-					in_val = self.input[i] ^ last[self.crc_size - 1]
-
-					# All values to XOR
-					in_vals = [None] * self.crc_size
-					for j in range(self.crc_size):
-						# If the polynomial is 1 at a bit, XOR it with that bit in the input value
-						if (self.polynomial & (1 << j)) == 0:
-							in_vals[j] = 0
-						else:
-							in_vals[j] = in_val
-
-					# Current CRC value
-					current = Signal(self.crc_size) # This needs to be a signal, otherwise the simulation doesn't work
-					# Shift the last CRC value and XOR all bits of it which are 1 in the polynomial with the input value
-					#m.d.comb += current[:16].eq(0xFFFF)
-					#m.d.comb += current[16:].eq((Cat(last) << 1)[0 : self.crc_size] ^ Cat(in_vals))
-					m.d.comb += current.eq((Cat(last) << 1)[0 : self.crc_size] ^ Cat(in_vals))
-					last = current
-
-				# Setting the output to the initial value resets it
-				# TODO: Redundant
-				with m.If(self.reset):
-					m.d.sync += self.intermediate.eq(self.init)
-				with m.Else():
-					m.d.sync += self.intermediate.eq(last)
-			
-			with m.Else():
-				last = self.intermediate
-				for i in range(len(self.input)):
-					# The input value is the input data XORed with the last bit of the CRC
-					in_val = self.input[i] ^ last[self.crc_size - 1]
-
-					# All values to XOR
-					in_vals = [None] * self.crc_size
-					for j in range(self.crc_size):
-						# If the polynomial is 1 at a bit, XOR it with that bit in the input value
-						if (self.polynomial & (1 << j)) == 0:
-							in_vals[j] = 0
-						else:
-							in_vals[j] = in_val
-
-					# Current CRC value
-					current = Signal(self.crc_size) # This needs to be a signal, otherwise the simulation doesn't work
-					# Shift the last CRC value and XOR all bits of it which are 1 in the polynomial with the input value
-					m.d.comb += current.eq((Cat(last) << 1)[0 : self.crc_size] ^ Cat(in_vals))
-					last = current
-
-				# Setting the output to the initial value resets it
-				with m.If(self.reset):
-					m.d.sync += self.intermediate.eq(self.init)
-				with m.Else():
-					m.d.sync += self.intermediate.eq(last)
-		
-		else:
-			last = self.intermediate
-			for i in range(len(self.input)):
-				# The input value is the input data XORed with the last bit of the CRC
-				in_val = self.input[i] ^ last[self.crc_size - 1]
-
-				# All values to XOR
-				in_vals = [None] * self.crc_size
-				for j in range(self.crc_size):
-					# If the polynomial is 1 at a bit, XOR it with that bit in the input value
-					if (self.polynomial & (1 << j)) == 0:
-						in_vals[j] = 0
-					else:
-						in_vals[j] = in_val
-
-				# Current CRC value
-				current = Signal(self.crc_size) # This needs to be a signal, otherwise the simulation doesn't work
-				# Shift the last CRC value and XOR all bits of it which are 1 in the polynomial with the input value
-				m.d.comb += current.eq((Cat(last) << 1)[0 : self.crc_size] ^ Cat(in_vals))
-				last = current
-			
-			# Setting the output to the initial value resets it
-			with m.If(self.reset):
-				m.d.sync += self.intermediate.eq(self.init)
-			with m.Else():
-				m.d.sync += self.intermediate.eq(last)
-		
-		if len(self.input) == 32:
-			for i in [0, 8, 16, 24]:
-				m.d.comb += self.output[24 - i : 24 - i + 8].eq(~self.intermediate[i : i + 8][::-1])
+		m.submodules.crc = crc = ParallelCRC(self.input, self.init, self.polynomial, self.crc_size, self.reset, self.partial_widths, self.pipeline)
 
-		else:
-			for i in [0, 8]:
-				m.d.comb += self.output[8 - i : 8 - i + 8].eq(~self.intermediate[i : i + 8][::-1])
+		self.intermediate = crc.output
+
+		m.d.comb += crc.restart.eq(self.restart)
+
+		if self.partial_widths:
+			last_reset = Signal()
+			m.d.sync += last_reset.eq(self.reset)
+			m.d.comb += crc.width.eq(Mux(last_reset & ~self.reset, 1, self.width))
+
+		for i in range(0, self.crc_size, 8):
+			m.d.comb += self.output[self.crc_size - 8 - i : self.crc_size - i].eq(~self.intermediate[i : i + 8][::-1])
 
 		return m
@@ -3,7 +3,7 @@ from amaranth.build import *
 from enum import IntEnum
 
 from .ltssm import PCIeLTSSM
-from .serdes import K, D, Ctrl
+from .serdes import K, D, Ctrl, LinkSpeed
 from .layouts import dll_layout, dll_status
 from .dllp import PCIeDLLPTransmitter, PCIeDLLPReceiver, DLLPType
 
@@ -29,17 +29,27 @@ class PCIeDLL(Elaboratable): # Based on Yumewatary phy.py
 	Parameters
 	----------
 	clk_freq : int
-		Maximum clock frequency in Hz, the speed in 5 GT/s mode
+		Maximum clock frequency in Hz, the one at 5 GT/s if use_speed is set, it is half of it at 2.5 GT/s
 	up : Signal()
 		Whether the DLL is active
 	credits_tx : Record(dll_layout)
-		Credits to transmit
+		Credits to transmit, driven by PCIeDLLTLPReceiver from its receive buffer
 	credits_rx : Record(dll_layout)
 		Received credits
 	speed : Signal()
 		Speed, from LinkSpeed enum from serdes.py
+	link_width : int
+		Number of lanes of the link, the replay timer and the AckNak latency limit depend on it
+	max_payload_size : Signal(3)
+		Max_Payload_Size field of the Device Control register, the replay timer and the AckNak latency limit depend on it
+	pm_send : Signal()
+		Send power management DLLPs of type pm_type repeatedly while asserted, for the handshake before going to L1
+	pm_type : Signal(3)
+		PMType of the power management DLLPs to send
+	rx_l0s : Signal()
+		Whether the receiver is in L0s, the replay timer is held then
 	"""
-	def __init__(self, ltssm : PCIeLTSSM, tx : PCIeDLLPTransmitter, rx : PCIeDLLPReceiver, clk_freq : int, use_speed : bool):
+	def __init__(self, ltssm : PCIeLTSSM, tx : PCIeDLLPTransmitter, rx : PCIeDLLPReceiver, clk_freq : int, use_speed : bool, link_width : int = 1):
 		self.up = Signal()
 		self.ltssm = ltssm
 		self.tx = tx
@@ -49,6 +59,11 @@ class PCIeDLL(Elaboratable): # Based on Yumewatary phy.py
 		self.clk_freq = clk_freq
 		self.speed = Signal()
 		self.use_speed = use_speed
+		self.link_width = link_width
+		self.max_payload_size = Signal(3)
+		self.pm_send = Signal()
+		self.pm_type = Signal(3)
+		self.rx_l0s = Signal()
 
 		self.status = Record(dll_status)
 
@@ -59,6 +74,9 @@ class PCIeDLL(Elaboratable): # Based on Yumewatary phy.py
 		self.scheduled_ack_nak_id = Signal(12)
 		"""ID of Ack or Nak DLLP to be sent"""
 
+		self.update_credits = Signal()
+		"""Send UpdateFC DLLPs as soon as possible instead of waiting for the timer, set to 1 for 1 cycle"""
+
 		self.received_ack_nak = Signal()
 		"""Whether an Ack or Nak was received"""
 		self.received_ack = Signal()
@@ -85,38 +103,18 @@ class PCIeDLL(Elaboratable): # Based on Yumewatary phy.py
 		got_np = Signal()
 		got_cpl = Signal()
 
-		# One credit equals 4 DW / 16 byte
-		m.d.comb += [ # Fix this maybe
-			#self.credits_tx.PH.eq(32),
-			#self.credits_tx.PD.eq(0xE0),
-			#self.credits_tx.NPH.eq(32),
-			#self.credits_tx.NPD.eq(0x20),
-			#self.credits_tx.CPLH.eq(0), # Must advertise infinite as root complex or endpoint
-			#self.credits_tx.CPLD.eq(0), #
-			#self.credits_tx.PH.eq(32),
-			#self.credits_tx.PD.eq(0xE0),
-			#self.credits_tx.NPH.eq(32),
-			#self.credits_tx.NPD.eq(0xE0),
-			#self.credits_tx.CPLH.eq(0), # Must advertise infinite as root complex or endpoint
-			#self.credits_tx.CPLD.eq(0), #
-			self.credits_tx.PH.eq(2),
-			self.credits_tx.PD.eq(0x20),
-			self.credits_tx.NPH.eq(2),
-			self.credits_tx.NPD.eq(0x02),
-			self.credits_tx.CPLH.eq(0), # Must advertise infinite as root complex or endpoint
-			self.credits_tx.CPLD.eq(0), #
-		]
-
 		# Which DLLPs to transmit, only concerning Flow Control Initialization
 		fc_type = Signal(2)
 		transmit_dllps = Signal()
 		done_dllp_transmission = Signal()
 
-		# For later use
-		sending_tlp = Signal() # TODO: Connect this wire for proper operation
+		# Whether an UpdateFC has been requested with update_credits
+		update_requested = Signal()
 
 		m.d.rx += self.received_ack_nak.eq(0)
 
+		m.d.comb += self.rx_l0s.eq(self.ltssm.status.power_state.rx_l0s)
+
 		# Get update DLLPs
 		with m.If(~self.ltssm.status.link.up):
 			pass
@@ -156,6 +154,7 @@ class PCIeDLL(Elaboratable): # Based on Yumewatary phy.py
 					got_cpl.eq(0),
 					done_dllp_transmission.eq(0),
 					transmit_dllps.eq(0),
+					update_requested.eq(0),
 					self.received_ack_nak.eq(0),
 				]
 
@@ -201,15 +200,25 @@ class PCIeDLL(Elaboratable): # Based on Yumewatary phy.py
 				# This is supposed to be in the above state, but does it matter?
 				m.d.rx += self.up.eq(1)
 
-				# Send DLLP UpdateFC packets often enough, assumes 62.5 MHz clock, transmits every 20 µs if there is no other ongoing transmission
-				clk = 62500000
+				# Send DLLP UpdateFC packets often enough, transmits every 20 µs, the limit is 30 µs.
+				# The clock frequency is the one at 5 GT/s, at 2.5 GT/s the clock runs at half of it and so does the limit.
+				# When credits have been returned, they are sent right away. The request is kept until the DLLPs are sent, since an Ack or Nak goes first.
+				clk = self.clk_freq
 				min_delay = 20E-6
 				update_timer = Signal(range(int(min_delay * clk + 1)))
+				speed_5GTps = (self.speed == LinkSpeed.S5_0) if self.use_speed else Const(1, 1)
+				update_limit = Mux(speed_5GTps, int(min_delay * clk), int(min_delay * clk) // 2)
+
+				# The timer is suspended while the transmitter is in L0s or L1, returned credits still make it leave them
+				with m.If(~self.ltssm.status.power_state.tx_l0s & ~self.ltssm.status.power_state.l1):
+					m.d.rx += update_timer.eq(update_timer + 1)
 
-				m.d.rx += update_timer.eq(update_timer + 1)
 				m.d.rx += transmit_dllps.eq(0)
 
-				with m.If(((update_timer << (self.speed if self.use_speed else 0)) >= int(min_delay * clk)) & ~sending_tlp):
+				with m.If(self.update_credits | (update_timer >= update_limit)):
+					m.d.rx += update_requested.eq(1)
+
+				with m.If(update_requested):
 					m.d.rx += fc_type.eq(FCType.UpdateFC)
 					m.d.rx += transmit_dllps.eq(1)
 					m.d.rx += done_dllp_transmission.eq(0)
@@ -221,7 +230,9 @@ class PCIeDLL(Elaboratable): # Based on Yumewatary phy.py
 					m.next = State.DL_Inactive
 		
 
-		# DLLP sending FSM
+		# DLLP sending FSM, PCIeDLLPTransmitter sends the DLLPs between TLPs
+		# Acks and Naks are sent before Flow Control DLLPs, see section 3.5.2.1 in PCIe Base 1.1.
+		# Power management DLLPs come after Acks and Naks, they are sent until the LTSSM has finished the handshake for L1.
 		# TODO: It transmits the first packet twice. This doesn't break it but it unnecessarily takes up bandwidth.
 		send_ack_nak = Signal()
 		with m.If(self.schedule_ack_nak):
@@ -232,15 +243,20 @@ class PCIeDLL(Elaboratable): # Based on Yumewatary phy.py
 		with m.FSM(domain="rx"):
 			with m.State("Idle"):
 				m.d.rx += self.tx.send.eq(0)
+				m.d.rx += self.tx.dllp.type_meta.eq(0)
 
-				with m.If(transmit_dllps):
-					m.next = "Pre-1"
-
-				with m.Elif(send_ack_nak & ~sending_tlp): # TODO: This might be a problem
+				with m.If(send_ack_nak):
 					m.next = "Ack_Nak"
+
+				with m.Elif(self.pm_send):
+					m.next = "PM"
+
+				with m.Elif(transmit_dllps):
+					m.next = "Pre-1"
 			
 			with m.State("Pre-1"):
 				m.d.rx += timer.eq(0)
+				m.d.rx += update_requested.eq(0) # The credits are read after this, so they include the returned ones
 				m.d.rx += self.tx.send.eq(0)
 				m.next = "Pre-2"
 			
@@ -329,4 +345,19 @@ class PCIeDLL(Elaboratable): # Based on Yumewatary phy.py
 				with m.If(self.tx.started_sending):
 					m.next = "Idle"
 
+			# It isn't sent anymore once the handshake is over, a DLLP which is sent afterwards would start it again on the other side
+			with m.State("PM"):
+				m.d.rx += [
+					self.tx.dllp.type.eq(DLLPType.PM),
+					self.tx.dllp.type_meta.eq(self.pm_type),
+					self.tx.dllp.header.eq(0),
+					self.tx.dllp.data.eq(0),
+					self.tx.dllp.valid.eq(1),
+					self.tx.send.eq(self.pm_send),
+				]
+
+				with m.If(self.tx.started_sending | ~self.pm_send):
+					m.d.rx += self.tx.send.eq(0)
+					m.next = "Idle"
+
 		return m
\ No newline at end of file
@@ -3,28 +3,91 @@ from amaranth.build import *
 from amaranth.lib.fifo import SyncFIFOBuffered
 
 from .layouts import dllp_layout
-from .serdes import K, D, Ctrl
+from .serdes import K, D, Ctrl, LinkSpeed
 from .crc import LCRC
 from .stream import StreamInterface
 from .dll import PCIeDLL
-from .memory import TLPBuffer
+from .memory import TLPBuffer, RetryBuffer
+from .flow_control import PCIeCreditTracker, PCIeCreditAllocator
+
+def ack_nak_latency_limit(max_payload_size: int, link_width: int = 1, speed_5GTps: bool = False) -> int:
+	"""
+	AckNak latency limit in symbol times, see Table 3-6 in PCIe Base 1.1 and Table 3-7 in PCIe Base 2.0 for 5 GT/s.
+	The Tx_L0s_Adjustment is 0, a scheduled Ack or Nak makes the transmitter leave L0s right away.
+
+	Parameters
+	----------
+	max_payload_size : int
+		Max_Payload_Size in bytes
+	link_width : int
+		Number of lanes of the link
+	speed_5GTps : bool
+		Whether the link runs at 5 GT/s
+	"""
+	# AckFactor in tenths
+	if link_width <= 4:
+		ack_factor = 14 if max_payload_size <= 256 else 10
+
+	elif link_width <= 8:
+		ack_factor = 25 if max_payload_size <= 256 else 10
+
+	else:
+		ack_factor = 30 if max_payload_size <= 256 else 20
+
+	tlp_overhead = 28
+	internal_delay = 70 if speed_5GTps else 19
+	return (max_payload_size + tlp_overhead) * ack_factor // (10 * link_width) + internal_delay
+
+def replay_timeout(max_payload_size: int, link_width: int = 1, speed_5GTps: bool = False) -> int:
+	"""
+	Replay timer limit in symbol times, see Table 3-4 in PCIe Base 1.1 and Table 3-5 in PCIe Base 2.0 for 5 GT/s.
+	The Rx_L0s_Adjustment is 0, the replay timer is held instead while the receiver is in L0s.
+	"""
+	return 3 * ack_nak_latency_limit(max_payload_size, link_width, speed_5GTps)
+
+def _timer_limit(m: Module, limit: Signal, symbol_times, dll: PCIeDLL, max_payload_size: int, ratio: int, round_up: bool):
+	"""
+	Drives limit with symbol_times(max_payload_size, link_width, speed_5GTps) in clock cycles for the Max_Payload_Size and speed of the link.
+	A clock cycle is ratio symbol times at either speed. The Max_Payload_Size is limited to the largest supported one.
+	"""
+	max_payload_code = max_payload_size.bit_length() - 8 # 128 bytes is 0
+	payload_code = Mux(dll.max_payload_size > max_payload_code, max_payload_code, dll.max_payload_size)
+	speed_5GTps = (dll.speed == LinkSpeed.S5_0) if dll.use_speed else Const(0, 1)
+
+	with m.Switch(Cat(payload_code[0:3], speed_5GTps)):
+		for code in range(max_payload_code + 1):
+			for speed in [0, 1]:
+				with m.Case(code | (speed << 3)):
+					value = symbol_times(128 << code, dll.link_width, speed == 1)
+					m.d.comb += limit.eq(-(-value // ratio) if round_up else value // ratio)
 
 class PCIeDLLTLPTransmitter(Elaboratable):
 	"""
+	Parameters
+	----------
+	ratio : int
+		Symbols per word, 4 or 8. With 8 symbols per word the last word of a TLP of an odd number of DW is padded with 4 symbols,
+		which aren't sent.
+	max_payload_size : int
+		Maximum number of data bytes in a TLP, the retry buffer is sized to hold several TLPs of this size
 	"""
-	def __init__(self, dll: PCIeDLL, ratio: int = 4):
+	def __init__(self, dll: PCIeDLL, ratio: int = 4, max_payload_size: int = 512):
 		self.tlp_sink = StreamInterface(8, ratio, name="TLP_Sink")
 		self.dllp_source = StreamInterface(9, ratio, name="DLLP_Source") # TODO: Maybe connect these in elaborate instead of where this class is instantiated
 
 		self.dll = dll
+		self.max_payload_size = max_payload_size
+
+		self.credits = PCIeCreditTracker(dll.credits_rx, self.tlp_sink.symbol, dll.up)
+		"""Flow control credits, TLPs are only accepted from tlp_sink if there are enough credits for them"""
 
 		self.send = Signal()
 		self.started_sending = Signal()
 		self.accepts_tlps = Signal()
 		self.nullify = Signal() # if this is 1 towards the end of the TLP, the TLP will be nullified (set to 1 in rx domain, will be set to 0 by this module)
-		assert len(self.dllp_source.symbol) == 4
-		assert len(self.tlp_sink.symbol) == 4
-		self.ratio = len(self.dllp_source.symbol)
+		self.pending = Signal() # Whether a TLP is waiting to be sent or being sent, this keeps the link out of L0s and L1
+		assert ratio in [4, 8]
+		self.ratio = ratio
 
 		self.clocks_per_ms = 62500
 
@@ -32,8 +95,8 @@ class PCIeDLLTLPTransmitter(Elaboratable):
 		self.next_transmit_seq = Signal(12, reset=0x000) # TLP sequence number
 		self.ackd_seq = Signal(12, reset=0xFFF) # Last acknowledged TLP
 		self.replay_num = Signal(2, reset=0b00) # Number of times the retry buffer has been re-transmitted
-		self.replay_timeout = 462 # TODO: is 462 right number? See page 148 Table 3-4 PCIe 1.1
-		self.replay_timer = Signal(range(self.replay_timeout), reset=0)  # Time since last TLP has finished transmitting, hold if LTSSM in recovery
+		self.replay_timeout = Signal(range(-(-replay_timeout(max_payload_size, dll.link_width, True) // ratio) + 1)) # In clock cycles, follows the Max_Payload_Size and speed of the link
+		self.replay_timer = Signal(len(self.replay_timeout), reset=0)  # Time since last TLP has finished transmitting, hold if LTSSM in recovery
 		self.replay_timer_running = Signal()
 
 
@@ -44,47 +107,67 @@ class PCIeDLLTLPTransmitter(Elaboratable):
 		self.debug_state = Signal(4)
 
 		self.state = [
-			self.debug_state
+			self.debug_state,
+			self.credits.consumed,
 		]
 
 	def elaborate(self, platform: Platform) -> Module:
 		m = Module()
 
 		ratio = self.ratio
-		assert ratio == 4
+
+		m.submodules.credits = credits = self.credits
+
+		# Rounded up so that the timer doesn't expire early
+		_timer_limit(m, self.replay_timeout, replay_timeout, self.dll, self.max_payload_size, ratio, round_up = True)
 
 		# Maybe these should be moved into PCIeDLLTLP class since it also involves RX a bit
-		m.submodules.buffer = buffer = TLPBuffer(ratio = ratio, max_tlps = 2 ** len(self.replay_num))
-		m.submodules.unacknowledged_tlp_fifo = unacknowledged_tlp_fifo = SyncFIFOBuffered(width = 12, depth = buffer.max_tlps)
+		# A TLP has up to 4 DW of header and 1 DW of digest in addition to its data
+		tlp_bytes = self.max_payload_size + 5 * 4
+		m.submodules.buffer = buffer = RetryBuffer(ratio = ratio, depth = max(512, 1 << (4 * tlp_bytes // ratio - 1).bit_length()), tlp_bytes = tlp_bytes)
 
-		m.d.comb += self.dll.status.retry_buffer_occupation.eq(buffer.slots_occupied)
+		m.d.comb += self.dll.status.retry_buffer_occupation.eq(buffer.occupied)
 		m.d.comb += self.dll.status.tx_seq_num.eq(self.next_transmit_seq)
 
+		transmitter_ready = Signal() # Whether the transmit FSM can start a TLP in this cycle
+		replay_requested = Signal()
+
+		# The first word of a TLP is held in tlp_sink until there are enough credits and space in the retry buffer for it, then the whole TLP is let through.
+		# No new TLPs are started while the retry buffer is replayed.
+		tlp_stream = StreamInterface(8, ratio, name="TLP_Credited")
+		tlp_stream_last_valid = Signal()
+		m.d.rx += tlp_stream_last_valid.eq(tlp_stream.all_valid)
+		tlp_allowed = tlp_stream_last_valid | (credits.sufficient & ~buffer.full & transmitter_ready & ~replay_requested)
+
+		for i in range(ratio):
+			m.d.comb += tlp_stream.symbol[i].eq(self.tlp_sink.symbol[i])
+			m.d.comb += tlp_stream.valid[i].eq(self.tlp_sink.valid[i] & tlp_allowed)
+
+		m.d.comb += credits.consume.eq(tlp_stream.all_valid & ~tlp_stream_last_valid)
+
 		source_from_buffer = Signal()
 		sink_ready = Signal()
-		m.d.comb += buffer.tlp_source.ready.eq(sink_ready & source_from_buffer)
-		m.d.comb += self.tlp_sink.ready.eq(sink_ready & ~source_from_buffer & ~buffer.slots_full)
-		sink_valid = Mux(source_from_buffer, buffer.tlp_source.all_valid, self.tlp_sink.all_valid)
-		sink_symbol = [Mux(source_from_buffer, buffer.tlp_source.symbol[i], self.tlp_sink.symbol[i]) for i in range(ratio)]
+		m.d.comb += buffer.tlp_source.ready.eq(source_from_buffer & transmitter_ready)
+		sink_valid = Mux(source_from_buffer, buffer.tlp_source.all_valid, tlp_stream.all_valid)
+		sink_symbol = [Mux(source_from_buffer, buffer.tlp_source.symbol[i], tlp_stream.symbol[i]) for i in range(ratio)]
+		tlp_seq = Mux(source_from_buffer, buffer.replay_seq, self.next_transmit_seq)
 
-		self.tlp_sink.connect(buffer.tlp_sink, m.d.comb)
+		tlp_stream.connect(buffer.tlp_sink, m.d.comb)
+		m.d.comb += self.tlp_sink.ready.eq(tlp_stream.ready & tlp_allowed)
+		m.d.comb += buffer.store_seq.eq(self.next_transmit_seq)
 
-		with m.If(self.dll.up):
-			m.d.comb += buffer.store_tlp.eq(1) # TODO: Is this a good idea?
-			m.d.rx += buffer.store_tlp_id.eq(self.next_transmit_seq)
-			m.d.rx += buffer.send_tlp_id.eq(unacknowledged_tlp_fifo.r_data)
-		
-		with m.Else():
+		with m.If(~self.dll.up):
 			m.d.rx += self.next_transmit_seq.eq(self.next_transmit_seq.reset)
 			m.d.rx += self.ackd_seq.eq(self.ackd_seq.reset)
 			m.d.rx += self.replay_num.eq(self.replay_num.reset)
 		
 		m.d.rx += self.accepts_tlps.eq((self.next_transmit_seq - self.ackd_seq) >= 2048) # mod 4096 is already applied since the signal is 12 bits long
 
-		with m.If(self.replay_timer_running):
+		# The timer is held while the receiver is in L0s, an Ack can only arrive once the other side has left L0s. This replaces the Rx_L0s_Adjustment.
+		with m.If(self.replay_timer_running & ~self.dll.rx_l0s):
 			m.d.rx += self.replay_timer.eq(self.replay_timer + 1)
 
-		with m.If(unacknowledged_tlp_fifo.r_level == 0):
+		with m.If(buffer.empty):
 			m.d.rx += self.replay_timer_running.eq(0)
 			m.d.rx += self.replay_timer.eq(0)
 
@@ -93,36 +176,44 @@ class PCIeDLLTLPTransmitter(Elaboratable):
 				m.d.rx += source_from_buffer.eq(0)
 
 				with m.If(self.replay_timer >= self.replay_timeout):
-					m.next = "Replay"
+					m.next = "Wait"
 				
 				with m.If(self.dll.received_ack_nak & ~self.dll.received_ack):
+					m.next = "Wait"
+
+			# Wait until the TLP which is being transmitted has ended
+			with m.State("Wait"):
+				m.d.comb += replay_requested.eq(1)
+				m.d.rx += self.replay_timer.eq(0)
+
+				with m.If(transmitter_ready & ~tlp_stream.all_valid & ~tlp_stream_last_valid):
+					m.d.comb += buffer.replay.eq(1)
+					m.d.rx += source_from_buffer.eq(1)
+					m.d.rx += self.replay_num.eq(self.replay_num + 1)
 					m.next = "Replay"
 
 			with m.State("Replay"):
-				m.d.rx += source_from_buffer.eq(1)
+				m.d.comb += replay_requested.eq(1)
 				m.d.rx += self.replay_timer.eq(0) # TODO: This should be after the TLP is sent
 
-				with m.If(buffer.slots_empty):
+				with m.If(~buffer.replaying & transmitter_ready):
 					m.d.rx += source_from_buffer.eq(0)
 					m.next = "Idle"
 		
 		m.d.rx += self.ackd_seq.eq(self.dll.received_ack_nak_id)
 
-		# If ACK received:
-		# Delete entry from retry buffer and advance unacknowledged_tlp_fifo
-		# TODO: This doesn't check whether the ID stored in the FIFO was the one which was acknowledged. Maybe it can be replaced with a counter or that can be checked.
-		with m.If(self.dll.received_ack_nak & self.dll.received_ack):
-			m.d.comb += buffer.delete_tlp.eq(1)
-			m.d.comb += buffer.delete_tlp_id.eq(self.dll.received_ack_nak_id)
-			m.d.comb += unacknowledged_tlp_fifo.r_en.eq(1)
+		# Acks and Naks acknowledge all TLPs up to their sequence number, free them in the retry buffer
+		with m.If(self.dll.received_ack_nak):
+			m.d.comb += buffer.ack.eq(1)
+			m.d.comb += buffer.ack_seq.eq(self.dll.received_ack_nak_id)
 
-			m.d.comb += buffer.in_buffer_id.eq(self.dll.received_ack_nak_id)
-			with m.If(buffer.in_buffer):
+			with m.If(buffer.ack_valid):
 				m.d.rx += self.replay_timer.eq(0)
+				m.d.rx += self.replay_num.eq(0)
 		
 		reset_crc = Signal(reset = 1)
 		# TODO Warning: Endianness
-		crc_input = Signal(32)
+		crc_input = Signal(8 * ratio)
 		m.submodules.lcrc = lcrc = DomainRenamer("rx")(LCRC(crc_input, reset_crc))
 		m.d.rx += self.debug_crc_output.eq(lcrc.output)
 		m.d.rx += self.debug_crc_input.eq(crc_input)
@@ -146,8 +237,7 @@ class PCIeDLLTLPTransmitter(Elaboratable):
 			with m.If(self.nullify):
 				m.d.comb += Cat(tlp_bytes[0 : 8 * ratio]).eq(~lcrc.output) # ~~x = x
 				m.d.rx += Cat(tlp_bytes_before[0 : 8 * ratio]).eq(~lcrc.output)
-				m.d.comb += buffer.delete_tlp.eq(1)
-				m.d.comb += buffer.delete_tlp_id.eq(self.next_transmit_seq)
+				m.d.comb += buffer.discard.eq(~source_from_buffer)
 
 			with m.Else():
 				m.d.comb += Cat(tlp_bytes[0 : 8 * ratio]).eq(lcrc.output) # TODO: Endianness correct?
@@ -156,61 +246,120 @@ class PCIeDLLTLPTransmitter(Elaboratable):
 
 		#m.d.rx += Cat(tlp_bytes[8 * ratio : 2 * 8 * ratio]).eq(Cat(tlp_bytes[0 : 8 * ratio]))
 
-		even_more_delay = [Signal(9) for i in range(4)]
+		even_more_delay = [Signal(9) for i in range(ratio)]
+		nullified = Signal() # The TLP whose END is sent in the last Post state was nullified
+
+		# The symbols of a TLP are shifted by the STP and the sequence number in front of it. With 8 symbols per word, a TLP of an odd number of DW
+		# is shifted by 4 more symbols and starts in the second half of a word, so every TLP ends in the last symbol of a word.
+		shifts = [3, 7] if ratio == 8 else [3]
+		shift = Signal(range(len(shifts)))
 
-		m.d.rx += unacknowledged_tlp_fifo.w_en.eq(0)
+		# The number of DW is odd if the number of header DW, data DW if there is data and digest DW is odd, a length of 0 is 1024 DW
+		odd_length = ~(sink_symbol[0][5] ^ (sink_symbol[0][6] & sink_symbol[3][0]) ^ sink_symbol[2][7])
+		start_shift = odd_length if ratio == 8 else Const(0)
+
+		def shifted(before, current, s):
+			return [before[8 * i : 8 * i + 8] for i in range(ratio - s, ratio)] + [current[8 * i : 8 * i + 8] for i in range(ratio - s)]
 
 		m.d.comb += sink_ready.eq(0) # TODO: maybe move to rx?
 
-		delayed_symbol = Signal(32)
+		delayed_symbol = Signal(8 * ratio)
 		m.d.rx += delayed_symbol.eq(Cat(sink_symbol))
 		m.d.comb += crc_input.eq(delayed_symbol)
 
-		for i in range(4):
+		for i in range(ratio):
 			m.d.rx += self.dllp_source.valid[i].eq(0)
 
 
-		with m.If(self.dllp_source.ready & unacknowledged_tlp_fifo.w_rdy):
-			m.d.comb += sink_ready.eq(1) # TODO: maybe move to rx?
-			with m.FSM(name = "DLL_TLP_tx_FSM", domain = "rx") as fsm:
-				m.d.comb += Cat(self.debug[0:4]).eq(fsm.state)
-				m.d.comb += self.debug_state.eq(fsm.state)
-				m.d.comb += self.debug[4].eq(reset_crc)
-
-				with m.State("Idle"):
-					with m.If(~last_valid & sink_valid):
-						m.d.comb += reset_crc.eq(0)
-						m.d.comb += crc_input.eq(Cat(self.next_transmit_seq[8 : 12], Const(0, shape = 4), self.next_transmit_seq[0 : 8]))
-						m.d.rx += even_more_delay[0].eq(Ctrl.STP)
-						m.d.rx += even_more_delay[1].eq(self.next_transmit_seq[8 : 12])
-						m.d.rx += even_more_delay[2].eq(self.next_transmit_seq[0 : 8])
-						m.d.rx += even_more_delay[3].eq(tlp_bytes[8 * 0 : 8 * 1])
-						m.next = "Transmit"
-
-				with m.State("Transmit"):
-					with m.If(last_valid & sink_valid):
-						m.d.comb += reset_crc.eq(0)
-						m.d.rx += even_more_delay[0].eq(tlp_bytes_before[8 * 1 : 8 * 2])
-						m.d.rx += even_more_delay[1].eq(tlp_bytes_before[8 * 2 : 8 * 3])
-						m.d.rx += even_more_delay[2].eq(tlp_bytes_before[8 * 3 : 8 * 4])
-						m.d.rx += even_more_delay[3].eq(tlp_bytes[8 * 0 : 8 * 1])
-						for i in range(4):
-							m.d.rx += self.dllp_source.symbol[i].eq(even_more_delay[i])
-						for i in range(4):
-							m.d.rx += self.dllp_source.valid[i].eq(1)
-
-					with m.Elif(~sink_valid):
-						m.d.comb += reset_crc.eq(0)
-						m.d.comb += sink_ready.eq(0) # TODO: maybe move to rx?
-						m.d.rx += even_more_delay[0].eq(tlp_bytes_before[8 * 1 : 8 * 2])
-						m.d.rx += even_more_delay[1].eq(tlp_bytes_before[8 * 2 : 8 * 3])
-						m.d.rx += even_more_delay[2].eq(tlp_bytes_before[8 * 3 : 8 * 4])
-						for i in range(4):
-							m.d.rx += self.dllp_source.symbol[i].eq(even_more_delay[i])
-						for i in range(4):
-							m.d.rx += self.dllp_source.valid[i].eq(1)
-						m.next = "Post-1"
+		# dllp_source.ready only holds back the start of a TLP, a TLP which has been started is sent without interruption since tlp_sink can't be stalled.
+		# This lets PCIeDLLPTransmitter send DLLPs between TLPs.
+		m.d.comb += sink_ready.eq(self.dllp_source.ready) # TODO: maybe move to rx?
+		with m.FSM(name = "DLL_TLP_tx_FSM", domain = "rx") as fsm:
+			m.d.comb += Cat(self.debug[0:4]).eq(fsm.state)
+			m.d.comb += self.debug_state.eq(fsm.state)
+			m.d.comb += self.debug[4].eq(reset_crc)
+
+			# The first word of a TLP is taken in Idle or in the cycle in which the END of the previous TLP is registered,
+			# so TLPs follow each other without a gap. A framed TLP is 3 + 4 * n + 4 + 1 symbols long, so it ends in the last symbol of a word.
+			# The LCRC starts over with the sequence number, it may still hold the LCRC of the previous TLP.
+			def start():
+				with m.If(~last_valid & sink_valid & self.dllp_source.ready):
+					m.d.comb += reset_crc.eq(0)
+					m.d.comb += lcrc.restart.eq(1)
+					m.d.comb += lcrc.width.eq(1)
+					m.d.comb += crc_input.eq(Cat(tlp_seq[8 : 12], Const(0, shape = 4), tlp_seq[0 : 8]))
+					m.d.rx += shift.eq(start_shift)
+
+					with m.Switch(start_shift):
+						for k, s in enumerate(shifts):
+							with m.Case(k):
+								first_word = [0] * (s - 3) + [Ctrl.STP, tlp_seq[8 : 12], tlp_seq[0 : 8]] + [tlp_bytes[8 * i : 8 * i + 8] for i in range(ratio - s)]
+								for i in range(ratio):
+									m.d.rx += even_more_delay[i].eq(first_word[i])
+
+					m.next = "Transmit"
+
+			with m.State("Idle"):
+				start()
+
+			with m.State("Transmit"):
+				with m.If(last_valid & sink_valid):
+					m.d.comb += reset_crc.eq(0)
+					with m.Switch(shift):
+						for k, s in enumerate(shifts):
+							with m.Case(k):
+								for i, symbol in enumerate(shifted(tlp_bytes_before, tlp_bytes, s)):
+									m.d.rx += even_more_delay[i].eq(symbol)
+					for i in range(ratio):
+						m.d.rx += self.dllp_source.symbol[i].eq(even_more_delay[i])
+					for i in range(ratio):
+						m.d.rx += self.dllp_source.valid[i].eq(1)
 
+				with m.Elif(~sink_valid):
+					m.d.comb += reset_crc.eq(0)
+					m.d.comb += sink_ready.eq(0) # TODO: maybe move to rx?
+
+					# The last word of a TLP of an odd number of DW only has 4 symbols with 8 symbols per word
+					if ratio == 8:
+						m.d.comb += lcrc.width.eq(Mux(shift, 2, 0))
+
+					# The last 3 symbols before the LCRC
+					with m.Switch(shift):
+						for k, s in enumerate(shifts):
+							with m.Case(k):
+								for i in range(3):
+									m.d.rx += even_more_delay[i].eq(tlp_bytes_before[8 * (ratio - s + i) : 8 * (ratio - s + i + 1)])
+					for i in range(ratio):
+						m.d.rx += self.dllp_source.symbol[i].eq(even_more_delay[i])
+					for i in range(ratio):
+						m.d.rx += self.dllp_source.valid[i].eq(1)
+					m.next = "Post-1"
+
+					if ratio == 8:
+						# The sequence number is advanced here already, since the next TLP can start in Post-1
+						m.d.rx += nullified.eq(self.nullify)
+						m.d.rx += self.nullify.eq(0)
+
+						with m.If(~self.nullify & ~source_from_buffer):
+							m.d.rx += self.next_transmit_seq.eq(self.next_transmit_seq + 1)
+
+			if ratio == 8:
+				# The LCRC and END fit into the last word, the next TLP starts in the word after it.
+				# The LCRC is taken from lcrc.output, since tlp_bytes already holds the first word of the next TLP if it starts.
+				with m.State("Post-1"):
+					lcrc_bytes = Mux(nullified, ~lcrc.output, lcrc.output)
+					last_word = even_more_delay[0 : 3] + [lcrc_bytes[8 * i : 8 * i + 8] for i in range(4)] + [Mux(nullified, Ctrl.EDB, Ctrl.END)]
+
+					for i in range(ratio):
+						m.d.rx += self.dllp_source.symbol[i].eq(last_word[i])
+						m.d.rx += self.dllp_source.valid[i].eq(1)
+
+					m.d.rx += self.replay_timer_running.eq(1)
+
+					m.next = "Idle"
+					start()
+
+			else:
 				with m.State("Post-1"):
 					m.d.rx += self.dllp_source.symbol[3].eq(tlp_bytes[8 * 0 : 8 * 1])
 
@@ -220,30 +369,33 @@ class PCIeDLLTLPTransmitter(Elaboratable):
 					for i in range(4):
 						m.d.rx += self.dllp_source.valid[i].eq(1)
 
+					# The sequence number is advanced here already, since the next TLP can start in Post-2
+					m.d.rx += nullified.eq(self.nullify)
+					m.d.rx += self.nullify.eq(0)
+
+					with m.If(~self.nullify & ~source_from_buffer):
+						m.d.rx += self.next_transmit_seq.eq(self.next_transmit_seq + 1)
+
 					m.next = "Post-2"
-				
+
 				with m.State("Post-2"):
 					m.d.comb += sink_ready.eq(0) # TODO: maybe move to rx?
 					m.d.rx += self.dllp_source.symbol[0].eq(tlp_bytes_before[8 * 1 : 8 * 2])
 					m.d.rx += self.dllp_source.symbol[1].eq(tlp_bytes_before[8 * 2 : 8 * 3])
 					m.d.rx += self.dllp_source.symbol[2].eq(tlp_bytes_before[8 * 3 : 8 * 4])
+					m.d.rx += self.dllp_source.symbol[3].eq(Mux(nullified, Ctrl.EDB, Ctrl.END))
 
-					with m.If(self.nullify):
-						m.d.rx += self.dllp_source.symbol[3].eq(Ctrl.EDB)
-						m.d.rx += self.nullify.eq(0)
-
-					with m.Else():
-						m.d.rx += self.dllp_source.symbol[3].eq(Ctrl.END)
-						m.d.rx += unacknowledged_tlp_fifo.w_data.eq(self.next_transmit_seq)
-						m.d.rx += unacknowledged_tlp_fifo.w_en.eq(1)
-						m.d.rx += self.next_transmit_seq.eq(self.next_transmit_seq + 1)
-					
 					m.d.rx += self.replay_timer_running.eq(1) # TODO: Maybe this should be in the Else block above
 
 					for i in range(4):
 						m.d.rx += self.dllp_source.valid[i].eq(1)
 
 					m.next = "Idle"
+					start()
+
+		last_state = "Post-1" if ratio == 8 else "Post-2"
+		m.d.comb += transmitter_ready.eq((fsm.ongoing("Idle") | fsm.ongoing(last_state)) & self.dllp_source.ready)
+		m.d.comb += self.pending.eq(self.tlp_sink.all_valid | replay_requested | source_from_buffer | ~fsm.ongoing("Idle"))
 
 
 
@@ -319,28 +471,88 @@ class PCIeDLLTLPTransmitter(Elaboratable):
 
 class PCIeDLLTLPReceiver(Elaboratable):
 	"""
+	Receives TLPs and advertises flow control credits for its receive buffer.
+
+	Every buffer slot holds one TLP, half of the slots which aren't left for completions are advertised as posted and the other half as non-posted header credits.
+	Completions are advertised as infinite, as required for endpoints, so the requester limits its requests to the slots left for them, see PCIeDMA.
+	A TLP for which the buffer has no free slot is dropped without acknowledging it, so the link partner replays it.
+
+	In cut-through mode a TLP is streamed to tlp_source while it is being received instead of after its LCRC has been checked,
+	if the buffer is empty and tlp_source is ready when it starts. Otherwise it is stored in the buffer like in the normal mode.
+	A TLP which has a wrong LCRC, is nullified or doesn't have the expected sequence number is dropped by setting abort
+	in the cycle after its last word, the sink needs to drop everything it did with it.
+
+	With 8 symbols per word a TLP can start in either half of a word, also in the second half of the word with the END of the previous TLP.
+	Only the first 4 symbols of the last word of a TLP of an odd number of DW are valid, if this word has the LCRC in its second half
+	abort is set in the same cycle as it.
+
+	Parameters
+	----------
+	ratio : int
+		Symbols per word, 4 or 8
+	max_tlps : int
+		Number of TLPs the receive buffer can hold
+	completion_tlps : int
+		Number of slots of the receive buffer which are left for the completions of the requests of this device, see PCIeDMA
+	max_payload_size : int
+		Maximum number of data bytes in a TLP, every slot of the receive buffer holds a TLP of this size
+	cut_through : bool
+		Whether to stream TLPs to tlp_source before their LCRC has been checked
+
+	Attributes
+	----------
+	tlp_source : StreamInterface
+		Received TLPs, the sink needs to accept all words of a TLP after it accepted the first one
+	abort : Signal()
+		Is 1 for 1 cycle after the last word of a TLP on tlp_source if it has to be dropped, only in cut-through mode
 	"""
-	def __init__(self, dll: PCIeDLL, ratio: int = 4):
-		#self.tlp_source = StreamInterface(8, ratio, name="TLP_Source")
+	def __init__(self, dll: PCIeDLL, ratio: int = 4, max_tlps: int = 8, completion_tlps: int = 0, max_payload_size: int = 512, cut_through: bool = False):
+		assert max_tlps - completion_tlps >= 2
 		self.dllp_sink = StreamInterface(9, ratio, name="DLLP_Sink") # TODO: Maybe connect these in elaborate instead of where this class is instantiated
 
-		# Buffer
-		self.buffer = TLPBuffer(ratio = ratio, max_tlps = 4)
-		self.tlp_source = self.buffer.tlp_source
+		# Buffer, a slot holds up to 4 DW of header, 1 DW of digest and the LCRC in addition to the data
+		self.buffer = TLPBuffer(ratio = ratio, max_tlps = max_tlps, tlp_bytes = max_payload_size + 6 * 4)
+		self.cut_through = cut_through
+
+		if cut_through:
+			self.tlp_source = StreamInterface(8, ratio, name="TLP_Source")
+
+		else:
+			self.tlp_source = self.buffer.tlp_source
+
+		self.abort = Signal()
 
 		self.dll = dll
+
+		# One credit equals 4 DW / 16 byte, the data of a TLP needs to fit into a slot together with a 4 DW header
+		requests = max_tlps - completion_tlps
+		headers = requests // 2
+		slot_data_credits = (self.buffer.tlp_depth * ratio - 16) // 16
+		initial_credits = {
+			"PH": headers,
+			"PD": headers * slot_data_credits,
+			"NPH": requests - headers,
+			"NPD": requests - headers, # Non-posted requests have at most 1 DW of data
+			"CPLH": 0, # Must advertise infinite as root complex or endpoint
+			"CPLD": 0,
+		}
+		self.released_header = [Signal(8, name=f"released_header_{i}") for i in range(4)]
+		self.credits = PCIeCreditAllocator(initial_credits, self.released_header, dll.up)
+		"""Flow control credits, the credits of a TLP are returned once it has been taken out of the buffer"""
 		
-		assert len(self.dllp_sink.symbol) == 4
-		assert len(self.tlp_source.symbol) == 4
-		self.ratio = len(self.dllp_sink.symbol)
+		assert ratio in [4, 8]
+		self.ratio = ratio
 
 		self.clocks_per_ms = 62500
 
 		# See page 142 in PCIe 1.1
 		self.next_receive_seq = Signal(12, reset=0x000) # Expected TLP sequence number
 		self.nak_scheduled = Signal(reset = 0)
-		self.ack_nak_latency_limit = 154
-		self.ack_nak_latency_timer = Signal(range(self.ack_nak_latency_limit), reset=0) # Time since an Ack or Nak DLLP was scheduled for transmission
+		self.max_payload_size = max_payload_size
+		self.ack_nak_latency_limit = Signal(range(ack_nak_latency_limit(max_payload_size, dll.link_width, True) // ratio + 1)) # In clock cycles, follows the Max_Payload_Size and speed of the link
+		self.ack_nak_latency_timer = Signal(len(self.ack_nak_latency_limit), reset=0) # Time since an Ack or Nak DLLP was scheduled for transmission
+		self.ack_pending = Signal() # Whether TLPs have been received which haven't been acknowledged yet
+		self.ack_threshold = max_tlps // 2 # Number of unacknowledged TLPs after which they are acknowledged without waiting for the AckNak latency timer
 
 		self.actual_receive_seq = Signal(12, reset=0x000) # Received TLP sequence number
 
@@ -353,22 +565,30 @@ class PCIeDLLTLPReceiver(Elaboratable):
 
 		self.state = [
 			self.actual_receive_seq,
-			self.debug_state
+			self.debug_state,
+			self.credits.credits,
 		]
 
 	def elaborate(self, platform: Platform) -> Module:
 		m = Module()
 
 		ratio = self.ratio
-		assert ratio == 4
 
 		# TODO: Send NAK if buffer is full
 		m.submodules.buffer = buffer = self.buffer
-		m.submodules.received_tlp_fifo = received_tlp_fifo = SyncFIFOBuffered(width = 12, depth = buffer.max_tlps)
+		m.submodules.credits = credits = self.credits
+
+		# Rounded down so that Acks aren't sent late
+		_timer_limit(m, self.ack_nak_latency_limit, ack_nak_latency_limit, self.dll, self.max_payload_size, ratio, round_up = False)
+
+		m.submodules.received_tlp_fifo = received_tlp_fifo = DomainRenamer("rx")(SyncFIFOBuffered(width = 12, depth = buffer.max_tlps))
 
 		m.d.comb += self.dll.status.receive_buffer_occupation.eq(buffer.slots_occupied)
 		m.d.comb += self.dll.status.rx_seq_num.eq(self.actual_receive_seq)
 
+		m.d.comb += self.dll.credits_tx.eq(credits.credits)
+		m.d.comb += self.dll.update_credits.eq(credits.update)
+
 		with m.If(~self.dll.up):
 			m.d.rx += self.ack_nak_latency_timer.eq(self.ack_nak_latency_timer.reset)
 		
@@ -377,144 +597,313 @@ class PCIeDLLTLPReceiver(Elaboratable):
 		#with m.If(self.timer_running):
 		#	m.d.rx += self.replay_timer.eq(self.replay_timer + 1)
 
-		source_3_delayed = Signal(8)
-		m.d.rx += source_3_delayed.eq(self.dllp_sink.symbol[3][0:8])
+		groups = ratio // 4
+
+		# TLPs start in the first symbol of a group of 4 symbols, the data and the LCRC are shifted by the STP and the sequence number in front of it
+		slot = Signal(range(groups))
+		current = self.dllp_sink.symbol
+		previous = [Signal(9, name=f"previous_{i}") for i in range(ratio)]
+		m.d.rx += Cat(previous).eq(Cat(current))
+		window = previous + current
 
 		# Aligned as received by TLP layer from other end of the link
-		source_symbols = [source_3_delayed, self.dllp_sink.symbol[0][0:8], self.dllp_sink.symbol[1][0:8], self.dllp_sink.symbol[2][0:8]]
+		source_symbols = [Signal(8, name=f"source_{i}") for i in range(ratio)]
 		last_symbols = Signal(32)
-		m.d.rx += last_symbols.eq(Cat(source_symbols))
 
+		# The LCRC is calculated over the sequence number and the data, so its input is shifted by 2 symbols less.
+		# It starts over with the first word of a TLP, so it doesn't need to be reset.
+		crc_input = Signal(8 * ratio)
+		m.submodules.lcrc = lcrc = DomainRenamer("rx")(LCRC(crc_input, Const(0), partial_widths = [8 * (4 * g + 2) for g in range(groups)]))
+		first_word = Signal()
+
+		# The END or EDB follows the LCRC, ends[g] is set if 4 * g symbols of the aligned data are in front of the LCRC.
+		# With 8 symbols per word the LCRC can be behind the aligned data, then 2 data symbols are left for the CRC in the next cycle.
+		end_groups = (2 * ratio - 7) // 4 + 1
+		ends = Signal(end_groups)
+		good_ends = Signal(end_groups)
+		lcrcs = [Signal(32, name=f"lcrc_{g}") for g in range(end_groups)]
+
+		with m.Switch(slot):
+			for k in range(groups):
+				with m.Case(k):
+					offset = 4 * k + 3
+					for i in range(ratio):
+						m.d.comb += source_symbols[i].eq(window[offset + i])
+					m.d.comb += crc_input.eq(Cat(symbol[0:8] for symbol in window[offset - 2 : offset - 2 + ratio]))
+
+					for g in range(end_groups):
+						end = offset + 4 * g + 4
+						if ratio <= end < 2 * ratio:
+							m.d.comb += ends[g].eq((window[end] == Ctrl.END) | (window[end] == Ctrl.EDB))
+							m.d.comb += good_ends[g].eq(window[end] == Ctrl.END)
+							m.d.comb += lcrcs[g].eq(Cat(symbol[0:8] for symbol in window[end - 4 : end]))
+
+		for i in range(ratio):
+			m.d.rx += buffer.tlp_sink.symbol[i].eq(Cat(source_symbols[i]))
 
-		reset_crc = Signal(reset = 1)
-		# TODO Warning: Endianness
-		crc_input = Signal(32)
-		m.submodules.lcrc = lcrc = DomainRenamer("rx")(LCRC(crc_input, reset_crc))
+		# In cut-through mode, the TLP goes to tlp_source at the same time as it would go into the buffer
+		cutting_through = Signal()
+		can_cut_through = Signal()
 
-		m.d.rx += crc_input.eq(Cat(source_symbols))
+		if self.cut_through:
+			with m.If(cutting_through):
+				for i in range(ratio):
+					m.d.comb += self.tlp_source.symbol[i].eq(buffer.tlp_sink.symbol[i])
+					m.d.comb += self.tlp_source.valid[i].eq(buffer.tlp_sink.valid[i])
 
-		for i in range(4):
-			m.d.rx += buffer.tlp_sink.symbol[i].eq(Cat(source_symbols[i]))
+			with m.Else():
+				buffer.tlp_source.connect(self.tlp_source, m.d.comb)
 		
 		end_good = Signal()
 
+		# Acks and Naks are scheduled further down, after the FSM
+		received_tlp = Signal()
+		received_duplicate = Signal()
+		received_bad_tlp = Signal()
+
 		def ack():
-			m.d.comb += self.dll.schedule_ack_nak.eq(1)
-			m.d.rx += [
-				self.dll.scheduled_ack.eq(1),
-				self.dll.scheduled_ack_nak_id.eq(self.actual_receive_seq),
-				self.ack_nak_latency_timer.eq(self.ack_nak_latency_timer.reset),
-			]
+			m.d.comb += received_tlp.eq(1)
+
+		def ack_duplicate():
+			m.d.comb += received_duplicate.eq(1)
 		
 		def nak():
-			with m.If(~self.nak_scheduled):
-				m.d.comb += self.dll.schedule_ack_nak.eq(1)
-				m.d.rx += [
-					self.dll.scheduled_ack.eq(0),
-					self.dll.scheduled_ack_nak_id.eq(self.next_receive_seq - 1),
-					self.nak_scheduled.eq(1),
-					self.ack_nak_latency_timer.eq(self.ack_nak_latency_timer.reset),
-				]
+			m.d.comb += received_bad_tlp.eq(1)
 
 		with m.If(self.ack_nak_latency_timer < self.ack_nak_latency_limit):
 			m.d.rx += self.ack_nak_latency_timer.eq(self.ack_nak_latency_timer + 1)
 
 		m.d.rx += buffer.delete_tlp.eq(0)
 
+		waiting = Signal() # There is no free space for the received TLP
+
 		m.d.comb += self.debug2.eq(lcrc.output)
 		m.d.comb += self.debug3.eq(crc_input)
 
-		with m.FSM(name = "DLL_TLP_rx_FSM", domain = "rx") as fsm:
-			m.d.comb += Cat(self.debug[0:4]).eq(fsm.state)
-			m.d.comb += Cat(self.debug_state[0:4]).eq(fsm.state)
+		# A TLP which ends in the first half of a word can be followed by one which starts in its second half. This TLP and one which starts
+		# in the word received in Tail are received from the LCRC state on, restart is set for them.
+		end_then_start = Signal()
+		restart = Signal()
 
-			with m.State("Idle"):
-				with m.If(self.dllp_sink.symbol[0] == Ctrl.STP):
-					tlp_id = Cat(source_symbols[3], source_symbols[2][0:4])
+		if groups > 1:
+			m.d.comb += end_then_start.eq(((current[3] == Ctrl.END) | (current[3] == Ctrl.EDB)) & (current[4] == Ctrl.STP))
+
+		# The first STP in a word starts a TLP
+		starts = Signal(groups)
+		start_slot = Signal(range(groups))
+		for k in range(groups):
+			m.d.comb += starts[k].eq(current[4 * k] == Ctrl.STP)
+
+		for k in reversed(range(groups)):
+			with m.If(starts[k]):
+				m.d.comb += start_slot.eq(k)
 
+		start_ids = Array(Cat(current[4 * k + 2][0:8], current[4 * k + 1][0:4]) for k in range(groups))
+		restart_ids = Array(Cat(previous[4 * k + 2][0:8], previous[4 * k + 1][0:4]) for k in range(groups))
+
+		with m.FSM(name = "DLL_TLP_rx_FSM", domain = "rx") as rx_fsm:
+			m.d.comb += Cat(self.debug[0:4]).eq(rx_fsm.state)
+			m.d.comb += Cat(self.debug_state[0:4]).eq(rx_fsm.state)
+
+			def begin(tlp_id, tlp_slot, cut_through):
+				with m.If(cut_through):
+					m.d.rx += cutting_through.eq(1)
+
+				with m.Else():
 					m.d.comb += buffer.store_tlp.eq(1)
-					m.d.rx += buffer.store_tlp_id.eq(tlp_id)
 
-					m.d.rx += reset_crc.eq(0)
-					m.d.rx += crc_input.eq(Cat(source_symbols[2], source_symbols[3]))
-					m.d.rx += self.actual_receive_seq.eq(tlp_id)
-					m.next = "Receive"
+				m.d.rx += buffer.store_tlp_id.eq(tlp_id)
+
+				m.d.rx += slot.eq(tlp_slot)
+				m.d.rx += first_word.eq(1)
+				m.d.rx += self.actual_receive_seq.eq(tlp_id)
+				m.next = "Receive"
+
+			# A TLP can start in the word after the END of the previous one, so this is also done in LCRC
+			def start():
+				with m.If(starts.any()):
+					begin(start_ids[start_slot], start_slot, can_cut_through)
 
 					m.d.comb += Cat(self.debug[4:8]).eq(0)
+
+			with m.State("Idle"):
+				start()
 				
 				#with m.If(self.dll.up  & (self.ack_nak_latency_timer == self.ack_nak_latency_limit) & ~ self.nak_scheduled)
 			
 			with m.State("Receive"):
-				with m.If((self.dllp_sink.symbol[3] == Ctrl.END) | (self.dllp_sink.symbol[3] == Ctrl.EDB)):
-					for i in range(4):
+				m.d.comb += lcrc.restart.eq(first_word)
+				m.d.rx += first_word.eq(0)
+
+				for i in range(ratio):
+					m.d.rx += buffer.tlp_sink.valid[i].eq(1)
+
+				# The data in front of the LCRC is the end of the TLP, the LCRC of the TLP is ready in the next cycle.
+				# With 8 symbols per word the last word is padded with the LCRC if it only has 4 data symbols.
+				for g in reversed(range(len(ends))):
+					with m.If(ends[g]):
+						for i in range(ratio):
+							m.d.rx += buffer.tlp_sink.valid[i].eq(i < 4 * g)
+
+						m.d.rx += end_good.eq(good_ends[g])
+						m.d.rx += last_symbols.eq(lcrcs[g])
+
+						if g < groups:
+							m.d.comb += lcrc.width.eq(g + 1)
+							m.next = "LCRC"
+
+							# The first word of the next TLP is aligned to its STP in the second half of this word
+							m.d.rx += restart.eq(end_then_start)
+							with m.If(end_then_start):
+								m.d.rx += slot.eq(1)
+
+						else:
+							m.next = "Tail"
+
+			if ratio > 4:
+				# The last 2 data symbols go into the CRC if the LCRC was behind the aligned data
+				with m.State("Tail"):
+					for i in range(ratio):
 						m.d.rx += buffer.tlp_sink.valid[i].eq(0)
 
-					m.d.rx += end_good.eq(self.dllp_sink.symbol[3] == Ctrl.END)
-
+					m.d.comb += lcrc.width.eq(1)
 					m.next = "LCRC"
 
-				with m.Else():
-					for i in range(4):
-						m.d.rx += buffer.tlp_sink.valid[i].eq(1)
-			
+					m.d.rx += restart.eq(starts.any())
+					m.d.rx += slot.eq(start_slot)
+
 			with m.State("LCRC"):
 				#ack()	
-				m.d.rx += reset_crc.eq(1)
 				m.d.comb += Cat(self.debug[4:8]).eq(7)
+				m.next = "Idle"
+
+				for i in range(ratio):
+					m.d.rx += buffer.tlp_sink.valid[i].eq(0)
+
+				m.d.rx += cutting_through.eq(0)
+				m.d.comb += self.abort.eq(cutting_through) # Cleared below if the TLP is good
 
 				with m.If((lcrc.output == last_symbols) & end_good):
-					with m.If(self.actual_receive_seq == self.next_receive_seq):
-						m.d.comb += received_tlp_fifo.w_en.eq(1)
+					# The buffer had no free slot for the TLP, it is dropped as if it hadn't been received and the link partner replays it
+					with m.If((self.actual_receive_seq == self.next_receive_seq) & ~cutting_through & ~buffer.tlp_stored):
+						m.d.comb += Cat(self.debug[4:8]).eq(8)
+
+					with m.Elif(self.actual_receive_seq == self.next_receive_seq):
+						m.d.comb += self.abort.eq(0)
+						m.d.comb += received_tlp_fifo.w_en.eq(~cutting_through)
 						m.d.comb += received_tlp_fifo.w_data.eq(self.actual_receive_seq)
 						m.d.rx += self.next_receive_seq.eq(self.next_receive_seq + 1)
 						m.d.rx += self.nak_scheduled.eq(0)
-						with m.If(~buffer.slots_full):
+						with m.If(~buffer.slots_full | cutting_through):
 							ack() # This should be fine, really, see PCIe Base 1.1 Page 157 Point 2
 							m.d.comb += Cat(self.debug[4:8]).eq(1)
 
 						with m.Else():
-							m.next = "Wait"
+							m.d.comb += waiting.eq(1)
 							m.d.comb += Cat(self.debug[4:8]).eq(2)
 
 					with m.Elif((self.next_receive_seq - self.actual_receive_seq) <= 2048): # Duplicate received
-						ack()
+						m.d.comb += buffer.discard_tlp.eq(1)
+						ack_duplicate()
 						m.d.comb += Cat(self.debug[4:8]).eq(3)
 
 					with m.Else():
-						m.d.rx += buffer.delete_tlp.eq(1)
-						m.d.rx += buffer.delete_tlp_id.eq(self.actual_receive_seq)
+						m.d.comb += buffer.discard_tlp.eq(1)
 						nak()
 						m.d.comb += Cat(self.debug[4:8]).eq(4)
 				
 				with m.Else():
+					m.d.comb += buffer.discard_tlp.eq(1)
+
 					with m.If((~lcrc.output == last_symbols) & ~end_good):
-						m.d.rx += buffer.delete_tlp.eq(1)
-						m.d.rx += buffer.delete_tlp_id.eq(self.actual_receive_seq)
 						m.d.comb += Cat(self.debug[4:8]).eq(5)
 
-					with m.Else(): # TODO: Delete TLP here too?
-						m.d.rx += buffer.delete_tlp.eq(1)
-						m.d.rx += buffer.delete_tlp_id.eq(self.actual_receive_seq)
+					with m.Else():
 						nak()
 						m.d.comb += Cat(self.debug[4:8]).eq(6)
 
-				m.next = "Idle"
-			
-			with m.State("Wait"): # It goes in this state if there is no free space, after space has been freed it is acknowledged such that the next TLP can be received.
-				with m.If(~buffer.slots_full):
-					ack()
-					m.next = "Idle"
+				if groups > 1:
+					# The next TLP started in the last word, its first word is received in this cycle already. It can't end in this word,
+					# since a TLP is at least 20 symbols long. It isn't cut through right after a TLP which was cut through,
+					# since the sink might not see a cycle without valid data between them.
+					with m.If(restart):
+						begin(restart_ids[slot], slot, can_cut_through & ~cutting_through)
+
+						m.d.comb += lcrc.restart.eq(1)
+						m.d.rx += first_word.eq(0)
+						m.d.rx += restart.eq(0)
+
+						for i in range(ratio):
+							m.d.rx += buffer.tlp_sink.valid[i].eq(1)
+
+					with m.Else():
+						start()
+
+				else:
+					start()
+
+		# If there is no free space left after a TLP, it is acknowledged once space has been freed such that the next TLP can be received.
+		# TLPs received in the meantime don't get a slot and are dropped without acknowledging them.
+		ack_deferred = Signal()
+
+		with m.If(waiting):
+			m.d.rx += ack_deferred.eq(1)
+
+		with m.Elif(ack_deferred & ~buffer.slots_full):
+			ack()
+			m.d.rx += ack_deferred.eq(0)
+
+		# Coalesce Acks, one Ack acknowledges all TLPs up to its sequence number. They are sent once per AckNak latency period,
+		# or earlier if many TLPs are unacknowledged so the retry buffer of the link partner doesn't fill up.
+		# Duplicates are acknowledged and bad TLPs are not acknowledged right away, see PCIe Base 1.1 page 157.
+		unacknowledged_tlps = Signal(range(self.ack_threshold + 1))
+		ack_due = self.ack_pending & ((self.ack_nak_latency_timer >= self.ack_nak_latency_limit) | (unacknowledged_tlps >= self.ack_threshold))
+
+		with m.If(received_bad_tlp & ~self.nak_scheduled):
+			m.d.comb += self.dll.schedule_ack_nak.eq(1)
+			m.d.rx += [
+				self.dll.scheduled_ack.eq(0),
+				self.dll.scheduled_ack_nak_id.eq(self.next_receive_seq - 1),
+				self.nak_scheduled.eq(1),
+				self.ack_nak_latency_timer.eq(self.ack_nak_latency_timer.reset),
+				self.ack_pending.eq(0),
+				unacknowledged_tlps.eq(0),
+			]
+
+		with m.Elif((received_duplicate | ack_due) & ~ack_deferred): # While waiting, next_receive_seq already includes the TLP which isn't acknowledged yet
+			m.d.comb += self.dll.schedule_ack_nak.eq(1)
+			m.d.rx += [
+				self.dll.scheduled_ack.eq(1),
+				self.dll.scheduled_ack_nak_id.eq(self.next_receive_seq - 1),
+				self.ack_nak_latency_timer.eq(self.ack_nak_latency_timer.reset),
+				self.ack_pending.eq(received_tlp),
+				unacknowledged_tlps.eq(received_tlp),
+			]
+
+		with m.Elif(received_tlp):
+			m.d.rx += self.ack_pending.eq(1)
+			m.d.rx += unacknowledged_tlps.eq(unacknowledged_tlps + 1)
+
+		with m.If(~self.dll.up):
+			m.d.rx += self.ack_pending.eq(0)
+			m.d.rx += unacknowledged_tlps.eq(0)
+
+		# Return the credits of a TLP after it has been taken out of the buffer
+		tlp_source_last_valid = Signal()
+		m.d.rx += tlp_source_last_valid.eq(self.tlp_source.all_valid)
+
+		with m.If(self.tlp_source.all_valid & ~tlp_source_last_valid):
+			m.d.rx += Cat(self.released_header).eq(Cat(self.tlp_source.symbol))
+
+		m.d.comb += credits.release.eq(~self.tlp_source.all_valid & tlp_source_last_valid & ~self.abort)
 
 		with m.FSM(name = "DLL_TLP_to_TLP_rx_FSM", domain = "rx") as fsm:
 			m.d.comb += Cat(self.debug_state[4:8]).eq(fsm.state)
 
-			with m.State("Wait"):
-				with m.If(~self.buffer.slots_empty):
-					tx_id = 0
-					for i in range(len(self.buffer.slots)):
-						tx_id = Mux(self.buffer.slots[i][0], self.buffer.slots[i][1], tx_id)
-					
-					m.d.rx += self.buffer.send_tlp_id.eq(tx_id)
+			with m.State("Wait"): # TLPs are taken out of the buffer in the order they were received
+				with m.If(received_tlp_fifo.r_rdy):
+					m.d.comb += received_tlp_fifo.r_en.eq(1)
+					m.d.rx += self.buffer.send_tlp_id.eq(received_tlp_fifo.r_data)
 					m.d.comb += self.buffer.send_tlp.eq(1)
 					m.next = "Send"
 			
@@ -527,4 +916,7 @@ class PCIeDLLTLPReceiver(Elaboratable):
 			with m.State("Wait-Delete"):
 				m.next = "Wait"
 
+		if self.cut_through: # Only if no TLPs are waiting in the buffer, so they stay in order
+			m.d.comb += can_cut_through.eq(fsm.ongoing("Wait") & ~received_tlp_fifo.r_rdy & buffer.slots_empty & ~buffer.storing_tlp & ~buffer.tlp_source.all_valid & self.tlp_source.ready)
+
 		return m
\ No newline at end of file
@@ -28,9 +28,19 @@ class DLLPType(IntEnum):
 	def _missing_(cls, value):
 		return cls.Unknown
 
+# Power management DLLPs are sent with these in type_meta, page 138 in PCIe 1.1
+class PMType(IntEnum):
+	Enter_L1                = 0,
+	Enter_L23               = 1,
+	Active_State_Request_L1 = 3,
+	Request_Ack             = 4,
+
 class PCIeDLLPTransmitter(Elaboratable):
 	"""
-	PCIe Data Link Layer Packet transmitter for x4 width
+	PCIe Data Link Layer Packet transmitter for 4 or 8 symbols per word
+
+	With 4 symbols per word a DLLP is sent in two halves, with 8 symbols in one word.
+	TLPs start in the first symbol of a group of 4 symbols and end in the last one.
 
 	Parameters
 	----------
@@ -38,6 +48,14 @@ class PCIeDLLPTransmitter(Elaboratable):
 		Symbols to TX Phy
 	send : Signal()
 		True when sending DLLPs
+	skp_request : Signal()
+		Asserted by the physical layer when it wants to send SKP ordered sets
+	skp_slot : Signal()
+		Set together with phy_source when the word is left free for a SKP ordered set
+	block_tlps : Signal()
+		No new TLP is started while asserted, for example during the handshake before going to L1. DLLPs are still sent.
+	busy : Signal()
+		Whether a packet is being sent or a DLLP is waiting to be sent
 	"""
 	def __init__(self, ratio = 4):
 		self.dllp = Record(dllp_layout)
@@ -45,9 +63,12 @@ class PCIeDLLPTransmitter(Elaboratable):
 		self.dllp_sink = StreamInterface(9, ratio, name="DLLP_Sink")
 		self.send = Signal()
 		self.started_sending = Signal()
-		assert len(self.phy_source.symbol) == 4
-		assert len(self.dllp_sink.symbol) == 4
-		self.ratio = len(self.phy_source.symbol)
+		self.skp_request = Signal()
+		self.skp_slot = Signal()
+		self.block_tlps = Signal()
+		self.busy = Signal()
+		assert ratio in [4, 8]
+		self.ratio = ratio
 
 		self.dllp_data = Signal(4 * 8)
 
@@ -59,6 +80,7 @@ class PCIeDLLPTransmitter(Elaboratable):
 		m = Module()
 
 		dllp = self.dllp
+		ratio = self.ratio
 
 		# The first 4 bytes
 		dllp_data = self.dllp_data# = Signal(4 * 8)
@@ -74,54 +96,175 @@ class PCIeDLLPTransmitter(Elaboratable):
 		m.submodules.crc = crc = SingleCRC(dllp_data, 0xFFFF, 0x100B, 16)
 
 		dllp_bytes = Cat(dllp_data, ~Cat(crc.output[::-1]))
+		dllp_symbols = [Ctrl.SDP] + [dllp_bytes[8 * i : 8 * i + 8] for i in range(6)] + [Ctrl.END]
 
-		# First or second half of DLLP
+		# First or second half of DLLP, with 8 symbols per word there is no second half
 		which_half = Signal()
 
-		m.d.comb += self.dllp_sink.ready.eq(0)
+		# Arbitration between DLLPs and TLPs, see section 3.5.2.1 in PCIe Base 1.1.
+		# A packet which has been started is always finished and a DLLP which is to be sent is sent before the next TLP, so Acks and UpdateFCs
+		# wait at most for one TLP. TLPs can't be starved since the Data Link Layer only sends a few DLLPs at a time.
+		# dllp_sink.ready holds back the start of the next TLP while a DLLP is waiting. A TLP which was started before arrives 2 cycles later,
+		# so the DLLP is only sent once ready has been 0 for 2 cycles and no TLP is being sent.
+		# SKP ordered sets requested by the physical layer are scheduled the same way before DLLPs, see section 4.2.7 in PCIe Base 1.1.
+		# A free word is left for every one of them, so they never interrupt a packet and the physical layer doesn't need to stall.
+		# Since it only takes one word, ready is already given back with the end of the TLP before it, the next TLP then follows it without a gap.
+		# No TLP can have been started in the cycle before the end, so ready only needs to have been 0 for one cycle.
+		in_tlp = Signal()
+		hold = Signal(range(3))
+		dllp_pending = dllp.valid & self.send & ~which_half
+		tlp_end = 0
+		tlp_start = 0
+		for i in range(0, ratio, 4):
+			tlp_end |= (self.dllp_sink.symbol[i + 3] == Ctrl.END) | (self.dllp_sink.symbol[i + 3] == Ctrl.EDB)
+			tlp_start |= self.dllp_sink.symbol[i] == Ctrl.STP
+
+		tlp_end &= self.dllp_sink.all_valid
+		skp_release = self.skp_request & in_tlp & tlp_end & (hold >= 1)
+		skp_released = Signal()
+
+		with m.If(self.dllp_sink.all_valid):
+			with m.If(tlp_end):
+				m.d.rx += in_tlp.eq(0)
+
+			with m.Elif(tlp_start):
+				m.d.rx += in_tlp.eq(1)
+
+		m.d.comb += self.dllp_sink.ready.eq(self.phy_source.ready & ~dllp_pending & (~self.skp_request | skp_release) & ~self.block_tlps)
+		m.d.comb += self.busy.eq(dllp_pending | which_half | in_tlp | self.dllp_sink.all_valid | Cat(self.phy_source.valid).any())
+
+		with m.If(self.dllp_sink.ready):
+			m.d.rx += hold.eq(0)
+
+		with m.Elif(hold < 2):
+			m.d.rx += hold.eq(hold + 1)
 
 		with m.If(self.phy_source.ready):
-			m.d.comb += self.dllp_sink.ready.eq(1)
-			with m.If(self.dllp_sink.all_valid):
-				for i in range(self.ratio):
+			m.d.rx += self.skp_slot.eq(0)
+			m.d.rx += skp_released.eq(skp_release)
+
+			# The second half of a DLLP is sent before everything else, no TLP can start before it
+			with m.If(which_half):
+				m.d.comb += self.dllp_sink.ready.eq(~self.skp_request & ~self.block_tlps)
+				m.d.rx += which_half.eq(0)
+				for i in range(ratio, len(dllp_symbols)):
+					m.d.rx += self.phy_source.symbol[i - ratio].eq(dllp_symbols[i])
+
+				for i in range(ratio):
+					m.d.rx += self.phy_source.valid[i].eq(1)
+
+			with m.Elif(in_tlp | self.dllp_sink.all_valid):
+				for i in range(ratio):
 					m.d.rx += self.phy_source.symbol[i].eq(self.dllp_sink.symbol[i])
 					m.d.rx += self.phy_source.valid[i].eq(self.dllp_sink.valid[i]) # TODO: Fix this
 
-			with m.Elif(dllp.valid & (self.send | which_half)):
-				#m.d.comb += self.dllp_sink.ready.eq(0)
-				for i in range(4):
+			with m.Elif(self.skp_request & ((hold == 2) | skp_released)):
+				m.d.rx += self.skp_slot.eq(1)
+				for i in range(ratio):
+					m.d.rx += self.phy_source.valid[i].eq(0)
+
+			# A TLP which starts in the next cycle comes after the DLLP
+			with m.Elif(dllp_pending & (hold == 2)):
+				m.d.comb += self.dllp_sink.ready.eq(~self.block_tlps)
+				m.d.comb += self.started_sending.eq(1)
+				m.d.rx += which_half.eq(ratio < len(dllp_symbols))
+				for i in range(ratio):
+					m.d.rx += self.phy_source.symbol[i].eq(dllp_symbols[i])
+				for i in range(ratio):
 					m.d.rx += self.phy_source.valid[i].eq(1)
 
-				with m.If(~which_half):
-					m.d.rx += which_half.eq(1)
-					m.d.rx += self.phy_source.symbol[0].eq(Ctrl.SDP)
-					m.d.comb += self.started_sending.eq(1)
+			with m.Else():
+				for i in range(ratio):
+					m.d.rx += self.phy_source.valid[i].eq(0)
 
-					for i in range(self.ratio - 1):
-						m.d.rx += self.phy_source.symbol[i + 1].eq(dllp_bytes[8 * i : 8 * i + 8])
+		return m
 
-				with m.Else():
-					m.d.rx += which_half.eq(0)
-					m.d.comb += self.started_sending.eq(0)
-					for i in range(self.ratio - 1):
-						m.d.rx += self.phy_source.symbol[i].eq(dllp_bytes[8 * i + (self.ratio - 1) * 8 : 8 * i + 8 + (self.ratio - 1) * 8])
+class PCIeFramingAligner(Elaboratable):
+	"""
+	Moves packets received at any symbol offset to symbol 0, see section 4.2.2.1 in PCIe Base 1.1.
+	A transmitter may start a packet in any symbol of a word and pack packets back to back, for example a DLLP right after a TLP.
+	The positions of the STP and SDP symbols in a word are decoded and the word is shifted so the first one is in symbol 0.
+	The shift is kept until the next start symbol, the END or EDB of the packet then is in symbol 3 since the framed length of a packet is a multiple of 4.
+	A packet which follows another one without idle data starts at the same offset, so the shift only changes between packets.
+	Two packets which share a word are sent one after another in consecutive words, so the following layers only have to handle one packet per word.
+	The output is one word behind the input. Like in the receivers, valid isn't used, the physical layer replaces SKP ordered sets with 0 like idle data.
 
-					m.d.rx += self.phy_source.symbol[3].eq(Ctrl.END)
+	With 8 symbols per word, every group of 4 symbols is shifted on its own by less than 4 symbols, so packets start in symbol 0 or 4
+	and the following layers handle up to two packets per word. Otherwise back to back packets could need more than a word per word.
 
-			with m.Else():
-				m.d.rx += which_half.eq(0)
-				m.d.comb += self.started_sending.eq(0)
-				for i in range(4):
-					m.d.rx += self.phy_source.valid[i].eq(0)
+	Parameters
+	----------
+	ratio : int
+		Gearbox ratio
+
+	Attributes
+	----------
+	sink : StreamInterface
+		Symbols from the physical layer
+	source : StreamInterface
+		Aligned symbols
+	offset : Signal(range(4))
+		Symbol offset of the current packet in the input, within a group of 4 symbols
+	"""
+	def __init__(self, ratio = 4):
+		assert ratio in [4, 8]
+
+		self.sink = StreamInterface(9, ratio, name="Framing_Sink")
+		self.source = StreamInterface(9, ratio, name="Framing_Source")
+		self.offset = Signal(range(4))
+		self.ratio = ratio
+
+	def elaborate(self, platform: Platform) -> Module:
+		m = Module()
+
+		ratio = self.ratio
+
+		current = self.sink.symbol
+		previous = [Signal(9, name=f"previous_{i}") for i in range(ratio)]
+		m.d.rx += Cat(previous).eq(Cat(current))
+
+		# Control symbols can't be confused with data, so a start symbol inside of a packet is a framing error and the receiver resyncs to it
+		starts = Signal(ratio)
+		for i in range(ratio):
+			m.d.comb += starts[i].eq((previous[i] == Ctrl.STP) | (previous[i] == Ctrl.SDP))
+
+		window = previous + current
+
+		# A group keeps the offset of the group before it, unless a packet starts in it
+		offset = self.offset
+		for group in range(0, ratio, 4):
+			group_offset = Signal(range(4), name=f"offset_{group // 4}")
+			m.d.comb += group_offset.eq(offset)
+
+			# The first start symbol sets the offset
+			for i in reversed(range(4)):
+				with m.If(starts[group + i]):
+					m.d.comb += group_offset.eq(i)
+
+			with m.Switch(group_offset):
+				for k in range(4):
+					with m.Case(k):
+						for i in range(4):
+							m.d.comb += self.source.symbol[group + i].eq(window[group + k + i])
+
+			offset = group_offset
+
+		m.d.rx += self.offset.eq(offset)
+
+		for i in range(ratio):
+			m.d.comb += self.source.valid[i].eq(1)
+
+		m.d.comb += self.sink.ready.eq(1)
 
 		return m
 
 class PCIeDLLPReceiver(Elaboratable):
 	"""
-	PCIe Data Link Layer Packet receiver
+	PCIe Data Link Layer Packet receiver, received symbols are aligned by a PCIeFramingAligner first.
+	A DLLP takes two groups of 4 symbols, with 8 symbols per word it is either in one word or in the second half of a word and the first half of the next one.
 	"""
 	def __init__(self, ratio = 4):
-		assert ratio == 4
+		assert ratio in [4, 8]
 
 		self.dllp = Record(dllp_layout)
 		self.phy_sink = StreamInterface(9, ratio, name="PHY_Sink")
@@ -145,18 +288,26 @@ class PCIeDLLPReceiver(Elaboratable):
 
 		m.submodules.crc = crc = SingleCRC(dllp_bytes[:4 * 8], 0xFFFF, 0x100B, 16)
 
-		with m.If(self.phy_sink.symbol[0] == Ctrl.SDP):
-			for i in range(self.ratio - 1):
-				m.d.rx += Cat(dllp_bytes[8 * i : 8 * i + 8]).eq(self.phy_sink.symbol[i + 1])
-			#m.d.rx += valid.eq(0)
+		m.submodules.aligner = aligner = PCIeFramingAligner(self.ratio)
+		self.phy_sink.connect(aligner.sink, m.d.comb)
+		phy_sink = aligner.source
 
-		with m.Elif(self.phy_sink.symbol[3] == Ctrl.END):
-			for i in range(self.ratio - 1):
-				m.d.rx += Cat(dllp_bytes[8 * i + (self.ratio - 1) * 8: 8 * i + 8 + (self.ratio - 1) * 8]).eq(self.phy_sink.symbol[i])
-			m.d.rx += received.eq(1)
+		# The last group of the previous word and the groups of this word, a DLLP has been received when a group starts with SDP and the next one ends with END
+		previous = [Signal(9, name=f"previous_{i}") for i in range(4)]
+		m.d.rx += Cat(previous).eq(Cat(phy_sink.symbol[-4:]))
+		groups = [previous] + [phy_sink.symbol[i : i + 4] for i in range(0, self.ratio, 4)]
+
+		for first, second in zip(groups, groups[1:]):
+			with m.If((first[0] == Ctrl.SDP) & (second[3] == Ctrl.END)):
+				for i, symbol in enumerate(first[1:] + second[:3]):
+					m.d.rx += dllp_bytes[8 * i : 8 * i + 8].eq(symbol)
+				m.d.rx += received.eq(1)
 		
 		m.d.comb += valid.eq(~Cat(crc.output[::-1]) == dllp_bytes[8 * 4:])
 
+		# Valid for one cycle per received DLLP, so Acks and Naks are only processed once
+		m.d.rx += dllp.valid.eq(0)
+
 		with m.If(valid & received):
 			m.d.rx += dllp.valid.eq(1)
 			m.d.rx += dllp.type.eq(dllp_bytes[4:8])
@@ -166,8 +317,8 @@ class PCIeDLLPReceiver(Elaboratable):
 			m.d.rx += received.eq(0)
 		
 
-		for i in range(4):
-			m.d.rx += self.dllp_source.symbol[i].eq(self.phy_sink.symbol[i])
+		for i in range(self.ratio):
+			m.d.rx += self.dllp_source.symbol[i].eq(phy_sink.symbol[i])
 			m.d.rx += self.dllp_source.valid[i].eq(1) # Maybe toggle this with STP / END, EDB
 
 		return m
\ No newline at end of file
@@ -0,0 +1,615 @@
+from amaranth import *
+from amaranth.build import *
+
+from .stream import StreamInterface
+from .tlp import TLPType
+from .memory import _encode_one_hot
+
+
+__all__ = ["PCIeTagTracker", "PCIeDMA"]
+
+
+class PCIeTagTracker(Elaboratable):
+	"""
+	Tracks outstanding non-posted requests by their tag and places the data of their completions, see sections 2.2.9 and 2.3.2 in PCIe Base 1.1
+
+	Every tag remembers the local address the data of its request goes to and how many bytes were requested.
+	The Byte Count field of a completion is the number of bytes which remain including its own, so the offset of its data in the request follows from it
+	and completions are reassembled in place, no matter in which order they arrive. The completion whose data reaches the end of the request frees the tag.
+
+	Every tag also reserves the number of completions its request can cause at most, they are counted in completions until the tag is freed.
+
+	A tag also times out if its request isn't completed within timeout cycles. For this every tag stores a coarse timestamp,
+	which counts up every timeout / 8 cycles, and one tag is checked per cycle, so a request times out after 7 / 8 to 8 / 8 of timeout.
+
+	Parameters
+	----------
+	tags : int
+		Number of tags, a power of 2 and at most 256. More than 32 are only used while extended_tag_enable is 1
+
+	depth : int
+		Depth of the local memory the data is placed in
+
+	timeout : int
+		Completion timeout in cycles, at least 8 times tags
+
+	Attributes
+	----------
+	extended_tag_enable : Signal()
+		Extended Tag Field Enable bit of the Device Control register
+	timeout_disable : Signal()
+		Completion Timeout Disable bit of the Device Control 2 register
+	available : Signal()
+		Whether a tag can be allocated
+	tag : Signal(8)
+		Tag which is allocated next
+	allocate : Signal()
+		Set to 1 for 1 cycle while available is 1 to allocate tag
+	allocate_address : Signal(range(depth))
+		Local DW address of the data of the request
+	allocate_bytes : Signal(13)
+		Number of bytes requested, up to 4096
+	allocate_completions : Signal(7)
+		Number of completions the request can cause at most
+	completions : Signal(range(65 * tags + 1))
+		Number of completions reserved by the outstanding requests, it lags a cycle behind allocate
+	idle : Signal()
+		Whether no request is outstanding
+	lookup : Signal()
+		Set to 1 for 1 cycle to look up the tag of a completion
+	lookup_tag : Signal(8)
+		Tag of the completion
+	lookup_byte_count : Signal(12)
+		Byte Count field of the completion, has to be held until complete
+	expected : Signal()
+		Whether the looked up tag is outstanding, valid from the cycle after lookup
+	offset : Signal(10)
+		DW offset of the data of the completion in its request, valid from the cycle after lookup
+	address : Signal(range(depth))
+		Local DW address of the data of the completion, valid from the cycle after lookup
+	complete : Signal()
+		Set to 1 for 1 cycle when the completion has been received
+	complete_last : Signal()
+		Set together with complete if the completion ends the request, the tag is freed
+	timed_out : Signal()
+		Is 1 for 1 cycle when a request has timed out, its tag is freed
+	"""
+	def __init__(self, tags: int = 32, depth: int = 1024, timeout: int = 2 ** 20):
+		assert tags & (tags - 1) == 0 and 1 <= tags <= 256
+		assert timeout >= 8 * tags
+
+		self.tags = tags
+		self.depth = depth
+		self.timeout = timeout
+
+		self.extended_tag_enable = Signal()
+		self.timeout_disable = Signal()
+
+		self.available = Signal()
+		self.tag = Signal(8)
+		self.allocate = Signal()
+		self.allocate_address = Signal(range(depth))
+		self.allocate_bytes = Signal(13)
+		self.allocate_completions = Signal(7)
+		self.completions = Signal(range(65 * tags + 1))
+		self.idle = Signal()
+
+		self.lookup = Signal()
+		self.lookup_tag = Signal(8)
+		self.lookup_byte_count = Signal(12)
+		self.expected = Signal()
+		self.offset = Signal(10)
+		self.address = Signal(range(depth))
+		self.complete = Signal()
+		self.complete_last = Signal()
+
+		self.timed_out = Signal()
+
+	def elaborate(self, platform: Platform) -> Module:
+		m = Module()
+
+		tags = self.tags
+		tag_bits = max(1, (tags - 1).bit_length())
+
+		outstanding = Signal(tags)
+		m.d.comb += self.idle.eq(~outstanding.any())
+
+		# Tags above 31 need the Extended Tag Field, see section 2.2.6.2 in PCIe Base 1.1
+		usable = Mux(self.extended_tag_enable, 2 ** tags - 1, 2 ** min(tags, 32) - 1)
+		free = Signal(tags)
+		m.d.comb += free.eq(~outstanding & usable)
+
+		# The next tag is registered, so it is stale in the cycle after an allocation
+		m.d.rx += self.tag.eq(_encode_one_hot(free & (~free + 1), tag_bits))
+		m.d.rx += self.available.eq(free.any() & ~self.allocate)
+
+		# Local address and number of bytes of every tag
+		entries = Memory(width = len(self.allocate_address) + 13, depth = tags, name = "Tag_Entries")
+		m.submodules.entry_write = entry_write = entries.write_port(domain = "rx")
+		m.submodules.entry_read = entry_read = entries.read_port(domain = "rx", transparent = False)
+
+		m.d.comb += [
+			entry_write.addr.eq(self.tag),
+			entry_write.data.eq(Cat(self.allocate_address, self.allocate_bytes)),
+			entry_write.en.eq(self.allocate),
+		]
+
+		entry_address = entry_read.data[:len(self.allocate_address)]
+		entry_bytes = entry_read.data[len(self.allocate_address):]
+
+		completion_tag = Signal(tag_bits)
+		byte_count = Mux(self.lookup_byte_count == 0, 4096, self.lookup_byte_count)
+
+		m.d.comb += [
+			entry_read.addr.eq(self.lookup_tag),
+			entry_read.en.eq(self.lookup),
+			self.offset.eq((entry_bytes - byte_count)[2:]),
+			self.address.eq(entry_address + self.offset),
+		]
+
+		with m.If(self.lookup):
+			m.d.rx += completion_tag.eq(self.lookup_tag)
+			m.d.rx += self.expected.eq((outstanding.bit_select(self.lookup_tag[:tag_bits], 1)) & (self.lookup_tag < tags))
+
+		# Completion timeout, see section 2.8 in PCIe Base 1.1
+		epoch = Signal(4)
+		epoch_timer = Signal(range(self.timeout // 8))
+
+		m.d.rx += epoch_timer.eq(epoch_timer + 1)
+		with m.If(epoch_timer == self.timeout // 8 - 1):
+			m.d.rx += epoch_timer.eq(0)
+			m.d.rx += epoch.eq(epoch + 1)
+
+		timestamps = Memory(width = len(epoch), depth = tags, name = "Tag_Timestamps")
+		m.submodules.timestamp_write = timestamp_write = timestamps.write_port(domain = "rx")
+		m.submodules.timestamp_read = timestamp_read = timestamps.read_port(domain = "rx", transparent = False)
+
+		scan_tag = Signal(tag_bits)
+		scanned_tag = Signal(tag_bits)
+		allocated_tag = Signal(tag_bits) # The timestamp read in the cycle of an allocation is the old one
+		allocated = Signal()
+
+		m.d.rx += [
+			scan_tag.eq(scan_tag + 1),
+			scanned_tag.eq(scan_tag),
+			allocated_tag.eq(self.tag),
+			allocated.eq(self.allocate),
+		]
+
+		m.d.comb += [
+			timestamp_write.addr.eq(self.tag),
+			timestamp_write.data.eq(epoch),
+			timestamp_write.en.eq(self.allocate),
+			timestamp_read.addr.eq(scan_tag),
+			timestamp_read.en.eq(1),
+		]
+
+		expired = (epoch - timestamp_read.data)[3]
+		m.d.comb += self.timed_out.eq(outstanding.bit_select(scanned_tag, 1) & expired & ~(allocated & (allocated_tag == scanned_tag)) & ~self.timeout_disable)
+
+		# The completion which frees a tag needs it to be still outstanding, it might have timed out since its lookup
+		completed = self.complete & self.complete_last & self.expected & outstanding.bit_select(completion_tag, 1)
+
+		allocating = Mux(self.allocate, Const(1, tags) << self.tag[:tag_bits], 0)
+		freeing = Mux(completed, Const(1, tags) << completion_tag, 0) | Mux(self.timed_out, Const(1, tags) << scanned_tag, 0)
+		m.d.rx += outstanding.eq((outstanding | allocating) & ~freeing)
+
+		# Reserved completions of every tag, read like the entries for the completion and like the timestamps for the timeout
+		reservations = Memory(width = len(self.allocate_completions), depth = tags, name = "Tag_Completions")
+		m.submodules.reservation_write = reservation_write = reservations.write_port(domain = "rx")
+		m.submodules.reservation_read = reservation_read = reservations.read_port(domain = "rx", transparent = False)
+		m.submodules.reservation_scan = reservation_scan = reservations.read_port(domain = "rx", transparent = False)
+
+		m.d.comb += [
+			reservation_write.addr.eq(self.tag),
+			reservation_write.data.eq(self.allocate_completions),
+			reservation_write.en.eq(self.allocate),
+			reservation_read.addr.eq(self.lookup_tag),
+			reservation_read.en.eq(self.lookup),
+			reservation_scan.addr.eq(scan_tag),
+			reservation_scan.en.eq(1),
+		]
+
+		released = Mux(completed, reservation_read.data, 0) + Mux(self.timed_out & ~(completed & (completion_tag == scanned_tag)), reservation_scan.data, 0)
+		m.d.rx += self.completions.eq(self.completions + Mux(self.allocate, self.allocate_completions, 0) - released)
+
+		return m
+
+
+class PCIeDMA(Elaboratable):
+	"""
+	Bus master DMA engine, moves data between host memory and a local memory as described by a ring of descriptors in host memory
+
+	Descriptors are 4 DW long and 16 byte aligned, every DW is little endian:
+
+	- DW 0 and 1: Host byte address, DW aligned
+	- DW 2: Bits 0 to 23 are the length in bytes, a multiple of 4. Bit 31 is the direction, 1 for host to card and 0 for card to host.
+	  Bit 30 is set when the descriptor is done and bit 29 when an error occured, they are written back to the descriptor
+	- DW 3: Local byte address, DW aligned
+
+	The host writes descriptors to the ring and advances tail, the engine processes them in order and advances head after
+	writing back DW 2 of each descriptor. Card to host transfers are split into Memory Write Requests of up to Max_Payload_Size bytes,
+	host to card transfers into Memory Read Requests of up to Max_Read_Request_Size bytes, neither crosses a 4 KB boundary,
+	see section 2.2.7 in PCIe Base 1.1. Memory Read Requests are issued as long as there are free tags, see PCIeTagTracker,
+	and the descriptor is written back once all of them are completed.
+
+	Completions are advertised with infinite credits, so the receive buffer needs to have space for the completions of all outstanding requests.
+	A completer may split a completion at every Read Completion Boundary, which is at least 64 bytes, see section 2.3.1.1 in PCIe Base 1.1.
+	A Memory Read Request is only issued if the completions it can cause at most fit into the receive buffer slots which are left for completions,
+	together with those of the outstanding requests. They stay reserved until the last completion of the request has been taken, every completion
+	fits into a slot since it isn't larger than Max_Payload_Size. Memory Read Requests are at most completion_tlps - 1 times 64 bytes long.
+
+	Parameters
+	----------
+	memory : Memory
+		32 bit wide local memory. If it is None, a memory of size bytes is used
+
+	size : int
+		Size of the local memory in bytes if memory is None, a power of 2
+
+	tags : int
+		Number of tags for outstanding Memory Read Requests, see PCIeTagTracker
+
+	completion_timeout : int
+		Completion timeout in cycles, see PCIeTagTracker
+
+	completion_tlps : int
+		Number of receive buffer slots which are left for completions, at least 2. Must match PCIeDLLTLPReceiver completion_tlps
+
+	ratio : int
+		Gearbox ratio
+
+	Attributes
+	----------
+	tlp_source : StreamInterface
+		Requests, the first word is held until ready is 1
+	tlp_sink : StreamInterface
+		Completions to the requests of the engine, they are always accepted
+	abort : Signal()
+		Is 1 after the last word of a completion on tlp_sink which has to be dropped
+	requester_id : Signal(16)
+		Bus, device and function number of this device
+	bus_master_enable : Signal()
+		Bus Master Enable bit of the Command register, no new descriptors are started while it is 0
+	max_payload_size : Signal(3)
+		Max_Payload_Size field of the Device Control register
+	max_read_request_size : Signal(3)
+		Max_Read_Request_Size field of the Device Control register
+	extended_tag_enable : Signal()
+		Extended Tag Field Enable bit of the Device Control register
+	completion_timeout_disable : Signal()
+		Completion Timeout Disable bit of the Device Control 2 register
+	ring_address : Signal(64)
+		Host byte address of the descriptor ring, 16 byte aligned
+	ring_size : Signal(16)
+		Number of descriptors in the ring
+	tail : Signal(16)
+		Index of the descriptor after the last one which is ready to be processed
+	enable : Signal()
+		Whether descriptors are processed
+	head : Signal(16)
+		Index of the next descriptor to be processed
+	done : Signal()
+		Is 1 for 1 cycle after a descriptor has been written back
+	error : Signal()
+		Is 1 together with done if a completion of the descriptor had an unsuccessful status or timed out
+	"""
+	def __init__(self, memory: Memory = None, size: int = 4096, tags: int = 32, completion_timeout: int = 2 ** 20, completion_tlps: int = 4, ratio: int = 4):
+		assert ratio == 4
+		assert completion_tlps >= 2
+
+		if memory is None:
+			assert size & (size - 1) == 0 and size >= 4
+			memory = Memory(width = 32, depth = size // 4, name = "DMA_Memory")
+
+		assert memory.width == 32
+		assert memory.depth & (memory.depth - 1) == 0
+
+		self.memory = memory
+		self.tags = tags
+		self.completion_timeout = completion_timeout
+		self.completion_tlps = completion_tlps
+		self.ratio = ratio
+
+		self.tlp_source = StreamInterface(8, ratio, name="DMA_Rq_Source")
+		self.tlp_sink = StreamInterface(8, ratio, name="DMA_Cpl_Sink")
+		self.abort = Signal()
+
+		self.requester_id = Signal(16)
+		self.bus_master_enable = Signal()
+		self.max_payload_size = Signal(3)
+		self.max_read_request_size = Signal(3)
+		self.extended_tag_enable = Signal()
+		self.completion_timeout_disable = Signal()
+
+		self.ring_address = Signal(64)
+		self.ring_size = Signal(16)
+		self.tail = Signal(16)
+		self.enable = Signal()
+		self.head = Signal(16)
+		self.done = Signal()
+		self.error = Signal()
+
+	def elaborate(self, platform: Platform) -> Module:
+		m = Module()
+
+		ratio = self.ratio
+
+		m.submodules.read_port = read_port = self.memory.read_port(domain = "rx", transparent = False)
+		m.submodules.write_port = write_port = self.memory.write_port(domain = "rx")
+
+		m.submodules.tracker = tracker = PCIeTagTracker(self.tags, self.memory.depth, self.completion_timeout)
+		m.d.comb += tracker.extended_tag_enable.eq(self.extended_tag_enable)
+		m.d.comb += tracker.timeout_disable.eq(self.completion_timeout_disable)
+
+		descriptor = [Signal(32, name = f"descriptor_{i}") for i in range(4)]
+		host_address = Signal(64)
+		local_address = Signal(range(self.memory.depth)) # DW address
+		remaining = Signal(22) # Remaining DW
+		to_card = Signal()
+		error = Signal()
+
+		m.d.rx += self.done.eq(0)
+		m.d.rx += self.error.eq(0)
+
+		# Request which is sent next
+		tlp_write = Signal()
+		tlp_address = Signal(64)
+		tlp_length = Signal(11) # In DW, 1 to 1024
+		tlp_tag = Signal(8)
+		send = Signal() # Starts sending the request
+		sent = Signal() # Is 1 while the last word of the request is accepted
+		sending_status = Signal() # The data of a write is the status of the descriptor instead of the local memory
+
+		status = Cat(descriptor[2][0:29], error, Const(1, 1), descriptor[2][31])
+
+		# Requests, see section 2.2.7 in PCIe Base 1.1
+		four_dw = tlp_address[32:64].any()
+
+		header = [
+			Mux(tlp_write, Mux(four_dw, TLPType.MWr64, TLPType.MWr32), Mux(four_dw, TLPType.MRd64, TLPType.MRd32)), 0, Cat(tlp_length[8:10], Const(0, 6)), tlp_length[0:8],
+			self.requester_id[8:16], self.requester_id[0:8], tlp_tag, Cat(Const(0b1111, 4), Mux(tlp_length == 1, 0, 0b1111)),
+			Mux(four_dw, tlp_address[56:64], tlp_address[24:32]), Mux(four_dw, tlp_address[48:56], tlp_address[16:24]), Mux(four_dw, tlp_address[40:48], tlp_address[8:16]), Mux(four_dw, tlp_address[32:40], Cat(Const(0, 2), tlp_address[2:8])),
+			tlp_address[24:32], tlp_address[16:24], tlp_address[8:16], Cat(Const(0, 2), tlp_address[2:8]),
+		]
+		header_words = len(header) // ratio
+		header_index = Signal(range(header_words))
+
+		data_address = Signal(range(self.memory.depth))
+		data_remaining = Signal(11)
+
+		m.d.comb += read_port.addr.eq(data_address)
+		m.d.comb += read_port.en.eq(1)
+
+		with m.FSM(name = "DMA_TX_FSM", domain = "rx"):
+			with m.State("Idle"):
+				with m.If(send):
+					m.d.rx += header_index.eq(0)
+					m.d.rx += data_address.eq(local_address)
+					m.d.rx += data_remaining.eq(tlp_length)
+					m.next = "Header"
+
+			with m.State("Header"):
+				for i in range(ratio):
+					m.d.comb += self.tlp_source.valid[i].eq(1)
+
+				with m.Switch(header_index):
+					for word in range(header_words):
+						with m.Case(word):
+							for i in range(ratio):
+								m.d.comb += self.tlp_source.symbol[i].eq(header[word * ratio + i])
+
+				with m.If(self.tlp_source.ready):
+					m.d.rx += header_index.eq(header_index + 1)
+
+					with m.If(header_index == Mux(four_dw, 3, 2)):
+						with m.If(tlp_write):
+							m.next = "Data"
+
+						with m.Else():
+							m.d.comb += sent.eq(1)
+							m.next = "Idle"
+
+			with m.State("Data"):
+				for i in range(ratio):
+					m.d.comb += self.tlp_source.valid[i].eq(1)
+					m.d.comb += self.tlp_source.symbol[i].eq(Mux(sending_status, status, read_port.data).word_select(i, 8))
+
+				# The next word is read while this one is accepted, the read port holds the current one otherwise
+				with m.If(self.tlp_source.ready):
+					m.d.comb += read_port.addr.eq(data_address + 1)
+					m.d.rx += data_address.eq(data_address + 1)
+					m.d.rx += data_remaining.eq(data_remaining - 1)
+
+					with m.If(data_remaining == 1):
+						m.d.comb += sent.eq(1)
+						m.next = "Idle"
+
+		# Completions, see section 2.2.9 in PCIe Base 1.1
+		completion_words = Signal(11) # DW of the completion which were received
+		completion_status = Signal(3)
+		fetching = Signal() # The completion data is a descriptor
+
+		with m.FSM(name = "DMA_Cpl_FSM", domain = "rx"):
+			with m.State("Idle"):
+				m.d.rx += completion_words.eq(0)
+
+				with m.If(self.tlp_sink.valid[0]):
+					m.next = "Header1"
+
+			with m.State("Header1"):
+				m.d.rx += completion_status.eq(self.tlp_sink.symbol[2][5:8])
+				m.d.rx += tracker.lookup_byte_count.eq(Cat(self.tlp_sink.symbol[3], self.tlp_sink.symbol[2][0:4]))
+
+				with m.If(self.tlp_sink.valid[0]):
+					m.next = "Header2"
+
+				with m.Else():
+					m.next = "Idle"
+
+			with m.State("Header2"):
+				m.d.comb += tracker.lookup_tag.eq(self.tlp_sink.symbol[2])
+				m.d.comb += tracker.lookup.eq(1)
+
+				with m.If(self.tlp_sink.valid[0]):
+					m.next = "Data"
+
+				with m.Else():
+					m.next = "Idle"
+
+			with m.State("Data"):
+				# Completions which aren't expected are dropped, see section 2.3.2 in PCIe Base 1.1
+				with m.If(self.tlp_sink.valid[0] & tracker.expected):
+					with m.If(fetching):
+						with m.Switch((tracker.offset + completion_words)[0:2]):
+							for i in range(4):
+								with m.Case(i):
+									m.d.rx += descriptor[i].eq(Cat(self.tlp_sink.symbol))
+
+					with m.Else():
+						m.d.comb += write_port.addr.eq(tracker.address + completion_words)
+						m.d.comb += write_port.data.eq(Cat(self.tlp_sink.symbol))
+						m.d.comb += write_port.en.eq(1)
+
+					m.d.rx += completion_words.eq(completion_words + 1)
+
+				# This is the cycle after its last word, the data of a dropped completion is overwritten by its replay
+				with m.If(~self.tlp_sink.valid[0]):
+					with m.If(~self.abort):
+						m.d.comb += tracker.complete.eq(1)
+						m.d.comb += tracker.complete_last.eq((completion_status != 0) | (Cat(Const(0, 2), completion_words) == Mux(tracker.lookup_byte_count == 0, 4096, tracker.lookup_byte_count)))
+
+						with m.If(tracker.expected & (completion_status != 0)):
+							m.d.rx += error.eq(1)
+
+					m.next = "Idle"
+
+		with m.If(tracker.timed_out):
+			m.d.rx += error.eq(1)
+
+		# The length of a request is limited by Max_Payload_Size or Max_Read_Request_Size, a 4 KB boundary and the remaining length
+		max_dw = Signal(11)
+		boundary_dw = Signal(11)
+		limited_dw = Signal(11)
+		size_code = Signal(3)
+		m.d.comb += size_code.eq(Mux(to_card, self.max_read_request_size, self.max_payload_size))
+		m.d.comb += max_dw.eq(Const(32, 11) << Mux(size_code > 5, 5, size_code)) # 128 bytes << size_code, larger codes are reserved
+		m.d.comb += boundary_dw.eq(1024 - host_address[2:12])
+		m.d.comb += limited_dw.eq(Mux(boundary_dw < max_dw, boundary_dw, max_dw))
+
+		# A read needs to fit into the slots left for completions, no matter where it starts within a Read Completion Boundary of 16 DW
+		completion_dw = 16 * (self.completion_tlps - 1)
+		with m.If(to_card & (limited_dw > completion_dw)):
+			m.d.comb += limited_dw.eq(completion_dw)
+
+		# Number of completions a read can cause at most, one per Read Completion Boundary it touches
+		request_completions = (tlp_address[2:6] + tlp_length + 15)[4:]
+		can_request = tracker.available & (tracker.completions + request_completions <= self.completion_tlps)
+
+		descriptor_address = self.ring_address + Cat(Const(0, 4), self.head)
+
+		m.d.comb += [
+			tracker.allocate_address.eq(local_address),
+			tracker.allocate_bytes.eq(Cat(Const(0, 2), tlp_length)),
+			tracker.allocate_completions.eq(request_completions),
+		]
+
+		with m.FSM(name = "DMA_FSM", domain = "rx"):
+			with m.State("Idle"):
+				with m.If(self.enable & self.bus_master_enable & (self.head != self.tail)):
+					m.d.rx += [
+						tlp_write.eq(0),
+						tlp_address.eq(descriptor_address),
+						tlp_length.eq(4),
+						fetching.eq(1),
+						error.eq(0),
+					]
+					m.next = "Fetch"
+
+			with m.State("Fetch"):
+				with m.If(can_request):
+					m.d.comb += tracker.allocate.eq(1)
+					m.d.comb += send.eq(1)
+					m.d.rx += tlp_tag.eq(tracker.tag)
+					m.next = "Descriptor"
+
+			with m.State("Descriptor"):
+				with m.If(tracker.idle):
+					m.d.rx += fetching.eq(0)
+
+					with m.If(error):
+						m.next = "Status"
+
+					with m.Else():
+						m.next = "Decode"
+
+			with m.State("Decode"):
+				m.d.rx += [
+					host_address.eq(Cat(Const(0, 2), descriptor[0][2:32], descriptor[1])),
+					remaining.eq(descriptor[2][2:24]),
+					to_card.eq(descriptor[2][31]),
+					local_address.eq(descriptor[3][2:]),
+				]
+				m.next = "Next"
+
+			with m.State("Next"):
+				m.d.rx += [
+					tlp_write.eq(~to_card),
+					tlp_address.eq(host_address),
+					tlp_length.eq(Mux(remaining < limited_dw, remaining, limited_dw)),
+				]
+
+				with m.If((remaining == 0) | error):
+					m.next = "Drain"
+
+				with m.Else():
+					m.next = "Request"
+
+			with m.State("Request"):
+				with m.If(tlp_write):
+					m.d.comb += send.eq(1)
+					m.next = "Send"
+
+				with m.Elif(can_request):
+					m.d.comb += tracker.allocate.eq(1)
+					m.d.comb += send.eq(1)
+					m.d.rx += tlp_tag.eq(tracker.tag)
+					m.next = "Send"
+
+			with m.State("Send"):
+				with m.If(sent):
+					m.d.rx += [
+						host_address.eq(host_address + Cat(Const(0, 2), tlp_length)),
+						local_address.eq(local_address + tlp_length),
+						remaining.eq(remaining - tlp_length),
+					]
+					m.next = "Next"
+
+			with m.State("Drain"):
+				with m.If(tracker.idle):
+					m.next = "Status"
+
+			with m.State("Status"):
+				m.d.rx += [
+					tlp_write.eq(1),
+					tlp_address.eq(descriptor_address + 8),
+					tlp_length.eq(1),
+					sending_status.eq(1),
+				]
+				m.next = "Write back"
+
+			with m.State("Write back"):
+				m.d.comb += send.eq(1)
+				m.next = "Write back wait"
+
+			with m.State("Write back wait"):
+				with m.If(sent):
+					m.d.rx += [
+						sending_status.eq(0),
+						self.head.eq(Mux(self.head + 1 == self.ring_size, 0, self.head + 1)),
+						self.done.eq(1),
+						self.error.eq(error),
+					]
+					m.next = "Idle"
+
+		return m
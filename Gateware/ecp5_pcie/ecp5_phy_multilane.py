@@ -0,0 +1,89 @@
+from amaranth import *
+from amaranth.build import *
+from .ecp5_serdes_geared_x4 import LatticeECP5PCIeSERDESx4
+from .serdes import PCIeSERDESAligner
+from .multilane import PCIeLaneCDC
+from .phy import PCIePhy
+from .ltssm import State
+
+class LatticeECP5PCIeMultiLanePhy(Elaboratable):
+	"""
+	A PCIe Phy for the ECP5 for a multi-lane link, one SERDES channel with 1:4 gearing per lane, see PCIePhy
+
+	The first lane provides the rx and tx clocks, the received data of the other lanes is moved into its rx domain.
+	LatticeECP5PCIeSERDESx4 instantiates a whole DCUA per channel, so each lane needs to be in a different DCU.
+	As the ECP5 has at most two DCUs, this limits the link to x2. The Data Link Layer gets 8 symbols per word then,
+	the Transaction Layer is connected through a TLPWidthAdapter and runs in tl_domain.
+
+	Parameters
+	----------
+	channels : tuple of (int, int)
+		DCU and channel of each lane, starting with lane 0
+	support_5GTps : bool
+		Whether to support 5 GT/s, which requires a 200 MHz reference clock instead of 100 MHz
+	upstream : bool
+		Whether it is an upstream port
+	cut_through, max_payload_size, dma, tl_domain
+		See PCIePhy
+	"""
+	def __init__(self, channels = ((0, 0), (1, 0)), support_5GTps = False, upstream = True, cut_through = False, max_payload_size = 512, dma = None, tl_domain = "rx"):
+		assert len(set(dcu for dcu, ch in channels)) == len(channels)
+
+		self.serdes = []
+		self.lane_cdcs = []
+		self.aligners = []
+
+		for i, (dcu, ch) in enumerate(channels):
+			domains = {"rxf": f"rxf{i}", "txf": f"txf{i}"}
+
+			if i > 0:
+				domains["rx"] = f"rx{i}"
+
+			serdes = DomainRenamer(domains)(LatticeECP5PCIeSERDESx4(speed_5GTps=support_5GTps, DCU=dcu, CH=ch, clkfreq=200e6 if support_5GTps else 100e6, fabric_clk=True))
+			lane = serdes.lane
+
+			if i > 0:
+				lane = PCIeLaneCDC(serdes.lane, f"rx{i}")
+				self.lane_cdcs.append(lane)
+
+			self.serdes.append(serdes)
+			self.aligners.append(DomainRenamer({"sync": "rx", "tx": "tx" if i == 0 else f"tx{i}"})(PCIeSERDESAligner(lane))) # Aligner for aligning COM symbols
+
+		self.phy = PCIePhy(self.aligners, upstream=upstream, support_5GTps=support_5GTps, cut_through=cut_through, max_payload_size=max_payload_size, dma=dma, tl_domain=tl_domain)
+
+		self.submodules = [
+			self.phy
+		]
+
+		self.state = []
+
+	def elaborate(self, platform: Platform) -> Module:
+		m = Module()
+
+		m.submodules.phy = self.phy
+
+		m.domains += ClockDomain("rx")
+
+		for i, (serdes, aligner) in enumerate(zip(self.serdes, self.aligners)):
+			m.submodules[f"serdes_{i}"] = serdes
+			m.submodules[f"aligner_{i}"] = aligner
+
+			if i > 0:
+				m.submodules[f"lane_cdc_{i}"] = self.lane_cdcs[i - 1]
+
+			tx_domain = "tx" if i == 0 else f"tx{i}"
+			m.domains += ClockDomain(tx_domain)
+			m.d.comb += ClockSignal(tx_domain).eq(serdes.tx_clk)
+
+			if i > 0:
+				m.domains += ClockDomain(f"rx{i}")
+				m.d.comb += ClockSignal(f"rx{i}").eq(serdes.rx_clk)
+
+		m.d.comb += ClockSignal("rx").eq(self.serdes[0].rx_clk)
+
+		last_state = Signal(8)
+		m.d.rx += last_state.eq(self.phy.ltssm.debug_state)
+		with m.If((last_state == State.L0) & (self.phy.ltssm.debug_state == State.Detect)):
+			m.d.comb += ResetSignal("rx").eq(1)
+
+		return m
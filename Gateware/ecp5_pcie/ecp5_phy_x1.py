@@ -2,19 +2,35 @@ from amaranth import *
 from amaranth.build import *
 from .ecp5_serdes_geared_x4 import LatticeECP5PCIeSERDESx4
 from .ecp5_serdes import LatticeECP5PCIeSERDES
-from .serdes import PCIeSERDESAligner, LinkSpeed, Ctrl
+from .serdes import PCIeSERDESAligner, PCIeElasticBuffer, LinkSpeed, Ctrl
 from .phy import PCIePhy
 from .ltssm import State
 
 class LatticeECP5PCIePhy(Elaboratable):
 	"""
 	A PCIe Phy for the ECP5 for PCIe x1
+
+	With 5 GT/s support the DCU needs a 200 MHz reference clock, see ispCLOCK-200MHz.cfg for the Versa board, otherwise 100 MHz.
+	It is off by default, so the reference clock only changes when support_5GTps is set.
+	With cut_through received TLPs are streamed to the TLP layer before their LCRC has been checked, see PCIeDLLTLPReceiver.
+	max_payload_size is the largest supported payload in bytes and dma is a bus master DMA engine for the Transaction Layer, see PCIePhy.
+	With elastic_buffer the received symbols go through a PCIeElasticBuffer and the rx domain runs from the transmit clock,
+	which is derived from the reference clock, instead of the recovered clock. The aligner then runs in the rx_recovered domain, on the recovered clock.
+	tx_cdc selects how transmitted symbols get into the tx domain, see PCIeSERDESAligner. "phase" can be used if the recovered clock
+	is locked to the reference clock, like with a common reference clock. With elastic_buffer both domains have the same clock and there is no CDC.
+	gearing is the number of symbols per word, 4 or 8. With 8 the clocks are half as fast and the Transaction Layer runs in tl_domain, which
+	is provided by the user if it isn't rx, see PCIePhy. The elastic buffer needs a gearing of 4.
 	"""
-	def __init__(self, support_5GTps = True):
+	def __init__(self, support_5GTps = False, cut_through = False, max_payload_size = 512, elastic_buffer = False, tx_cdc = "async", dma = None, gearing = 4, tl_domain = "rx"):
+		assert not elastic_buffer or gearing == 4
+
 		#self.__serdes = LatticeECP5PCIeSERDESx2() # Declare SERDES module with 1:2 gearing
-		self.serdes = LatticeECP5PCIeSERDESx4(speed_5GTps=support_5GTps, clkfreq=100e6, fabric_clk=True) # Declare SERDES module with 1:4 gearing
-		self.aligner = DomainRenamer("rx")(PCIeSERDESAligner(self.serdes.lane)) # Aligner for aligning COM symbols
-		self.phy = PCIePhy(self.aligner, support_5GTps=support_5GTps)
+		self.serdes = LatticeECP5PCIeSERDESx4(speed_5GTps=support_5GTps, clkfreq=200e6 if support_5GTps else 100e6, fabric_clk=True, gearing=gearing) # Declare SERDES module with 1:4 or 1:8 gearing
+		self.elastic_buffer = elastic_buffer
+		self.recovered_domain = "rx_recovered" if elastic_buffer else "rx"
+		self.aligner = DomainRenamer({"rx": self.recovered_domain})(PCIeSERDESAligner(self.serdes.lane, tx_cdc = "none" if elastic_buffer else tx_cdc)) # Aligner for aligning COM symbols
+		self.lane = PCIeElasticBuffer(self.aligner, self.recovered_domain) if elastic_buffer else self.aligner
+		self.phy = PCIePhy(self.lane, support_5GTps=support_5GTps, cut_through=cut_through, max_payload_size=max_payload_size, dma=dma, tl_domain=tl_domain)
 		#self.serdes.lane.speed = 1
 		self.submodules = [
 			self.serdes.lane,
@@ -58,22 +74,26 @@ class LatticeECP5PCIePhy(Elaboratable):
 		m.submodules.aligner = self.aligner
 		m.submodules.phy = self.phy
 
+		# The error counters are in the domain of the received symbols of the SERDES, the state is only used as a hint
 		with m.If(self.phy.ltssm.debug_state > 2):
 			with m.If(~serdes.lane.rx_locked):
-				m.d.rx += self.err_cnt_1.eq(self.err_cnt_1 + 1)
+				m.d[self.recovered_domain] += self.err_cnt_1.eq(self.err_cnt_1 + 1)
 
-			with m.If((serdes.lane.rx_symbol[0:9] == Ctrl.Error) | (serdes.lane.rx_symbol[9:18] == Ctrl.Error) | (serdes.lane.rx_symbol[18:27] == Ctrl.Error) | (serdes.lane.rx_symbol[27:36] == Ctrl.Error)):
-				m.d.rx += self.err_cnt_2.eq(self.err_cnt_2 + 1)
+			with m.If(Cat(serdes.lane.rx_symbol.word_select(i, 9) == Ctrl.Error for i in range(serdes.gearing)).any()):
+				m.d[self.recovered_domain] += self.err_cnt_2.eq(self.err_cnt_2 + 1)
 
-		m.d.comb += self.serdes.lane.speed.eq(LinkSpeed.S2_5)
-		
 		m.domains.rx = ClockDomain()
 		m.domains.tx = ClockDomain()
 		m.d.comb += [
-			ClockSignal("rx").eq(serdes.rx_clk),
+			ClockSignal("rx").eq(serdes.tx_clk if self.elastic_buffer else serdes.rx_clk),
 			ClockSignal("tx").eq(serdes.tx_clk),
 		]
 
+		if self.elastic_buffer:
+			m.submodules.elastic_buffer = self.lane
+			m.domains.rx_recovered = ClockDomain()
+			m.d.comb += ClockSignal("rx_recovered").eq(serdes.rx_clk)
+
 		last_state = Signal(8)
 		m.d.rx += last_state.eq(self.phy.ltssm.debug_state)
 		with m.If((last_state == State.L0) & (self.phy.ltssm.debug_state == State.Detect)):
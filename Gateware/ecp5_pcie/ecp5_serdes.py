@@ -13,8 +13,8 @@ __all__ = ["LatticeECP5PCIeSERDES", "ECP5SerDesConfigInterface"]
 
 class LatticeECP5PCIeSERDES(Elaboratable): # Based on Yumewatari
 	"""
-	Lattice ECP5 DCU configured in PCIe mode, currently 2.5 GT/s. Assumes 100 MHz reference clock on SERDES clock
-	input pair. Only provides a single lane.
+	Lattice ECP5 DCU configured in PCIe mode, 2.5 or 5 GT/s. Assumes 100 MHz reference clock on SERDES clock
+	input pair, or 200 MHz when 5 GT/s is supported. Only provides a single lane.
 	Uses 1:1 or 1:2 gearing.
 
 	Clock frequencies are 250 MHz for 1:1 and 125 MHz for 1:2.
@@ -46,6 +46,7 @@ class LatticeECP5PCIeSERDES(Elaboratable): # Based on Yumewatari
 		Clock for the transmit FIFO.
 	divide_clk : Signal
 		Divide clock by 2 when true, used for 5 GT/s mode. When enabled with 200 MHz REFCLK the transfer rate is 2.5 GT/s.
+		With 5 GT/s support it follows lane.speed, the DCU is reset whenever it changes.
 	"""
 	def __init__(self, gearing, speed_5GTps = False, DCU=0, CH=0, clkfreq = 200e6, fabric_clk = False):
 		assert gearing == 1 or gearing == 2
@@ -214,6 +215,12 @@ class LatticeECP5PCIeSERDES(Elaboratable): # Based on Yumewatari
 		pcs_reset       = Signal()
 		cnt = Signal(8)
 
+		# The rate of the DCU changes with divide_clk, which requires resetting it
+		divide_clk_last = Signal()
+		speed_changed = Const(0)
+		if self.speed_5GTps:
+			speed_changed = divide_clk_last != self.divide_clk
+
 		with m.FSM(domain="rx"): # Inspirations taken from LUNA
 			with m.State("init"):
 				m.d.comb += [
@@ -223,6 +230,7 @@ class LatticeECP5PCIeSERDES(Elaboratable): # Based on Yumewatari
 					lane.reset_done.eq(0),
 				]
 				m.d.rx += cnt.eq(0)
+				m.d.rx += divide_clk_last.eq(self.divide_clk)
 
 				with m.If(~self.lane.reset):
 					m.next = "start-tx"
@@ -260,7 +268,7 @@ class LatticeECP5PCIeSERDES(Elaboratable): # Based on Yumewatari
 					lane.reset_done.eq(1),
 				]
 
-				with m.If(self.lane.reset):
+				with m.If(self.lane.reset | speed_changed):
 					m.next = "init"
 
 
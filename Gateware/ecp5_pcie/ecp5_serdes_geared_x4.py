@@ -10,9 +10,9 @@ __all__ = ["LatticeECP5PCIeSERDESx4"]
 class LatticeECP5PCIeSERDESx4(Elaboratable): # Based on Yumewatari
 	"""
 	Lattice ECP5 DCU configured in PCIe mode, 2.5 or 5 GT/s. Assumes 100 MHz reference clock on SERDES clock input pair. Only provides a single lane.
-	Uses 1:4 gearing.
+	Uses 1:4 gearing by default or 1:8 gearing, the DCU uses 1:2 gearing and the words are put together in the fabric.
 
-	Clock frequencies are 125 MHz for 5 GT/s and 62.5 MHz for 2.5 GT/s.
+	Clock frequencies are 125 MHz for 5 GT/s and 62.5 MHz for 2.5 GT/s, half of them with 1:8 gearing.
 
 	Parameters
 	----------
@@ -22,6 +22,8 @@ class LatticeECP5PCIeSERDESx4(Elaboratable): # Based on Yumewatari
 		Which DCU to use
 	CH : int
 		Which channel within the DCU to use
+	gearing : int
+		Symbols per word, 4 or 8
 
 	Attributes
 	----------
@@ -36,15 +38,16 @@ class LatticeECP5PCIeSERDESx4(Elaboratable): # Based on Yumewatari
 	tx_clk_i : Signal
 		Clock for the transmit FIFO.
 	"""
-	def __init__(self, speed_5GTps=True, DCU=0, CH=0, clkfreq = 200e6, fabric_clk = False):
+	def __init__(self, speed_5GTps=True, DCU=0, CH=0, clkfreq = 200e6, fabric_clk = False, gearing = 4):
 		self.rx_clk = Signal(name="pcie_clk")  # recovered word clock
 
 		self.tx_clk = Signal(name="tx_slow_clk")  # generated word clock
 
 		# The PCIe lane with all signals necessary to control it
-		self.lane = PCIeSERDESInterface(4)
+		assert gearing in [4, 8]
+		self.lane = PCIeSERDESInterface(gearing)
 
-		self.gearing = 4
+		self.gearing = gearing
 
 		assert DCU == 0 or DCU == 1
 		assert CH == 0 or CH == 1
@@ -61,7 +64,7 @@ class LatticeECP5PCIeSERDESx4(Elaboratable): # Based on Yumewatari
 		self.__serdes = DomainRenamer({"tx": "txf"})(LatticeECP5PCIeSERDES(2, speed_5GTps = self.speed_5GTps, DCU=self.DCU, CH=self.CH, clkfreq=clkfreq, fabric_clk=fabric_clk))
 		self.serdes = self.__serdes # For testing
 
-		self.lane.frequency     = int(self.__serdes.lane.frequency / 2)
+		self.lane.frequency     = int(self.__serdes.lane.frequency * 2 / gearing)
 		self.lane.speed         = self.__serdes.lane.speed
 		self.lane.use_speed     = self.__serdes.lane.use_speed
 
@@ -105,48 +108,57 @@ class LatticeECP5PCIeSERDESx4(Elaboratable): # Based on Yumewatari
 			ClockSignal("txf").eq(serdes.tx_clk),
 		]
 
-		platform.add_clock_constraint(self.rx_clk, 125e6 if self.speed_5GTps else 625e5) # For NextPNR, set the maximum clock frequency such that errors are given
-		platform.add_clock_constraint(self.tx_clk, 125e6 if self.speed_5GTps else 625e5)
+		# The word clocks are divided from the DCU's clocks, a word is made of this many words of the DCU
+		phases = self.gearing // serdes.gearing
 
-		m.submodules.lane = lane = PCIeSERDESInterface(4) # TODO: Uhh is this supposed to be here? // I think it might be the fast lane
+		platform.add_clock_constraint(self.rx_clk, (250e6 if self.speed_5GTps else 125e6) / phases) # For NextPNR, set the maximum clock frequency such that errors are given
+		platform.add_clock_constraint(self.tx_clk, (250e6 if self.speed_5GTps else 125e6) / phases)
+
+		m.submodules.lane = lane = PCIeSERDESInterface(self.gearing) # TODO: Uhh is this supposed to be here? // I think it might be the fast lane
 
 		# IF SOMETHING IS BROKE: Check if the TX actually transmits good data and not order-swapped data
 		# TODO: Maybe use hardware divider? Though this seems to be fine
-		m.d.rxf += self.rx_clk.eq(~self.rx_clk)
-
-		with m.If(~self.rx_clk):
-			m.d.rxf += lane.rx_symbol   [data_width     :data_width     * 2 ].eq(serdes.lane.rx_symbol)
-			m.d.rxf += lane.rx_valid    [serdes.gearing :serdes.gearing * 2 ].eq(serdes.lane.rx_valid)
-		with m.Else():
-			m.d.rxf += lane.rx_symbol   [0:data_width       ].eq(serdes.lane.rx_symbol)
-			m.d.rxf += lane.rx_valid    [0:serdes.gearing   ].eq(serdes.lane.rx_valid)
+		rx_phase = Signal(range(phases))
+		m.d.rxf += rx_phase.eq(rx_phase + 1)
+		m.d.comb += self.rx_clk.eq(rx_phase[-1])
+
+		# The last part of a word is received in phase 0, it is written into the FIFO in phase 1 so it changes its output in the first half of rx_clk
+		with m.Switch(rx_phase):
+			for phase in range(phases):
+				with m.Case(phase):
+					part = (phase - 1) % phases
+					m.d.rxf += lane.rx_symbol   [data_width     * part  :data_width     * (part + 1)    ].eq(serdes.lane.rx_symbol)
+					m.d.rxf += lane.rx_valid    [serdes.gearing * part  :serdes.gearing * (part + 1)    ].eq(serdes.lane.rx_valid)
 
 			# To ensure that it outputs consistent data
 			# m.d.rxf += self.lane.rx_symbol.eq(lane.rx_symbol)
 			# m.d.rxf += self.lane.rx_valid.eq(lane.rx_valid)
 
-		m.d.txf += self.tx_clk.eq(~self.tx_clk)
+		tx_phase = Signal(range(phases))
+		m.d.txf += tx_phase.eq(tx_phase + 1)
+		m.d.comb += self.tx_clk.eq(tx_phase[-1])
 
-		m.d.txf += serdes.lane.tx_symbol    .eq(Mux(self.tx_clk, lane.tx_symbol     [data_width    :data_width * 2      ],  lane.tx_symbol  [0:data_width]))
-		m.d.txf += serdes.lane.tx_disp      .eq(Mux(self.tx_clk, lane.tx_disp       [serdes.gearing:serdes.gearing * 2  ],  lane.tx_disp    [0:serdes.gearing]))
-		m.d.txf += serdes.lane.tx_set_disp  .eq(Mux(self.tx_clk, lane.tx_set_disp   [serdes.gearing:serdes.gearing * 2  ],  lane.tx_set_disp[0:serdes.gearing]))
-		m.d.txf += serdes.lane.tx_e_idle    .eq(Mux(self.tx_clk, lane.tx_e_idle     [serdes.gearing:serdes.gearing * 2  ],  lane.tx_e_idle  [0:serdes.gearing]))
+		m.d.txf += serdes.lane.tx_symbol    .eq(lane.tx_symbol      .word_select(tx_phase, data_width))
+		m.d.txf += serdes.lane.tx_disp      .eq(lane.tx_disp        .word_select(tx_phase, serdes.gearing))
+		m.d.txf += serdes.lane.tx_set_disp  .eq(lane.tx_set_disp    .word_select(tx_phase, serdes.gearing))
+		m.d.txf += serdes.lane.tx_e_idle    .eq(lane.tx_e_idle      .word_select(tx_phase, serdes.gearing))
 
 
 		# CDC
 		# TODO: Keep the SyncFIFO? Its faster but is it reliable?
 		#rx_fifo = m.submodules.rx_fifo = AsyncFIFOBuffered(width=(data_width + serdes.gearing) * 2, depth=4, r_domain="rx", w_domain="rxf")
-		rx_fifo = m.submodules.rx_fifo = DomainRenamer("rxf")(SyncFIFOBuffered(width=(data_width + serdes.gearing) * 2, depth=4))
+		rx_fifo = m.submodules.rx_fifo = DomainRenamer("rxf")(SyncFIFOBuffered(width=(data_width + serdes.gearing) * phases, depth=4))
 		m.d.rxf += rx_fifo.w_data.eq(Cat(lane.rx_symbol, lane.rx_valid))
 		m.d.comb += Cat(self.lane.rx_symbol, self.lane.rx_valid).eq(rx_fifo.r_data)
 		m.d.comb += rx_fifo.r_en.eq(1)
-		m.d.rxf += rx_fifo.w_en.eq(self.rx_clk)
+		m.d.rxf += rx_fifo.w_en.eq(rx_phase == 1)
 
+		# The FIFO is full, a word is read in the phase before the last one, so the next one is written in the last phase while the current one is sent
 		#tx_fifo = m.submodules.tx_fifo = AsyncFIFOBuffered(width=(data_width + serdes.gearing * 3) * 2, depth=4, r_domain="txf", w_domain="tx")
-		tx_fifo = m.submodules.tx_fifo = DomainRenamer("txf")(SyncFIFOBuffered(width=(data_width + serdes.gearing * 3) * 2, depth=4))
+		tx_fifo = m.submodules.tx_fifo = DomainRenamer("txf")(SyncFIFOBuffered(width=(data_width + serdes.gearing * 3) * phases, depth=4))
 		m.d.comb += tx_fifo.w_data.eq(Cat(self.lane.tx_symbol, self.lane.tx_set_disp, self.lane.tx_disp, self.lane.tx_e_idle))
 		m.d.txf  += Cat(lane.tx_symbol, lane.tx_set_disp, lane.tx_disp, lane.tx_e_idle).eq(tx_fifo.r_data)
-		m.d.txf  += tx_fifo.r_en.eq(self.tx_clk)
+		m.d.txf  += tx_fifo.r_en.eq(tx_phase == (phases - 3) % phases)
 		m.d.comb += tx_fifo.w_en.eq(1)
 		#m.d.txf  += Cat(lane.tx_symbol, lane.tx_set_disp, lane.tx_disp, lane.tx_e_idle).eq(Cat(self.lane.tx_symbol, self.lane.tx_set_disp, self.lane.tx_disp, self.lane.tx_e_idle))
 
@@ -0,0 +1,218 @@
+from amaranth import *
+from amaranth.build import *
+
+from .layouts import dll_layout
+
+
+__all__ = ["PCIeCreditTracker", "PCIeCreditAllocator", "tlp_credit_type", "tlp_data_credits"]
+
+
+def tlp_credit_type(header):
+	"""
+	Decodes which flow control credits a TLP consumes, see section 2.6.1 in PCIe 1.1
+
+	Parameters
+	----------
+	header : list of Value(8)
+		First 4 bytes of the TLP
+
+	Returns
+	-------
+	(Value, Value, Value)
+		Whether the TLP is posted, non-posted or a completion
+	"""
+	fmt = header[0][5:8]
+	tlp_type = header[0][0:5]
+
+	posted = ((tlp_type == 0b00000) & fmt[1]) | (tlp_type[3:5] == 0b10) # MWr, Msg and MsgD
+	completion = tlp_type[1:5] == 0b0101 # Cpl, CplD, CplLk and CplDLk
+	non_posted = ~posted & ~completion # MRd, MRdLk, IORd, IOWr, CfgRd and CfgWr
+
+	return posted, non_posted, completion
+
+
+def tlp_data_credits(header):
+	"""
+	Number of data credits a TLP consumes, one data credit equals 4 DW and a length of 0 means 1024 DW
+
+	Parameters
+	----------
+	header : list of Value(8)
+		First 4 bytes of the TLP
+	"""
+	has_data = header[0][6]
+	length = Cat(header[3], header[2][0:2])
+
+	return Mux(has_data, Mux(length == 0, 256, (length + 3) >> 2), 0)
+
+
+class PCIeCreditTracker(Elaboratable):
+	"""
+	Transmit side flow control credit accounting, see section 2.6.1.2 in PCIe 1.1
+
+	Counts the credits consumed by sent TLPs and checks whether the next TLP fits into the credit limit advertised by the link partner.
+	The counters wrap around, so a TLP is blocked if (limit - (consumed + required)) mod 2^[Field Size] > 2^[Field Size] / 2.
+	A credit type which was initialized with 0 credits is infinite and never blocks.
+
+	Parameters
+	----------
+	limits : Record(dll_layout)
+		Credit limits received from the link partner, for example PCIeDLL.credits_rx
+	header : list of Signal(8)
+		First 4 bytes of the TLP to be sent
+	up : Signal()
+		Whether the DLL is active, the consumed credits are reset while it isn't and the infinite credit types are taken from the limits when it becomes active
+
+	Attributes
+	----------
+	consumed : Record(dll_layout)
+		Consumed credits
+	sufficient : Signal()
+		Whether there are enough credits to send the TLP in header
+	consume : Signal()
+		Set to 1 for 1 cycle to consume the credits of the TLP in header
+	"""
+	def __init__(self, limits, header, up):
+		assert len(header) >= 4
+
+		self.limits = limits
+		self.header = header
+		self.up = up
+
+		self.consumed = Record(dll_layout)
+		self.sufficient = Signal()
+		self.consume = Signal()
+
+		self.state = [
+			self.consumed,
+			self.sufficient,
+		]
+
+	def elaborate(self, platform: Platform) -> Module:
+		m = Module()
+
+		header = self.header
+
+		data_credits = Signal(9)
+		m.d.comb += data_credits.eq(tlp_data_credits(header))
+
+		initialized = Signal()
+
+		with m.If(~self.up):
+			m.d.rx += initialized.eq(0)
+
+		with m.Elif(~initialized):
+			m.d.rx += initialized.eq(1)
+
+		sufficient = 0
+
+		for (header_field, data_field), selected in zip([("PH", "PD"), ("NPH", "NPD"), ("CPLH", "CPLD")], tlp_credit_type(header)):
+			fits = 1
+
+			for field, required in [(header_field, 1), (data_field, data_credits)]:
+				limit = self.limits[field]
+				consumed = self.consumed[field]
+
+				infinite = Signal(name=f"infinite_{field}")
+				remaining = Signal(len(limit), name=f"remaining_{field}")
+				m.d.comb += remaining.eq(limit - (consumed + required)) # mod 2^[Field Size] is applied by the length of remaining
+
+				fits &= infinite | (remaining <= 2 ** (len(limit) - 1))
+
+				with m.If(~self.up):
+					m.d.rx += consumed.eq(0)
+
+				with m.Elif(~initialized):
+					m.d.rx += infinite.eq(limit == 0)
+
+				with m.Elif(self.consume & selected & ~infinite):
+					m.d.rx += consumed.eq(consumed + required)
+
+			sufficient |= selected & fits
+
+		m.d.comb += self.sufficient.eq(initialized & sufficient)
+
+		return m
+
+
+class PCIeCreditAllocator(Elaboratable):
+	"""
+	Receive side flow control credit accounting, see section 2.6.1.2 in PCIe 1.1
+
+	Advertises the initial credits of the receive buffer and returns the credits of each TLP which is taken out of it.
+	Once half of the initial credits of a field have been returned since the last UpdateFC, the link partner might be waiting for them,
+	so an UpdateFC is requested right away instead of waiting for the next periodic one.
+
+	Parameters
+	----------
+	initial : dict of str to int
+		Initial credits for each field of dll_layout, 0 means infinite credits
+	header : list of Signal(8)
+		First 4 bytes of the TLP to be released
+	up : Signal()
+		Whether the DLL is active, the initial credits are advertised while it isn't
+
+	Attributes
+	----------
+	credits : Record(dll_layout)
+		Credit limits to advertise, connect to PCIeDLL.credits_tx
+	release : Signal()
+		Set to 1 for 1 cycle to return the credits of the TLP in header
+	update : Signal()
+		Is 1 for 1 cycle if an UpdateFC should be sent
+	"""
+	def __init__(self, initial, header, up):
+		assert len(header) >= 4
+		assert all(0 <= initial[field] <= 2 ** (size - 1) for field, size in dll_layout)
+
+		self.initial = initial
+		self.header = header
+		self.up = up
+
+		self.credits = Record(dll_layout)
+		self.release = Signal()
+		self.update = Signal()
+
+		self.state = [
+			self.credits,
+			self.update,
+		]
+
+	def elaborate(self, platform: Platform) -> Module:
+		m = Module()
+
+		header = self.header
+
+		data_credits = Signal(9)
+		m.d.comb += data_credits.eq(tlp_data_credits(header))
+
+		update = 0
+
+		for (header_field, data_field), selected in zip([("PH", "PD"), ("NPH", "NPD"), ("CPLH", "CPLD")], tlp_credit_type(header)):
+			for field, required in [(header_field, 1), (data_field, data_credits)]:
+				initial = self.initial[field]
+
+				if initial == 0: # Infinite
+					m.d.comb += self.credits[field].eq(0)
+					continue
+
+				# Credits returned since the last UpdateFC
+				returned = Signal(len(self.credits[field]), name=f"returned_{field}")
+				allocated = Signal(len(self.credits[field]), name=f"allocated_{field}", reset=initial)
+				m.d.comb += self.credits[field].eq(allocated)
+
+				increment = Mux(self.release & selected, required, 0)
+
+				with m.If(~self.up):
+					m.d.rx += allocated.eq(initial)
+					m.d.rx += returned.eq(0)
+
+				with m.Else():
+					m.d.rx += allocated.eq(allocated + increment) # mod 2^[Field Size] is applied by the length of allocated
+					m.d.rx += returned.eq(Mux(self.update, 0, returned) + increment)
+
+				update |= returned >= max(1, initial // 2)
+
+		m.d.comb += self.update.eq(update)
+
+		return m
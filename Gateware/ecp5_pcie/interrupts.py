@@ -0,0 +1,228 @@
+from amaranth import *
+from amaranth.build import *
+
+from .stream import StreamInterface
+from .tlp import TLPType
+from .memory import _encode_one_hot
+
+
+__all__ = ["PCIeInterrupts"]
+
+
+class PCIeInterrupts(Elaboratable):
+	"""
+	Message Signaled Interrupts, turns interrupt strobes into MSI or MSI-X messages, see section 6.1.4 in PCIe Base 1.1 and section 6.8 in PCI Local Bus 3.0
+
+	A message is a Memory Write Request of 1 DW to the address the host programmed. With MSI every vector uses the same address
+	and the vector number replaces the lower Multiple Message Enable bits of the Message Data, vectors which weren't allocated share the last one.
+	With MSI-X every vector has its own address and data in the MSI-X table in BAR 0 and can be masked,
+	the engine keeps a copy of the table which is updated from the writes to BAR 0.
+
+	Interrupts are coalesced: Strobes of a vector are counted and a message is sent once coalesce_count strobes are pending
+	or the first pending strobe is coalesce_time cycles old. Vectors which are masked, or all while messages are disabled, stay pending.
+	The lowest vector which is ready is sent first.
+
+	Parameters
+	----------
+	vectors : int
+		Number of interrupt vectors, 1, 2, 4, 8, 16 or 32
+
+	msix : bool
+		Whether MSI-X is supported in addition to MSI
+
+	ratio : int
+		Gearbox ratio
+
+	Attributes
+	----------
+	interrupt : Signal(vectors)
+		Set a bit to 1 for 1 cycle to signal an interrupt of that vector
+	coalesce_count : Signal(16)
+		Number of pending strobes of a vector after which a message is sent, 1 sends a message for every strobe
+	coalesce_time : Signal(16)
+		Number of cycles after the first pending strobe of a vector after which a message is sent, 0 disables it
+	pending : Signal(vectors)
+		Whether a vector has pending strobes, the Pending Bits of the MSI-X Pending Bit Array
+	masked : Signal(vectors)
+		Mask Bits of the Vector Control DWs of the MSI-X table, all are set after reset
+	tlp_source : StreamInterface
+		Messages, the first word is held until ready is 1
+	requester_id : Signal(16)
+		Bus, device and function number of this device
+	bus_master_enable : Signal()
+		Bus Master Enable bit of the Command register, no messages are sent while it is 0
+	msi_enable : Signal()
+		MSI Enable bit of the MSI Message Control register
+	msi_multiple_message_enable : Signal(3)
+		Multiple Message Enable field of the MSI Message Control register
+	msi_address : Signal(64)
+		MSI Message Address and Message Upper Address registers
+	msi_data : Signal(16)
+		MSI Message Data register
+	msix_enable : Signal()
+		MSI-X Enable bit of the MSI-X Message Control register, takes precedence over msi_enable
+	msix_function_mask : Signal()
+		Function Mask bit of the MSI-X Message Control register
+	table_write : Signal()
+		Set to 1 for 1 cycle to write a DW of the MSI-X table
+	table_address : Signal(range(4 * vectors))
+		DW address in the MSI-X table
+	table_data : Signal(32)
+		Data which is written to the MSI-X table
+	table_be : Signal(4)
+		Byte enables of the DW which is written
+	"""
+	def __init__(self, vectors: int = 1, msix: bool = True, ratio: int = 4):
+		assert ratio == 4
+		assert vectors in [1, 2, 4, 8, 16, 32]
+
+		self.vectors = vectors
+		self.msix = msix
+		self.ratio = ratio
+
+		self.interrupt = Signal(vectors)
+		self.coalesce_count = Signal(16, reset = 1)
+		self.coalesce_time = Signal(16)
+		self.pending = Signal(vectors)
+		# The Mask Bit in the Vector Control DW of every MSI-X table entry is set after reset, see section 6.8.2.9 in PCI Local Bus 3.0
+		self.masked = Signal(vectors, reset = 2 ** vectors - 1)
+
+		self.tlp_source = StreamInterface(8, ratio, name="Interrupt_Source")
+
+		self.requester_id = Signal(16)
+		self.bus_master_enable = Signal()
+		self.msi_enable = Signal()
+		self.msi_multiple_message_enable = Signal(3)
+		self.msi_address = Signal(64)
+		self.msi_data = Signal(16)
+		self.msix_enable = Signal()
+		self.msix_function_mask = Signal()
+
+		self.table_write = Signal()
+		self.table_address = Signal(range(4 * vectors))
+		self.table_data = Signal(32)
+		self.table_be = Signal(4)
+
+	def elaborate(self, platform: Platform) -> Module:
+		m = Module()
+
+		ratio = self.ratio
+		vectors = self.vectors
+		vector_bits = max(1, (vectors - 1).bit_length())
+
+		msix_enable = self.msix_enable if self.msix else Const(0, 1)
+		enabled = self.bus_master_enable & Mux(msix_enable, ~self.msix_function_mask, self.msi_enable)
+
+		# Coalescing
+		count = [Signal(16, name = f"count_{i}") for i in range(vectors)]
+		age = [Signal(16, name = f"age_{i}") for i in range(vectors)]
+		ready = Signal(vectors)
+		clear = Signal(vectors) # The pending strobes of a vector are sent
+
+		for i in range(vectors):
+			with m.If(clear[i]):
+				m.d.rx += count[i].eq(self.interrupt[i])
+				m.d.rx += age[i].eq(0)
+
+			with m.Else():
+				with m.If(self.interrupt[i] & ~count[i].all()):
+					m.d.rx += count[i].eq(count[i] + 1)
+
+				with m.If((count[i] != 0) & ~age[i].all()):
+					m.d.rx += age[i].eq(age[i] + 1)
+
+			threshold = (count[i] >= self.coalesce_count) | ((self.coalesce_time != 0) & (age[i] >= self.coalesce_time))
+
+			m.d.comb += self.pending[i].eq(count[i] != 0)
+			m.d.comb += ready[i].eq(self.pending[i] & threshold & ~(msix_enable & self.masked[i]))
+
+		next_vector = Signal(vector_bits)
+		m.d.comb += next_vector.eq(_encode_one_hot(ready & (~ready + 1), vector_bits))
+
+		# With MSI the vector number is in the lower bits of the Message Data, see section 6.8.1.6 in PCI Local Bus 3.0
+		allocated_mask = Signal(16)
+		m.d.comb += allocated_mask.eq((Const(1, 16) << self.msi_multiple_message_enable) - 1)
+		msi_data = (self.msi_data & ~allocated_mask) | Mux(next_vector > allocated_mask, allocated_mask, next_vector)
+
+		# Message which is sent next
+		vector = Signal(vector_bits)
+		message_address = Signal(64)
+		message_data = Signal(32)
+
+		four_dw = message_address[32:64].any()
+
+		header = [
+			Mux(four_dw, TLPType.MWr64, TLPType.MWr32), 0, 0, 1,
+			self.requester_id[8:16], self.requester_id[0:8], 0, 0b1111,
+			Mux(four_dw, message_address[56:64], message_address[24:32]), Mux(four_dw, message_address[48:56], message_address[16:24]), Mux(four_dw, message_address[40:48], message_address[8:16]), Mux(four_dw, message_address[32:40], Cat(Const(0, 2), message_address[2:8])),
+			message_address[24:32], message_address[16:24], message_address[8:16], Cat(Const(0, 2), message_address[2:8]),
+		]
+		header_words = len(header) // ratio
+		header_index = Signal(range(header_words))
+
+		if self.msix:
+			table = Memory(width = 32, depth = 4 * vectors, name = "MSIX_Table")
+			m.submodules.table_read_port = table_read_port = table.read_port(domain = "rx", transparent = False)
+			m.submodules.table_write_port = table_write_port = table.write_port(domain = "rx", granularity = 8)
+
+			m.d.comb += [
+				table_write_port.addr.eq(self.table_address),
+				table_write_port.data.eq(self.table_data),
+				table_write_port.en.eq(Mux(self.table_write, self.table_be, 0)),
+				table_read_port.addr.eq(Cat(Const(0, 2), next_vector)),
+				table_read_port.en.eq(1),
+			]
+
+			# Vector Control is DW 3 of an entry, its bit 0 is the Mask Bit
+			for i in range(vectors):
+				with m.If(self.table_write & (self.table_address == i * 4 + 3) & self.table_be[0]):
+					m.d.rx += self.masked[i].eq(self.table_data[0])
+
+		with m.FSM(name = "Interrupt_FSM", domain = "rx"):
+			with m.State("Idle"):
+				with m.If(enabled & ready.any()):
+					m.d.comb += clear.eq(Const(1, vectors) << next_vector)
+					m.d.rx += vector.eq(next_vector)
+					m.d.rx += header_index.eq(0)
+					m.d.rx += message_address.eq(self.msi_address)
+					m.d.rx += message_data.eq(msi_data)
+
+					with m.If(msix_enable):
+						m.next = "Table0"
+
+					with m.Else():
+						m.next = "Header"
+
+			# Message Address, Message Upper Address and Message Data of the MSI-X table entry are read one after another
+			if self.msix:
+				for i, target in enumerate([message_address[0:32], message_address[32:64], message_data]):
+					with m.State(f"Table{i}"):
+						m.d.comb += table_read_port.addr.eq(Cat(Const(i + 1, 2), vector))
+						m.d.rx += target.eq(table_read_port.data)
+						m.next = f"Table{i + 1}" if i < 2 else "Header"
+
+			with m.State("Header"):
+				for i in range(ratio):
+					m.d.comb += self.tlp_source.valid[i].eq(1)
+
+				with m.Switch(header_index):
+					for word in range(header_words):
+						with m.Case(word):
+							for i in range(ratio):
+								m.d.comb += self.tlp_source.symbol[i].eq(header[word * ratio + i])
+
+				with m.If(self.tlp_source.ready):
+					m.d.rx += header_index.eq(header_index + 1)
+
+					with m.If(header_index == Mux(four_dw, 3, 2)):
+						m.next = "Data"
+
+			with m.State("Data"):
+				for i in range(ratio):
+					m.d.comb += self.tlp_source.valid[i].eq(1)
+					m.d.comb += self.tlp_source.symbol[i].eq(message_data.word_select(i, 8))
+
+				with m.If(self.tlp_source.ready):
+					m.next = "Idle"
+
+		return m
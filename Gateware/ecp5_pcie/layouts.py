@@ -48,12 +48,18 @@ ltssm_layout = [
         ("changed_speed_recovery", 1),
         ("upconfigure_capable", 1),
         ("successful_speed_negotiation", 1),
+        ("width", 6), # Negotiated link width, 1 for x1, 2 for x2, 4 for x4
 
     ]),
     ("recv_err", 2),
     ("presence", 1),
     ("idle_to_rlock_transitioned", 8),
     ("directed_speed_change", 1),
+    ("power_state", [ # Active State Power Management
+        ("tx_l0s", 1), # The transmitter is in L0s
+        ("rx_l0s", 1), # The receiver is in L0s
+        ("l1", 1),
+    ]),
 ]
 
 dllp_layout = [
@@ -78,4 +84,16 @@ dll_status = [
     ("receive_buffer_occupation", 8),
     ("tx_seq_num", 12),
     ("rx_seq_num", 12),
-]
\ No newline at end of file
+]
+memory_request_layout = [
+    ("write",           1), # Memory Write Request, otherwise Memory Read Request
+    ("drop",            1), # Write which was aborted, its data is discarded
+    ("address",         30), # DW address
+    ("length",          10), # Length in DW, 0 means 1024 DW
+    ("first_dw_be",     4),
+    ("last_dw_be",      4),
+    ("requester_id",    16),
+    ("tag",             8),
+    ("tc",              3),
+    ("attr",            2),
+]
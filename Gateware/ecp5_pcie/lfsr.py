@@ -2,78 +2,103 @@ from amaranth import *
 from amaranth.build import *
 
 
-__all__ = ["PCIeLFSR"]
+__all__ = ["PCIeLFSR", "lfsr_advance", "lfsr_matrix"]
+
+
+def lfsr_advance(state : int, advances : int = 1):
+	"""
+	Advances a state of the PCIe LFSR by a number of symbols, each of which shifts it by 8 bits
+	"""
+	for _ in range(advances):
+		state = ((state >> 8) | ((state & 0xFF) << 8)) ^ ((state & 0xFF00) >> 5) ^ ((state & 0xFF00) >> 4) ^ ((state & 0xFF00) >> 3)
+
+	return state
+
+
+def lfsr_matrix(advances : int):
+	"""
+	Advancing the LFSR is linear over GF(2), so advancing it by a number of symbols is a matrix.
+
+	Returns
+	-------
+	list of int
+		For each bit of the advanced state, a mask of the bits of the original state it is the XOR of
+	"""
+	columns = [lfsr_advance(1 << i, advances) for i in range(16)]
+	return [sum(1 << i for i in range(16) if columns[i] & (1 << j)) for j in range(16)]
 
 
 class PCIeLFSR(Elaboratable):
 	"""
-	PCIe Linear Feedback Shift Register for scrambling
+	PCIe Linear Feedback Shift Register for scrambling any number of symbols per clock cycle
+
+	A COM symbol resets the LFSR to 0xFFFF, SKP symbols don't advance it and all other symbols advance it by one symbol.
+	The state used for a symbol is the state at the start of the word or after the last COM in it, advanced by the number
+	of advancing symbols in between. The matrices for every number of advances are computed when elaborating,
+	so COM and SKP symbols can be anywhere within the word.
 
 	Parameters
 	----------
 	bytes : int
 		Number of bytes of scrambling data to produce
-	reset : Signal
-		Reset LFSR, should be 'symbol == Ctrl.COM'
-	advance : Signal
-		Advance LFSR, should be 'symbol != Ctrl.SKP'
-	
+	reset : Value(bytes)
+		Reset LFSR, one bit per symbol, should be 'symbol == Ctrl.COM'
+	advance : Value(bytes)
+		Advance LFSR, one bit per symbol, should be 'symbol != Ctrl.SKP'
+	restart : Value(1)
+		Start the word from the reset state as if a COM was in front of it, for words after a SKP ordered set which an elastic buffer removed
+
 	output : Signal(9 * bytes)
 		output data for scrambling. XOR symbols with this to scramble. 9th bit is 0
 	"""
-	def __init__(self, bytes, reset, advance):
+	def __init__(self, bytes, reset, advance, restart = Const(0)):
+		assert len(reset) == bytes and len(advance) == bytes
 		self.reset = reset
 		self.advance = advance
+		self.restart = restart
 		self.output = Signal(9 * bytes)
-		#self.count = Signal(32)
 		self.__bytes = bytes
 
 	def elaborate(self, platform: Platform) -> Module:
 		m = Module()
 
-		def calculate_lfsr(advances):
-			state = 0xFFFF
-			for _ in range(advances):
-				state = ((state >> 8) | ((state & 0xFF) << 8)) ^ ((state & 0xFF00) >> 5) ^ ((state & 0xFF00) >> 4) ^ ((state & 0xFF00) >> 3)
-				
-			return state
-
-		def apply_lfsr(in_state):
-			return Cat(in_state[8:16], in_state[0:8]) ^ Cat(Const(0, 3), in_state[8:16]) ^ Cat(Const(0, 4), in_state[8:16]) ^ Cat(Const(0, 5), in_state[8:16])
-
-		#states = [Signal(16, reset=calculate_lfsr(i)) for i in range(self.__bytes)]
-		states = [Signal(16, reset=0xFFFF) for i in range(self.__bytes)]# * self.__bytes
-
-
-		for i in range(0, self.__bytes - 1):
-			m.d.comb += states[i + 1].eq(apply_lfsr(states[i]))
-
-
-		with m.If(self.reset):
-			with m.If(self.advance):
-				m.d.rx += states[0].eq([0, 0xFFFF, 0xE817, 0x0328, 0x284B, 0x4DE8, 0xE755, 0x404F, 0x4140][self.__bytes]) # TODO: This is a hack. Please fix. It is the next state after 0xFFFF. It happens when there is 'COM x' where x is not SKP.
-			with m.Else():
-				m.d.rx += states[0].eq(0xFFFF) # When x is SKP, it can go straight to 0xFFFF.
-				# Because when its not SKP, it already needs to advance by 1 cycle. With COM SKP, the number of LFSR advances look like this, symbol 1 besides symbol 2:
-				# 0 1
-				# 2 3
-				# 4 5
-				# and so on. But for example with COM D0.0 it goes like
-				# 1 2
-				# 3 4
-				# 5 6
-				# afterwards, where it is shifted by ½ clock cycle. In the PCIeScrambler, before the beginning of the thing above, the second symbol gets scrambled with 0xFF.
-			#for i in range(1, self.__bytes - 1):
-			#    m.d.comb += states[i + 1].eq(apply_lfsr(states[i]))
-		with m.Elif(self.advance):
-			m.d.rx += states[0].eq(apply_lfsr(states[self.__bytes - 1]))
-			#for i in range(self.__bytes):
-			#    if i == self.__bytes - 1:
-			#        m.d.rx += states[0].eq(apply_lfsr(states[i]))
-			#    else:
-			#        m.d.comb += states[i + 1].eq(apply_lfsr(states[i]))
-		
+		state = Signal(16, reset=0xFFFF)
+
+		def apply_matrix(matrix, in_state):
+			return Cat(Cat(in_state[i] for i in range(16) if mask & (1 << i)).xor() for mask in matrix)
+
+		# States after any number of advances within a word, starting from the current state
+		advanced = [Signal(16, name=f"advanced_{n}") for n in range(self.__bytes + 1)]
+		for n in range(self.__bytes + 1):
+			m.d.comb += advanced[n].eq(apply_matrix(lfsr_matrix(n), state))
+
+		def select(domain, target, reset, count):
+			"""
+			Sets target to the state after count advances, starting from the reset state if reset is true
+			"""
+			with m.Switch(Cat(count, reset)):
+				for n in range(self.__bytes + 1):
+					with m.Case(n):
+						domain += target.eq(advanced[n])
+
+					with m.Case(n | (1 << len(count))):
+						domain += target.eq(lfsr_advance(0xFFFF, n))
+
+		# Whether a COM has been in the word so far, and the number of advances since then or since the start of the word
+		reset = self.restart
+		count = Const(0, range(self.__bytes + 1))
+
 		for i in range(self.__bytes):
-			m.d.comb += self.output.word_select(i, 9).eq(states[i][15:7:-1])
+			current = Signal(16, name=f"current_{i}")
+			select(m.d.comb, current, reset, count)
+			m.d.comb += self.output.word_select(i, 9).eq(current[15:7:-1])
+
+			next_count = Signal(range(self.__bytes + 1), name=f"count_{i}")
+			next_reset = Signal(name=f"reset_{i}")
+			m.d.comb += next_count.eq(Mux(self.reset[i], 0, Mux(self.advance[i], count + 1, count)))
+			m.d.comb += next_reset.eq(reset | self.reset[i])
+			count, reset = next_count, next_reset
+
+		select(m.d.rx, state, reset, count)
 
-		return m
\ No newline at end of file
+		return m
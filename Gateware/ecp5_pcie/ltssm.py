@@ -2,11 +2,14 @@ from amaranth import *
 from amaranth.build import *
 
 from enum import IntEnum
+import math
 
 from .serdes import K, D, Ctrl, PCIeSERDESInterface, LinkSpeed
 from .layouts import ltssm_layout
 from .phy_tx import PCIePhyTX
 from .phy_rx import PCIePhyRX
+from .multilane import supported_widths
+from .dllp import PMType
 
 class State(IntEnum):
 	Detect = 0
@@ -32,30 +35,82 @@ class State(IntEnum):
 	Recovery_Idle = 16
 	L0 = 17
 	Disabled = 18
+	L1_Entry = 19
+	L1_Idle = 20
+
+# Substates of the transmitter and the receiver in L0s, L0 if they aren't in L0s
+class L0sState(IntEnum):
+	L0 = 0
+	Entry = 1
+	Idle = 2
+	FTS = 3
 
 class PCIeLTSSM(Elaboratable): # Based on Yumewatary phy.py
 	"""
-	PCIe Link Training and Status State Machine for 1:4 gearing and one lane
+	PCIe Link Training and Status State Machine for 1:4 or 1:8 gearing and one or more lanes
 
 	Parameters
 	----------
-	lane : PCIeSERDESInterface
-		PCIe lane
-	tx : PCIePhyTX
-		PCIe transmitter
-	rx : PCIePhyRX
-		PCIe receiver
+	lane : PCIeSERDESInterface or list of PCIeSERDESInterface
+		PCIe lane, or the lanes of a multi-lane link. The first lane is the primary lane which is used for training,
+		the other lanes follow it and are only checked for their link and lane numbers in Configuration.Linkwidth.*.
+	tx : PCIePhyTX or list of PCIePhyTX
+		PCIe transmitter, one per lane
+	rx : PCIePhyRX or list of PCIePhyRX
+		PCIe receiver, one per lane
 	upstream : Boolean
 		Whether it is an upstream port. True by default.
 		An upstream port is the port type on a PCIe card which connects to a root hub or a switch.
 		Within a device it is the port closest to the root complex, others are downstream ports (if it has only one connection towards the root complex)
+	support_5GTps : Boolean
+		Whether 5 GT/s is supported. The link is trained at 2.5 GT/s and changed to 5 GT/s through Recovery.Speed.
+	autonomous_speed_change : Boolean
+		Whether to change to 5 GT/s on its own once the link is up and both sides support it.
+		If such a speed change fails, it is not attempted again until speed_change_request is asserted.
+	n_fts : int
+		Number of fast training sequences the receiver needs to leave L0s, it is advertised in the training sequences.
+		ConfigurationMemory.make_init derives the L0s exit latency from it.
+	link_widths : list of int
+		Link widths which may be negotiated, by default all which the lanes support, see supported_widths.
+		If the usable lanes allow none of them, the link isn't configured and the LTSSM times out to Detect.
+
+	Attributes
+	----------
+	speed_change_request : Signal()
+		Asserting it in L0 changes the link to 5 GT/s if both sides support it
+	aspm_control : Signal(2)
+		ASPM Control field of the Link Control register, bit 0 enables L0s and bit 1 enables L1
+	tx_pending : Signal()
+		Whether a TLP is waiting to be sent or being sent, connect to PCIeDLLTLPTransmitter.pending
+	tx_busy : Signal()
+		Whether a packet is being sent or a DLLP is waiting to be sent, connect to PCIeDLLPTransmitter.busy
+	tx_acknowledged : Signal()
+		Whether all TLPs which were sent have been acknowledged, the link only goes to L1 then
+	block_tlps : Signal()
+		Asserted while no new TLPs may be sent during the handshake for L1, connect to PCIeDLLPTransmitter.block_tlps
+	pm_send : Signal()
+		Send power management DLLPs of type pm_type, connect to PCIeDLL.pm_send
+	pm_type : Signal(3)
+		PMType of the power management DLLPs to send, connect to PCIeDLL.pm_type
+	pm_received : Signal()
+		Asserted for one cycle when a power management DLLP of type pm_received_type has been received
+	pm_received_type : Signal(3)
+		PMType of the received power management DLLP
+	tx_l0s_state : Signal(2)
+		Substate of the transmitter in L0s
+	rx_l0s_state : Signal(2)
+		Substate of the receiver in L0s
 	"""
-	def __init__(self, lane : PCIeSERDESInterface, tx : PCIePhyTX, rx : PCIePhyRX, upstream = True, support_5GTps = True, disable_scrambling = False):
-		assert lane.ratio == 4
-		self.lane = lane
+	def __init__(self, lane : PCIeSERDESInterface, tx : PCIePhyTX, rx : PCIePhyRX, upstream = True, support_5GTps = True, disable_scrambling = False, autonomous_speed_change = True, n_fts = 128, link_widths = None):
+		self.lanes = lane if isinstance(lane, list) else [lane]
+		self.txs = tx if isinstance(tx, list) else [tx]
+		self.rxs = rx if isinstance(rx, list) else [rx]
+		assert len(self.lanes) == len(self.txs) == len(self.rxs)
+		assert all(lane.ratio == self.lanes[0].ratio for lane in self.lanes) and self.lanes[0].ratio in [4, 8]
+		self.lane = self.lanes[0]
 		self.status = Record(ltssm_layout)
-		self.tx = tx
-		self.rx = rx
+		self.tx = self.txs[0]
+		self.rx = self.rxs[0]
 		self.upstream = upstream
 
 		# Debug
@@ -63,21 +118,42 @@ class PCIeLTSSM(Elaboratable): # Based on Yumewatary phy.py
 		self.rx_ts_count = Signal(range(16 + 1))
 		self.tx_ts_count = Signal(range(1024 + 1))
 		self.extra_signals = Signal(8) # Extra signals, assigned in each state
-		self.clocks_per_ms = Mux(self.lane.speed == LinkSpeed.S2_5, 62500, 125000)
-		self.clocks_per_ms_max = 125000 # Equals the maximum frequency multiplied by 1 ms
-		self.ui_per_clock = 40 # 10 UI per symbol, 4 wide gearing
+		ratio = self.lane.ratio
+		self.clocks_per_ms = Mux(self.lane.speed == LinkSpeed.S2_5, 250000 // ratio, 500000 // ratio)
+		self.clocks_per_ms_max = 500000 // ratio # Equals the maximum frequency multiplied by 1 ms
+		self.ui_per_clock = 10 * ratio # 10 UI per symbol
 		self.simulate = False # Set to true to make it go faster, for example only count to 64 instead of 1024 TS in Polling.Active
 		self.timer = Signal(range(64 * self.clocks_per_ms_max + 1))
 
 		self.support_5GTps = support_5GTps
+		self.autonomous_speed_change = autonomous_speed_change
+		self.speed_change_request = Signal()
 		self.disable_scrambling = disable_scrambling
 
+		assert 0 <= n_fts <= 255
+		self.n_fts = n_fts
+		self.link_widths = supported_widths(len(self.lanes)) if link_widths is None else link_widths
+		assert set(self.link_widths) <= set(supported_widths(len(self.lanes)))
+		self.aspm_control = Signal(2)
+		self.tx_pending = Signal()
+		self.tx_busy = Signal()
+		self.tx_acknowledged = Signal()
+		self.block_tlps = Signal()
+		self.pm_send = Signal()
+		self.pm_type = Signal(3)
+		self.pm_received = Signal()
+		self.pm_received_type = Signal(3)
+		self.tx_l0s_state = Signal(2, decoder=L0sState)
+		self.rx_l0s_state = Signal(2, decoder=L0sState)
+
 		self.state = [
 			self.debug_state,
 			self.rx_ts_count,
 			self.tx_ts_count,
 			self.extra_signals,
-			self.status
+			self.status,
+			self.tx_l0s_state,
+			self.rx_l0s_state,
 		]
 
 	def elaborate(self, platform: Platform) -> Module: # TODO: Think about clock domains! (assuming RX, TX pll lock, the discrepancy is 0 on average)
@@ -111,8 +187,61 @@ class PCIeLTSSM(Elaboratable): # Based on Yumewatary phy.py
 		# Current FSM state, for debugging
 		debug_state = self.debug_state
 
+		# The other lanes of a multi-lane link follow the first one, apart from their lane numbers.
+		# Lanes which don't become part of the link stop transmitting data and go to electrical idle.
+		lane_count = len(self.lanes)
+		active_lanes = Signal(lane_count, reset=2 ** lane_count - 1)
+
+		for i in range(1, lane_count):
+			m.d.comb += [
+				self.lanes[i].tx_e_idle.eq(lane.tx_e_idle | Repl(~active_lanes[i], lane.ratio)),
+				self.lanes[i].det_enable.eq(lane.det_enable),
+				self.lanes[i].reset.eq(lane.reset),
+				self.rxs[i].ready.eq(rx.ready),
+				self.txs[i].ready.eq(tx.ready),
+				self.txs[i].idle.eq(tx.idle),
+				self.txs[i].idle_symbol.eq(tx.idle_symbol),
+				self.txs[i].ltssm_L0.eq(tx.ltssm_L0),
+				self.txs[i].eios.eq(tx.eios),
+				self.txs[i].fts.eq(tx.fts),
+				self.txs[i].skp.eq(tx.skp),
+				self.txs[i].ts.eq(tx.ts),
+				self.txs[i].ts.link.valid.eq(tx.ts.link.valid & active_lanes[i]),
+				self.txs[i].ts.lane.valid.eq(tx.ts.lane.valid & active_lanes[i]),
+				self.txs[i].ts.lane.number.eq(tx.ts.lane.number + i),
+			]
+
+		def negotiate_width(lanes_ok):
+			"""
+			Sets the link width to the widest of link_widths for which the first lanes are usable and disables the other lanes
+
+			Parameters:
+				lanes_ok: Value
+					One bit per lane, whether the lane can be part of the link
+			"""
+			for width in sorted(self.link_widths):
+				with m.If(lanes_ok[0:width].all()):
+					m.d.rx += status.link.width.eq(width)
+					m.d.rx += active_lanes.eq(2 ** width - 1)
+
+		def width_possible(lanes_ok):
+			"""
+			Whether the usable lanes allow any of link_widths, otherwise the link can't be configured
+			"""
+			return lanes_ok[0:min(self.link_widths)].all()
+
 		m.d.comb += tx.ts.rate.gen1.eq(1)
 		m.d.comb += tx.ts.rate.gen2.eq(self.support_5GTps)
+
+		# The lanes run at the speed selected in Recovery.Speed, this also changes clocks_per_ms
+		for i in range(lane_count):
+			m.d.comb += self.lanes[i].speed.eq(Mux(status.link.speed, LinkSpeed.S5_0, LinkSpeed.S2_5))
+
+		# Set when a speed change failed, which stops further autonomous speed changes
+		speed_change_failed = Signal()
+
+		# Number of TS2 sent in Recovery.RcvrCfg after a TS2 requesting a speed change has been received
+		speed_ts_count = Signal(range(32 + 1))
 		
 		m.d.rx += tx.ts.ctrl.loopback.eq(0)
 
@@ -126,6 +255,29 @@ class PCIeLTSSM(Elaboratable): # Based on Yumewatary phy.py
 
 		m.d.rx += self.tx.ltssm_L0.eq(0)
 
+		# Active State Power Management, see section 5.4.1 in PCIe Base 1.1.
+		# The transmitter and the receiver go to L0s on their own while the LTSSM stays in L0, their substates are kept in tx_l0s and rx_l0s.
+		tx_l0s = self.tx_l0s_state
+		rx_l0s = self.rx_l0s_state
+		m.d.comb += status.power_state.tx_l0s.eq(tx_l0s != L0sState.L0)
+		m.d.comb += status.power_state.rx_l0s.eq(rx_l0s != L0sState.L0)
+		m.d.rx += status.power_state.l1.eq(0)
+		m.d.rx += self.block_tlps.eq(0)
+		m.d.rx += self.pm_send.eq(0)
+
+		# Whether the upstream port is sending PM_Active_State_Request_L1 DLLPs, whether it has received a PM_Request_Ack DLLP
+		# and whether the other side didn't answer, which stops further requests until L1 is enabled again
+		l1_request = Signal()
+		l1_acknowledged = Signal()
+		l1_rejected = Signal()
+
+		# Whether the downstream port is sending PM_Request_Ack DLLPs and whether it has received the electrical idle ordered set afterwards
+		l1_acknowledge = Signal()
+		l1_eios_received = Signal()
+
+		# Set when the link leaves L0s or L1 through Recovery, the Data Link Layer stays up then
+		keep_link_up = Signal()
+
 		
 		def reset_ts_count_and_jump(next_state):
 			"""
@@ -141,6 +293,12 @@ class PCIeLTSSM(Elaboratable): # Based on Yumewatary phy.py
 			m.d.rx += tx_idl_count.eq(0)
 			m.d.rx += extra_signals.eq(0)
 			m.d.rx += timer.eq(0)
+			m.d.rx += tx_l0s.eq(L0sState.L0)
+			m.d.rx += rx_l0s.eq(L0sState.L0)
+			m.d.rx += l1_request.eq(0)
+			m.d.rx += l1_acknowledged.eq(0)
+			m.d.rx += l1_acknowledge.eq(0)
+			m.d.rx += l1_eios_received.eq(0)
 
 			m.next = next_state
 
@@ -183,7 +341,39 @@ class PCIeLTSSM(Elaboratable): # Based on Yumewatary phy.py
 
 			return timer
 
-		m.d.rx += tx.ts.n_fts.eq(0xFF)
+		def clocks(time_in_us):
+			"""
+			Approximate number of clock cycles in a time of less than a millisecond, at the current speed
+
+			Parameters:
+				time_in_us: float
+					Time in microseconds
+			"""
+			return (clocks_per_ms * math.ceil(time_in_us * 2 ** 20 / 1000)) >> 20
+
+		m.d.rx += tx.ts.n_fts.eq(self.n_fts)
+
+		# Number of cycles in which nothing has been sent, the transmitter goes to L0s after 7 µs at most and the link to L1 after a longer time
+		l0s_entry_time = 7
+		l1_entry_time = 32
+		idle_timer_max = clocks_per_ms_max * l1_entry_time // 1000 + 1
+		idle_timer = Signal(range(idle_timer_max + 1))
+		tx_idle = ~self.tx_pending & ~self.tx_busy
+
+		with m.If(~tx_idle):
+			m.d.rx += idle_timer.eq(0)
+
+		with m.Elif(idle_timer != idle_timer_max):
+			m.d.rx += idle_timer.eq(idle_timer + 1)
+
+		# After a rejected request the next one is only made once TLPs have been sent again
+		with m.If(~self.aspm_control[1] | self.tx_pending):
+			m.d.rx += l1_rejected.eq(0)
+
+		# Whether the upstream port starts the handshake for L1 in this cycle, it takes precedence over Tx_L0s
+		l1_start = Signal()
+		if upstream:
+			m.d.comb += l1_start.eq(~l1_request & self.aspm_control[1] & ~l1_rejected & self.tx_acknowledged & tx_idle & (idle_timer >= clocks(l1_entry_time)))
 
 
 		# Link Training and Status State Machine, Page 177 in PCIe 1.1, Page 244 in PCIe 3.0
@@ -194,8 +384,16 @@ class PCIeLTSSM(Elaboratable): # Based on Yumewatary phy.py
 
 				# The Link is now down and the TX SERDES is put into electrical idle
 				m.d.rx += status.link.up.eq(0)
+				m.d.rx += status.link.width.eq(0)
+				m.d.rx += active_lanes.eq(active_lanes.reset)
+
+				# Go back to 2.5 GT/s
+				m.d.rx += status.link.speed.eq(0)
+				m.d.rx += status.link.changed_speed_recovery.eq(0)
+				m.d.rx += status.directed_speed_change.eq(0)
+				m.d.rx += tx.ts.rate.speed_change.eq(0)
 				#m.d.rx += tx.eidle.eq(0b11)
-				m.d.rx += lane.tx_e_idle.eq(0b1111)
+				m.d.rx += lane.tx_e_idle.eq(Repl(1, lane.ratio))
 				m.d.rx += rx.ready.eq(0)
 				m.d.rx += tx.ready.eq(0)
 				m.d.rx += tx.idle.eq(0)
@@ -231,7 +429,7 @@ class PCIeLTSSM(Elaboratable): # Based on Yumewatary phy.py
 				# reset_ts_count_and_jump(State.Polling)
 
 				with m.If(timer > 20):
-					m.d.rx += lane.tx_e_idle.eq(0b0000)
+					m.d.rx += lane.tx_e_idle.eq(0)
 
 				with m.If(lane.det_valid):
 					# Wait until the detection result is there and disable lane detection again as soon as it is.
@@ -249,13 +447,14 @@ class PCIeLTSSM(Elaboratable): # Based on Yumewatary phy.py
 			with m.State(State.Polling_Active):
 				m.d.rx += debug_state.eq(State.Polling_Active)
 
-				# Send TS1 ordered sets with Link and Lane set to PAD
+				# Send TS1 ordered sets with Link and Lane set to PAD, the transmitter leaves electrical idle in case the receiver was detected early
 				m.d.rx += [
 					tx.ts.valid.eq(1),
 					tx.ts.ts_id.eq(0),
 					tx.ts.link.valid.eq(0),
 					tx.ts.lane.valid.eq(0),
 					tx_ts_count.eq(0),
+					lane.tx_e_idle.eq(0),
 				]
 				m.d.rx += rx_ts_count.eq(0)
 				reset_ts_count_and_jump(State.Polling_Active_TS)
@@ -359,6 +558,10 @@ class PCIeLTSSM(Elaboratable): # Based on Yumewatary phy.py
 					& rx.ts.link.valid & ~rx.ts.lane.valid):
 						m.d.rx += tx.ts.link.valid.eq(1)
 						m.d.rx += tx.ts.link.number.eq(rx.ts.link.number)
+						# Only lanes which received the same link number become part of the link
+						m.d.rx += active_lanes.eq(Cat(1, *(
+							rxn.ts.valid & (rxn.ts.ts_id == 0) & rxn.ts.link.valid & (rxn.ts.link.number == rx.ts.link.number)
+							for rxn in self.rxs[1:])))
 						reset_ts_count_and_jump(State.Configuration_Linkwidth_Accept)
 				
 				else:
@@ -382,7 +585,12 @@ class PCIeLTSSM(Elaboratable): # Based on Yumewatary phy.py
 
 					# Accept TS1s with Link=Link_num Lane=PAD
 					with m.If(received_padpad & rx.ts.valid & (rx.ts.ts_id == 0) & rx.ts.link.valid & (rx.ts.link.number == link_num) & ~rx.ts.lane.valid):
-						with m.If(tx_ts_count >= 2):
+						lanes_ok = Cat(1, *(
+							rxn.ts.valid & (rxn.ts.ts_id == 0) & rxn.ts.link.valid & (rxn.ts.link.number == link_num)
+							for rxn in self.rxs[1:]))
+
+						with m.If((tx_ts_count >= 2) & width_possible(lanes_ok)):
+							negotiate_width(lanes_ok)
 							reset_ts_count_and_jump(State.Configuration_Linkwidth_Accept)
 
 					with m.Else():
@@ -397,11 +605,17 @@ class PCIeLTSSM(Elaboratable): # Based on Yumewatary phy.py
 
 				if upstream:
 					# Accept TS1 Link=Upstream-Link Lane=Upstream-Lane
-					# with the lane number 0, in a x4 implementation it should be lane-dependent.
+					# with the lane number 0, the other lanes of the link need to have the lane numbers 1, 2, ...
+					# The link is as wide as the lanes with matching lane numbers allow, lane reversal is not supported.
 					# Report back that the received lane is valid.
 					#with m.If(rx.ts_received):
 					with m.If(rx.ts.valid & (rx.ts.ts_id == 0) & rx.ts.link.valid & rx.ts.lane.valid & rx.consecutive):
-						with m.If(rx.ts.lane.number == 0):
+						lanes_ok = active_lanes & Cat(1, *(
+							rxn.ts.valid & (rxn.ts.ts_id == 0) & rxn.ts.link.valid & rxn.ts.lane.valid & (rxn.ts.lane.number == i + 1)
+							for i, rxn in enumerate(self.rxs[1:])))
+
+						with m.If((rx.ts.lane.number == 0) & width_possible(lanes_ok)):
+							negotiate_width(lanes_ok)
 							m.d.rx += tx.ts.lane.valid.eq(1)
 							m.d.rx += tx.ts.lane.number.eq(rx.ts.lane.number)
 							reset_ts_count_and_jump(State.Configuration_Lanenum_Wait)
@@ -493,7 +707,7 @@ class PCIeLTSSM(Elaboratable): # Based on Yumewatary phy.py
 				# And reset the TS counts.
 				m.d.rx += [
 					tx.ts.ts_id.eq(1),
-					tx.ts.n_fts.eq(0xFF),
+					tx.ts.n_fts.eq(self.n_fts),
 					tx_ts_count.eq(0),
 					rx_ts_count.eq(0),
 				]
@@ -609,12 +823,22 @@ class PCIeLTSSM(Elaboratable): # Based on Yumewatary phy.py
 				m.d.rx += [
 					tx.ts.valid.eq(1),
 					tx.ts.ts_id.eq(0),
-					status.link.up.eq(0), # Not sure if this is right
 					rx.ready.eq(0),
 					tx.ready.eq(0),
-					tx.ts.rate.speed_change.eq(tx.ts.rate.speed_change | status.directed_speed_change),
+					tx.ts.rate.speed_change.eq(status.directed_speed_change),
+					speed_ts_count.eq(0),
+					lane.tx_e_idle.eq(0),
 				]
 
+				# The Data Link Layer stays up when the link leaves L0s or L1
+				with m.If(~keep_link_up):
+					m.d.rx += status.link.up.eq(0) # Not sure if this is right
+
+				# Follow a speed change requested by the other side if both sides support 5 GT/s
+				if self.support_5GTps:
+					with m.If((rx_ts_count == 8) & rx.ts.rate.speed_change & rx.ts.rate.gen2 & ~status.link.speed):
+						m.d.rx += status.directed_speed_change.eq(1)
+
 				# If a TS is received with the link and lane numbers matching the configured ones and 8 such have been received, go to Recovery.RcvrCfg
 				with m.If(rx.ts_received & rx.ts.valid & rx.ts.link.valid & rx.ts.lane.valid & rx.consecutive &
 					(rx.ts.link.number == tx.ts.link.number) &
@@ -636,25 +860,75 @@ class PCIeLTSSM(Elaboratable): # Based on Yumewatary phy.py
 						# TODO: Add "| 5 GT/s DRI in TX TS1 & in 8x RX TS2"
 				
 				with m.Elif(timer >= 24 * clocks_per_ms):
+					# The link doesn't work at the new speed, go back to 2.5 GT/s
 					with m.If(status.link.changed_speed_recovery):
+						m.d.rx += status.link.successful_speed_negotiation.eq(0)
 						reset_ts_count_and_jump(State.Recovery_Speed)
 					
+					# The link doesn't work at 5 GT/s anymore, try 2.5 GT/s
 					with m.Elif(~status.link.changed_speed_recovery & status.link.speed):
+						m.d.rx += status.link.successful_speed_negotiation.eq(0)
 						reset_ts_count_and_jump(State.Recovery_Speed)
 
 					# TODO: Add jump to Configuration.Linkwidth.Start
 					
 					with m.Else():
+						m.d.rx += speed_change_failed.eq(speed_change_failed | status.directed_speed_change)
+						m.d.rx += status.directed_speed_change.eq(0)
 						reset_ts_count_and_jump(State.Detect)
 			
 
 			with m.State(State.Recovery_Speed):
-				stimer = Signal(range(int(16000 / ui_per_clock) + 1))
-				m.d.rx += stimer.eq(stimer + 1)
-				
-				with m.If(status.link.successful_speed_negotiation):
-					with m.If(rx.ts_received):
-						m.d.rx += stimer.eq(0)
+				m.d.rx += debug_state.eq(State.Recovery_Speed)
+				m.d.rx += timer.eq(timer + 1)
+
+				m.d.rx += [
+					tx.ts.valid.eq(0),
+					tx.idle.eq(0),
+					rx.ready.eq(0),
+					tx.ready.eq(0),
+				]
+
+				# Send two EIOS and then go to electrical idle, extra_signals[0] is set once the transmitter is in electrical idle
+				with m.If(~extra_signals[0]):
+					m.d.comb += tx.eios.eq(1)
+
+					with m.If(tx.eios_sent):
+						m.d.rx += tx_ts_count.eq(tx_ts_count + 1)
+
+						with m.If(tx_ts_count == 1):
+							m.d.rx += lane.tx_e_idle.eq(Repl(1, lane.ratio))
+							m.d.rx += extra_signals[0].eq(1)
+
+				# The receiver is in electrical idle when an EIOS has been received,
+				# or inferred when no TS has been received for 4680 UI after a successful speed negotiation, 2000 UI otherwise.
+				# extra_signals[1] is set once the receiver is in electrical idle.
+				stimer = Signal(range(int(4680 / ui_per_clock) + 1))
+
+				with m.If(rx.ts_received):
+					m.d.rx += stimer.eq(0)
+
+				with m.Elif(stimer < int(4680 / ui_per_clock)):
+					m.d.rx += stimer.eq(stimer + 1)
+
+				with m.If(rx.eios_received | (stimer >= Mux(status.link.successful_speed_negotiation, int(4680 / ui_per_clock), int(2000 / ui_per_clock)))):
+					m.d.rx += extra_signals[1].eq(1)
+
+				# Both sides need to be in electrical idle for at least 800 ns after a successful speed negotiation, 6 µs otherwise
+				with m.If(~(extra_signals[0] & extra_signals[1])):
+					m.d.rx += timer.eq(0)
+
+				with m.Elif(timer >= Mux(status.link.successful_speed_negotiation, clocks(0.8), clocks(6))):
+					# Change to 5 GT/s after a successful speed negotiation, otherwise go back to 2.5 GT/s.
+					# The SERDES is reset on the speed change and electrical idle ends with the TS1 sent in Recovery.RcvrLock.
+					m.d.rx += [
+						status.link.speed.eq(status.link.successful_speed_negotiation),
+						status.link.changed_speed_recovery.eq(status.link.successful_speed_negotiation),
+						status.directed_speed_change.eq(0),
+						speed_change_failed.eq(speed_change_failed | ~status.link.successful_speed_negotiation),
+						lane.tx_e_idle.eq(0),
+					]
+					reset_ts_count_and_jump(State.Recovery_RcvrLock)
 
 
 			with m.State(State.Recovery_RcvrCfg): # Revise when implementing 5 GT/s, page 290
@@ -665,7 +939,8 @@ class PCIeLTSSM(Elaboratable): # Based on Yumewatary phy.py
 				# Send TS2 ordered sets with same Link and Lane as configured
 				m.d.rx += [
 					tx.ts.valid.eq(1),
-					tx.ts.ts_id.eq(1)
+					tx.ts.ts_id.eq(1),
+					tx.ts.rate.speed_change.eq(status.directed_speed_change),
 				]
 
 				last_ts = Signal()
@@ -686,23 +961,46 @@ class PCIeLTSSM(Elaboratable): # Based on Yumewatary phy.py
 				#	(rx.ts.lane.number == tx.ts.lane.number)):
 				#	m.d.rx += rx_ts_count.eq(rx_ts_count + 1)
 
+				# The counter stays at 8 until 16 TS2s have been sent, the other side might already be in Recovery.Idle after leaving L1.
+				# It is only reset one cycle after the ID changed, so the ID of the last TS is checked as well.
 				with m.If(rx.ts_received):
-					with m.If(rx.consecutive & (rx_ts_count < 8)):
-						m.d.rx += rx_ts_count.eq(rx_ts_count + 1)
-
-					with m.Else():
+					with m.If(~rx.consecutive):
 						m.d.rx += rx_ts_count.eq(0)
 
+					with m.Elif(rx_ts_count < 8):
+						m.d.rx += rx_ts_count.eq(rx_ts_count + 1)
+
 				#with m.If((rx_ts_count == 8) & (last_ts == 1) & (tx_ts_count == 16)):
-				with m.If((rx_ts_count == 8) & (tx_ts_count == 16) & (rx.ts.ts_id == 1) &
+				with m.If((rx_ts_count == 8) & (tx_ts_count == 16) & (rx.ts.ts_id == 1) & (last_ts == 1) &
 					rx.ts.valid & rx.ts.link.valid & rx.ts.lane.valid & (rx.ts.rate.speed_change == 0) &
 					(rx.ts.link.number == tx.ts.link.number) &
 					(rx.ts.lane.number == tx.ts.lane.number)):
 					m.d.rx += last_ts.eq(0)
+					m.d.rx += status.link.changed_speed_recovery.eq(0)
+					m.d.rx += status.directed_speed_change.eq(0)
 					reset_ts_count_and_jump(State.Recovery_Idle)
+
+				# Change the speed after 8 TS2 requesting a speed change have been received and 32 have been sent after the first one,
+				# extra_signals[0] is set once the first one has been received
+				if self.support_5GTps:
+					with m.If(rx.ts_received & (rx.ts.ts_id == 1) & rx.ts.rate.speed_change):
+						m.d.rx += extra_signals[0].eq(1)
+
+					with m.If(tx.start_send_ts & extra_signals[0] & (speed_ts_count < 32)):
+						m.d.rx += speed_ts_count.eq(speed_ts_count + 1)
+
+					with m.If(status.directed_speed_change & (rx_ts_count == 8) & (speed_ts_count == 32) & (rx.ts.ts_id == 1) & (last_ts == 1) &
+						rx.ts.rate.speed_change & rx.ts.rate.gen2):
+						m.d.rx += last_ts.eq(0)
+						m.d.rx += status.link.successful_speed_negotiation.eq(1)
+						reset_ts_count_and_jump(State.Recovery_Speed)
 				
-				# If 8 TS1s have been received and 16 TS2s sent, go back to Configuration
-				with m.If((rx_ts_count == 8) & (rx.ts.ts_id == 0) & (tx_ts_count == 16) & (rx.ts.rate.speed_change == 0)):
+				# If 8 TS1s with a different link or lane number have been received and 16 TS2s sent, go back to Configuration.
+				# TS1s with matching numbers are sent by the other side while it is still in Recovery.RcvrLock.
+				with m.If((rx_ts_count == 8) & (rx.ts.ts_id == 0) & (last_ts == 0) & (tx_ts_count == 16) & (rx.ts.rate.speed_change == 0) &
+					(~rx.ts.link.valid | ~rx.ts.lane.valid |
+					(rx.ts.link.number != tx.ts.link.number) |
+					(rx.ts.lane.number != tx.ts.lane.number))):
 					reset_ts_count_and_jump(State.Configuration)
 
 
@@ -711,6 +1009,7 @@ class PCIeLTSSM(Elaboratable): # Based on Yumewatary phy.py
 				
 				# Set the transmitter to send IDL symbols
 				m.d.rx += tx.idle.eq(1)
+				m.d.rx += tx.ts.valid.eq(0)
 
 				# TODO: Add Hot Reset state
 				if(upstream):
@@ -765,29 +1064,226 @@ class PCIeLTSSM(Elaboratable): # Based on Yumewatary phy.py
 				m.d.rx += status.link.up.eq(1)
 				m.d.rx += rx.ready.eq(1)
 				m.d.rx += tx.ready.eq(1)
+				m.d.rx += keep_link_up.eq(0)
 				
 				with m.If(rx.has_symbol(Ctrl.STP) | rx.has_symbol(Ctrl.SDP)):
 					m.d.rx += status.idle_to_rlock_transitioned.eq(0)
 				
-				with m.If(rx.ts_received):
-					# TODO: Record speed here for Recovery
+				# In Rx_L0s the receiver only sees noise until it has locked again, so only consecutive training sequences count
+				with m.If(rx.ts_received & ((rx_l0s == L0sState.L0) | rx.consecutive)):
+					m.d.rx += keep_link_up.eq((rx_l0s != L0sState.L0) | (tx_l0s != L0sState.L0))
 					reset_ts_count_and_jump(State.Recovery)
+
+				# Go to Recovery to change the speed to 5 GT/s, if both sides support it
+				if self.support_5GTps:
+					change_speed = self.speed_change_request
+					if self.autonomous_speed_change:
+						change_speed |= ~speed_change_failed
+
+					with m.Elif(change_speed & ~status.link.speed & status.link.rate.gen2):
+						m.d.rx += status.directed_speed_change.eq(1)
+						m.d.rx += speed_change_failed.eq(0)
+						reset_ts_count_and_jump(State.Recovery)
 				
 
 				error_count = Signal(range(64))
 
-				# When more than 1/9 of cycles have errors, reset
-				with m.If(rx.has_symbol(Ctrl.Error)):
-					m.d.rx += error_count.eq(error_count + 8)
+				# When more than 1/9 of cycles have errors, reset. The receiver loses its lock in electrical idle, which isn't an error in L0s.
+				with m.If(rx_l0s == L0sState.L0):
+					with m.If(rx.has_symbol(Ctrl.Error)):
+						m.d.rx += error_count.eq(error_count + 8)
+
+						with m.If(error_count > 50):
+							reset_ts_count_and_jump(State.Detect)
 
-					with m.If(error_count > 50):
+					with m.Elif(error_count != 0):
+						m.d.rx += error_count.eq(error_count - 1)
+					
+					with m.If(~lane.rx_locked):
 						reset_ts_count_and_jump(State.Detect)
 
-				with m.Elif(error_count != 0):
-					m.d.rx += error_count.eq(error_count - 1)
-				
-				with m.If(~lane.rx_locked):
-					reset_ts_count_and_jump(State.Detect)
+				# Tx_L0s, once nothing has been sent for a while the transmitter sends an electrical idle ordered set and goes to electrical idle.
+				# When there is something to send, it sends as many fast training sequences as the other side asked for and a SKP ordered set,
+				# so the receiver on the other side can lock again. No new packet can start while tx.ready is 0, so none is cut off.
+				tx_timer = Signal(range(256 + 1))
+
+				with m.Switch(tx_l0s):
+					with m.Case(L0sState.L0):
+						with m.If(self.aspm_control[0] & tx_idle & (idle_timer >= clocks(l0s_entry_time)) & ~l1_start & ~l1_request & ~l1_acknowledge):
+							m.d.rx += [
+								tx_l0s.eq(L0sState.Entry),
+								tx.ready.eq(0),
+								self.tx.ltssm_L0.eq(0),
+							]
+
+					with m.Case(L0sState.Entry):
+						m.d.rx += tx.ready.eq(0)
+						m.d.rx += self.tx.ltssm_L0.eq(0)
+						m.d.comb += tx.eios.eq(1)
+
+						with m.If(tx.eios_sent):
+							m.d.rx += lane.tx_e_idle.eq(Repl(1, lane.ratio))
+							m.d.rx += tx_timer.eq(0)
+							m.d.rx += tx_l0s.eq(L0sState.Idle)
+
+					# The transmitter stays in electrical idle for at least 20 ns
+					with m.Case(L0sState.Idle):
+						m.d.rx += tx.ready.eq(0)
+						m.d.rx += self.tx.ltssm_L0.eq(0)
+
+						with m.If(tx_timer < 3):
+							m.d.rx += tx_timer.eq(tx_timer + 1)
+
+						with m.Elif(~tx_idle):
+							m.d.rx += lane.tx_e_idle.eq(0)
+							m.d.rx += tx_timer.eq(0)
+							m.d.rx += tx_l0s.eq(L0sState.FTS)
+
+					with m.Case(L0sState.FTS):
+						m.d.rx += tx_timer.eq(tx_timer + 1)
+
+						# With more than 4 symbols per word several fast training sequences are sent in one word
+						with m.If(tx_timer * (lane.ratio // 4) < status.link.n_fts):
+							m.d.rx += tx.ready.eq(0)
+							m.d.rx += self.tx.ltssm_L0.eq(0)
+							m.d.comb += tx.fts.eq(1)
+
+						with m.Else():
+							m.d.comb += tx.skp.eq(1)
+							m.d.rx += tx_l0s.eq(L0sState.L0)
+
+				# Rx_L0s, the receiver waits for the fast training sequences after an electrical idle ordered set and is ready again after the SKP ordered set.
+				# If it doesn't arrive in time, the link is retrained in Recovery.
+				rx_timer = Signal(range(2 * self.n_fts + 16 + 1))
+
+				with m.Switch(rx_l0s):
+					with m.Case(L0sState.L0):
+						with m.If(rx.eios_received & ~l1_acknowledge):
+							m.d.rx += rx.ready.eq(0)
+							m.d.rx += rx_l0s.eq(L0sState.Idle)
+
+					with m.Case(L0sState.Idle):
+						m.d.rx += rx.ready.eq(0)
+
+						with m.If(rx.has_symbol(Ctrl.FTS)):
+							m.d.rx += rx_timer.eq(0)
+							m.d.rx += rx_l0s.eq(L0sState.FTS)
+
+					with m.Case(L0sState.FTS):
+						m.d.rx += rx_timer.eq(rx_timer + 1)
+
+						with m.If(rx.has_symbol(Ctrl.SKP)):
+							m.d.rx += rx_l0s.eq(L0sState.L0)
+
+						with m.Elif(rx_timer == 2 * self.n_fts + 16):
+							m.d.rx += keep_link_up.eq(1)
+							reset_ts_count_and_jump(State.Recovery)
+
+						with m.Else():
+							m.d.rx += rx.ready.eq(0)
+
+				# The handshake for L1 is started by the upstream port once all its TLPs have been acknowledged and it has been idle for a while.
+				# It stops sending TLPs and sends PM_Active_State_Request_L1 DLLPs until the downstream port answers with PM_Request_Ack DLLPs,
+				# which it sends once all of its TLPs have been acknowledged as well. The upstream port then sends an electrical idle ordered set,
+				# the downstream port answers with one and both go to L1. The DLLPs which are being sent are sent completely first.
+				l1_timer = Signal(range(clocks_per_ms_max + 1))
+
+				if upstream:
+					with m.If(l1_start):
+						m.d.rx += l1_request.eq(1)
+						m.d.rx += l1_timer.eq(0)
+						m.d.rx += self.block_tlps.eq(1)
+
+					with m.Elif(l1_request):
+						l1_ack = self.pm_received & (self.pm_received_type == PMType.Request_Ack)
+
+						# The transmitter might have to leave Tx_L0s first
+						with m.If(tx_l0s == L0sState.L0):
+							m.d.rx += l1_timer.eq(l1_timer + 1)
+
+						m.d.rx += self.block_tlps.eq(1)
+						m.d.rx += self.pm_send.eq(self.tx_acknowledged & ~l1_acknowledged & ~l1_ack)
+						m.d.rx += self.pm_type.eq(PMType.Active_State_Request_L1)
+
+						with m.If(l1_ack):
+							m.d.rx += l1_acknowledged.eq(1)
+
+						with m.If(l1_acknowledged & ~self.tx_busy & (tx_l0s == L0sState.L0)):
+							reset_ts_count_and_jump(State.L1_Entry)
+
+						# A downstream port which doesn't support L1 answers with a PM_Active_State_Nak Message
+						with m.Elif(~l1_acknowledged & (l1_timer >= clocks_per_ms)):
+							m.d.rx += l1_request.eq(0)
+							m.d.rx += l1_rejected.eq(1)
+
+				else:
+					with m.If(~l1_acknowledge):
+						with m.If(self.aspm_control[1] & self.pm_received & (self.pm_received_type == PMType.Active_State_Request_L1)):
+							m.d.rx += l1_acknowledge.eq(1)
+							m.d.rx += l1_timer.eq(0)
+							m.d.rx += self.block_tlps.eq(1)
+
+					with m.Else():
+						with m.If(tx_l0s == L0sState.L0):
+							m.d.rx += l1_timer.eq(l1_timer + 1)
+
+						m.d.rx += self.block_tlps.eq(1)
+						m.d.rx += self.pm_send.eq(self.tx_acknowledged & ~l1_eios_received & ~rx.eios_received)
+						m.d.rx += self.pm_type.eq(PMType.Request_Ack)
+
+						with m.If(rx.eios_received):
+							m.d.rx += l1_eios_received.eq(1)
+
+						# The receiver is in electrical idle already
+						with m.If(l1_eios_received & ~self.tx_busy):
+							reset_ts_count_and_jump(State.L1_Entry)
+							m.d.rx += extra_signals[1].eq(1)
+
+						with m.Elif(~l1_eios_received & (l1_timer >= clocks_per_ms)):
+							m.d.rx += l1_acknowledge.eq(0)
+
+
+			# Send an electrical idle ordered set and go to electrical idle, extra_signals[0] is set once the transmitter is in electrical idle
+			# and extra_signals[1] once the electrical idle ordered set of the other side has been received
+			with m.State(State.L1_Entry):
+				m.d.rx += debug_state.eq(State.L1_Entry)
+				m.d.rx += timer.eq(timer + 1)
+				m.d.rx += [
+					rx.ready.eq(0),
+					tx.ready.eq(0),
+					self.block_tlps.eq(1),
+					status.power_state.l1.eq(1),
+				]
+
+				with m.If(~extra_signals[0]):
+					m.d.comb += tx.eios.eq(1)
+
+					with m.If(tx.eios_sent):
+						m.d.rx += lane.tx_e_idle.eq(Repl(1, lane.ratio))
+						m.d.rx += extra_signals[0].eq(1)
+
+				with m.If(rx.eios_received):
+					m.d.rx += extra_signals[1].eq(1)
+
+				with m.If(extra_signals[0] & extra_signals[1]):
+					reset_ts_count_and_jump(State.L1_Idle)
+
+				with m.Elif(timer >= 2 * clocks_per_ms):
+					m.d.rx += keep_link_up.eq(1)
+					reset_ts_count_and_jump(State.Recovery)
+
+			# L1 is left through Recovery when there is something to send or the other side has started Recovery
+			with m.State(State.L1_Idle):
+				m.d.rx += debug_state.eq(State.L1_Idle)
+				m.d.rx += [
+					rx.ready.eq(0),
+					tx.ready.eq(0),
+					status.power_state.l1.eq(1),
+				]
+
+				with m.If(self.tx_pending | self.tx_busy | (rx.ts_received & rx.consecutive)):
+					m.d.rx += keep_link_up.eq(1)
+					reset_ts_count_and_jump(State.Recovery)
 			
 
 			with m.State(State.Disabled):
@@ -26,9 +26,10 @@ class TLPBuffer(Elaboratable):
 		self.ratio = ratio
 
 		self.tlp_sink = StreamInterface(8, ratio, name="TLP_Sink")
-		"""Connect this to the TLP source, when all_valid goes low it marks the end of a TLP"""
+		"""Connect this to the TLP source, when all_valid goes low it marks the end of a TLP. The next TLP can follow after a cycle without valid data.
+		A word whose last group of 4 symbols isn't valid also ends a TLP, then the next one can follow right after it"""
 		self.tlp_source = StreamInterface(8, ratio, name="TLP_Source")
-		"""Connect this to the TLP sink"""
+		"""Connect this to the TLP sink, the valid symbols of the last word of a TLP are the ones it was stored with"""
 
 		self.max_tlps = max_tlps
 		"""Number of TLPs to maximally store"""
@@ -55,9 +56,13 @@ class TLPBuffer(Elaboratable):
 		self.store_tlp_id = Signal(12)
 		"""The ID of the TLP to be stored, can be set 1 cycle later than store_tlp"""
 		self.store_tlp = Signal()
-		"""Set to 1 for 1 cycle to start storing a TLP"""
+		"""Set to 1 for 1 cycle to start storing a TLP, 1 or 2 cycles before its first word. It can be set while the previous TLP is ending"""
 		self.storing_tlp = Signal()
 		"""Is 1 while TLP is being stored"""
+		self.tlp_stored = Signal()
+		"""Whether the TLP of the last store_tlp got a slot, valid from 2 cycles after store_tlp on. If it didn't, the TLP is dropped and must not be acknowledged"""
+		self.discard_tlp = Signal()
+		"""Set to 1 for 1 cycle while a TLP is being stored, up to 2 cycles after its last word, to not keep it. For example if its LCRC is wrong"""
 
 		self.slots_full = Signal(reset = 0)
 		"""Whether all TLP slots are full, check for free space with ~slots_full"""
@@ -77,41 +82,40 @@ class TLPBuffer(Elaboratable):
 	def elaborate(self, platform: Platform) -> Module:
 		m = Module()
 
-		storage = Memory(width = self.ratio * 8 + 1, depth = self.tlp_depth * self.max_tlps)
+		# A word holds its symbols, whether every group of 4 symbols after the first one is valid and, in the last bit, whether it is the last word of the TLP
+		groups = self.ratio // 4
+		storage = Memory(width = self.ratio * 8 + groups, depth = self.tlp_depth * self.max_tlps)
 
 		read_port  = m.submodules.read_port  = storage.read_port(domain = "rx", transparent = False)
 		write_port = m.submodules.write_port = storage.write_port(domain = "rx")
 
-		slots_empty_statement = 1
-		for i in range(self.max_tlps):
-			slots_empty_statement = slots_empty_statement & ~self.slots[i][0]
-
-		m.d.comb += self.slots_empty.eq(slots_empty_statement)
+		valid = Cat(slot[0] for slot in self.slots)
 
-		slots_full_statement = 1
-		for i in range(self.max_tlps):
-			slots_full_statement = slots_full_statement & self.slots[i][0]
-
-		m.d.comb += self.slots_full.eq(slots_full_statement) # TODO: Maybe replace with Cat([i[0] for i in self.slots]).all()? (~….any() for slots_empty)
+		m.d.comb += self.slots_empty.eq(~valid.any())
+		m.d.comb += self.slots_full.eq(valid.all())
 
 		read_address_base = Signal(range(self.max_tlps))
 		read_address_counter = Signal(range(self.tlp_depth))
 		m.d.comb += read_port.addr.eq(Cat(read_address_counter, read_address_base))
-		m.d.rx += Cat(self.tlp_source.symbol).eq(read_port.data[:-1])
+		m.d.rx += Cat(self.tlp_source.symbol).eq(read_port.data[:self.ratio * 8])
+		group_valid = Cat(1, read_port.data[self.ratio * 8 : -1])
 
 		tlp_source_valid = Signal(2)
 		m.d.rx += tlp_source_valid.eq(tlp_source_valid << 1)
 		m.d.rx += tlp_source_valid[0].eq(0)
-		m.d.rx += [self.tlp_source.valid[i].eq(tlp_source_valid[-1]) for i in range(self.ratio)]
+		m.d.rx += [self.tlp_source.valid[i].eq(tlp_source_valid[-1] & group_valid[i // 4]) for i in range(self.ratio)]
 		m.d.rx += read_port.en.eq(1)
 
 
-		valid_id_check = 0
+		# Slots are looked up by comparing every slot at once, like a CAM, the one-hot results are encoded with an OR tree.
+		# The lookups for sending and the free slot for storing are registered, so their depth doesn't end up in the FSMs.
+		m.d.comb += self.in_buffer.eq(_slot_match(self.slots, self.in_buffer_id).any())
 
-		for i in range(self.max_tlps):
-			valid_id_check = valid_id_check | self.slots[i][0] & (self.slots[i][1] == self.in_buffer_id)
-		
-		m.d.comb += self.in_buffer.eq(valid_id_check)
+		send_match = _slot_match(self.slots, self.send_tlp_id)
+		send_slot = Signal(range(self.max_tlps))
+		send_slot_valid = Signal()
+		m.d.rx += send_slot.eq(_encode_one_hot(send_match, len(send_slot)))
+		m.d.rx += send_slot_valid.eq(send_match.any())
 
 		with m.If(self.slots_empty):
 			m.d.rx += self.slots_occupied.eq(0)
@@ -122,25 +126,21 @@ class TLPBuffer(Elaboratable):
 				m.d.rx += tlp_source_valid[1].eq(0)
 				with m.If(self.send_tlp):
 					m.d.rx += self.sending_tlp.eq(1)
-					m.next = "Set offset"
+					m.next = "Lookup"
 					
 				with m.Else():
 					m.d.rx += self.sending_tlp.eq(0)
 
-			with m.State("Set offset"):
-				offset = 0
-				valid_id = 0
+			with m.State("Lookup"): # send_tlp_id is set now, the lookup is registered in this cycle
+				m.next = "Set offset"
 
-				for i in range(self.max_tlps):
-					offset = Mux(self.slots[i][0] & (self.slots[i][1] == self.send_tlp_id), i, offset)
-					valid_id = valid_id | self.slots[i][0] & (self.slots[i][1] == self.send_tlp_id)
-
-				m.d.rx += read_address_base.eq(offset)
+			with m.State("Set offset"):
+				m.d.rx += read_address_base.eq(send_slot)
 
-				with m.If(valid_id & self.tlp_source.ready):
+				with m.If(send_slot_valid & self.tlp_source.ready):
 					m.next = "Transmit"
 					
-				with m.Elif(~valid_id):
+				with m.Elif(~send_slot_valid):
 					m.d.rx += self.sending_tlp.eq(0)
 					m.next = "Idle"
 			
@@ -163,11 +163,14 @@ class TLPBuffer(Elaboratable):
 		
 
 		# Dereference pointer
-		with m.If(self.delete_tlp):
+		delete_match = _slot_match(self.slots, self.delete_tlp_id)
+
+		with m.If(self.delete_tlp & delete_match.any()):
 			for i in range(self.max_tlps):
-				with m.If(self.slots[i][0] & (self.delete_tlp_id == self.slots[i][1])):
+				with m.If(delete_match[i]):
 					m.d.rx += self.slots[i][0].eq(0)
-					m.d.rx += self.slots_occupied.eq(self.slots_occupied - 1)
+
+			m.d.rx += self.slots_occupied.eq(self.slots_occupied - 1)
 
 
 		end_tlp = Signal()
@@ -175,7 +178,10 @@ class TLPBuffer(Elaboratable):
 		write_address_base = Signal(range(self.max_tlps))
 		write_address_counter = Signal(range(self.tlp_depth), reset = 0)
 		m.d.comb += write_port.addr.eq(Cat(write_address_counter, write_address_base))
-		m.d.rx += write_port.data.eq(Cat(self.tlp_sink.symbol))
+		# A partial word is written as the last word right away
+		partial = Signal()
+		m.d.comb += partial.eq(self.tlp_sink.all_valid & ~self.tlp_sink.valid[-1])
+		m.d.rx += write_port.data.eq(Cat(Cat(self.tlp_sink.symbol), Cat(self.tlp_sink.valid[4 * g] for g in range(1, groups)), partial))
 
 		m.d.rx += self.tlp_sink.ready.eq(0)
 		m.d.rx += write_port.en.eq(0)
@@ -184,11 +190,35 @@ class TLPBuffer(Elaboratable):
 		m.d.rx += tlp_sink_last_valid.eq(tlp_sink_last_valid << 1)
 		m.d.rx += tlp_sink_last_valid[0].eq(self.tlp_sink.all_valid)
 
-		with m.FSM(name = "store_fsm", domain = "rx"):
-			offset = 0
-			slot_exists = 0
+		tlp_sink_last_partial = Signal(2)
+		m.d.rx += tlp_sink_last_partial.eq(tlp_sink_last_partial << 1)
+		m.d.rx += tlp_sink_last_partial[0].eq(partial)
+
+		# Lowest free slot and whether a TLP with the ID to be stored is already in the buffer, TLPs with the same ID aren't stored twice.
+		# The slot which is being written isn't free, so the next TLP can be stored right after the current one.
+		# Once the FSM has left Receive the slot is either valid or free again.
+		stored_tlp_id = Signal(12)
+		receiving = Signal()
+		free_slots = ~valid & ~Mux(receiving, Const(1, self.max_tlps) << write_address_base, 0)[:self.max_tlps]
+		free_slot = Signal(range(self.max_tlps))
+		free_slot_valid = Signal()
+		store_slot_exists = Signal()
+		m.d.rx += free_slot.eq(_encode_one_hot(free_slots & (~free_slots + 1), len(free_slot)))
+		m.d.rx += free_slot_valid.eq(free_slots.any())
+		m.d.rx += store_slot_exists.eq(_slot_match(self.slots, stored_tlp_id).any())
 
+		discarded = Signal()
+
+		with m.If(self.discard_tlp):
+			m.d.rx += discarded.eq(1)
+
+		store_pending = Signal() # The next TLP starts while the current one is ending
+
+		with m.FSM(name = "store_fsm", domain = "rx"):
 			with m.State("Idle"):
+				with m.If(self.store_tlp):
+					m.d.rx += self.tlp_stored.eq(~self.slots_full)
+
 				with m.If(self.store_tlp & ~self.slots_full):
 					m.next = "Set offset"
 					m.d.rx += self.storing_tlp.eq(1)
@@ -196,24 +226,27 @@ class TLPBuffer(Elaboratable):
 				with m.Else():
 					m.d.rx += self.storing_tlp.eq(0)
 
-			with m.State("Set offset"):
-
-				for i in range(self.max_tlps):
-					slot_exists = slot_exists | ((self.slots[i][1] == self.store_tlp_id) & self.slots[i][0])
-					offset = Mux(~self.slots[i][0], i, offset)
-
-				with m.If(slot_exists):
-					m.next = "Idle"
+			with m.State("Set offset"): # store_tlp_id is set now, it is checked when the TLP is complete
+				m.d.rx += write_address_base.eq(free_slot)
+				m.d.rx += stored_tlp_id.eq(self.store_tlp_id)
+				m.d.rx += self.tlp_sink.ready.eq(1)
+				m.d.rx += discarded.eq(0)
 
-				with m.Else():
-					m.d.rx += write_address_base.eq(offset)
-					m.d.rx += self.tlp_sink.ready.eq(1)
+				# The first word can already be in this cycle
+				with m.If(self.tlp_sink.all_valid):
+					m.d.rx += write_port.en.eq(1)
 
-					m.next = "Receive"
+				m.next = "Receive"
 			
 			with m.State("Receive"):
+				m.d.comb += receiving.eq(1)
 				m.d.rx += self.tlp_sink.ready.eq(1)
 
+				# Whether the next TLP gets a slot is decided when the current one ends
+				with m.If(self.store_tlp):
+					m.d.rx += store_pending.eq(1)
+					m.d.rx += self.tlp_stored.eq(0)
+
 				with m.If(self.tlp_sink.all_valid):
 					with m.If(tlp_sink_last_valid[0]):
 						m.d.rx += write_address_counter.eq(write_address_counter + 1)
@@ -224,18 +257,249 @@ class TLPBuffer(Elaboratable):
 					m.d.rx += write_port.data.eq(Cat(write_port.data[:-1], 1))
 
 
-				with m.If((write_address_counter == self.tlp_depth - 1) | (~self.tlp_sink.all_valid & ~tlp_sink_last_valid[0] & tlp_sink_last_valid[1])):
+				# A TLP ends after a cycle without valid data or after a partial word, the first word of the next TLP can already be in this cycle
+				tlp_ended = (~tlp_sink_last_valid[0] & tlp_sink_last_valid[1] & ~tlp_sink_last_partial[1]) | tlp_sink_last_partial[0]
+				with m.If((write_address_counter == self.tlp_depth - 1) | tlp_ended):
 					m.d.rx += self.tlp_sink.ready.eq(0)
 					m.d.rx += write_address_counter.eq(0)
 					m.d.rx += write_port.en.eq(0)
-					m.d.rx += self.slots_occupied.eq(self.slots_occupied + 1)
 
-					for i in range(self.max_tlps): # TODO: This can also be solved with amaranth.lib.coding.PriorityEncoder
-						with m.If((offset == i) & ~slot_exists & ~self.slots_full):
-							m.d.rx += self.slots[i][0].eq(1) # TODO: Should this be moved down to Receive to the transition to Idle in case a TLP is being stored incompletely?
-							m.d.rx += self.slots[i][1].eq(self.store_tlp_id)
+					with m.If(~store_slot_exists & ~discarded & ~self.discard_tlp):
+						m.d.rx += self.slots_occupied.eq(self.slots_occupied + 1)
+
+						for i in range(self.max_tlps):
+							with m.If(write_address_base == i):
+								m.d.rx += self.slots[i][0].eq(1)
+								m.d.rx += self.slots[i][1].eq(stored_tlp_id)
+
+					# The next TLP is stored right away, like in Set offset, its first word can arrive in this or the next cycle.
+					# The free slot lags a cycle behind, a slot freed in the meantime isn't used yet, so without one the next TLP is dropped.
+					with m.If(store_pending & free_slot_valid):
+						m.d.rx += write_address_base.eq(free_slot)
+						m.d.rx += stored_tlp_id.eq(self.store_tlp_id)
+						m.d.rx += self.tlp_sink.ready.eq(1)
+						m.d.rx += discarded.eq(0)
+						m.d.rx += write_port.en.eq(self.tlp_sink.all_valid & (~tlp_sink_last_valid[0] | tlp_sink_last_partial[0]))
+						m.d.rx += self.tlp_stored.eq(1)
+
+					with m.Elif(self.store_tlp & free_slot_valid):
+						m.d.rx += self.tlp_stored.eq(1)
+						m.next = "Set offset"
+
+					with m.Else():
+						m.d.rx += self.storing_tlp.eq(0)
+						m.next = "Idle"
+
+					m.d.rx += store_pending.eq(0)
+
+
+		return m
+
+
+def _slot_match(slots, tlp_id):
+	"""
+	Compares every valid slot with tlp_id at once, returns a one-hot vector of the matching slots
+	"""
+	return Cat(slot[0] & (slot[1] == tlp_id) for slot in slots)
+
+
+def _encode_one_hot(one_hot, width):
+	"""
+	Index of the set bit in a one-hot vector, every bit of the index is an OR of the bits of the vector it is set in
+	"""
+	return Cat(Cat(one_hot[i] for i in range(len(one_hot)) if i & (1 << bit)).any() for bit in range(width))
+
+
+class RetryBuffer(Elaboratable):
+	"""
+	Circular retry buffer for transmitted TLPs. TLPs are stored back to back, so small TLPs only take up as many words as they are long.
+	Stored TLPs have consecutive sequence numbers and are acknowledged in order, an acknowledgement frees all TLPs up to its sequence number.
+
+	Parameters
+	----------
+	ratio : int
+		Gearbox ratio.
+
+	depth : int
+		Number of words to store, a power of 2
+
+	max_tlps : int
+		Maximum number of TLPs to store, a power of 2
+
+	tlp_bytes : int
+		Maximum number of bytes in a TLP, a new TLP is only accepted if there is space for this many bytes
+	"""
+	def __init__(self, ratio: int = 4, depth: int = 512, max_tlps: int = 64, tlp_bytes: int = 512):
+		assert depth & (depth - 1) == 0
+		assert max_tlps & (max_tlps - 1) == 0
+		assert max_tlps < 2048 # Half the sequence number space
+
+		self.ratio = ratio
+		self.depth = depth
+		self.max_tlps = max_tlps
+		self.tlp_words = (tlp_bytes + ratio - 1) // ratio
+
+		self.tlp_sink = StreamInterface(8, ratio, name="TLP_Sink")
+		"""Connect this to the TLP source, when all_valid goes low it marks the end of a TLP"""
+		self.tlp_source = StreamInterface(8, ratio, name="TLP_Source")
+		"""Replayed TLPs, a TLP is sent when ready is 1 and after it ends, ready needs to go to 0 before the next one is sent"""
+
+		self.store_seq = Signal(12)
+		"""Sequence number of the TLP being stored, needs to be set when the TLP starts and be one more than the one of the last stored TLP"""
+		self.discard = Signal()
+		"""Set to 1 in the cycle after the end of the TLP being stored to discard it, for example for nullified TLPs"""
+
+		self.ack = Signal()
+		"""Set to 1 for 1 cycle to free all TLPs up to and including ack_seq"""
+		self.ack_seq = Signal(12)
+		"""Sequence number of the acknowledged TLP"""
+		self.ack_valid = Signal()
+		"""Whether ack_seq is in the buffer, comb domain"""
+
+		self.replay = Signal()
+		"""Set to 1 for 1 cycle to send all stored TLPs on tlp_source"""
+		self.replaying = Signal()
+		"""Is 1 while TLPs are being replayed"""
+		self.replay_seq = Signal(12)
+		"""Sequence number of the TLP being replayed"""
+
+		self.head_seq = Signal(12)
+		"""Sequence number of the oldest stored TLP"""
+		self.full = Signal()
+		"""Whether there is no space for another TLP"""
+		self.empty = Signal()
+		"""Whether no TLPs are stored"""
+		self.occupied = Signal(range(max_tlps + 1))
+		"""How many TLPs are stored"""
+
+	def elaborate(self, platform: Platform) -> Module:
+		m = Module()
+
+		address_bits = int(math.log2(self.depth))
+
+		# The last bit marks the last word of a TLP
+		storage = Memory(width = self.ratio * 8 + 1, depth = self.depth)
+		write_port = m.submodules.write_port = storage.write_port(domain = "rx")
+		read_port = m.submodules.read_port = storage.read_port(domain = "rx", transparent = False)
+
+		# Start address of every stored TLP, indexed by its sequence number
+		starts = Memory(width = address_bits + 1, depth = self.max_tlps)
+		starts_write_port = m.submodules.starts_write_port = starts.write_port(domain = "rx")
+		starts_read_port = m.submodules.starts_read_port = starts.read_port(domain = "comb")
+
+		# Pointers have one more bit than the addresses, so a full buffer can be told apart from an empty one
+		head = Signal(address_bits + 1)
+		"""Start of the oldest TLP"""
+		committed = Signal(address_bits + 1)
+		"""End of the newest TLP"""
+		write_pointer = Signal(address_bits + 1)
+		"""Where the next word is written"""
+
+		m.d.comb += self.empty.eq(self.occupied == 0)
+		m.d.comb += self.full.eq((self.occupied == self.max_tlps) | (self.depth - (write_pointer - head)[:address_bits + 1] < self.tlp_words))
+
+
+		# Store TLPs
+		last_valid = Signal()
+		last_word = Signal(self.ratio * 8)
+		m.d.rx += last_valid.eq(self.tlp_sink.all_valid)
+		m.d.comb += self.tlp_sink.ready.eq(1)
+
+		m.d.comb += write_port.addr.eq(write_pointer)
+		m.d.comb += write_port.data.eq(Cat(Cat(self.tlp_sink.symbol), 0))
+
+		tail_seq = Signal(12)
+		commit = Signal()
 
+		with m.If(self.tlp_sink.all_valid):
+			m.d.comb += write_port.en.eq(1)
+			m.d.rx += write_pointer.eq(write_pointer + 1)
+			m.d.rx += last_word.eq(Cat(self.tlp_sink.symbol))
+
+			with m.If(~last_valid):
+				m.d.rx += tail_seq.eq(self.store_seq)
+
+		with m.Elif(last_valid):
+			with m.If(self.discard):
+				m.d.rx += write_pointer.eq(committed)
+
+			with m.Else():
+				# Mark the end of the TLP
+				m.d.comb += write_port.en.eq(1)
+				m.d.comb += write_port.addr.eq(write_pointer - 1)
+				m.d.comb += write_port.data.eq(Cat(last_word, 1))
+
+				m.d.comb += starts_write_port.en.eq(1)
+				m.d.comb += starts_write_port.addr.eq(tail_seq)
+				m.d.comb += starts_write_port.data.eq(committed)
+
+				m.d.comb += commit.eq(1)
+				m.d.rx += committed.eq(write_pointer)
+
+				with m.If(self.empty):
+					m.d.rx += self.head_seq.eq(tail_seq)
+
+
+		# Free acknowledged TLPs, the start of the TLP after the acknowledged one is the new head
+		acknowledged = Signal(12)
+		m.d.comb += acknowledged.eq(self.ack_seq - self.head_seq + 1)
+		m.d.comb += self.ack_valid.eq((acknowledged != 0) & (acknowledged <= self.occupied))
+
+		m.d.comb += starts_read_port.addr.eq(self.ack_seq + 1)
+
+		with m.If(self.ack & self.ack_valid):
+			m.d.rx += self.head_seq.eq(self.ack_seq + 1)
+			m.d.rx += head.eq(Mux(acknowledged == self.occupied, committed, starts_read_port.data))
+			m.d.rx += self.occupied.eq(self.occupied - acknowledged + commit)
+
+		with m.Elif(commit):
+			m.d.rx += self.occupied.eq(self.occupied + 1)
+
+
+		# Replay TLPs
+		read_pointer = Signal(address_bits + 1)
+		reading = Signal()
+		m.d.comb += read_port.addr.eq(read_pointer)
+		m.d.rx += reading.eq(0)
+
+		m.d.rx += Cat(self.tlp_source.symbol).eq(read_port.data[:-1])
+		m.d.rx += [self.tlp_source.valid[i].eq(reading) for i in range(self.ratio)]
+
+		with m.FSM(name = "replay_fsm", domain = "rx"):
+			with m.State("Idle"):
+				m.d.rx += self.replaying.eq(0)
+
+				with m.If(self.replay & ~self.empty):
+					m.d.rx += read_pointer.eq(head)
+					m.d.rx += self.replay_seq.eq(self.head_seq)
+					m.d.rx += self.replaying.eq(1)
+					m.next = "Wait"
+
+			with m.State("Wait"):
+				with m.If(read_pointer == committed):
+					m.d.rx += self.replaying.eq(0)
 					m.next = "Idle"
 
+				with m.Elif(self.tlp_source.ready):
+					m.d.comb += read_port.en.eq(1)
+					m.d.rx += read_pointer.eq(read_pointer + 1)
+					m.d.rx += reading.eq(1)
+					m.next = "Transmit"
+
+			with m.State("Transmit"):
+				m.d.comb += read_port.en.eq(1)
+
+				# The word at read_pointer is being read, it is the start of the next TLP if this is the end of one
+				with m.If(reading & read_port.data[-1]):
+					m.d.rx += self.replay_seq.eq(self.replay_seq + 1)
+					m.next = "Wait-Ready"
+
+				with m.Else():
+					m.d.rx += read_pointer.eq(read_pointer + 1)
+					m.d.rx += reading.eq(1)
+
+			with m.State("Wait-Ready"):
+				with m.If(~self.tlp_source.ready):
+					m.next = "Wait"
 
-		return m
\ No newline at end of file
+		return m
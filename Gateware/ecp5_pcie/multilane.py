@@ -0,0 +1,320 @@
+from amaranth import *
+from amaranth.build import *
+from amaranth.lib.fifo import AsyncFIFOBuffered
+from .serdes import Ctrl, PCIeSERDESInterface
+from .stream import StreamInterface
+
+
+__all__ = ["PCIeLaneCDC", "PCIeDeskewedLane", "PCIeLaneDeskew", "PCIeByteStriper", "PCIeByteUnstriper", "supported_widths"]
+
+
+def supported_widths(lanes : int):
+	"""
+	Link widths which can be negotiated with the given number of lanes, x1, x2, x4, ... up to **lanes**
+	"""
+	return [1 << i for i in range(lanes.bit_length()) if 1 << i <= lanes]
+
+
+class PCIeLaneCDC(PCIeSERDESInterface):
+	"""
+	Moves the received symbols of a lane from the clock domain of its SERDES channel to the rx domain.
+	All lanes of a link are clocked by the same transmitter on the other side, so the clocks have the same frequency
+	and a small FIFO suffices, the remaining phase difference is removed by PCIeLaneDeskew.
+
+	Parameters
+	----------
+	lane : PCIeSERDESInterface
+		Lane in the domain **domain**
+	domain : str
+		Domain the received symbols of the lane are in
+	"""
+	def __init__(self, lane : PCIeSERDESInterface, domain : str):
+		super().__init__(lane.ratio)
+
+		self.rx_invert    = lane.rx_invert
+		self.rx_align     = lane.rx_align
+		self.rx_present   = lane.rx_present
+		self.rx_locked    = lane.rx_locked
+		self.rx_aligned   = lane.rx_aligned
+
+		self.tx_symbol    = lane.tx_symbol
+		self.tx_set_disp  = lane.tx_set_disp
+		self.tx_disp      = lane.tx_disp
+		self.tx_e_idle    = lane.tx_e_idle
+		self.tx_locked    = lane.tx_locked
+
+		self.det_enable   = lane.det_enable
+		self.det_valid    = lane.det_valid
+		self.det_status   = lane.det_status
+
+		self.frequency    = lane.frequency
+		self.speed        = lane.speed
+		self.use_speed    = lane.use_speed
+
+		self.reset        = lane.reset
+		self.reset_done   = lane.reset_done
+
+		self.domain = domain
+		self.__lane = lane
+
+	def elaborate(self, platform: Platform) -> Module:
+		m = Module()
+
+		rx_fifo = m.submodules.rx_fifo = AsyncFIFOBuffered(width=self.ratio * 10, depth=4, r_domain="rx", w_domain=self.domain)
+		m.d.comb += rx_fifo.w_data.eq(Cat(self.__lane.rx_symbol, self.__lane.rx_valid))
+		m.d.comb += rx_fifo.w_en.eq(1)
+		m.d.comb += rx_fifo.r_en.eq(1)
+
+		with m.If(rx_fifo.r_rdy):
+			m.d.comb += Cat(self.rx_symbol, self.rx_valid).eq(rx_fifo.r_data)
+
+		return m
+
+
+class PCIeDeskewedLane(PCIeSERDESInterface):
+	"""
+	A lane whose received symbols are delayed by a PCIeLaneDeskew, the transmitted symbols are passed through unchanged.
+	"""
+	def __init__(self, lane : PCIeSERDESInterface):
+		super().__init__(lane.ratio)
+
+		self.rx_invert    = lane.rx_invert
+		self.rx_align     = lane.rx_align
+		self.rx_present   = lane.rx_present
+		self.rx_locked    = lane.rx_locked
+		self.rx_aligned   = lane.rx_aligned
+
+		self.tx_e_idle    = lane.tx_e_idle
+		self.tx_locked    = lane.tx_locked
+
+		self.det_enable   = lane.det_enable
+		self.det_valid    = lane.det_valid
+		self.det_status   = lane.det_status
+
+		self.frequency    = lane.frequency
+		self.speed        = lane.speed
+		self.use_speed    = lane.use_speed
+
+		self.reset        = lane.reset
+		self.reset_done   = lane.reset_done
+
+		self.__lane = lane
+
+	def elaborate(self, platform: Platform) -> Module:
+		m = Module()
+
+		m.d.comb += [
+			self.__lane.tx_symbol.eq(self.tx_symbol),
+			self.__lane.tx_set_disp.eq(self.tx_set_disp),
+			self.__lane.tx_disp.eq(self.tx_disp),
+		]
+
+		return m
+
+
+class PCIeLaneDeskew(Elaboratable):
+	"""
+	Removes the skew between the lanes of a link. Ordered sets are transmitted on all lanes at the same time,
+	so SKP ordered sets are used as markers and every lane is delayed until its SKP ordered sets line up with
+	the ones of the latest lane. TS ordered sets are not used since they repeat every 16 symbols, which makes
+	a skew of more than 8 symbols ambiguous. The lanes need to be aligned by a PCIeSERDESAligner first,
+	such that COM symbols are always the first symbol of a word.
+
+	Parameters
+	----------
+	lanes : list of PCIeSERDESInterface
+		Aligned lanes, all with the same ratio
+	max_skew : int
+		Maximum skew between two lanes in words.
+		At 1:4 gearing the default of 4 words corresponds to 16 symbol times, the spec allows 20 ns (5 symbol times) at 2.5 GT/s
+		and 8 ns (4 symbol times) at 5 GT/s, the rest is margin for the CDC of each lane.
+
+	Attributes
+	----------
+	lanes : list of PCIeDeskewedLane
+		Deskewed lanes
+	enable : Signal()
+		Whether to update the delays when SKP ordered sets are received
+	aligned : Signal()
+		Asserted once the delays have been set from SKP ordered sets arriving on all lanes
+	delays : list of Signal(range(max_skew + 1))
+		Current delay of each lane in words
+	"""
+	def __init__(self, lanes : list, max_skew = 4):
+		self.ratio = lanes[0].ratio
+		assert self.ratio >= 2
+		assert all(lane.ratio == self.ratio for lane in lanes)
+
+		self.max_skew = max_skew
+		self.lanes = [PCIeDeskewedLane(lane) for lane in lanes]
+		self.enable = Signal(reset=1)
+		self.aligned = Signal()
+		self.delays = [Signal(range(max_skew + 1), name=f"delay_{i}") for i in range(len(lanes))]
+
+		self.__lanes = lanes
+
+		self.state = [
+			self.aligned,
+			*self.delays,
+		]
+
+	def elaborate(self, platform: Platform) -> Module:
+		m = Module()
+
+		ratio = self.ratio
+		max_skew = self.max_skew
+		lane_count = len(self.__lanes)
+
+		for i, lane in enumerate(self.lanes):
+			m.submodules[f"lane_{i}"] = lane
+
+		# Words received on each lane, the first entry is the current word and the others are delayed by their index
+		history = []
+		for lane in self.__lanes:
+			words = [Cat(lane.rx_symbol, lane.rx_valid)] + [Signal(ratio * 10) for _ in range(max_skew)]
+
+			for i in range(1, max_skew + 1):
+				m.d.rx += words[i].eq(words[i - 1])
+
+			history.append(Array(words))
+
+		for i, lane in enumerate(self.lanes):
+			m.d.comb += Cat(lane.rx_symbol, lane.rx_valid).eq(history[i][self.delays[i]])
+
+		com = Cat((lane.rx_symbol[0:9] == Ctrl.COM) & (lane.rx_symbol[9:18] == Ctrl.SKP) for lane in self.__lanes)
+
+		# Which lanes already received a SKP ordered set and how many words after the first one it arrived
+		seen = Signal(lane_count)
+		arrival = [Signal(range(max_skew + 1)) for _ in range(lane_count)]
+		timer = Signal(range(max_skew + 1))
+
+		with m.FSM(domain="rx"):
+			with m.State("Idle"):
+				with m.If(self.enable & com.any()):
+					# No skew
+					with m.If(com.all()):
+						m.d.rx += self.aligned.eq(1)
+						m.d.rx += [delay.eq(0) for delay in self.delays]
+
+					with m.Else():
+						m.d.rx += seen.eq(com)
+						m.d.rx += timer.eq(1)
+						m.d.rx += [time.eq(0) for time in arrival]
+						m.next = "Collect"
+
+			with m.State("Collect"):
+				m.d.rx += timer.eq(timer + 1)
+
+				# SKP ordered sets can be sent back to back, only the first one of each lane counts
+				for i in range(lane_count):
+					with m.If(com[i] & ~seen[i]):
+						m.d.rx += arrival[i].eq(timer)
+
+				m.d.rx += seen.eq(seen | com)
+
+				# The lanes receiving their SKP ordered set now are the latest ones, delay the others by the difference
+				with m.If((seen | com).all()):
+					for i in range(lane_count):
+						m.d.rx += self.delays[i].eq(Mux(seen[i], timer - arrival[i], 0))
+
+					m.d.rx += self.aligned.eq(1)
+					m.next = "Idle"
+
+				# The SKP ordered sets don't belong together, keep the old delays
+				with m.Elif(timer == max_skew):
+					m.next = "Idle"
+
+		return m
+
+
+class PCIeByteStriper(Elaboratable):
+	"""
+	Distributes the symbols of a link across its lanes. Symbol k of a word goes to lane k % width, so that
+	consecutive symbols are transmitted on consecutive lanes. Lanes which are not part of the link get no data.
+
+	Parameters
+	----------
+	lanes : int
+		Number of lanes
+	ratio : int
+		Symbols per lane per clock cycle
+
+	Attributes
+	----------
+	sink : StreamInterface(9, ratio * lanes)
+		Link data, of which the first ratio * width symbols are used
+	sources : list of StreamInterface(9, ratio)
+		Data for each lane
+	width : Signal(6)
+		Negotiated link width, usually connected to the LTSSM
+	"""
+	def __init__(self, lanes : int, ratio : int = 4):
+		self.lanes = lanes
+		self.ratio = ratio
+		self.sink = StreamInterface(9, ratio * lanes, name="Striper_Sink")
+		self.sources = [StreamInterface(9, ratio, name=f"Striper_Source_{i}") for i in range(lanes)]
+		self.width = Signal(6, reset=1)
+
+	def elaborate(self, platform: Platform) -> Module:
+		m = Module()
+
+		ratio = self.ratio
+
+		# All lanes transmit at the same time, the first lane is used for flow control
+		m.d.comb += self.sink.ready.eq(self.sources[0].ready)
+
+		with m.Switch(self.width):
+			for width in supported_widths(self.lanes):
+				with m.Case(width):
+					for k in range(ratio * width):
+						source = self.sources[k % width]
+						m.d.comb += source.symbol[k // width].eq(self.sink.symbol[k])
+						m.d.comb += source.valid[k // width].eq(self.sink.valid[k])
+
+		return m
+
+
+class PCIeByteUnstriper(Elaboratable):
+	"""
+	Reassembles the symbols of a link from its deskewed lanes, the reverse of PCIeByteStriper.
+
+	Parameters
+	----------
+	lanes : int
+		Number of lanes
+	ratio : int
+		Symbols per lane per clock cycle
+
+	Attributes
+	----------
+	sinks : list of StreamInterface(9, ratio)
+		Data from each lane
+	source : StreamInterface(9, ratio * lanes)
+		Link data, of which the first ratio * width symbols are valid
+	width : Signal(6)
+		Negotiated link width, usually connected to the LTSSM
+	"""
+	def __init__(self, lanes : int, ratio : int = 4):
+		self.lanes = lanes
+		self.ratio = ratio
+		self.sinks = [StreamInterface(9, ratio, name=f"Unstriper_Sink_{i}") for i in range(lanes)]
+		self.source = StreamInterface(9, ratio * lanes, name="Unstriper_Source")
+		self.width = Signal(6, reset=1)
+
+	def elaborate(self, platform: Platform) -> Module:
+		m = Module()
+
+		ratio = self.ratio
+
+		for sink in self.sinks:
+			m.d.comb += sink.ready.eq(self.source.ready)
+
+		with m.Switch(self.width):
+			for width in supported_widths(self.lanes):
+				with m.Case(width):
+					for k in range(ratio * width):
+						sink = self.sinks[k % width]
+						m.d.comb += self.source.symbol[k].eq(sink.symbol[k // width])
+						m.d.comb += self.source.valid[k].eq(sink.valid[k // width])
+
+		return m
@@ -1,46 +1,88 @@
 from amaranth import *
 from amaranth.build import *
+from amaranth.lib.cdc import FFSynchronizer
 from .serdes import K, D, Ctrl, PCIeScrambler
 from .phy_rx import PCIePhyRX
 from .phy_tx import PCIePhyTX
 from .ltssm import PCIeLTSSM
+from .phy_multilane import PCIeMultiLanePhy
 from .dll_tlp import PCIeDLLTLPTransmitter, PCIeDLLTLPReceiver
-from .dllp import PCIeDLLPTransmitter, PCIeDLLPReceiver
+from .dllp import PCIeDLLPTransmitter, PCIeDLLPReceiver, DLLPType
 from .dll import PCIeDLL
 from .virtual_tlp_gen import PCIeVirtualTLPGenerator
 from .tlp import TLP
+from .tlp_adapter import TLPWidthAdapter
 
 class PCIePhy(Elaboratable): # Phy might not be the right name for this
 	"""
 	A PCIe Phy
+
+	max_payload_size is the largest payload which is supported, 128, 256 or 512 bytes. It sizes the buffers and is advertised
+	in the Device Capabilities register, TLPs use the Max_Payload_Size the host programs into the Device Control register.
+
+	dma is a PCIeDMA for the upstream Transaction Layer, the receive buffer leaves its completion_tlps slots for its completions.
+
+	The PHY and the Data Link Layer use the gearing of the lane, 4 or 8 symbols per word. The Transaction Layer only supports 4 symbols per word,
+	with 8 symbols per word the upstream tlp is connected through a TLPWidthAdapter. It runs in tl_domain then, with a clock of twice
+	the frequency of rx it gets all of the bandwidth of the link, see TLPWidthAdapter. dma is in tl_domain too.
+
+	lane can also be a list of lanes for a multi-lane link, for example two lanes with 1:4 gearing. A PCIeMultiLanePhy stripes
+	the link data across them, so the Data Link Layer gets ratio * len(lanes) symbols per word, which has to be 4 or 8 as well.
+	The width of the Data Link Layer is fixed, so only a link of all lanes is negotiated.
 	"""
-	def __init__(self, lane, upstream = True, support_5GTps = True, disable_scrambling = False):
+	def __init__(self, lane, upstream = True, support_5GTps = True, disable_scrambling = False, cut_through = False, max_payload_size = 512, dma = None, tl_domain = "rx"):
+		assert max_payload_size in [128, 256, 512]
+		assert dma is None or upstream
+		lanes = lane if isinstance(lane, list) else [lane]
+		ratio = lanes[0].ratio * len(lanes)
+		assert ratio in [4, 8]
+		assert tl_domain == "rx" or (upstream and ratio == 8)
+
 		self.upstream = upstream
+		lane = lanes[0]
 		
 		# PHY
-		self.descrambled_lane = PCIeScrambler(lane)#, Signal())
-		self.rx = PCIePhyRX(lane, self.descrambled_lane)
-		self.tx = PCIePhyTX(self.descrambled_lane)
-		self.ltssm = PCIeLTSSM(self.descrambled_lane, self.tx, self.rx, upstream=upstream, support_5GTps=support_5GTps, disable_scrambling=disable_scrambling) # It doesn't care whether the lane is scrambled or not, since it only uses it for RX detection in Detect
+		if len(lanes) > 1:
+			self.multilane = PCIeMultiLanePhy(lanes, upstream=upstream, support_5GTps=support_5GTps, disable_scrambling=disable_scrambling, skp_handshake=True, link_widths=[len(lanes)])
+			self.descrambled_lane = self.multilane.descrambled_lanes[0]
+			self.rx = self.multilane.rxs[0]
+			self.tx = self.multilane.txs[0]
+			self.ltssm = self.multilane.ltssm
+
+		else:
+			self.multilane = None
+			self.descrambled_lane = PCIeScrambler(lane)#, Signal())
+			self.rx = PCIePhyRX(lane, self.descrambled_lane)
+			self.tx = PCIePhyTX(self.descrambled_lane, skp_handshake = True)
+			self.ltssm = PCIeLTSSM(self.descrambled_lane, self.tx, self.rx, upstream=upstream, support_5GTps=support_5GTps, disable_scrambling=disable_scrambling) # It doesn't care whether the lane is scrambled or not, since it only uses it for RX detection in Detect
 		
 		# DLL
-		self.dllp_rx = PCIeDLLPReceiver()
-		self.dllp_tx = PCIeDLLPTransmitter()
+		self.dllp_rx = PCIeDLLPReceiver(ratio = ratio)
+		self.dllp_tx = PCIeDLLPTransmitter(ratio = ratio)
 
 		self.dll = PCIeDLL(self.ltssm, self.dllp_tx, self.dllp_rx, lane.frequency, use_speed = self.descrambled_lane.use_speed)
 
-		self.dll_tlp_rx = (ResetInserter(~self.dll.up))(PCIeDLLTLPReceiver(self.dll))
-		self.dll_tlp_tx = (ResetInserter(~self.dll.up))(PCIeDLLTLPTransmitter(self.dll))
+		self.dll_tlp_rx = (ResetInserter(~self.dll.up))(PCIeDLLTLPReceiver(self.dll, ratio = ratio, completion_tlps = 0 if dma is None else dma.completion_tlps, max_payload_size = max_payload_size, cut_through = cut_through))
+		self.dll_tlp_tx = (ResetInserter(~self.dll.up))(PCIeDLLTLPTransmitter(self.dll, ratio = ratio, max_payload_size = max_payload_size))
 
 		self.debug = Signal(32)
 		self.debug2 = Signal(8)
 
 		# TL
+		self.tl_domain = tl_domain
+		self.tlp_adapter = None
+
 		if self.upstream:
-			self.tlp = TLP()
+			self.tlp = TLP(dma = dma, max_payload_size = max_payload_size, support_5GTps = support_5GTps, max_link_width = len(lanes))
+
+			if tl_domain != "rx":
+				self.tlp = DomainRenamer({"rx": tl_domain})(self.tlp)
+
+			if ratio == 8:
+				self.tlp_adapter = TLPWidthAdapter(max_payload_size = max_payload_size, tl_domain = tl_domain)
 		
 		else:
-			self.tlp = PCIeVirtualTLPGenerator()
+			self.tlp = PCIeVirtualTLPGenerator(ratio = ratio)
 		
 		# Debug
 		self.submodules = [
@@ -73,35 +115,81 @@ class PCIePhy(Elaboratable): # Phy might not be the right name for this
 		#	self.dll_tlp_tx,
 		#	self.virt_tlp_gen,
 		#]
-		m.submodules.rx = self.rx
-		m.submodules.tx = self.tx
-		m.submodules.descrambled_lane = self.descrambled_lane
-		m.submodules.ltssm = self.ltssm
+		if self.multilane is not None:
+			m.submodules.multilane = self.multilane
+			phy_source = self.multilane.source
+			phy_sink = self.multilane.sink
+
+		else:
+			m.submodules.rx = self.rx
+			m.submodules.tx = self.tx
+			m.submodules.descrambled_lane = self.descrambled_lane
+			m.submodules.ltssm = self.ltssm
+			phy_source = self.rx.source
+			phy_sink = self.tx.sink
+
 		m.submodules.dllp_rx = self.dllp_rx
 		m.submodules.dllp_tx = self.dllp_tx
 		m.submodules.dll = self.dll
 		m.submodules.dll_tlp_tx = self.dll_tlp_tx
 		m.submodules.dll_tlp_rx = self.dll_tlp_rx
-		if self.upstream:
-			m.submodules.tlp = self.tlp
-		else:
-			m.submodules.tlp = self.tlp
+		m.submodules.tlp = self.tlp
 
 		m.d.comb += self.dll.speed.eq(self.descrambled_lane.speed)
 
-		self.dllp_tx.phy_source.connect(self.tx.sink, m.d.comb)
-		self.rx.source.connect(self.dllp_rx.phy_sink, m.d.comb)
+		# On a multi-lane link the first transmitter schedules the SKP ordered sets for all lanes
+		self.dllp_tx.phy_source.connect(phy_sink, m.d.comb)
+		m.d.comb += self.dllp_tx.skp_request.eq(self.tx.skp_request)
+		m.d.comb += self.tx.skp_slot.eq(self.dllp_tx.skp_slot)
+		phy_source.connect(self.dllp_rx.phy_sink, m.d.comb)
+
+		# Active State Power Management, the LTSSM decides when the link goes to L0s or L1 and the Data Link Layer sends the PM DLLPs for it
+		m.d.comb += [
+			self.ltssm.tx_pending.eq(self.dll_tlp_tx.pending),
+			self.ltssm.tx_busy.eq(self.dllp_tx.busy),
+			self.ltssm.tx_acknowledged.eq(self.dll.status.retry_buffer_occupation == 0),
+			self.dllp_tx.block_tlps.eq(self.ltssm.block_tlps),
+			self.dll.pm_send.eq(self.ltssm.pm_send),
+			self.dll.pm_type.eq(self.ltssm.pm_type),
+			self.ltssm.pm_received.eq(self.dllp_rx.dllp.valid & (self.dllp_rx.dllp.type == DLLPType.PM)),
+			self.ltssm.pm_received_type.eq(self.dllp_rx.dllp.type_meta),
+		]
 
 		self.dll_tlp_tx.dllp_source.connect(self.dllp_tx.dllp_sink, m.d.comb)
 		self.dllp_rx.dllp_source.connect(self.dll_tlp_rx.dllp_sink, m.d.comb)
 
-		if self.upstream:
+		if not self.upstream:
 			self.tlp.tlp_source.connect(self.dll_tlp_tx.tlp_sink, m.d.comb)
-			self.dll_tlp_rx.tlp_source.connect(self.tlp.tlp_sink, m.d.comb)
-		
+
+		elif self.tlp_adapter is not None:
+			# Aborted TLPs are dropped by the adapter, the Transaction Layer's abort stays 0
+			m.submodules.tlp_adapter = adapter = self.tlp_adapter
+			self.tlp.tlp_source.connect(adapter.tlp_sink, m.d.comb)
+			adapter.tlp_source.connect(self.tlp.tlp_sink, m.d.comb)
+			adapter.dll_source.connect(self.dll_tlp_tx.tlp_sink, m.d.comb)
+			self.dll_tlp_rx.tlp_source.connect(adapter.dll_sink, m.d.comb)
+			m.d.comb += adapter.abort.eq(self.dll_tlp_rx.abort)
+
 		else:
 			self.tlp.tlp_source.connect(self.dll_tlp_tx.tlp_sink, m.d.comb)
-		
+			self.dll_tlp_rx.tlp_source.connect(self.tlp.tlp_sink, m.d.comb)
+			m.d.comb += self.tlp.abort.eq(self.dll_tlp_rx.abort)
+
+		if self.upstream and self.tl_domain != "rx":
+			# The registers of the configuration space only change on configuration writes
+			m.submodules += [
+				FFSynchronizer(self.tlp.device_max_payload_size, self.dll.max_payload_size, o_domain="rx"),
+				FFSynchronizer(self.tlp.aspm_control, self.ltssm.aspm_control, o_domain="rx"),
+				FFSynchronizer(self.ltssm.status.link.speed, self.tlp.link_speed, o_domain=self.tl_domain),
+				FFSynchronizer(self.ltssm.status.link.width, self.tlp.link_width, o_domain=self.tl_domain, reset=1),
+			]
+
+		elif self.upstream:
+			m.d.comb += self.dll.max_payload_size.eq(self.tlp.device_max_payload_size)
+			m.d.comb += self.ltssm.aspm_control.eq(self.tlp.aspm_control)
+			m.d.comb += self.tlp.link_speed.eq(self.ltssm.status.link.speed)
+			m.d.comb += self.tlp.link_width.eq(self.ltssm.status.link.width)
+
 		m.d.comb += self.debug.eq(Cat(self.dll_tlp_tx.tlp_sink.symbol))
 		m.d.comb += self.debug2.eq(Cat(self.dll_tlp_tx.tlp_sink.valid))
 
@@ -126,8 +214,10 @@ class PCIePhy(Elaboratable): # Phy might not be the right name for this
 
 
 
-		m.d.rx += self.descrambled_lane.rx_align.eq(1)
+		# PCIeMultiLanePhy does this for its lanes
+		if self.multilane is None:
+			m.d.rx += self.descrambled_lane.rx_align.eq(1)
 
-		m.d.rx += self.descrambled_lane.enable.eq(self.ltssm.status.link.scrambling & ~self.tx.sending_ts)
+			m.d.rx += self.descrambled_lane.enable.eq(self.ltssm.status.link.scrambling & ~self.tx.sending_ts)
 
 		return m
\ No newline at end of file
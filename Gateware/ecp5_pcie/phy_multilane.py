@@ -0,0 +1,92 @@
+from amaranth import *
+from amaranth.build import *
+from .serdes import PCIeScrambler
+from .phy_rx import PCIePhyRX
+from .phy_tx import PCIePhyTX
+from .ltssm import PCIeLTSSM
+from .multilane import PCIeLaneDeskew, PCIeByteStriper, PCIeByteUnstriper
+
+class PCIeMultiLanePhy(Elaboratable):
+	"""
+	Physical layer of a multi-lane PCIe link. Each lane gets its own scrambler, receiver and transmitter,
+	the lanes are deskewed and the link data is striped across the lanes which are part of the negotiated link.
+
+	PCIePhy connects it to the Data Link Layer when it gets a list of lanes, see there.
+
+	Parameters
+	----------
+	lanes : list of PCIeSERDESInterface
+		Aligned lanes, all in the rx domain. The first lane is lane 0 of the link.
+	upstream : bool
+		Whether it is an upstream port
+	max_skew : int
+		Maximum lane to lane skew in words, see PCIeLaneDeskew
+	skp_handshake : bool
+		Whether the packet source schedules SKP ordered sets with txs[0].skp_request and txs[0].skp_slot, see PCIePhyTX
+	link_widths : list of int
+		Link widths which may be negotiated, see PCIeLTSSM
+
+	Attributes
+	----------
+	source : StreamInterface(9, ratio * len(lanes))
+		Received link data, symbols beyond ratio * ltssm.status.link.width are not valid
+	sink : StreamInterface(9, ratio * len(lanes))
+		Link data to transmit, symbols beyond ratio * ltssm.status.link.width are ignored
+	"""
+	def __init__(self, lanes : list, upstream = True, support_5GTps = True, disable_scrambling = False, max_skew = 4, skp_handshake = False, link_widths = None):
+		self.upstream = upstream
+		self.ratio = lanes[0].ratio
+
+		self.deskew = PCIeLaneDeskew(lanes, max_skew=max_skew)
+		self.descrambled_lanes = [PCIeScrambler(lane) for lane in self.deskew.lanes]
+		self.rxs = [PCIePhyRX(lane, descrambled_lane) for lane, descrambled_lane in zip(self.deskew.lanes, self.descrambled_lanes)]
+		self.txs = [PCIePhyTX(self.descrambled_lanes[0], skp_handshake=skp_handshake)]
+		self.txs += [PCIePhyTX(descrambled_lane, primary=self.txs[0]) for descrambled_lane in self.descrambled_lanes[1:]]
+		self.ltssm = PCIeLTSSM(self.descrambled_lanes, self.txs, self.rxs, upstream=upstream, support_5GTps=support_5GTps, disable_scrambling=disable_scrambling, link_widths=link_widths)
+
+		self.striper = PCIeByteStriper(len(lanes), self.ratio)
+		self.unstriper = PCIeByteUnstriper(len(lanes), self.ratio)
+
+		# Packets can start and end on any lane, so without the handshake the first transmitter needs to see the whole link to place SKP ordered sets
+		self.txs[0].framing_symbols = self.striper.sink.symbol
+
+		self.source = self.unstriper.source
+		self.sink = self.striper.sink
+
+		# Debug
+		self.submodules = [
+			self.deskew,
+			*self.rxs,
+			*self.txs,
+			self.ltssm,
+		]
+
+		self.state = [
+			self.descrambled_lanes[0].enable,
+		]
+
+	def elaborate(self, platform: Platform) -> Module:
+		m = Module()
+
+		m.submodules.deskew = self.deskew
+
+		for i in range(len(self.rxs)):
+			m.submodules[f"descrambled_lane_{i}"] = self.descrambled_lanes[i]
+			m.submodules[f"rx_{i}"] = self.rxs[i]
+			m.submodules[f"tx_{i}"] = self.txs[i]
+
+		m.submodules.ltssm = self.ltssm
+		m.submodules.striper = self.striper
+		m.submodules.unstriper = self.unstriper
+
+		for i in range(len(self.rxs)):
+			self.striper.sources[i].connect(self.txs[i].sink, m.d.comb)
+			self.rxs[i].source.connect(self.unstriper.sinks[i], m.d.comb)
+
+			m.d.rx += self.descrambled_lanes[i].rx_align.eq(1)
+			m.d.rx += self.descrambled_lanes[i].enable.eq(self.ltssm.status.link.scrambling & ~self.txs[0].sending_ts)
+
+		m.d.comb += self.striper.width.eq(self.ltssm.status.link.width)
+		m.d.comb += self.unstriper.width.eq(self.ltssm.status.link.width)
+
+		return m
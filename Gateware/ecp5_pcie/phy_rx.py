@@ -7,7 +7,7 @@ from .stream import StreamInterface
 
 class PCIePhyRX(Elaboratable):
 	"""
-	PCIe Receiver for 1:4 gearing
+	PCIe Receiver for 1:4 or 1:8 gearing
 
 	Parameters
 	----------
@@ -23,9 +23,11 @@ class PCIePhyRX(Elaboratable):
 		Asserted by LTSSM to enable data reception
 	fifo : SyncFIFOBuffered()
 		Received data gets stored in here
+	eios_received : Signal()
+		Asserted for one cycle after an electrical idle ordered set has been received
 	"""
 	def __init__(self, raw_lane : PCIeSERDESInterface, decoded_lane : PCIeScrambler):
-		assert raw_lane.ratio == 4
+		assert raw_lane.ratio in [4, 8]
 		self.raw_lane = raw_lane
 		self.decoded_lane = decoded_lane
 		self.ts = Record(ts_layout)
@@ -34,6 +36,7 @@ class PCIePhyRX(Elaboratable):
 		self.consecutive = Signal()
 		self.inverted = Signal()
 		self.ready = Signal()
+		self.eios_received = Signal()
 		self.source = StreamInterface(9, raw_lane.ratio, name="PHY_Source")
 
 		self.state = [
@@ -62,20 +65,12 @@ class PCIePhyRX(Elaboratable):
 		ratio = raw_lane.ratio
 
 		# Idle signal for when the idle symbol or SKP ordered sets are received
-		self.idle = (decoded_lane.rx_symbol == 0) | (decoded_lane.rx_symbol == compose([Ctrl.COM, Ctrl.SKP, Ctrl.SKP, Ctrl.SKP]))
+		self.idle = decoded_lane.idle
 
 		# The received symbols
 		symbols = [raw_lane.rx_symbol[i * 9 : i * 9 + 9] for i in range(ratio)]
 		decoded_symbols = [decoded_lane.rx_symbol[i * 9 : i * 9 + 9] for i in range(ratio)]
 
-		def compare(*csymbols):
-			statement = True
-			
-			for i in range(ratio):
-				statement &= csymbols[i] == symbols[i]
-
-			return statement
-
 		# Whether a TS is being received
 		self.recv_tsn = recv_tsn = Signal()
 
@@ -106,93 +101,91 @@ class PCIePhyRX(Elaboratable):
 		# In that case, the 9th bit is true.
 		# Otherwise its valid and the link number gets stored.
 		# There is also a SKP ordered set composed of COM SKP SKP SKP
-		# A comma aligner before the RX causes the comma to be aligned to symbol1.
-		with m.FSM(domain="rx"):
-			with m.State("IDLE"):
-				m.d.rx += self.ts_received.eq(0)
-				with m.If(compare(Ctrl.COM, Ctrl.SKP, Ctrl.SKP, Ctrl.SKP)):
-					m.d.comb += Cat(self.source.valid).eq(0)
-
-				with m.Elif(symbols[0] == Ctrl.COM):
-					# Ignore the comma otherwise, could be a different ordered set
-					with m.If((symbols[1] == Ctrl.PAD) | (symbols[1][8] == 0)):
-						with m.If(symbols[1] == Ctrl.PAD):
-							m.d.rx += ts_current.link.valid.eq(0)
-							m.d.rx += recv_tsn.eq(1)
-						with m.Elif(symbols[1][8] == 0):
-							m.d.rx += ts_current.link.number.eq(symbols[1][:8])
-							m.d.rx += ts_current.link.valid.eq(1)
-							m.d.rx += recv_tsn.eq(1)
-						
-						m.d.rx += ts_current.valid.eq(1)
-						m.d.rx += self.start_receive_ts.eq(1)
-
-						# Lane and Fast Training Sequence count
-						
-						with m.If(symbols[2] == Ctrl.PAD):
-							m.d.rx += ts_current.lane.valid.eq(0)
-						with m.Elif(symbols[2][8] == 0):
-							m.d.rx += ts_current.lane.valid.eq(1)
-							m.d.rx += ts_current.lane.number.eq(symbols[2][:5])
-						with m.If(symbols[3][8] == 0):
-							m.d.rx += ts_current.n_fts.eq(symbols[3][:8])
-						
-						m.next = "TSn-DATA"
-
-				with m.Elif(self.ready): # Might overflow
-					m.d.comb += Cat(self.source.valid).eq(decoded_lane.rx_valid)
-					m.d.comb += Cat(self.source.symbol).eq(decoded_lane.rx_symbol)
-
-				#with m.Else():
-				#    m.d.rx += recv_tsn.eq(0)
-
-			# OLD: From when the bus was 2 symbols wide
-			# SKP ordered set, in COMMA there is 'COM SKP' and here is 'SKP SKP' in rx_symbol, after which it goes back to COMMA.
-			#with m.State("SKP"):
-			#	m.next = "IDLE"
-			
+		# A comma aligner before the RX causes the comma to be aligned to the first symbol of a group of 4 symbols.
+		# Every ordered set starts at such a group, with 1:8 gearing in either half of a word. The groups of a word are handled
+		# one after another, position is the number of groups of the current TS which have been received before a group.
+		m.d.rx += self.ts_received.eq(0)
+		m.d.rx += self.eios_received.eq(0)
+		m.d.rx += self.start_receive_ts.eq(0)
+
+		ts_position = Signal(range(4))
+		ordered_set = Signal(ratio // 4) # Which groups of the last word were part of an ordered set
+		position = ts_position
+
+		for i in range(ratio // 4):
+			group = symbols[4 * i : 4 * i + 4]
+			next_position = Signal(range(4), name=f"position_{i + 1}")
+
+			with m.If(position == 0):
+				m.d.rx += ordered_set[i].eq(group[0] == Ctrl.COM)
+
+				# Electrical idle ordered set, the transmitter on the other side goes to electrical idle now
+				with m.If((group[0] == Ctrl.COM) & (group[1] == Ctrl.IDL) & (group[2] == Ctrl.IDL) & (group[3] == Ctrl.IDL)):
+					m.d.rx += self.eios_received.eq(1)
+
+				# Start of a TS, other ordered sets like SKP ordered sets are ignored
+				with m.Elif((group[0] == Ctrl.COM) & ((group[1] == Ctrl.PAD) | (group[1][8] == 0))):
+					m.d.comb += next_position.eq(1)
+
+					with m.If(group[1] == Ctrl.PAD):
+						m.d.rx += ts_current.link.valid.eq(0)
+						m.d.rx += recv_tsn.eq(1)
+					with m.Elif(group[1][8] == 0):
+						m.d.rx += ts_current.link.number.eq(group[1][:8])
+						m.d.rx += ts_current.link.valid.eq(1)
+						m.d.rx += recv_tsn.eq(1)
+
+					m.d.rx += ts_current.valid.eq(1)
+					m.d.rx += self.start_receive_ts.eq(1)
+
+					# Lane and Fast Training Sequence count
+					with m.If(group[2] == Ctrl.PAD):
+						m.d.rx += ts_current.lane.valid.eq(0)
+					with m.Elif(group[2][8] == 0):
+						m.d.rx += ts_current.lane.valid.eq(1)
+						m.d.rx += ts_current.lane.number.eq(group[2][:5])
+					with m.If(group[3][8] == 0):
+						m.d.rx += ts_current.n_fts.eq(group[3][:8])
+
+			with m.Else():
+				m.d.rx += ordered_set[i].eq(1)
+				m.d.comb += next_position.eq(position + 1) # Wraps around to 0 after the last group
+
 			# Rate and Ctrl bytes
-			with m.State("TSn-DATA"):
-				m.next = "TSn-ID1"
-				m.d.rx += self.start_receive_ts.eq(0)
-				with m.If(symbols[0][8] == 0):
-					m.d.rx += Cat(ts_current.rate).eq(symbols[0][:8])
+			with m.If(position == 1):
+				with m.If(group[0][8] == 0):
+					m.d.rx += Cat(ts_current.rate).eq(group[0][:8])
 
-				with m.If(symbols[1][8] == 0):
-					m.d.rx += Cat(ts_current.ctrl).eq(symbols[1][:5])
+				with m.If(group[1][8] == 0):
+					m.d.rx += Cat(ts_current.ctrl).eq(group[1][:5])
 
 				m.d.rx += ts_current.valid.eq(1)
 
-
-				with m.If(symbols[2] == D(10,2)):
+				# Find out whether its a TS1, a TS2 or inverted
+				with m.If(group[2] == D(10,2)):
 					m.d.rx += ts_current.ts_id.eq(0)
 
-				with m.If(symbols[2] == D(5,2)):
+				with m.If(group[2] == D(5,2)):
 					m.d.rx += ts_current.ts_id.eq(1)
-					
-				with m.If(symbols[2] == D(21,5)):
+
+				with m.If(group[2] == D(21,5)):
 					m.d.rx += ts_current.ts_id.eq(0)
 					m.d.rx += inverted.eq(1)
 
-				with m.If(symbols[2] == D(26,5)):
+				with m.If(group[2] == D(26,5)):
 					m.d.rx += ts_current.ts_id.eq(1)
 					m.d.rx += inverted.eq(1)
 
-			# Find out whether its a TS1, a TS2 or inverted, called ID1 because some ID bits are already gotten before
-			with m.State("TSn-ID1"):
-				m.next = "TSn-ID2"
-
 			# When its not inverted, accept it.
 			# Additionally it can be checked whether two consecutive TSs are valid by uncommenting the if statement
-			with m.State("TSn-ID2"):
-				m.next = "IDLE"
+			with m.If(position == 3):
 				with m.If(inverted):
 					m.d.rx += ts.valid.eq(0)
 					m.d.rx += inverted.eq(0)
 					with m.If(last_invert == 0): # Should this be moved into the If(inverted) statement?
 						m.d.rx += raw_lane.rx_invert.eq(~raw_lane.rx_invert) # Maybe it should change the disparity instead?
 						m.d.rx += last_invert.eq(200)
-				
+
 				# If its not inverted, then a valid TS was received.
 				with m.Else():
 					#with m.If((ts_last == ts_current)):
@@ -203,7 +196,20 @@ class PCIePhyRX(Elaboratable):
 
 					# Consecutive TS sensing
 					m.d.rx += self.consecutive.eq(ts_last == ts_current)
-		
+
+			position = next_position
+
+		m.d.rx += ts_position.eq(position)
+
+		# SKP and other ordered sets are replaced with idle data. They are found in the received symbols above,
+		# which are one cycle ahead of the descrambled symbols.
+		with m.If(self.ready): # Might overflow
+			for i in range(ratio // 4):
+				with m.If(~ordered_set[i]):
+					for j in range(4 * i, 4 * i + 4):
+						m.d.comb += self.source.valid[j].eq(decoded_lane.rx_valid[j])
+						m.d.comb += self.source.symbol[j].eq(decoded_symbols[j])
+
 		with m.If(ts.link.valid):
 			m.d.rx += vlink.eq(ts.link.number)
 		with m.If(ts.lane.valid):
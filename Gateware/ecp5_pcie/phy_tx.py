@@ -8,7 +8,9 @@ from .stream import StreamInterface
 # TODO: When TS data changes during TS sending, the sent TS changes. For example when it changes from TS1 to TS2, itll send ...D10.2 D10.2 D5.2 D5.2 which is kinda suboptimal. TS should be buffered.
 class PCIePhyTX(Elaboratable):
 	"""
-	PCIe Transmitter for 1:4 gearing
+	PCIe Transmitter for 1:4 or 1:8 gearing
+
+	With 1:8 gearing a training sequence takes 2 words and the other ordered sets are sent twice to fill a word.
 
 	Parameters
 	----------
@@ -22,10 +24,35 @@ class PCIePhyTX(Elaboratable):
 		Symbols to send from higher layers
 	fifo : SyncFIFOBuffered()
 		Data to transmit goes in here
+	primary : PCIePhyTX
+		For multi-lane links, the transmitter of the first lane. SKP ordered sets are inserted whenever the primary
+		transmitter inserts them, such that they are sent on all lanes at the same time.
+	framing_symbols : [Signal(9)]
+		Symbols which are checked for STP, SDP, END and EDB to find out whether a packet is being sent.
+		By default the symbols of the sink, for multi-lane links the symbols of the whole link. Not used with skp_handshake.
+	skp_handshake : bool
+		Whether the packet source schedules SKP ordered sets with skp_request and skp_slot, so they are only sent between packets.
+		Otherwise packets are detected with the framing symbols and the sink is held while a SKP ordered set is sent.
+	skp_request : Signal()
+		Asserted 2 cycles before a SKP ordered set is scheduled and while SKP ordered sets are due. The packet source finishes
+		the current packet, doesn't start a new one and then leaves a word free for every SKP ordered set.
+	skp_slot : Signal()
+		Set by the packet source with the symbols of a word which is left free for a SKP ordered set
+	eios : Signal()
+		Send electrical idle ordered sets instead of anything else
+	eios_sent : Signal()
+		Asserted for one cycle after an electrical idle ordered set has been sent
+	fts : Signal()
+		Send fast training sequences instead of anything else, one per 4 symbols, when leaving L0s
+	skp : Signal()
+		Send a SKP ordered set instead of anything else but electrical idle and fast training sequences, it follows the fast training sequences
 	"""
-	def __init__(self, lane : PCIeSERDESInterface):
-		assert lane.ratio == 4
+	def __init__(self, lane : PCIeSERDESInterface, primary = None, skp_handshake = False):
+		assert lane.ratio in [4, 8]
+		assert not (skp_handshake and primary is not None)
 		self.lane = lane
+		self.primary = primary
+		self.skp_handshake = skp_handshake
 		self.ts = Record(ts_layout)
 		self.idle = Signal()
 		self.sending_ts = Signal()
@@ -34,6 +61,14 @@ class PCIePhyTX(Elaboratable):
 		self.enable_higher_layers = Signal()
 		self.ltssm_L0 = Signal()
 		self.idle_symbol = Signal(9, reset = 1)
+		self.insert_skp = Signal()
+		self.skp_request = Signal()
+		self.skp_slot = Signal()
+		self.eios = Signal()
+		self.eios_sent = Signal()
+		self.fts = Signal()
+		self.skp = Signal()
+		self.framing_symbols = self.sink.symbol
 
 		self.state = [
 			self.ts, self.ltssm_L0, self.enable_higher_layers
@@ -54,6 +89,9 @@ class PCIePhyTX(Elaboratable):
 		def send(*ssymbols):
 			for i in range(ratio):
 				m.d.comb += symbols[i].eq(ssymbols[i])
+
+		def send_ordered_set(*ssymbols):
+			send(*(ssymbols * (ratio // 4)))
 		
 
 
@@ -62,22 +100,53 @@ class PCIePhyTX(Elaboratable):
 		#m.d.rx += fifo.r_en.eq(0)
 
 		m.d.rx += self.start_send_ts.eq(0)
+		m.d.rx += self.eios_sent.eq(0)
 
 		skp_counter = Signal(range(int(1538)))
 		skp_accumulator = Signal(4)
 		
-		# Increase SKP accumulator once counter reaches 325 (SKP between 1180 and 1538 symbol times, here 1300)
+		# Whether a SKP ordered set was sent before it was scheduled
+		skp_ahead = Signal()
+		skp_sent = Signal()
+		skp_sent_ahead = skp_sent & (skp_accumulator == 0)
+
+		# Increase SKP accumulator once counter reaches 325 with 1:4 gearing (SKP between 1180 and 1538 symbol times, here 1300)
+		skp_interval = 1300 // ratio
 		m.d.rx += skp_counter.eq(skp_counter + 1)
 		#with m.If((skp_counter << lane.speed) == 650):
-		with m.If(skp_counter == 325):
+		skp_scheduled = (skp_counter == skp_interval) & ~skp_ahead & ~skp_sent_ahead & (skp_accumulator < 15)
+		m.d.rx += skp_accumulator.eq(skp_accumulator + skp_scheduled - (skp_sent & ~skp_sent_ahead))
+
+		with m.If(skp_counter == skp_interval):
 			m.d.rx += skp_counter.eq(0)
-			with m.If(skp_accumulator < 15):
-				m.d.rx += skp_accumulator.eq(skp_accumulator + 1)
+			m.d.rx += skp_ahead.eq(0)
+
+		with m.Elif(skp_sent_ahead):
+			m.d.rx += skp_ahead.eq(1)
+
+		# The packet source needs 2 cycles until no new packet can arrive, so the request is announced early to get a free word
+		# right when the SKP ordered set is scheduled if the link is idle. At full load it comes right after the current packet.
+		# A word which is left free before that is used for the SKP ordered set which is about to be scheduled.
+		m.d.comb += self.skp_request.eq((skp_accumulator > 0) | ((skp_counter >= skp_interval - 2) & ~skp_ahead))
 
 		m.d.comb += self.sink.ready.eq(0) # TODO: Is this necessary?
 
 		# Structure of a TS:
 		# COM Link Lane n_FTS Rate Ctrl ID ID ID ID ID ID ID ID ID ID
+		# Send PAD symbols if the link/lane is invalid, otherwise send the link/lane number.
+		ts_symbol = Mux(ts.ts_id, D(5, 2), D(10, 2))
+		ts_symbols = [
+			Ctrl.COM,
+			Mux(ts.link.valid, ts.link.number, Ctrl.PAD),
+			Mux(ts.lane.valid, ts.lane.number, Ctrl.PAD),
+			ts.n_fts,
+			ts.rate,
+			ts.ctrl,
+		] + [ts_symbol] * 10
+
+		# The first word is sent in IDLE, the other ones in these states
+		ts_states = ["TSn-DATA", "TSn-ID0", "TSn-ID1"][: 16 // ratio - 1]
+
 		with m.FSM(domain="rx"):
 
 			with m.State("IDLE"):
@@ -87,9 +156,14 @@ class PCIePhyTX(Elaboratable):
 				# Whether higher levels are sending DLLPs or TLPs
 				sending_old = Signal()
 				# When a TLP starts, set sending_data to 1 and reset it when it ends.
-				# (self.in_symbols[0:9] == Ctrl.SDP) | 
-				sending_data = ((self.sink.symbol[0] == Ctrl.STP) | (self.sink.symbol[0] == Ctrl.SDP) # TODO: This might insert SKP sets in the beginning of a TLP since the pipeline takes a while and the ready signal might be buggy
-				| sending_old) & ~((self.sink.symbol[3] == Ctrl.END) | (self.sink.symbol[3] == Ctrl.EDB))
+				# On a multi-lane link a packet can start and end anywhere in the word, so check all symbols.
+				packet_start = 0
+				packet_end = 0
+				for symbol in self.framing_symbols:
+					packet_start |= (symbol == Ctrl.STP) | (symbol == Ctrl.SDP)
+					packet_end |= (symbol == Ctrl.END) | (symbol == Ctrl.EDB)
+
+				sending_data = (packet_start | sending_old) & ~packet_end # TODO: This might insert SKP sets in the beginning of a TLP since the pipeline takes a while and the ready signal might be buggy
 
 				m.d.rx += sending_old.eq(sending_data)
 				m.d.rx += self.enable_higher_layers.eq(1)
@@ -107,30 +181,49 @@ class PCIePhyTX(Elaboratable):
 				#with m.If(skp_accumulator > 0):
 				#    m.d.comb += self.sink.ready.eq(0)
 
-				with m.If((skp_accumulator > 0) & ~sending_old & ~sending_data):#(~sending_data | ((last_symbols[3] == Ctrl.END) | (last_symbols[3] == Ctrl.EDB)))):
+				if self.skp_handshake:
+					# Without the ready signal from the LTSSM no packets are sent, so there is no need to wait for a free word
+					m.d.comb += self.insert_skp.eq(self.skp_request & (self.skp_slot | ~self.ready))
+				elif self.primary is None:
+					m.d.comb += self.insert_skp.eq((skp_accumulator > 0) & ~sending_old & ~packet_start)
+				else:
+					m.d.comb += self.insert_skp.eq(self.primary.insert_skp)
+
+				# Electrical idle ordered set before going to electrical idle, for example for a speed change or L0s.
+				# Like SKP ordered sets it only consists of control symbols, scrambling isn't disabled since the receiver might still get data in L0.
+				with m.If(self.eios):
 					m.d.comb += self.sink.ready.eq(0)
-					send(Ctrl.COM, Ctrl.SKP, Ctrl.SKP, Ctrl.SKP)
+					send_ordered_set(Ctrl.COM, Ctrl.IDL, Ctrl.IDL, Ctrl.IDL)
 					m.d.rx += [
 						self.enable_higher_layers.eq(0),
-						skp_accumulator.eq(skp_accumulator - 1),
-						self.sending_ts.eq(1),
+						self.eios_sent.eq(1),
 					]
 
+				# Fast training sequence, the receiver on the other side locks to it when the transmitter leaves L0s.
+				# Like SKP ordered sets it only consists of control symbols, so scrambling isn't disabled.
+				with m.Elif(self.fts):
+					m.d.comb += self.sink.ready.eq(0)
+					send_ordered_set(Ctrl.COM, Ctrl.FTS, Ctrl.FTS, Ctrl.FTS)
+					m.d.rx += self.enable_higher_layers.eq(0)
+
+				with m.Elif(self.insert_skp | self.skp):#(~sending_data | ((last_symbols[3] == Ctrl.END) | (last_symbols[3] == Ctrl.EDB)))):
+					# The free word is replaced by the SKP ordered set
+					m.d.comb += self.sink.ready.eq(self.skp_slot if self.skp_handshake else 0)
+					send_ordered_set(Ctrl.COM, Ctrl.SKP, Ctrl.SKP, Ctrl.SKP)
+					# Scrambling isn't disabled with sending_ts, SKP ordered sets only consist of control symbols which aren't scrambled
+					# and don't advance the LFSR. The enable of the scramblers lags behind, so it would affect the words after it.
+					m.d.comb += skp_sent.eq(1)
+					m.d.rx += self.enable_higher_layers.eq(0)
+
 				with m.Elif(ts.valid):
 					m.d.rx += self.sending_ts.eq(1)
 					#m.d.comb += lane.tx_e_idle.eq(0b0)
-					m.next = "TSn-DATA"
+					m.next = ts_states[0]
 					m.d.rx += [
 						self.start_send_ts.eq(1)
 					]
 
-					# Send PAD symbols if the link/lane is invalid, otherwise send the link/lane number.
-					send(
-						Ctrl.COM,
-						Mux(ts.link.valid, ts.link.number, Ctrl.PAD),
-						Mux(ts.lane.valid, ts.lane.number, Ctrl.PAD),
-						ts.n_fts
-						)
+					send(*ts_symbols[0 : ratio])
 
 				# Transmit data from higher layers
 				with m.Elif(self.ready):
@@ -140,24 +233,15 @@ class PCIePhyTX(Elaboratable):
 
 				# Transmit idle data
 				with m.Elif(self.idle):
-					send(self.idle_symbol, self.idle_symbol, self.idle_symbol, self.idle_symbol)
+					send(*[self.idle_symbol] * ratio)
 
 				# Otherwise go to electrical idle, if told so
 				#with m.Else():
 				#	m.d.comb += lane.tx_e_idle.eq(self.eidle)
 
-			ts_symbol = Mux(ts.ts_id, D(5, 2), D(10, 2))
-
-			with m.State("TSn-DATA"):
-				send(ts.rate, ts.ctrl, ts_symbol, ts_symbol)
-				m.next = "TSn-ID0"
-
-			with m.State("TSn-ID0"):
-				send(ts_symbol, ts_symbol, ts_symbol, ts_symbol)
-				m.next = "TSn-ID1"
-
-			with m.State("TSn-ID1"):
-				send(ts_symbol, ts_symbol, ts_symbol, ts_symbol)
-				m.next = "IDLE"
+			for i, state in enumerate(ts_states):
+				with m.State(state):
+					send(*ts_symbols[(i + 1) * ratio : (i + 2) * ratio])
+					m.next = (ts_states + ["IDLE"])[i + 1]
 
 		return m
\ No newline at end of file
@@ -1,8 +1,8 @@
 from amaranth import *
 from amaranth.build import *
 from amaranth.hdl.ast import Part
-from amaranth.lib.fifo import AsyncFIFOBuffered
-from amaranth.lib.cdc import FFSynchronizer
+from amaranth.lib.fifo import AsyncFIFO, AsyncFIFOBuffered
+from amaranth.lib.cdc import FFSynchronizer, PulseSynchronizer
 
 from enum import IntEnum
 
@@ -10,7 +10,7 @@ from .align import SymbolSlip
 from .lfsr import PCIeLFSR
 
 
-__all__ = ["PCIeSERDESInterface", "PCIeSERDESAligner", "PCIeScrambler"]
+__all__ = ["PCIeSERDESInterface", "PCIeSERDESAligner", "PCIeElasticBuffer", "PCIeScrambler"]
 
 
 def K(x, y):
@@ -99,6 +99,9 @@ class PCIeSERDESInterface(Elaboratable): # From Yumewatari
 		Asserted if the received symbol has no coding errors. If not asserted, ``rx_data`` and
 		``rx_control`` must be ignored, and may contain symbols that do not exist in 8b10b coding
 		space.
+	rx_skp_removed : Signal
+		Asserted with the first word after a SKP ordered set which an elastic buffer removed,
+		the descrambler starts this word from its reset state since the COM is missing.
 
 	tx_locked : Signal
 		Asserted if the transmitter is generating a valid clock.
@@ -153,6 +156,7 @@ class PCIeSERDESInterface(Elaboratable): # From Yumewatari
 
 		self.rx_symbol    = Signal(ratio * 9, decoder=symbol_decoder)
 		self.rx_valid     = Signal(ratio)
+		self.rx_skp_removed = Signal()
 
 		self.tx_symbol    = Signal(ratio * 9, decoder=symbol_decoder)
 		self.tx_set_disp  = Signal(ratio)
@@ -171,8 +175,11 @@ class PCIeSERDESInterface(Elaboratable): # From Yumewatari
 		self.reset        = Signal()
 		self.reset_done   = Signal()
 
-		# Idle signal for when the idle symbol or SKP ordered sets are received
-		self.idle = (self.rx_symbol == 0) | (self.rx_symbol == compose([Ctrl.COM, Ctrl.SKP, Ctrl.SKP, Ctrl.SKP]))
+		# Idle signal for when the idle symbol or SKP ordered sets are received, with more than 4 symbols per word every 4 symbols are checked on their own
+		self.idle = Const(1)
+		for i in range(0, 9 * ratio, 9 * 4):
+			symbols = self.rx_symbol[i : i + 9 * 4]
+			self.idle &= (symbols == 0) | (symbols == compose([Ctrl.COM, Ctrl.SKP, Ctrl.SKP, Ctrl.SKP]))
 
 		self.state = [
 			self.speed
@@ -197,10 +204,31 @@ class PCIeSERDESAligner(PCIeSERDESInterface):
 	"""
 	A multiplexer that aligns commas to the first symbol of the word, for SERDESes that only
 	perform bit alignment and not symbol alignment.
+
+	With more than 4 symbols per word, commas are aligned to a multiple of 4 symbols. Ordered sets are 4 or 16 symbols long
+	and packets are a multiple of 4 symbols long, so a SKP ordered set between packets doesn't shift the received data.
+
+	Parameters
+	----------
+	lane : PCIeSERDESInterface
+		Lane of the SERDES
+	tx_cdc : str
+		How the transmitted symbols are moved from the rx domain to the tx domain.
+		"async" uses an asynchronous FIFO, which works for any two clocks.
+		"phase" uses a phase compensation FIFO of 4 words, for clocks with the same frequency like with a common reference clock.
+		It takes 2 cycles less than the async FIFO.
+		"none" connects them directly, for when both domains have the same clock.
+
+	Attributes
+	----------
+	tx_occupancy : Signal(2)
+		Only with "phase", number of words in the phase compensation FIFO as measured in the tx domain, should stay at about 2
 	"""
-	def __init__(self, lane : PCIeSERDESInterface):
+	def __init__(self, lane : PCIeSERDESInterface, tx_cdc : str = "async"):
 		super().__init__(lane.ratio)
 
+		assert tx_cdc in ["async", "phase", "none"]
+
 		#self.ratio        = lane.ratio
 #
 		self.rx_invert    = lane.rx_invert
@@ -231,36 +259,66 @@ class PCIeSERDESAligner(PCIeSERDESInterface):
 
 		self.debug = Signal(8)
 
+		self.tx_cdc = tx_cdc
+		self.tx_occupancy = Signal(2)
+
 		self.__lane = lane
 
 	def elaborate(self, platform: Platform) -> Module:
 		m = Module()
 
-		# Do TX CDC
-		# FFSynchronizer
-		if False:
-			m.submodules.tx_ff = FFSynchronizer(Cat(self.tx_symbol, self.tx_set_disp, self.tx_disp, self.tx_e_idle), Cat(self.__lane.tx_symbol, self.__lane.tx_set_disp, self.__lane.tx_disp, self.__lane.tx_e_idle), o_domain="tx", stages=4)
-		
-		# No CDC
-		# TODO: Check if this actually works
-		if False:
-			m.d.comb += Cat(self.__lane.tx_symbol, self.__lane.tx_set_disp, self.__lane.tx_disp, self.__lane.tx_e_idle).eq(
-				Cat(self.tx_symbol, self.tx_set_disp, self.tx_disp, self.tx_e_idle))
+		# TX CDC
+		tx_data = Cat(self.tx_symbol, self.tx_set_disp, self.tx_disp, self.tx_e_idle)
+		lane_tx_data = Cat(self.__lane.tx_symbol, self.__lane.tx_set_disp, self.__lane.tx_disp, self.__lane.tx_e_idle)
 
-		# AsyncFIFOBuffered
-		if True:
+		if self.tx_cdc == "async":
 			tx_fifo = m.submodules.tx_fifo = AsyncFIFOBuffered(width=self.ratio * 12, depth=8, r_domain="tx", w_domain="rx")
-			m.d.comb += tx_fifo.w_data.eq(Cat(self.tx_symbol, self.tx_set_disp, self.tx_disp, self.tx_e_idle))
-			m.d.comb += Cat(self.__lane.tx_symbol, self.__lane.tx_set_disp, self.__lane.tx_disp, self.__lane.tx_e_idle).eq(tx_fifo.r_data)
+			m.d.comb += tx_fifo.w_data.eq(tx_data)
+			m.d.comb += lane_tx_data.eq(tx_fifo.r_data)
 			m.d.comb += tx_fifo.r_en.eq(1)
 			m.d.comb += tx_fifo.w_en.eq(1)
 
+		elif self.tx_cdc == "phase":
+			# Every word is written into the next slot. Since the clocks have the same frequency the tx domain can read
+			# the slots with a pointer which runs at the same rate, it only needs to start in the middle once.
+			# The write pointer arrives in the tx domain 2 cycles late, so the slot after it is read 2 cycles after it was written
+			# and 2 cycles before it is overwritten. The slot is passed on without another register, like with the async FIFO
+			# the path from the slots to the lane only needs to be stable when the read pointer selects them.
+			slots = Array(Signal(len(tx_data), name=f"tx_slot_{i}") for i in range(4))
+			write_pointer = Signal(2)
+			write_pointer_gray = Signal(2)
+			m.d.rx += slots[write_pointer].eq(tx_data)
+			next_write_pointer = (write_pointer + 1)[0:2]
+			m.d.rx += write_pointer.eq(next_write_pointer)
+			m.d.rx += write_pointer_gray.eq(next_write_pointer ^ (next_write_pointer >> 1))
+
+			write_pointer_gray_tx = Signal(2)
+			m.submodules.tx_pointer = FFSynchronizer(write_pointer_gray, write_pointer_gray_tx, o_domain="tx")
+			write_pointer_tx = Cat(write_pointer_gray_tx[0] ^ write_pointer_gray_tx[1], write_pointer_gray_tx[1])
+
+			read_pointer = Signal(2)
+			started = Signal()
+			m.d.comb += self.tx_occupancy.eq(write_pointer_tx - read_pointer + 2)
+
+			# If the occupancy drifts away the clocks aren't locked, the read pointer is moved back to the middle
+			with m.If(~started | (self.tx_occupancy == 0)):
+				m.d.tx += read_pointer.eq(write_pointer_tx + 1)
+				m.d.tx += started.eq(1)
+
+			with m.Else():
+				m.d.tx += read_pointer.eq(read_pointer + 1)
+
+			m.d.comb += lane_tx_data.eq(slots[read_pointer])
+
+		else:
+			m.d.comb += lane_tx_data.eq(tx_data)
+
 		# Testing symbols
 		if False:
 			m.d.comb += self.__lane.tx_symbol.eq(Cat(Ctrl.COM, D(10, 2)))
 
 
-		self.slip = SymbolSlip(symbol_size=10, word_size=self.__lane.ratio, comma=Cat(Const(Ctrl.COM, 9), 1))
+		self.slip = SymbolSlip(symbol_size=10, word_size=self.__lane.ratio, comma=Cat(Const(Ctrl.COM, 9), 1), alignment=min(self.__lane.ratio, 4))
 		m.submodules.slip = self.slip
 
 		m.d.comb += self.debug.eq(self.slip.debug)
@@ -283,6 +341,142 @@ class PCIeSERDESAligner(PCIeSERDESInterface):
 		return m
 
 
+class PCIeElasticBuffer(PCIeSERDESInterface):
+	"""
+	Elastic buffer, moves the received symbols of an aligned lane from the recovered clock domain into the rx domain,
+	which can run from a local clock. The difference between the clocks is compensated with SKP ordered sets,
+	see section 4.2.7 in PCIe Base 1.1.
+
+	A SKP ordered set fills a whole word, so whole ordered sets are removed or added. Both is decided on the write side,
+	since the level each side sees lags behind the other side: SKP ordered sets aren't written while the buffer is more
+	than half full and are marked to be read twice while it is less than half full. The write side sees reads a few cycles late,
+	so the threshold for removing them is 3 words higher. Reading starts once the buffer is half full and starts over like this after it ran empty.
+
+	Parameters
+	----------
+	lane : PCIeSERDESInterface
+		Aligned lane in the domain **domain**
+	domain : str
+		Domain the received symbols of the lane are in, its recovered clock
+	depth : int
+		Number of words the buffer holds, a power of 2
+
+	Attributes
+	----------
+	fill_level : Signal(range(depth + 1))
+		Number of words in the buffer, in the rx domain
+	overflows : Signal(16)
+		Number of words which were lost because the buffer was full, saturates
+	underflows : Signal(16)
+		Number of times the buffer ran empty, saturates
+	"""
+	def __init__(self, lane : PCIeSERDESInterface, domain : str, depth : int = 16):
+		super().__init__(lane.ratio)
+
+		assert lane.ratio == 4
+		assert depth & (depth - 1) == 0 and depth >= 4
+
+		self.rx_invert    = lane.rx_invert
+		self.rx_align     = lane.rx_align
+		self.rx_present   = lane.rx_present
+		self.rx_locked    = lane.rx_locked
+		self.rx_aligned   = lane.rx_aligned
+
+		self.tx_symbol    = lane.tx_symbol
+		self.tx_set_disp  = lane.tx_set_disp
+		self.tx_disp      = lane.tx_disp
+		self.tx_e_idle    = lane.tx_e_idle
+		self.tx_locked    = lane.tx_locked
+
+		self.det_enable   = lane.det_enable
+		self.det_valid    = lane.det_valid
+		self.det_status   = lane.det_status
+
+		self.frequency    = lane.frequency
+		self.speed        = lane.speed
+		self.use_speed    = lane.use_speed
+
+		self.reset        = lane.reset
+		self.reset_done   = lane.reset_done
+
+		self.domain = domain
+		self.depth = depth
+
+		self.fill_level = Signal(range(depth + 1))
+		self.overflows = Signal(16)
+		self.underflows = Signal(16)
+
+		self.__lane = lane
+
+	def elaborate(self, platform: Platform) -> Module:
+		m = Module()
+
+		ratio = self.ratio
+		depth = self.depth
+		lane = self.__lane
+
+		skp = compose([Ctrl.COM] + [Ctrl.SKP] * (ratio - 1))
+
+		# Symbols, valid bits, whether a SKP ordered set was removed in front of the word and whether to read it twice
+		m.submodules.fifo = fifo = AsyncFIFO(width = 9 * ratio + ratio + 2, depth = depth, r_domain = "rx", w_domain = self.domain)
+
+		skp_received = (lane.rx_symbol == skp) & lane.rx_valid.all()
+		removed = Signal()
+		remove = skp_received & (fifo.w_level > depth // 2 + 3)
+		insert = skp_received & (fifo.w_level < depth // 2)
+
+		m.d.comb += fifo.w_data.eq(Cat(lane.rx_symbol, lane.rx_valid, removed, insert))
+		m.d.comb += fifo.w_en.eq(~remove)
+
+		with m.If(remove):
+			m.d[self.domain] += removed.eq(1)
+
+		with m.Elif(fifo.w_rdy):
+			m.d[self.domain] += removed.eq(0)
+
+		m.submodules.overflow = overflow = PulseSynchronizer(self.domain, "rx")
+		m.d.comb += overflow.i.eq(fifo.w_en & ~fifo.w_rdy)
+
+		with m.If(overflow.o & ~self.overflows.all()):
+			m.d.rx += self.overflows.eq(self.overflows + 1)
+
+		# Read side
+		started = Signal()
+		repeated = Signal() # The word is read for the second time
+		r_symbol = fifo.r_data[0 : 9 * ratio]
+		r_valid = fifo.r_data[9 * ratio : 10 * ratio]
+		r_removed = fifo.r_data[10 * ratio]
+		r_insert = fifo.r_data[10 * ratio + 1]
+
+		m.d.comb += self.fill_level.eq(fifo.r_level)
+
+		with m.If(~started):
+			m.d.rx += self.rx_symbol.eq(0)
+			m.d.rx += self.rx_valid.eq(0)
+			m.d.rx += self.rx_skp_removed.eq(0)
+
+			with m.If(fifo.r_level >= depth // 2):
+				m.d.rx += started.eq(1)
+
+		with m.Elif(~fifo.r_rdy):
+			m.d.rx += self.rx_symbol.eq(0)
+			m.d.rx += self.rx_valid.eq(0)
+			m.d.rx += self.rx_skp_removed.eq(0)
+			m.d.rx += started.eq(0)
+
+			with m.If(~self.underflows.all()):
+				m.d.rx += self.underflows.eq(self.underflows + 1)
+
+		with m.Else():
+			m.d.comb += fifo.r_en.eq(~r_insert | repeated)
+			m.d.rx += self.rx_symbol.eq(r_symbol)
+			m.d.rx += self.rx_valid.eq(r_valid)
+			m.d.rx += self.rx_skp_removed.eq(r_removed & ~repeated)
+			m.d.rx += repeated.eq(r_insert & ~repeated)
+
+		return m
+
+
 class PCIeScrambler(PCIeSERDESInterface):
 	"""
 	Scrambler and Descrambler for PCIe, needs to be after an aligner
@@ -325,33 +519,19 @@ class PCIeScrambler(PCIeSERDESInterface):
 		m = Module()
 
 		# Scramble transmitted and received data, skip on SKP, reset on COM
-		# TODO: Add case for when only one SKP character is received
 
-		def scramble(input, output, enable):
-			lfsr = PCIeLFSR(self.ratio, input[0:9] == Ctrl.COM, input[9:18] != Ctrl.SKP)
-			m.submodules += lfsr 
-			with m.If(enable & (input[8] == 0)):
-				m.d.rx += output[0:9].eq(lfsr.output[0:9] ^ input[0:9])
+		def scramble(input, output, enable, restart = Const(0)):
+			symbols = [input[9 * i : 9 * i + 9] for i in range(self.ratio)]
+			lfsr = PCIeLFSR(self.ratio, Cat(symbol == Ctrl.COM for symbol in symbols), Cat(symbol != Ctrl.SKP for symbol in symbols), restart)
+			m.submodules += lfsr
 
-			with m.Else():
-				m.d.rx += output[0:9].eq(input[0:9])
-				
-				
-			with m.If(enable & (input[17] == 0)):
-				with m.If(input[0:9] == Ctrl.COM): # TODO: This is a hack. Please fix.
-					m.d.rx += output[9:18].eq(0xFF ^ input[9:18])
+			# Only data symbols are scrambled
+			for i, symbol in enumerate(symbols):
+				with m.If(enable & (symbol[8] == 0)):
+					m.d.rx += output[9 * i : 9 * i + 9].eq(lfsr.output[9 * i : 9 * i + 9] ^ symbol)
 
 				with m.Else():
-					m.d.rx += output[9:18].eq(lfsr.output[9:18] ^ input[9:18])
-
-				if (self.ratio > 2):
-					for i in range(2, self.ratio):
-						m.d.rx += output[9 * i : 9 * i + 9].eq(Mux(input[9 * i : 9 * i + 9][8], 0, lfsr.output[9 * i : 9 * i + 9]) ^ input[9 * i : 9 * i + 9])
-
-			with m.Else():
-				for i in range(1, self.ratio):
-					m.d.rx += output[9 * i : 9 * i + 9].eq(input[9 * i : 9 * i + 9])
-			
+					m.d.rx += output[9 * i : 9 * i + 9].eq(symbol)
 
 		#with m.If(self.enable & (self.__lane.rx_symbol[8] == 0)):
 		#    with m.If(self.__lane.rx_symbol[0:9] == Ctrl.COM):
@@ -361,7 +541,7 @@ class PCIeScrambler(PCIeSERDESInterface):
 		#with m.Else():
 		#    m.d.rx += self.rx_symbol.eq(self.__lane.rx_symbol)
 
-		scramble(self.__lane.rx_symbol, self.rx_symbol, self.enable)
+		scramble(self.__lane.rx_symbol, self.rx_symbol, self.enable, self.__lane.rx_skp_removed)
 		scramble(self.tx_symbol, self.__lane.tx_symbol, self.enable)
 
 		i1 = Signal(len(self.__lane.rx_symbol)) # TODO: This is for debug, remove
@@ -2,7 +2,9 @@ from amaranth import *
 from amaranth.build import *
 from enum import IntEnum
 import math
+from amaranth.lib.fifo import SyncFIFOBuffered
 from .stream import StreamInterface
+from .layouts import memory_request_layout
 
 class TLPType(IntEnum): # PCIe Base 1.1 Page 49
 	# Value equals to Cat(type, fmt)
@@ -80,10 +82,11 @@ class MemoryIORequest(TLPBase):
 			self.first_dw_be.eq(data[7][0:4]),
 		]
 
+		# The lowest 2 bits of the address are reserved, the byte enables select the bytes within a DW
 		with m.If(self.fmt[0]):
-			m.d.comb += self.address[2:].eq(Cat(data[8:16][::-1]))
+			m.d.comb += self.address[2:].eq(Cat(data[8:16][::-1])[2:])
 		with m.Else():
-			m.d.comb += self.address[2:].eq(Cat(data[8:12][::-1]))
+			m.d.comb += self.address[2:].eq(Cat(data[8:12][::-1])[2:])
 
 		return m
 
@@ -243,6 +246,20 @@ class ConfigurationCompletion(TLPBase):
 		return m
 
 
+def _lowest_byte(be):
+	"""
+	Index of the first enabled byte of a DW
+	"""
+	return Mux(be[0], 0, Mux(be[1], 1, Mux(be[2], 2, Mux(be[3], 3, 0))))
+
+
+def _highest_byte(be):
+	"""
+	Index of the last enabled byte of a DW
+	"""
+	return Mux(be[3], 3, Mux(be[2], 2, Mux(be[1], 1, 0)))
+
+
 class ConfigurationMemory(Elaboratable):
 	"""
 	Configuration memory
@@ -260,17 +277,96 @@ class ConfigurationMemory(Elaboratable):
 
 	ratio : int
 		Gearbox ratio
+
+	bar0_size : int
+		Size of BAR 0 in bytes, its lower address bits are read-only 0 so the host can determine the size. 0 disables BAR 0
+
+	Attributes
+	----------
+	bus_master_enable : Signal()
+		Bus Master Enable bit of the Command register
+	max_payload_size : Signal(3)
+		Max_Payload_Size field of the Device Control register, 128 bytes << max_payload_size
+	max_read_request_size : Signal(3)
+		Max_Read_Request_Size field of the Device Control register, 128 bytes << max_read_request_size
+	extended_tag_enable : Signal()
+		Extended Tag Field Enable bit of the Device Control register
+	read_completion_boundary : Signal()
+		Read Completion Boundary bit of the Link Control register, 0 for 64 bytes and 1 for 128 bytes
+	aspm_control : Signal(2)
+		ASPM Control field of the Link Control register, bit 0 enables L0s and bit 1 enables L1
+	completion_timeout_disable : Signal()
+		Completion Timeout Disable bit of the Device Control 2 register
+	msi_enable : Signal()
+		MSI Enable bit of the MSI Message Control register
+	msi_multiple_message_enable : Signal(3)
+		Multiple Message Enable field of the MSI Message Control register, 2 ** msi_multiple_message_enable vectors are allocated
+	msi_address : Signal(64)
+		MSI Message Address and Message Upper Address registers
+	msi_data : Signal(16)
+		MSI Message Data register
+	msix_enable : Signal()
+		MSI-X Enable bit of the MSI-X Message Control register
+	msix_function_mask : Signal()
+		Function Mask bit of the MSI-X Message Control register
+	link_speed : Signal()
+		Current speed of the link, 0 for 2.5 GT/s and 1 for 5 GT/s, read as the Current Link Speed field of the Link Status register
+	link_width : Signal(6)
+		Negotiated width of the link in lanes, read as the Negotiated Link Width field of the Link Status register
 	"""
-	def __init__(self, init: list[int], configuration_request: ConfigurationRequest, new_request: Signal, ratio = 4):
+	COMMAND = 0x04
+	DEVICE_CONTROL = 0x40 + 0x08 # The PCI Express Capability is the first one, see make_init
+	LINK_CONTROL = 0x40 + 0x10
+	DEVICE_CONTROL_2 = 0x40 + 0x28
+
+	def __init__(self, init: list[int], configuration_request: ConfigurationRequest, new_request: Signal, ratio = 4, bar0_size = 0):
 		self.ratio = ratio
 		assert 4096 // ratio == 4096 / ratio # Ratio needs to be 2 ** n
 		assert ratio >= 4 # And at least 4
+		assert bar0_size == 0 or (bar0_size & (bar0_size - 1) == 0 and bar0_size >= 128)
+		self.bar0_size = bar0_size
 		self.init = init
 		self.configuration_request = configuration_request
 		self.configuration_completion = ConfigurationCompletion()
 		self.new_request = new_request
 		self.done = Signal() # Is high for 1 cycle
 
+		# Copies of the registers which are used by the transaction layer
+		self.bus_master_enable = Signal()
+		self.max_payload_size = Signal(3)
+		self.max_read_request_size = Signal(3, reset = 0b010)
+		self.extended_tag_enable = Signal()
+		self.read_completion_boundary = Signal()
+		self.aspm_control = Signal(2)
+		self.completion_timeout_disable = Signal()
+		self.msi_enable = Signal()
+		self.msi_multiple_message_enable = Signal(3)
+		self.msi_address = Signal(64)
+		self.msi_data = Signal(16)
+		self.msix_enable = Signal()
+		self.msix_function_mask = Signal()
+		self.link_speed = Signal()
+		self.link_width = Signal(6, reset = 1)
+
+		# The MSI and MSI-X Capabilities are optional, so their position depends on the init values
+		self.msi_offset = self.find_capability(init, 0x05)
+		self.msix_offset = self.find_capability(init, 0x11)
+
+	@staticmethod
+	def find_capability(init: list[int], capability_id: int):
+		"""
+		Returns the offset of the capability with the given ID in the init values or None if it isn't in the list
+		"""
+		pointer = init[0x34]
+
+		while pointer != 0:
+			if init[pointer] == capability_id:
+				return pointer
+
+			pointer = init[pointer + 1]
+
+		return None
+
 	def elaborate(self, platform: Platform) -> Module:
 		m = Module()
 
@@ -293,6 +389,9 @@ class ConfigurationMemory(Elaboratable):
 		debug_tlp = Signal()
 		tlp_type = Signal(len(self.configuration_request.tlp_type))
 		tlp_type2 = Signal(len(self.configuration_request.tlp_type))
+		data = self.configuration_request.configuration_data
+		be = self.configuration_request.first_dw_be
+
 		with m.FSM(name = "Configuration_FSM", domain = "rx"):
 			with m.State("Idle"):
 				with m.If(self.new_request):
@@ -309,12 +408,18 @@ class ConfigurationMemory(Elaboratable):
 							read_port.data.word_select(i | (self.configuration_request.register & int(math.log2(ratio // 4))).shift_left(2), 8)
 							)
 						for i in range(4)]
+
+					# The Current Link Speed and the Negotiated Link Width follow the LTSSM, the Link Status register is the upper half of the DW
+					with m.If(self.configuration_request.register == self.LINK_CONTROL // 4):
+						m.d.rx += self.configuration_completion.configuration_data[2][0:4].eq(Mux(self.link_speed, 0b0010, 0b0001))
+						m.d.rx += self.configuration_completion.configuration_data[2][4:8].eq(self.link_width[0:4])
+						m.d.rx += self.configuration_completion.configuration_data[3][0:2].eq(self.link_width[4:6])
 					
 					m.d.rx += [
 						self.configuration_completion.completer_id.eq(self.configuration_request.completer_id),
 						self.configuration_completion.requester_id.eq(self.configuration_request.requester_id),
 						self.configuration_completion.tag.eq(self.configuration_request.tag),
-						self.configuration_completion.byte_count.eq(4), # TODO: Eh, this might cause errors when byte enables are set
+						self.configuration_completion.byte_count.eq(Mux(be == 0, 1, _highest_byte(be) - _lowest_byte(be) + 1)), # See section 2.3.1.1 in PCIe Base 1.1
 						self.configuration_completion.tlp_type.eq(TLPType.CplD),
 						self.configuration_completion.length.eq(self.configuration_request.first_dw_be.any()),
 					]
@@ -323,6 +428,49 @@ class ConfigurationMemory(Elaboratable):
 					m.d.rx += write_port.addr.eq(self.configuration_request.register.shift_right(self.ratio // 4 - 1))
 					m.d.rx += write_port.en.eq(self.configuration_request.first_dw_be | (self.configuration_request.register & int(math.log2(ratio // 4))).shift_left(2))
 					m.d.rx += write_port.data.eq(Repl(Cat(self.configuration_request.configuration_data), self.ratio // 4))
+
+					# BAR 0 is a 32 bit non-prefetchable memory BAR, see section 7.5.1.2.1 in PCIe Base 1.1
+					with m.If(self.configuration_request.register == 0x10 // 4):
+						m.d.rx += write_port.data.eq(Repl(Cat(self.configuration_request.configuration_data) & (~(self.bar0_size - 1) & 0xFFFFFFFF), self.ratio // 4))
+
+					with m.If((self.configuration_request.register == self.COMMAND // 4) & be[0]):
+						m.d.rx += self.bus_master_enable.eq(data[0][2])
+
+					with m.If(self.configuration_request.register == self.DEVICE_CONTROL // 4):
+						with m.If(be[0]):
+							m.d.rx += self.max_payload_size.eq(data[0][5:8])
+
+						with m.If(be[1]):
+							m.d.rx += self.extended_tag_enable.eq(data[1][0])
+							m.d.rx += self.max_read_request_size.eq(data[1][4:7])
+
+					with m.If((self.configuration_request.register == self.LINK_CONTROL // 4) & be[0]):
+						m.d.rx += self.aspm_control.eq(data[0][0:2])
+						m.d.rx += self.read_completion_boundary.eq(data[0][3])
+
+					with m.If((self.configuration_request.register == self.DEVICE_CONTROL_2 // 4) & be[0]):
+						m.d.rx += self.completion_timeout_disable.eq(data[0][4])
+
+					if self.msi_offset is not None:
+						with m.If((self.configuration_request.register == self.msi_offset // 4) & be[2]):
+							m.d.rx += self.msi_enable.eq(data[2][0])
+							m.d.rx += self.msi_multiple_message_enable.eq(data[2][4:7])
+
+						for i, register in enumerate([self.msi_offset + 0x04, self.msi_offset + 0x08]):
+							with m.If(self.configuration_request.register == register // 4):
+								for j in range(4):
+									with m.If(be[j]):
+										m.d.rx += self.msi_address.word_select(i * 4 + j, 8).eq(data[j] & (0xFC if i == 0 and j == 0 else 0xFF)) # The address is DW aligned
+
+						with m.If(self.configuration_request.register == (self.msi_offset + 0x0C) // 4):
+							for j in range(2):
+								with m.If(be[j]):
+									m.d.rx += self.msi_data.word_select(j, 8).eq(data[j])
+
+					if self.msix_offset is not None:
+						with m.If((self.configuration_request.register == self.msix_offset // 4) & be[3]):
+							m.d.rx += self.msix_function_mask.eq(data[3][6])
+							m.d.rx += self.msix_enable.eq(data[3][7])
 					
 					m.d.rx += [
 						self.configuration_completion.completer_id.eq(self.configuration_request.completer_id),
@@ -339,7 +487,7 @@ class ConfigurationMemory(Elaboratable):
 		return m
 
 	@staticmethod
-	def make_init(vendor_id: int, device_id: int, subsystem_vendor_id: int = 0, subsystem_device_id: int = 0, command: int = 0, status: int = 0x0010, max_payload_size = 128):
+	def make_init(vendor_id: int, device_id: int, subsystem_vendor_id: int = 0, subsystem_device_id: int = 0, command: int = 0, status: int = 0x0010, max_payload_size = 128, max_link_width = 1, support_5GTps = False, extended_tags = False, msi_vectors = 0, msix_vectors = 0, msix_table_offset = 0, msix_pba_offset = 0, aspm_support = 0b00, n_fts = 255):
 		"""
 		Make init values
 		
@@ -356,7 +504,41 @@ class ConfigurationMemory(Elaboratable):
 
 		subsystem_device_id : int
 			Device ID, 16 bits
+
+		max_link_width : int
+			Number of lanes, 1, 2, 4, 8, 12, 16 or 32
+
+		support_5GTps : bool
+			Whether the link supports 5 GT/s in addition to 2.5 GT/s
+
+		extended_tags : bool
+			Whether 8 bit tags are supported, otherwise requests use 5 bit tags
+
+		msi_vectors : int
+			Number of MSI vectors which are requested, 1, 2, 4, 8, 16 or 32. 0 omits the MSI Capability
+
+		msix_vectors : int
+			Size of the MSI-X table, up to 2048. 0 omits the MSI-X Capability
+
+		msix_table_offset : int
+			Byte offset of the MSI-X table in BAR 0, 8 byte aligned
+
+		msix_pba_offset : int
+			Byte offset of the MSI-X Pending Bit Array in BAR 0, 8 byte aligned
+
+		aspm_support : int
+			Active State Power Management states which are supported, 0b01 for L0s, 0b10 for L1 and 0b11 for both
+
+		n_fts : int
+			Number of fast training sequences the receiver needs to leave L0s, used for the L0s Exit Latency
 		"""
+		assert max_link_width in [1, 2, 4, 8, 12, 16, 32]
+		assert msi_vectors in [0, 1, 2, 4, 8, 16, 32]
+		assert 0 <= msix_vectors <= 2048
+		assert msix_table_offset % 8 == 0 and msix_pba_offset % 8 == 0
+		assert aspm_support in [0b00, 0b01, 0b10, 0b11]
+		assert 0 <= n_fts <= 255
+
 		def get_bytes(val, n):
 			return val.to_bytes(n, byteorder = "little")
 
@@ -394,9 +576,9 @@ class ConfigurationMemory(Elaboratable):
 		device_capabilities = 0
 		device_capabilities |= max_payload_size_dict[max_payload_size] << 0 # Max_Payload_Size
 		device_capabilities |= 0b00 << 3 # Phantom Functions
-		device_capabilities |= 0b0 << 5 # Extended Tag Field
-		device_capabilities |= 0b000 << 6 # Endpoint L0s Acceptable Latency
-		device_capabilities |= 0b000 << 9 # Endpoint L1 Acceptable Latency
+		device_capabilities |= int(extended_tags) << 5 # Extended Tag Field
+		device_capabilities |= (0b111 if aspm_support else 0b000) << 6 # Endpoint L0s Acceptable Latency, 0b111 is no limit. Hosts only enable ASPM if the latencies of the link are acceptable
+		device_capabilities |= (0b111 if aspm_support else 0b000) << 9 # Endpoint L1 Acceptable Latency
 		device_capabilities |= 0b000 << 12 # Undefined
 		device_capabilities |= 0b0 << 15 # Role-Based Error Reporting
 		device_capabilities |= 0 << 18 # Captured Slot Power Limit Value, set by Set_Slot_Power_Limit Message
@@ -411,12 +593,20 @@ class ConfigurationMemory(Elaboratable):
 
 		device_status = 0
 
+		# The receiver leaves L0s after n_fts + 1 fast training sequences and a SKP ordered set of 16 ns symbols each at 2.5 GT/s, encoded as less than 64 ns << code
+		l0s_exit_latency = (n_fts + 1) * 4 * 4
+		l0s_exit_code = next(k for k in range(8) if l0s_exit_latency < 64 << k or k == 7)
+
+		# The link leaves L1 through Recovery, which includes the ECP5 CDR relocking and the SERDES and PCS reset after electrical idle.
+		# That time hasn't been measured on hardware, so the conservative maximum is advertised, 0b111 is more than 64 µs
+		l1_exit_code = 0b111
+
 		link_capabilities = 0
-		link_capabilities |= 0b0001 << 0 # Max Link Speed, 2.5 GT/s is 0001 and 5 GT/s is 0010
-		link_capabilities |= 0b000001 << 4 # Maximum Link Width, x1
-		link_capabilities |= 0b00 << 10 # Active State Power Management (ASPM) Support, whether L0s and L1 is supported (0b01 = L0s, 0b10 = L1, 0b11 = 0b01 | 0b10)
-		link_capabilities |= 0b111 << 12 # L0s Exit Latency
-		link_capabilities |= 0b111 << 15 # L1 Exit Latency
+		link_capabilities |= (0b0010 if support_5GTps else 0b0001) << 0 # Max Link Speed, 2.5 GT/s is 0001 and 5 GT/s is 0010
+		link_capabilities |= max_link_width << 4 # Maximum Link Width, x1 is 000001, x2 is 000010, x4 is 000100 and so on
+		link_capabilities |= aspm_support << 10 # Active State Power Management (ASPM) Support, whether L0s and L1 is supported (0b01 = L0s, 0b10 = L1, 0b11 = 0b01 | 0b10)
+		link_capabilities |= l0s_exit_code << 12 # L0s Exit Latency
+		link_capabilities |= l1_exit_code << 15 # L1 Exit Latency
 		link_capabilities |= 0b1 << 22 # ASPM Optionality Compliance, must be set to 0b1
 		link_capabilities |= 0b00000000 << 24 # Port Number, TODO: Does this need to be set in the LTSSM when the port is negotiated?
 
@@ -424,21 +614,21 @@ class ConfigurationMemory(Elaboratable):
 		link_control |= 0b0 << 6 # Common Clock Configuration, if 1 this means that the clocks are synchronized. TODO: Does this affect Spread Spectrum Clocking (SSC)?
 
 		link_status = 0
-		link_status |= 0b0001 << 0 # 2.5 GT/s, TODO: This should be set by the LTSSM, at least for transition to 5 GT/s
-		link_status |= 0b000001 << 4 # Link width x1 TODO: set by LTSSM
+		link_status |= 0b0001 << 0 # Current Link Speed, 2.5 GT/s, reads follow the LTSSM, see ConfigurationMemory.link_speed
+		link_status |= max_link_width << 4 # Negotiated Link Width, same encoding as the Maximum Link Width, reads follow the LTSSM, see ConfigurationMemory.link_width
 		link_status |= 0b0 << 12 # Use shared reference clock = 0b1
 
 
 		device_capabilities_2 = 0 
 		device_capabilities_2 |= 0b0000 << 0 # Completion Timeout Ranges Supported, whether the completion timeout can be set, in this case 50 µs to 50 ms
-		device_capabilities_2 |= 0b0 << 4 # Completion Timeout Disable Supported
+		device_capabilities_2 |= 0b1 << 4 # Completion Timeout Disable Supported
 
 		device_control_2 = 0
 
 		device_status_2 = 0 # Placeholder in PCIe Base 3.0
 
 		link_capabilities_2 = 0
-		link_capabilities_2 |= 0b001 << 1 # Supported Link Speeds, 8.0, 5.0 and 2.5 GT/s
+		link_capabilities_2 |= (0b011 if support_5GTps else 0b001) << 1 # Supported Link Speeds, 8.0, 5.0 and 2.5 GT/s
 
 		link_control_2 = 0
 
@@ -470,6 +660,39 @@ class ConfigurationMemory(Elaboratable):
 			]
 		]
 
+		# See section 6.8.1 in PCI Local Bus 3.0
+		if msi_vectors:
+			msi_message_control = 0
+			msi_message_control |= 0b0 << 0 # MSI Enable
+			msi_message_control |= int(math.log2(msi_vectors)) << 1 # Multiple Message Capable, the number of vectors is 2 ** n
+			msi_message_control |= 0b000 << 4 # Multiple Message Enable, set by the host
+			msi_message_control |= 0b1 << 7 # 64 bit address capable, required for PCI Express endpoints
+
+			capabilities.append([
+				0x05,								 # 00 MSI Capability
+				0x00,								 # 01 Next Capability Pointer
+				*get_bytes(msi_message_control, 2),   # 02
+				0x00, 0x00, 0x00, 0x00,			   # 04 Message Address
+				0x00, 0x00, 0x00, 0x00,			   # 08 Message Upper Address
+				0x00, 0x00,						   # 0C Message Data
+				0x00, 0x00,						   # 0E Reserved
+			])
+
+		# See section 6.8.2 in PCI Local Bus 3.0
+		if msix_vectors:
+			msix_message_control = 0
+			msix_message_control |= (msix_vectors - 1) << 0 # Table Size, encoded as N - 1
+			msix_message_control |= 0b0 << 14 # Function Mask
+			msix_message_control |= 0b0 << 15 # MSI-X Enable
+
+			capabilities.append([
+				0x11,								 # 00 MSI-X Capability
+				0x00,								 # 01 Next Capability Pointer
+				*get_bytes(msix_message_control, 2),  # 02
+				*get_bytes(msix_table_offset, 4),	 # 04 Table Offset, Table BIR 0 is BAR 0
+				*get_bytes(msix_pba_offset, 4),	   # 08 PBA Offset, PBA BIR 0 is BAR 0
+			])
+
 		current_pointer = 0x40 # Start at 0x40
 
 		init[0x34] = current_pointer # Set first capability pointer
@@ -492,6 +715,279 @@ class ConfigurationMemory(Elaboratable):
 		return init
 
 
+class BARMemory(Elaboratable):
+	"""
+	Memory target for a BAR, writes the data of Memory Write Requests to a memory and answers Memory Read Requests with Completions with Data
+
+	Requests are processed in order, so reads return the data of preceding writes. The data of a write is collected
+	and only written to the memory once the write has ended without being aborted, so it works with a cut-through receiver.
+	Only requests to the BAR are routed to an endpoint, so the address is taken modulo the size of the memory.
+
+	Reads are answered with as many completions as needed to keep them within Max_Payload_Size. Every completion but the last
+	ends at a Read Completion Boundary, see section 2.3.1.1 in PCIe Base 1.1, and the completions are sent one after another.
+
+	Parameters
+	----------
+	request : MemoryIORequest
+		Decoded header of the current request
+
+	memory : Memory
+		32 bit wide memory, for example to share it with user logic through another port. If it is None, a memory of size bytes is used
+
+	size : int
+		Size of the memory in bytes if memory is None, a power of 2
+
+	max_payload_size : int
+		Maximum number of bytes in a write or completion which is supported
+
+	ratio : int
+		Gearbox ratio
+
+	Attributes
+	----------
+	write_data : list of Signal(8)
+		Data DW of a write
+	write_valid : Signal()
+		Set to 1 for every data DW of a write
+	end : Signal()
+		Set to 1 for 1 cycle after the last DW of a request to queue it
+	abort : Signal()
+		Set to 1 together with end if the request has to be dropped
+	ready : Signal()
+		Whether another request of the maximum size can be received
+	completer_id : Signal(16)
+		Bus, device and function number of this device, captured from configuration writes
+	max_payload_size : Signal(3)
+		Max_Payload_Size field of the Device Control register, completions are limited to the smaller of it and the supported size
+	read_completion_boundary : Signal()
+		Read Completion Boundary bit of the Link Control register, 0 for 64 bytes and 1 for 128 bytes
+	tlp_source : StreamInterface
+		Completions, the first word of every completion is held until ready is 1
+	sending : Signal()
+		Whether the completions of a read are being sent, there is a cycle without valid between them
+	written : Signal()
+		Is 1 while a DW of a write is written to the memory, for logic which mirrors registers in the BAR
+	written_address : Signal(range(depth))
+		DW address which is written
+	written_data : Signal(32)
+		Data which is written
+	written_be : Signal(4)
+		Byte enables of the DW which is written
+	read_address : Signal(range(depth))
+		DW address of the data which is sent next, for logic which serves registers in the BAR
+	override : Signal()
+		Set to 1 to send override_data instead of the memory data at read_address
+	override_data : Signal(32)
+		Data which is sent while override is 1
+	"""
+	def __init__(self, request: MemoryIORequest, memory: Memory = None, size: int = 4096, max_payload_size: int = 128, ratio: int = 4):
+		assert ratio == 4
+
+		if memory is None:
+			assert size & (size - 1) == 0 and size >= 4
+			memory = Memory(width = 32, depth = size // 4, name = "BAR_Memory")
+
+		assert memory.width == 32
+		assert memory.depth & (memory.depth - 1) == 0
+
+		assert max_payload_size in [128, 256, 512, 1024, 2048, 4096]
+
+		self.request = request
+		self.memory = memory
+		self.ratio = ratio
+		self.max_payload_dw = max_payload_size // 4
+
+		self.write_data = [Signal(8, name = f"BAR_Write_Data_{i}") for i in range(4)]
+		self.write_valid = Signal()
+		self.end = Signal()
+		self.abort = Signal()
+		self.ready = Signal()
+		self.completer_id = Signal(16)
+		self.max_payload_size = Signal(3)
+		self.read_completion_boundary = Signal()
+		self.tlp_source = StreamInterface(8, ratio, name="BAR_Cpl_Source")
+		self.sending = Signal()
+		self.written = Signal()
+		self.written_address = Signal(range(memory.depth))
+		self.written_data = Signal(32)
+		self.written_be = Signal(4)
+		self.read_address = Signal(range(memory.depth))
+		self.override = Signal()
+		self.override_data = Signal(32)
+
+	def elaborate(self, platform: Platform) -> Module:
+		m = Module()
+
+		request = self.request
+
+		m.submodules.read_port = read_port = self.memory.read_port(domain = "rx", transparent = False)
+		m.submodules.write_port = write_port = self.memory.write_port(domain = "rx", granularity = 8)
+
+		# Requests are queued together with the data of writes, so the requests don't need to wait for the previous ones
+		queued_request = Record(memory_request_layout)
+		m.submodules.request_fifo = request_fifo = DomainRenamer("rx")(SyncFIFOBuffered(width = len(queued_request), depth = 8))
+		m.submodules.data_fifo = data_fifo = DomainRenamer("rx")(SyncFIFOBuffered(width = 32, depth = 4 * self.max_payload_dw))
+
+		# Number of data DW in the FIFO of the write which is being received, writes are taken out of the FIFO by this count
+		# so a write with a corrupted length can be dropped
+		received_words = Signal(11)
+
+		with m.If(self.end):
+			m.d.rx += received_words.eq(0)
+
+		with m.Elif(data_fifo.w_en & data_fifo.w_rdy):
+			m.d.rx += received_words.eq(received_words + 1)
+
+		m.d.comb += [
+			queued_request.write.eq(request.fmt[1]),
+			queued_request.drop.eq(self.abort),
+			queued_request.address.eq(request.address[2:32]),
+			queued_request.length.eq(Mux(request.fmt[1], received_words, request.length)),
+			queued_request.first_dw_be.eq(request.first_dw_be),
+			queued_request.last_dw_be.eq(request.last_dw_be),
+			queued_request.requester_id.eq(request.requester_id),
+			queued_request.tag.eq(request.tag),
+			queued_request.tc.eq(request.tc),
+			queued_request.attr.eq(request.attr),
+
+			request_fifo.w_data.eq(queued_request),
+			request_fifo.w_en.eq(self.end & Mux(queued_request.write, received_words != 0, ~self.abort)),
+			data_fifo.w_data.eq(Cat(self.write_data)),
+			data_fifo.w_en.eq(self.write_valid),
+		]
+
+		# There might be another request after the one which is received while ready goes low
+		m.d.rx += self.ready.eq((request_fifo.w_level < request_fifo.depth - 2) & (data_fifo.w_level <= data_fifo.depth - 2 * self.max_payload_dw))
+
+		current = Record(memory_request_layout)
+		remaining = Signal(11) # Remaining DW
+		first = Signal()
+		word_address = Signal(range(self.memory.depth))
+
+		# See section 2.3.1.1 in PCIe Base 1.1
+		byte_count = Signal(13) # Of the remaining completions, 4096 is sent as 0
+		lower_address = Signal(7)
+		length_dw = Mux(current.length == 0, 1024, current.length)
+
+		# Completions end at a multiple of the Read Completion Boundary unless they are the last one, Max_Payload_Size is a multiple of it
+		completion_dw = Signal(11)
+		completion_remaining = Signal(11)
+		max_payload_code = Mux(self.max_payload_size > self.max_payload_dw.bit_length() - 6, self.max_payload_dw.bit_length() - 6, self.max_payload_size)
+		boundary_dw = (Const(32, 11) << max_payload_code) - Mux(self.read_completion_boundary, word_address[0:5], word_address[0:4])
+
+		header = [
+			TLPType.CplD, Cat(Const(0, 4), current.tc, Const(0, 1)), Cat(completion_dw[8:10], Const(0, 2), current.attr, Const(0, 2)), completion_dw[0:8],
+			self.completer_id[8:16], self.completer_id[0:8], Cat(byte_count[8:12], Const(0, 4)), byte_count[0:8],
+			current.requester_id[8:16], current.requester_id[0:8], current.tag, Cat(lower_address, Const(0, 1)),
+		]
+		header_words = len(header) // self.ratio
+		header_index = Signal(range(header_words + 1))
+
+		m.d.comb += read_port.addr.eq(word_address)
+		m.d.comb += read_port.en.eq(1)
+
+		m.d.comb += self.written.eq(write_port.en.any())
+		m.d.comb += self.written_address.eq(write_port.addr)
+		m.d.comb += self.written_data.eq(write_port.data)
+		m.d.comb += self.written_be.eq(write_port.en)
+
+		# The read port holds the data at word_address while a completion is sent
+		m.d.comb += self.read_address.eq(word_address)
+		read_data = Mux(self.override, self.override_data, read_port.data)
+
+		with m.FSM(name = "BAR_FSM", domain = "rx"):
+			with m.State("Idle"):
+				with m.If(request_fifo.r_rdy):
+					m.d.comb += request_fifo.r_en.eq(1)
+					m.d.rx += current.eq(request_fifo.r_data)
+					m.next = "Decode"
+
+			with m.State("Decode"):
+				m.d.rx += [
+					remaining.eq(length_dw),
+					first.eq(1),
+					header_index.eq(0),
+					word_address.eq(current.address),
+					lower_address.eq(Cat(Mux(current.write, 0, _lowest_byte(current.first_dw_be)), current.address[0:5])),
+				]
+
+				with m.If(current.length == 1):
+					m.d.rx += byte_count.eq(Mux(current.first_dw_be == 0, 1, _highest_byte(current.first_dw_be) - _lowest_byte(current.first_dw_be) + 1))
+
+				with m.Else():
+					m.d.rx += byte_count.eq(length_dw * 4 - _lowest_byte(current.first_dw_be) - (3 - _highest_byte(current.last_dw_be)))
+
+				m.d.comb += read_port.addr.eq(current.address)
+
+				with m.If(current.write):
+					m.next = "Write"
+
+				with m.Else():
+					m.next = "Split"
+
+			with m.State("Write"):
+				with m.If(data_fifo.r_rdy):
+					m.d.comb += data_fifo.r_en.eq(1)
+					m.d.comb += write_port.addr.eq(word_address)
+					m.d.comb += write_port.data.eq(data_fifo.r_data)
+
+					with m.If(~current.drop):
+						m.d.comb += write_port.en.eq(Mux(first, current.first_dw_be, Mux(remaining == 1, current.last_dw_be, 0b1111)))
+
+					m.d.rx += word_address.eq(word_address + 1)
+					m.d.rx += remaining.eq(remaining - 1)
+					m.d.rx += first.eq(0)
+
+					with m.If(remaining == 1):
+						m.next = "Idle"
+
+			with m.State("Split"):
+				m.d.comb += self.sending.eq(1)
+				m.d.rx += header_index.eq(0)
+				m.d.rx += completion_dw.eq(Mux(remaining < boundary_dw, remaining, boundary_dw))
+				m.d.rx += completion_remaining.eq(Mux(remaining < boundary_dw, remaining, boundary_dw))
+				m.next = "Read"
+
+			with m.State("Read"):
+				m.d.comb += self.sending.eq(1)
+
+				for i in range(self.ratio):
+					m.d.comb += self.tlp_source.valid[i].eq(1)
+
+				with m.If(header_index < header_words):
+					with m.Switch(header_index):
+						for word in range(header_words):
+							with m.Case(word):
+								for i in range(self.ratio):
+									m.d.comb += self.tlp_source.symbol[i].eq(header[word * self.ratio + i])
+
+					with m.If(self.tlp_source.ready):
+						m.d.rx += header_index.eq(header_index + 1)
+
+				with m.Else():
+					for i in range(self.ratio):
+						m.d.comb += self.tlp_source.symbol[i].eq(read_data.word_select(i, 8))
+
+					# The next word is read while this one is accepted, the read port holds the current one otherwise
+					with m.If(self.tlp_source.ready):
+						m.d.comb += read_port.addr.eq(word_address + 1)
+						m.d.rx += word_address.eq(word_address + 1)
+						m.d.rx += remaining.eq(remaining - 1)
+						m.d.rx += completion_remaining.eq(completion_remaining - 1)
+
+						with m.If(remaining == 1):
+							m.next = "Idle"
+
+						# The next completion starts at a Read Completion Boundary
+						with m.Elif(completion_remaining == 1):
+							m.d.rx += first.eq(0)
+							m.d.rx += byte_count.eq(byte_count - completion_dw * 4 + Mux(first, _lowest_byte(current.first_dw_be), 0))
+							m.d.rx += lower_address.eq(Cat(Const(0, 2), (word_address + 1)[0:5]))
+							m.next = "Split"
+
+		return m
+
+
 class TLPTransmitter(Elaboratable): # Unused
 	def __init__(self, ratio = 4):
 		self.tlp_source = StreamInterface(8, ratio, name="TLP_Gen_Source")
@@ -519,10 +1015,57 @@ class TLPTransmitter(Elaboratable): # Unused
 
 
 class TLP(Elaboratable):
-	def __init__(self, ratio = 4):
+	"""
+	Transaction layer, answers configuration requests and memory requests to BAR 0
+
+	Parameters
+	----------
+	ratio : int
+		Gearbox ratio
+
+	bar0_size : int
+		Size of BAR 0 in bytes, a power of 2 and at least 128
+
+	bar0_memory : Memory
+		32 bit wide memory behind BAR 0, see BARMemory. If it is None, a memory of bar0_size bytes is used
+
+	dma : PCIeDMA
+		Bus master DMA engine, its requests are sent and completions are passed to it. None if this device doesn't make requests
+
+	max_payload_size : int
+		Largest payload in bytes which is supported, it is advertised in the Device Capabilities register.
+		Writes and completions use the Max_Payload_Size in the Device Control register up to this size
+
+	interrupts : PCIeInterrupts
+		Message Signaled Interrupts, its MSI and MSI-X Capabilities are added to the configuration space and its messages are sent.
+		The MSI-X table and Pending Bit Array are at the end of BAR 0. None if this device doesn't signal interrupts
+
+	n_fts : int
+		Number of fast training sequences the receiver needs to leave L0s, must match PCIeLTSSM n_fts
+
+	support_5GTps : bool
+		Whether the link supports 5 GT/s, it is advertised in the Link Capabilities register
+
+	max_link_width : int
+		Number of lanes of the link, it is advertised in the Link Capabilities register
+	"""
+	def __init__(self, ratio = 4, bar0_size = 4096, bar0_memory = None, dma = None, max_payload_size = 512, interrupts = None, n_fts = 128, support_5GTps = False, max_link_width = 1):
 		self.tlp_sink = StreamInterface(8, ratio, name="TLP_Gen_Sink")
 		self.tlp_source = StreamInterface(8, ratio, name="TLP_Gen_Source")
+		self.abort = Signal() # Connect to PCIeDLLTLPReceiver.abort, is 1 after the last word of a TLP on tlp_sink which has to be dropped
+		self.device_max_payload_size = Signal(3) # Connect to PCIeDLL.max_payload_size, Max_Payload_Size field of the Device Control register
+		self.aspm_control = Signal(2) # Connect to PCIeLTSSM.aspm_control, ASPM Control field of the Link Control register
+		self.link_speed = Signal() # Connect to PCIeLTSSM.status.link.speed, read as the Current Link Speed
+		self.link_width = Signal(6, reset = 1) # Connect to PCIeLTSSM.status.link.width, read as the Negotiated Link Width
 		self.ratio = ratio
+		self.bar0_size = bar0_size
+		self.bar0_memory = bar0_memory
+		self.dma = dma
+		self.max_payload_size = max_payload_size
+		self.interrupts = interrupts
+		self.n_fts = n_fts
+		self.support_5GTps = support_5GTps
+		self.max_link_width = max_link_width
 		self.debug = Signal(8)
 		self.debug_state = self.debug #Signal(4)
 		self.debug_header = Signal(32)
@@ -548,16 +1091,110 @@ class TLP(Elaboratable):
 
 		new_configuration_request = Signal()
 
-		m.submodules.configuration_memory = configuration_memory = ConfigurationMemory(ConfigurationMemory.make_init(0x1234, 0x5678), configuration_request, new_configuration_request)
+		dma = self.dma
+		interrupts = self.interrupts
+
+		interrupt_init = {}
+
+		if interrupts is not None:
+			interrupt_init["msi_vectors"] = interrupts.vectors
+
+			if interrupts.msix:
+				# One Pending Bit Array QW is enough for up to 64 vectors
+				msix_table_offset = self.bar0_size - 16 * interrupts.vectors - 16
+				msix_pba_offset = self.bar0_size - 8
+				assert msix_table_offset >= 0
+
+				interrupt_init["msix_vectors"] = interrupts.vectors
+				interrupt_init["msix_table_offset"] = msix_table_offset
+				interrupt_init["msix_pba_offset"] = msix_pba_offset
+
+		m.submodules.configuration_memory = configuration_memory = ConfigurationMemory(ConfigurationMemory.make_init(0x1234, 0x5678, max_payload_size = self.max_payload_size, extended_tags = dma is not None and dma.tags > 32, aspm_support = 0b11, n_fts = self.n_fts, support_5GTps = self.support_5GTps, max_link_width = self.max_link_width, **interrupt_init), configuration_request, new_configuration_request, bar0_size = self.bar0_size)
+		m.submodules.bar_memory = bar_memory = BARMemory(memory_io_request, self.bar0_memory, self.bar0_size, self.max_payload_size)
+
+		m.d.comb += bar_memory.max_payload_size.eq(configuration_memory.max_payload_size)
+		m.d.comb += self.device_max_payload_size.eq(configuration_memory.max_payload_size)
+		m.d.comb += self.aspm_control.eq(configuration_memory.aspm_control)
+		m.d.comb += configuration_memory.link_speed.eq(self.link_speed)
+		m.d.comb += configuration_memory.link_width.eq(self.link_width)
+		m.d.comb += bar_memory.read_completion_boundary.eq(configuration_memory.read_completion_boundary)
+
+		if dma is not None:
+			m.submodules.dma = dma
+
+			max_payload_code = self.max_payload_size.bit_length() - 8 # 128 bytes is 0
+
+			m.d.comb += [
+				dma.requester_id.eq(bar_memory.completer_id),
+				dma.bus_master_enable.eq(configuration_memory.bus_master_enable),
+				dma.max_payload_size.eq(Mux(configuration_memory.max_payload_size > max_payload_code, max_payload_code, configuration_memory.max_payload_size)),
+				dma.max_read_request_size.eq(configuration_memory.max_read_request_size),
+				dma.extended_tag_enable.eq(configuration_memory.extended_tag_enable),
+				dma.completion_timeout_disable.eq(configuration_memory.completion_timeout_disable),
+			]
+
+		if interrupts is not None:
+			m.submodules.interrupts = interrupts
+
+			m.d.comb += [
+				interrupts.requester_id.eq(bar_memory.completer_id),
+				interrupts.bus_master_enable.eq(configuration_memory.bus_master_enable),
+				interrupts.msi_enable.eq(configuration_memory.msi_enable),
+				interrupts.msi_multiple_message_enable.eq(configuration_memory.msi_multiple_message_enable),
+				interrupts.msi_address.eq(configuration_memory.msi_address),
+				interrupts.msi_data.eq(configuration_memory.msi_data),
+				interrupts.msix_enable.eq(configuration_memory.msix_enable),
+				interrupts.msix_function_mask.eq(configuration_memory.msix_function_mask),
+			]
+
+			# The MSI-X table is kept in BAR 0 so it reads back, the copy in the interrupt engine follows the writes to it
+			if interrupts.msix:
+				table_start = msix_table_offset // 4
+				table_end = table_start + 4 * interrupts.vectors
+				pba_start = msix_pba_offset // 4
+
+				m.d.comb += [
+					interrupts.table_write.eq(bar_memory.written & (bar_memory.written_address >= table_start) & (bar_memory.written_address < table_end)),
+					interrupts.table_address.eq(bar_memory.written_address - table_start),
+					interrupts.table_data.eq(bar_memory.written_data),
+					interrupts.table_be.eq(bar_memory.written_be),
+				]
+
+				# The Vector Control DWs and the Pending Bit Array are read from the interrupt engine, so the Mask Bits read 1 after reset
+				# and the Pending Bits are live, see section 6.8.2 in PCI Local Bus 3.0. The table starts at a multiple of 4 DW
+				read_entry = (bar_memory.read_address - table_start)[2:]
+
+				with m.If((bar_memory.read_address >= table_start) & (bar_memory.read_address < table_end) & (bar_memory.read_address[0:2] == 3)):
+					m.d.comb += bar_memory.override.eq(1)
+					m.d.comb += bar_memory.override_data.eq(interrupts.masked.bit_select(read_entry, 1))
+
+				with m.Elif(bar_memory.read_address == pba_start):
+					m.d.comb += bar_memory.override.eq(1)
+					m.d.comb += bar_memory.override_data.eq(interrupts.pending)
+
+				with m.Elif(bar_memory.read_address == pba_start + 1):
+					m.d.comb += bar_memory.override.eq(1)
+					m.d.comb += bar_memory.override_data.eq(0)
+
+		# The completer ID is captured from configuration writes, see section 2.2.6.2 in PCIe Base 1.1
+		with m.If(new_configuration_request & (configuration_request.tlp_type == TLPType.CfgWr0)):
+			m.d.rx += bar_memory.completer_id.eq(configuration_request.completer_id)
 
 		last_valid = Signal()
 		m.d.rx += last_valid.eq(self.tlp_sink.valid[0])
 
+		for i in range(4):
+			m.d.comb += bar_memory.write_data[i].eq(self.tlp_sink.symbol[i])
+
+		m.d.comb += bar_memory.abort.eq(self.abort)
+
+		is_completion = (self.tlp_sink.symbol[0] == TLPType.Cpl) | (self.tlp_sink.symbol[0] == TLPType.CplD)
+
 		with m.FSM(name = "TLP_rx_FSM", domain = "rx") as fsm:
 			m.d.comb += Cat(self.debug[0:4]).eq(fsm.state)
 
 			with m.State("Wait"):
-				m.d.rx += self.tlp_sink.ready.eq(1)
+				m.d.rx += self.tlp_sink.ready.eq(bar_memory.ready)
 				with m.If(~last_valid & self.tlp_sink.valid[0]):
 					for i in range(4):
 						# Assign header_data one by one
@@ -568,6 +1205,14 @@ class TLP(Elaboratable):
 					with m.If((self.tlp_sink.symbol[0] == TLPType.CfgRd0) | (self.tlp_sink.symbol[0] == TLPType.CfgWr0)):
 						m.next = "CfgRq1"
 
+					with m.Elif((self.tlp_sink.symbol[0] == TLPType.MRd32) | (self.tlp_sink.symbol[0] == TLPType.MRd64) | (self.tlp_sink.symbol[0] == TLPType.MWr32) | (self.tlp_sink.symbol[0] == TLPType.MWr64)):
+						m.d.rx += self.tlp_sink.ready.eq(0)
+						m.next = "MemRq1"
+
+					if dma is not None:
+						with m.Elif(is_completion):
+							m.next = "Cpl"
+
 			with m.State("CfgRq1"):
 				for i in range(4):
 					m.d.rx += self.header_data[i + 4].eq(self.tlp_sink.symbol[i])
@@ -595,36 +1240,136 @@ class TLP(Elaboratable):
 				m.next = "CfgRq4"
 
 			with m.State("CfgRq4"):
-				# Signal that there is a new configuration request to process
-				m.d.comb += new_configuration_request.eq(1)
+				# Signal that there is a new configuration request to process, this is the cycle after its last word
+				m.d.comb += new_configuration_request.eq(~self.abort)
 				m.next = "Wait"
 
+			with m.State("MemRq1"):
+				for i in range(4):
+					m.d.rx += self.header_data[i + 4].eq(self.tlp_sink.symbol[i])
+
+				m.next = "MemRq2"
+
+			with m.State("MemRq2"):
+				for i in range(4):
+					m.d.rx += self.header_data[i + 8].eq(self.tlp_sink.symbol[i])
+
+				with m.If(memory_io_request.fmt[0]): # 4 DW header
+					m.next = "MemRq3"
+
+				with m.Elif(memory_io_request.fmt[1]):
+					m.next = "MemWr"
+
+				with m.Else():
+					m.next = "MemRd"
+
+			with m.State("MemRq3"):
+				for i in range(4):
+					m.d.rx += self.header_data[i + 12].eq(self.tlp_sink.symbol[i])
+
+				with m.If(memory_io_request.fmt[1]):
+					m.next = "MemWr"
+
+				with m.Else():
+					m.next = "MemRd"
+
+			with m.State("MemWr"):
+				with m.If(self.tlp_sink.valid[0]):
+					m.d.comb += bar_memory.write_valid.eq(1)
+
+				with m.Else(): # This is the cycle after its last word
+					m.d.comb += bar_memory.end.eq(1)
+					m.next = "Wait"
+
+			with m.State("MemRd"): # This is the cycle after its last word
+				m.d.comb += bar_memory.end.eq(1)
+				m.next = "Wait"
+
+			if dma is not None:
+				with m.State("Cpl"):
+					with m.If(~self.tlp_sink.valid[0]):
+						m.next = "Wait"
+
+		# Completions are passed to the DMA engine including the cycle after their last word, in which abort is valid
+		if dma is not None:
+			forward = (fsm.ongoing("Wait") & ~last_valid & is_completion) | fsm.ongoing("Cpl")
+
+			for i in range(4):
+				m.d.comb += dma.tlp_sink.symbol[i].eq(self.tlp_sink.symbol[i])
+				m.d.comb += dma.tlp_sink.valid[i].eq(self.tlp_sink.valid[i] & forward)
+
+			m.d.comb += dma.abort.eq(self.abort & fsm.ongoing("Cpl"))
+
+		# Configuration completions are sent as soon as the first word has been accepted, completions of BAR 0 are held in its source until they are sent
+		configuration_source = StreamInterface(8, ratio, name="Cfg_Cpl_Source")
+		configuration_pending = Signal()
+
+		with m.If(configuration_memory.done):
+			m.d.rx += configuration_pending.eq(1)
+
 		with m.FSM(name = "TLP_tx_FSM", domain = "rx") as fsm:
 			m.d.comb += Cat(self.debug[4:8]).eq(fsm.state)
 			with m.State("Wait"):
-				with m.If(configuration_memory.done):
+				with m.If(configuration_memory.done | configuration_pending):
+					m.d.rx += configuration_pending.eq(0)
 					m.next = "CfgCpl0"
+
+				with m.Elif(bar_memory.tlp_source.all_valid):
+					m.next = "BAR"
+
+				if dma is not None:
+					with m.Elif(dma.tlp_source.all_valid):
+						m.next = "DMA"
+
+				if interrupts is not None:
+					with m.Elif(interrupts.tlp_source.all_valid):
+						m.next = "Interrupt"
+
+			with m.State("BAR"):
+				bar_memory.tlp_source.connect(self.tlp_source, m.d.comb)
+
+				with m.If(~bar_memory.tlp_source.all_valid & ~bar_memory.sending):
+					m.next = "Wait"
+
+			if dma is not None:
+				with m.State("DMA"):
+					dma.tlp_source.connect(self.tlp_source, m.d.comb)
+
+					with m.If(~dma.tlp_source.all_valid):
+						m.next = "Wait"
+
+			if interrupts is not None:
+				with m.State("Interrupt"):
+					interrupts.tlp_source.connect(self.tlp_source, m.d.comb)
+
+					with m.If(~interrupts.tlp_source.all_valid):
+						m.next = "Wait"
 		
 			for i in range(len(configuration_memory.configuration_completion.data) // ratio):
 				with m.State(f"CfgCpl{i}"):
-					for j in range(4):
-						m.d.rx += self.tlp_source.symbol[j].eq(configuration_memory.configuration_completion.data[j + i * ratio])
-						m.d.rx += self.tlp_source.valid[j].eq(1)
-
-					if i < len(configuration_memory.configuration_completion.data) // ratio - 1:
-						m.next = f"CfgCpl{i + 1}"
-					
-					else:
-						m.next = "CfgCplEnd"
-					
-					if i == len(configuration_memory.configuration_completion.data) // ratio - 2:
-						with m.If(~configuration_memory.configuration_completion.has_data):
+					# The first word is held until it is accepted, for example while the link leaves a low power state
+					with m.If(configuration_source.ready if i == 1 else 1):
+						for j in range(4):
+							m.d.rx += configuration_source.symbol[j].eq(configuration_memory.configuration_completion.data[j + i * ratio])
+							m.d.rx += configuration_source.valid[j].eq(1)
+
+						if i < len(configuration_memory.configuration_completion.data) // ratio - 1:
+							m.next = f"CfgCpl{i + 1}"
+						
+						else:
 							m.next = "CfgCplEnd"
+						
+						if i == len(configuration_memory.configuration_completion.data) // ratio - 2:
+							with m.If(~configuration_memory.configuration_completion.has_data):
+								m.next = "CfgCplEnd"
 			
 			with m.State("CfgCplEnd"):
 				for j in range(4):
-					m.d.rx += self.tlp_source.valid[j].eq(0)
+					m.d.rx += configuration_source.valid[j].eq(0)
 
 				m.next = "Wait"
 
+		with m.If(~fsm.ongoing("BAR") & ~fsm.ongoing("DMA") & ~fsm.ongoing("Interrupt")):
+			configuration_source.connect(self.tlp_source, m.d.comb)
+
 		return m
\ No newline at end of file
@@ -0,0 +1,199 @@
+from amaranth import *
+from amaranth.build import *
+from amaranth.lib.fifo import SyncFIFOBuffered, AsyncFIFO
+from .stream import StreamInterface
+
+
+__all__ = ["TLPWidthAdapter"]
+
+
+class TLPWidthAdapter(Elaboratable):
+	"""
+	Connects the Data Link Layer with 8 symbols per word to a Transaction Layer with 4 symbols per word, see TLP
+
+	TLPs are stored completely in a FIFO in each direction before they are passed on, because the Data Link Layer and the Transaction Layer
+	both need the words of a TLP without gaps once its first word has been accepted. Received TLPs which the Data Link Layer aborts
+	are dropped in the FIFO, so the Transaction Layer never sees them and its abort can stay 0.
+
+	The Transaction Layer runs in tl_domain. In the rx domain it gets half of the bandwidth of the link,
+	with a clock of twice the frequency of rx in its own domain all of it. Then the FIFOs are asynchronous.
+
+	Parameters
+	----------
+	max_payload_size : int
+		Largest payload in bytes, every FIFO holds two TLPs of this size
+	tl_domain : str
+		Clock domain of the Transaction Layer
+
+	Attributes
+	----------
+	dll_sink : StreamInterface
+		Connect to PCIeDLLTLPReceiver.tlp_source, 8 symbols per word. ready is 1 if a TLP of the maximum size fits into the FIFO
+	abort : Signal()
+		Connect to PCIeDLLTLPReceiver.abort
+	dll_source : StreamInterface
+		Connect to PCIeDLLTLPTransmitter.tlp_sink, the first word of a TLP is held until ready is 1.
+		The last word of a TLP of an odd number of DW is padded with 0
+	tlp_sink : StreamInterface
+		Connect to TLP.tlp_source in tl_domain, 4 symbols per word
+	tlp_source : StreamInterface
+		Connect to TLP.tlp_sink in tl_domain, a TLP is only sent if ready is 1 before its first word
+	"""
+	def __init__(self, max_payload_size: int = 512, tl_domain: str = "rx"):
+		self.dll_sink = StreamInterface(8, 8, name="Adapter_DLL_Sink")
+		self.abort = Signal()
+		self.dll_source = StreamInterface(8, 8, name="Adapter_DLL_Source")
+		self.tlp_sink = StreamInterface(8, 4, name="Adapter_TLP_Sink")
+		self.tlp_source = StreamInterface(8, 4, name="Adapter_TLP_Source")
+
+		self.tl_domain = tl_domain
+
+		# 4 DW of header and 1 DW of digest in addition to the data, in words of 2 DW
+		self.tlp_words = (max_payload_size + 5 * 4 + 7) // 8
+		self.depth = 2 ** (2 * self.tlp_words - 1).bit_length()
+
+	def elaborate(self, platform: Platform) -> Module:
+		m = Module()
+
+		tl = self.tl_domain
+		depth = self.depth
+
+		def fifo(width, depth, r_domain, w_domain):
+			if r_domain == w_domain:
+				return DomainRenamer(w_domain)(SyncFIFOBuffered(width = width, depth = depth))
+
+			else:
+				return AsyncFIFO(width = width, depth = depth, r_domain = r_domain, w_domain = w_domain)
+
+		# Every entry has a word of 8 symbols and whether it is the first one of a TLP, a token is written after the last word of a TLP.
+		# Received entries have whether their second half is valid and received tokens whether the TLP was aborted.
+		m.submodules.rx_data = rx_data = fifo(8 * 8 + 2, depth, tl, "rx")
+		m.submodules.rx_tokens = rx_tokens = fifo(1, 8, tl, "rx")
+		m.submodules.tx_data = tx_data = fifo(8 * 8 + 1, depth, "rx", tl)
+		m.submodules.tx_tokens = tx_tokens = fifo(1, 8, "rx", tl)
+
+		# A TLP can start before the last word and the token of the previous one show up in the levels, asynchronous FIFOs update them a cycle later
+		def room(data, tokens):
+			return (data.w_level < depth - self.tlp_words) & (tokens.w_level < 8 - 1)
+
+		# Received TLPs are written into the FIFO as they arrive, a TLP ends with a word of which only the first half is valid or before a word which isn't valid
+		sink = self.dll_sink
+
+		last_valid = Signal()
+		last_half = Signal()
+		last_abort = Signal()
+
+		m.d.rx += last_valid.eq(sink.all_valid)
+		m.d.rx += last_half.eq(sink.all_valid & ~sink.valid[-1])
+		m.d.rx += last_abort.eq(self.abort)
+
+		m.d.comb += [
+			sink.ready.eq(room(rx_data, rx_tokens)),
+			rx_data.w_data.eq(Cat(Cat(sink.symbol), sink.valid[-1], ~last_valid | last_half)),
+			rx_data.w_en.eq(sink.all_valid),
+		]
+
+		# abort is set in the cycle after the last word, or in the same cycle as a last word of which only the first half is valid
+		m.d.comb += [
+			rx_tokens.w_data.eq(Mux(last_half, last_abort, self.abort)),
+			rx_tokens.w_en.eq(last_valid & (last_half | ~sink.all_valid)),
+		]
+
+		# A TLP is sent to the Transaction Layer once it is complete, an aborted TLP is read out of the FIFO without sending it
+		source = self.tlp_source
+
+		rx_entry = rx_data.r_data
+		rx_start = Signal()
+		rx_aborted = Signal()
+		rx_second = Signal()
+
+		with m.FSM(name = "Adapter_RX_FSM", domain = tl):
+			with m.State("Idle"):
+				with m.If(rx_tokens.r_rdy & (source.ready | rx_tokens.r_data)):
+					m.d.comb += rx_tokens.r_en.eq(1)
+					m.d[tl] += rx_aborted.eq(rx_tokens.r_data)
+					m.d[tl] += rx_start.eq(1)
+					m.next = "Send"
+
+			with m.State("Send"):
+				# The words of the TLP are in the FIFO, it ends before the first word of the next one or when the FIFO is empty
+				with m.If(rx_data.r_rdy & (rx_start | rx_second | ~rx_entry[-1])):
+					for i in range(4):
+						m.d[tl] += source.symbol[i].eq(Mux(rx_second, rx_entry[32 + 8 * i : 40 + 8 * i], rx_entry[8 * i : 8 * i + 8]))
+						m.d[tl] += source.valid[i].eq(~rx_aborted)
+
+					m.d[tl] += rx_start.eq(0)
+					m.d[tl] += rx_second.eq(~rx_second & rx_entry[64])
+					m.d.comb += rx_data.r_en.eq(rx_second | ~rx_entry[64])
+
+				with m.Else():
+					for i in range(4):
+						m.d[tl] += source.valid[i].eq(0)
+
+					m.next = "Idle"
+
+		# Sent TLPs are written into the FIFO in pairs of words, the Transaction Layer leaves at least one cycle between them.
+		# Once the first word has been accepted all of the TLP fits into the FIFO.
+		sink = self.tlp_sink
+
+		accepted = Signal()
+		tl_last_valid = Signal()
+		lower = Signal(32)
+		lower_first = Signal()
+		lower_valid = Signal()
+		tx_token = Signal()
+
+		m.d.comb += sink.ready.eq(room(tx_data, tx_tokens) | tl_last_valid)
+		m.d.comb += accepted.eq(sink.all_valid & sink.ready)
+
+		m.d[tl] += tl_last_valid.eq(accepted)
+		m.d[tl] += tx_token.eq(0)
+
+		with m.If(accepted):
+			with m.If(lower_valid):
+				m.d.comb += tx_data.w_data.eq(Cat(lower, Cat(sink.symbol), lower_first))
+				m.d.comb += tx_data.w_en.eq(1)
+				m.d[tl] += lower_valid.eq(0)
+
+			with m.Else():
+				m.d[tl] += lower.eq(Cat(sink.symbol))
+				m.d[tl] += lower_first.eq(~tl_last_valid)
+				m.d[tl] += lower_valid.eq(1)
+
+		with m.Elif(tl_last_valid): # This is the cycle after the last word, the token is written after it
+			with m.If(lower_valid):
+				m.d.comb += tx_data.w_data.eq(Cat(lower, Const(0, 32), lower_first))
+				m.d.comb += tx_data.w_en.eq(1)
+				m.d[tl] += lower_valid.eq(0)
+
+			m.d[tl] += tx_token.eq(1)
+
+		m.d.comb += tx_tokens.w_en.eq(tx_token)
+
+		# A TLP is sent to the Data Link Layer once it is complete, after the first word has been accepted all others follow without gaps
+		source = self.dll_source
+
+		tx_entry = tx_data.r_data
+		tx_start = Signal()
+
+		with m.FSM(name = "Adapter_TX_FSM", domain = "rx"):
+			with m.State("Idle"):
+				with m.If(tx_tokens.r_rdy):
+					m.d.comb += tx_tokens.r_en.eq(1)
+					m.d.rx += tx_start.eq(1)
+					m.next = "Send"
+
+			with m.State("Send"):
+				with m.If(tx_data.r_rdy & (tx_start | ~tx_entry[-1])):
+					for i in range(8):
+						m.d.comb += source.symbol[i].eq(tx_entry[8 * i : 8 * i + 8])
+						m.d.comb += source.valid[i].eq(1)
+
+					with m.If(source.ready | ~tx_start):
+						m.d.comb += tx_data.r_en.eq(1)
+						m.d.rx += tx_start.eq(0)
+
+				with m.Else():
+					m.next = "Idle"
+
+		return m
@@ -2,17 +2,22 @@ from amaranth import *
 from amaranth.build import *
 from .virtual_serdes import VirtualPCIeSERDESx4
 from .ecp5_serdes import LatticeECP5PCIeSERDES
-from .serdes import PCIeSERDESAligner, LinkSpeed
+from .serdes import PCIeSERDESAligner
 from .phy import PCIePhy
 
 class VirtualPCIePhy(Elaboratable):
     """
     A PCIe Phy for the ECP5 for PCIe Gen1 x1
+
+    With support_5GTps the LTSSM goes through a speed change to 5 GT/s, the virtual SERDES keeps running at the same clock.
+    With cut_through received TLPs are streamed to the TLP layer before their LCRC has been checked, see PCIeDLLTLPReceiver.
+    max_payload_size is the largest supported payload in bytes, see PCIePhy.
+    gearing is the number of symbols per word, 4 or 8. With 8 the Transaction Layer of the upstream PHY runs in tl_domain, see PCIePhy.
     """
-    def __init__(self, upstream = True):
-        self.serdes = VirtualPCIeSERDESx4(speed_5GTps=False) # Declare SERDES module with 1:4 gearing
-        self.aligner = DomainRenamer({"rx" : "sync", "tx" : "sync"})(PCIeSERDESAligner(self.serdes.lane)) # Aligner for aligning COM symbols
-        self.phy = DomainRenamer({"rx" : "sync", "tx" : "sync"})(PCIePhy(self.aligner, upstream=upstream, support_5GTps=False, disable_scrambling=False))
+    def __init__(self, upstream = True, support_5GTps = False, cut_through = False, max_payload_size = 512, gearing = 4, tl_domain = "sync"):
+        self.serdes = VirtualPCIeSERDESx4(speed_5GTps=support_5GTps, gearing=gearing) # Declare SERDES module with 1:4 or 1:8 gearing
+        self.aligner = DomainRenamer({"rx" : "sync", "tx" : "sync"})(PCIeSERDESAligner(self.serdes.lane, tx_cdc="none")) # Aligner for aligning COM symbols, both domains are the same
+        self.phy = DomainRenamer({"rx" : "sync", "tx" : "sync"})(PCIePhy(self.aligner, upstream=upstream, support_5GTps=support_5GTps, disable_scrambling=False, cut_through=cut_through, max_payload_size=max_payload_size, tl_domain="rx" if tl_domain == "sync" else tl_domain))
         #self.serdes.lane.speed = 1
 
     def elaborate(self, platform: Platform) -> Module:
@@ -22,8 +27,6 @@ class VirtualPCIePhy(Elaboratable):
         m.submodules.aligner = self.aligner
         m.submodules.phy = self.phy
 
-        m.d.comb += self.serdes.lane.speed.eq(LinkSpeed.S2_5)
-        
         #m.domains.rx = ClockDomain()
         #m.domains.tx = ClockDomain()
         #m.d.comb += [
@@ -25,6 +25,10 @@ class PCIeVirtualTLPGenerator(Elaboratable):
 		#test_tlp = [0x74, 0, 0, 1, 0, 0xE2, 0, 0x50, 0, 0, 0, 0, 0, 0, 0, 0, 0xA, 0, 0, 0]
 		assert (len(test_tlp_1) // 4) * 4 == len(test_tlp_1)
 		assert (len(test_tlp_2) // 4) * 4 == len(test_tlp_2)
+
+		# The last word of a TLP is padded, with 8 symbols per word a TLP of an odd number of DW only fills half of it
+		test_tlp_1 += [0] * (-len(test_tlp_1) % ratio)
+		test_tlp_2 += [0] * (-len(test_tlp_2) % ratio)
 		#test_tlp = [1,2,3,4,5,6,7,8,9,10,11,12]
 
 		with m.If(self.tlp_source.ready):
@@ -37,16 +41,16 @@ class PCIeVirtualTLPGenerator(Elaboratable):
 			with m.If(timer == 2):
 				pass
 
-			for j in range(len(test_tlp_1) // 4):
+			for j in range(len(test_tlp_1) // ratio):
 				with m.Elif(timer == 10 + j):
 					for i in range(ratio):
-						m.d.rx += self.tlp_source.symbol[i].eq(test_tlp_1[i + j * 4])
+						m.d.rx += self.tlp_source.symbol[i].eq(test_tlp_1[i + j * ratio])
 						m.d.rx += self.tlp_source.valid[i].eq(1)
 
-			for j in range(len(test_tlp_2) // 4):
+			for j in range(len(test_tlp_2) // ratio):
 				with m.Elif(timer == 300 + j):
 					for i in range(ratio):
-						m.d.rx += self.tlp_source.symbol[i].eq(test_tlp_2[i + j * 4])
+						m.d.rx += self.tlp_source.symbol[i].eq(test_tlp_2[i + j * ratio])
 						m.d.rx += self.tlp_source.valid[i].eq(1)
 
 			with m.Else():
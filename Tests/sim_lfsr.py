@@ -6,7 +6,7 @@ import random
 if __name__ == "__main__":
     m = Module()
 
-    m.submodules.lfsr = lfsr = PCIeLFSR(4, Signal(), 1)
+    m.submodules.lfsr = lfsr = PCIeLFSR(4, Signal(4), Const(0b1111, 4))
 
     sim = Simulator(m)
     sim.add_clock(1/125e6, domain="rx")
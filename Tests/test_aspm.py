@@ -0,0 +1,210 @@
+from amaranth import *
+from amaranth.sim import Simulator, Delay, Settle, Passive
+from ecp5_pcie.virtual_phy_Gen1_x1 import VirtualPCIePhy
+from ecp5_pcie.virtual_serdes import VirtualPCIeSERDESx4
+from ecp5_pcie.serdes import PCIeSERDESAligner
+from ecp5_pcie.phy import PCIePhy
+from ecp5_pcie.ltssm import State, L0sState
+from ecp5_pcie.stream import StreamInterface
+
+def configuration_write_link_control(aspm_control):
+	"""
+	CfgWr0 to the Link Control register which sets the ASPM Control field, in words of 4 bytes
+	"""
+	tlp = [0x44, 0, 0, 1, 0, 0, 0, 0xF, 1, 0, 0, 0x50, aspm_control, 0, 0, 0]
+	return [int.from_bytes(bytes(tlp[i : i + 4]), byteorder = "little") for i in range(0, len(tlp), 4)]
+
+# CfgRd0 of the Vendor ID and Device ID, answered with a completion
+CONFIGURATION_READ = [int.from_bytes(bytes(word), byteorder = "little") for word in [[0x04, 0, 0, 1], [0, 0, 0, 0xF], [1, 0, 0, 0]]]
+
+class TLPSource(Elaboratable):
+	"""
+	Takes the place of the virtual TLP generator on the downstream side, the simulation sends the TLPs
+	"""
+	def __init__(self):
+		self.tlp_source = StreamInterface(8, 4, name="TLP_Source")
+
+	def elaborate(self, platform):
+		return Module()
+
+class ASPMTestbench(Elaboratable):
+	"""
+	Two virtual PHYs connected to each other, a lane in electrical idle is received as 0.
+	The downstream PHY is built like VirtualPCIePhy, but the simulation sends its TLPs
+	"""
+	def __init__(self):
+		self.phy_virtual_u = VirtualPCIePhy(upstream=True)
+		self.phy_u = self.phy_virtual_u.phy
+
+		self.serdes_d = VirtualPCIeSERDESx4()
+		self.aligner_d = DomainRenamer({"rx" : "sync", "tx" : "sync"})(PCIeSERDESAligner(self.serdes_d.lane, tx_cdc="none"))
+		self.phy_d = PCIePhy(self.aligner_d, upstream=False, support_5GTps=False)
+		self.phy_d.tlp = TLPSource()
+
+		for phy in [self.phy_u, self.phy_d]:
+			phy.ltssm.clocks_per_ms = 1024
+			phy.dll_tlp_tx.clocks_per_ms = 128
+			phy.ltssm.simulate = True
+
+	def elaborate(self, platform):
+		m = Module()
+
+		m.submodules.phy_u = self.phy_virtual_u
+		m.submodules.serdes_d = self.serdes_d
+		m.submodules.aligner_d = self.aligner_d
+		m.submodules.phy_d = DomainRenamer({"rx" : "sync", "tx" : "sync"})(self.phy_d)
+
+		lane_u = self.phy_virtual_u.serdes.lane
+		lane_d = self.serdes_d.lane
+
+		m.d.comb += lane_u.rx_symbol.eq(Mux(lane_d.tx_e_idle.any(), 0, lane_d.tx_symbol))
+		m.d.comb += lane_d.rx_symbol.eq(Mux(lane_u.tx_e_idle.any(), 0, lane_u.tx_symbol))
+
+		return m
+
+if __name__ == "__main__":
+	m = Module()
+	m.submodules.pcie = pcie = ASPMTestbench()
+
+	sim = Simulator(m)
+	sim.add_clock(1e-8, domain="sync")
+
+	phys = {"u": pcie.phy_u, "d": pcie.phy_d}
+	source = pcie.phy_d.tlp.tlp_source
+
+	def send(words):
+		for i in range(4):
+			yield source.valid[i].eq(1)
+		yield Cat(source.symbol).eq(words[0])
+
+		while True: # The first word is held until it is accepted
+			yield Settle()
+			if (yield source.ready):
+				break
+			yield
+
+		for word in words[1:]:
+			yield
+			yield Cat(source.symbol).eq(word)
+
+		yield
+		for i in range(4):
+			yield source.valid[i].eq(0)
+		yield
+
+	record = {}
+
+	def reset_record():
+		record.update(
+			states = {name: set() for name in phys},
+			tx_l0s = {name: set() for name in phys},
+			rx_l0s = {name: set() for name in phys},
+			l1_entries = {name: 0 for name in phys},
+			e_idle = {name: 0 for name in phys},
+			naks = 0,
+			link_down = 0,
+		)
+
+	def monitor():
+		"""
+		Records what happens on both sides
+		"""
+		yield Passive()
+
+		# The completions which are received on the downstream side are dropped
+		yield pcie.phy_d.dll_tlp_rx.tlp_source.ready.eq(1)
+
+		last_state = {name: None for name in phys}
+
+		while True:
+			for name, phy in phys.items():
+				state = yield phy.ltssm.debug_state
+				record["states"][name].add(State(state))
+				if state == State.L1_Idle and last_state[name] != State.L1_Idle:
+					record["l1_entries"][name] += 1
+				last_state[name] = state
+
+				record["tx_l0s"][name].add(L0sState((yield phy.ltssm.tx_l0s_state)))
+				record["rx_l0s"][name].add(L0sState((yield phy.ltssm.rx_l0s_state)))
+				record["e_idle"][name] += (yield phy.ltssm.lane.tx_e_idle) != 0
+
+				if (yield phy.dll.received_ack_nak) and not (yield phy.dll.received_ack):
+					record["naks"] += 1
+
+				record["link_down"] += not (yield phy.dll.up)
+
+			yield
+
+	def run(cycles, interval = 400):
+		"""
+		Sends a configuration read every interval cycles
+		"""
+		reset_record()
+
+		for i in range(cycles // interval):
+			yield from send(CONFIGURATION_READ)
+
+			for j in range(interval):
+				yield
+
+		return record["states"], record["tx_l0s"], record["rx_l0s"], record["l1_entries"], record["e_idle"], record["naks"], record["link_down"]
+
+	def seq_nums():
+		result = []
+		for phy in phys.values():
+			result.append((yield phy.dll.status.rx_seq_num))
+		return result
+
+	def process():
+		# Train the link without ASPM
+		for i in range(5000):
+			if (yield pcie.phy_u.dll.up) and (yield pcie.phy_d.dll.up):
+				break
+			yield
+
+		else:
+			assert False, "Link didn't come up"
+
+		states, tx_l0s, rx_l0s, l1_entries, e_idle, naks, link_down = yield from run(2000)
+		assert all(tx_l0s[name] == {L0sState.L0} for name in phys), tx_l0s
+		assert all(e_idle[name] == 0 for name in phys), e_idle
+
+		# Enable L0s on both sides, the transmitters go to electrical idle when they have nothing to send and come back with fast training sequences
+		yield from send(configuration_write_link_control(0b01))
+		yield pcie.phy_d.ltssm.aspm_control.eq(0b01)
+
+		first_seq_nums = yield from seq_nums()
+
+		states, tx_l0s, rx_l0s, l1_entries, e_idle, naks, link_down = yield from run(5000)
+		assert (yield pcie.phy_u.ltssm.aspm_control) == 0b01
+		assert all(states[name] == {State.L0} for name in phys), states
+		assert all(tx_l0s[name] == set(L0sState) for name in phys), tx_l0s
+		assert all(rx_l0s[name] == {L0sState.L0, L0sState.Idle, L0sState.FTS} for name in phys), rx_l0s # The receiver goes to Rx_L0s.Idle directly
+		assert all(e_idle[name] > 2000 for name in phys), e_idle
+		assert naks == 0 and link_down == 0, (naks, link_down)
+
+		# TLPs are still sent in both directions
+		second_seq_nums = yield from seq_nums()
+		assert all(b - a >= 10 for a, b in zip(first_seq_nums, second_seq_nums)), (first_seq_nums, second_seq_nums)
+
+		# Enable L1 as well, once everything has been acknowledged the link goes to L1 and leaves it through Recovery for the next TLP
+		yield from send(configuration_write_link_control(0b11))
+		yield pcie.phy_d.ltssm.aspm_control.eq(0b11)
+
+		states, tx_l0s, rx_l0s, l1_entries, e_idle, naks, link_down = yield from run(6000, 1000)
+		assert all(l1_entries[name] >= 4 for name in phys), l1_entries
+		assert all({State.L0, State.L1_Entry, State.L1_Idle, State.Recovery_RcvrLock}.issubset(states[name]) for name in phys), states
+		assert not any(state in [State.Detect_Quiet, State.Polling_Active, State.Configuration_Linkwidth_Start] for name in phys for state in states[name]), states
+		assert naks == 0 and link_down == 0, (naks, link_down)
+
+		third_seq_nums = yield from seq_nums()
+		assert all(b - a >= 6 for a, b in zip(second_seq_nums, third_seq_nums)), (second_seq_nums, third_seq_nums)
+
+		print("Test passed")
+
+	reset_record()
+
+	sim.add_sync_process(process, domain="sync")
+	sim.add_sync_process(monitor, domain="sync")
+
+	sim.run()
@@ -0,0 +1,228 @@
+from amaranth import *
+from amaranth.sim import Simulator, Delay, Settle, Passive
+from ecp5_pcie.tlp import TLP, TLPType
+
+def dw(value):
+	"""
+	Bytes of a DW of a TLP header, most significant byte first
+	"""
+	return list(value.to_bytes(4, byteorder = "big"))
+
+def memory_request(fmt_type, address, length = 1, first_be = 0xF, last_be = 0, data = [], tag = 0, requester_id = 0x0100):
+	header = [fmt_type, 0, (length >> 8) & 0b11, length & 0xFF, *requester_id.to_bytes(2, byteorder = "big"), tag, (last_be << 4) | first_be]
+
+	if fmt_type in [TLPType.MRd64, TLPType.MWr64]:
+		header += list(address.to_bytes(8, byteorder = "big"))
+
+	else:
+		header += dw(address)
+
+	return header + [byte for word in data for byte in word.to_bytes(4, byteorder = "little")]
+
+def configuration_request(fmt_type, register, data = 0, bus = 0, device = 0, function = 0):
+	header = [fmt_type, 0, 0, 1, 0x01, 0x00, 0, 0x0F, bus, (device << 3) | function, 0, register & 0xFC]
+
+	if fmt_type == TLPType.CfgWr0:
+		header += list(data.to_bytes(4, byteorder = "little"))
+
+	return header
+
+def completion(words):
+	"""
+	Decodes a completion, returns the fields of its header and its data
+	"""
+	header = [byte for word in words[0:3] for byte in word.to_bytes(4, byteorder = "little")]
+
+	fields = {
+		"type": header[0],
+		"length": ((header[2] & 0b11) << 8) | header[3],
+		"completer_id": (header[4] << 8) | header[5],
+		"byte_count": ((header[6] & 0xF) << 8) | header[7],
+		"requester_id": (header[8] << 8) | header[9],
+		"tag": header[10],
+		"lower_address": header[11] & 0x7F,
+	}
+
+	return fields, words[3:]
+
+if __name__ == "__main__":
+	m = Module()
+
+	m.submodules.tlp = tlp = TLP(bar0_size = 4096, max_payload_size = 256, support_5GTps = True, max_link_width = 2)
+
+	sim = Simulator(m)
+	sim.add_clock(1, domain="rx")
+
+	completions = []
+
+	def send(symbols, abort = False):
+		while not (yield tlp.tlp_sink.ready):
+			yield
+
+		for i in range(0, len(symbols), 4):
+			for j in range(4):
+				yield tlp.tlp_sink.symbol[j].eq(symbols[i + j])
+				yield tlp.tlp_sink.valid[j].eq(1)
+			yield
+
+		for j in range(4):
+			yield tlp.tlp_sink.valid[j].eq(0)
+		yield tlp.abort.eq(abort)
+		yield
+		yield tlp.abort.eq(0)
+		yield
+
+	def receive():
+		"""
+		Collects the TLPs sent by the transaction layer
+		"""
+		yield Passive()
+		yield tlp.tlp_source.ready.eq(1)
+		words = []
+
+		while True:
+			if (yield tlp.tlp_source.all_valid):
+				words.append((yield Cat(tlp.tlp_source.symbol)))
+
+			elif words:
+				completions.append(words)
+				words = []
+
+			yield
+
+	def wait_for_completions(n):
+		for i in range(500):
+			if len(completions) >= n:
+				return
+			yield
+
+		assert False, completions
+
+	def read(address, length = 1, first_be = 0xF, last_be = 0xF, tag = 0, fmt_type = TLPType.MRd32):
+		completions.clear()
+		yield from send(memory_request(fmt_type, address, length, first_be, last_be if length > 1 else 0, tag = tag))
+		yield from wait_for_completions(1)
+		return completion(completions[0])
+
+	def process():
+		# BAR 0 reads back the size when all ones are written to it
+		yield from send(configuration_request(TLPType.CfgWr0, 0x10, 0xFFFFFFFF, bus = 3, device = 1, function = 2))
+		yield from send(configuration_request(TLPType.CfgRd0, 0x10))
+		yield from wait_for_completions(2)
+		assert completions[1][3] == 0xFFFFF000, hex(completions[1][3])
+
+		# The supported Max_Payload_Size is advertised in the Device Capabilities register
+		yield from send(configuration_request(TLPType.CfgRd0, 0x44))
+		yield from wait_for_completions(3)
+		assert completions[2][3] & 0b111 == 0b001, hex(completions[2][3])
+
+		# 5 GT/s and x2 are advertised in the Link Capabilities register,
+		# the Current Link Speed and the Negotiated Link Width in the Link Status register follow the LTSSM
+		yield from send(configuration_request(TLPType.CfgRd0, 0x4C))
+		yield from wait_for_completions(4)
+		assert completions[3][3] & 0xF == 0b0010, hex(completions[3][3])
+		assert (completions[3][3] >> 4) & 0x3F == 2, hex(completions[3][3])
+
+		for link_speed, encoding, link_width in [(1, 0b0010, 2), (0, 0b0001, 1)]:
+			yield tlp.link_speed.eq(link_speed)
+			yield tlp.link_width.eq(link_width)
+			completions.clear()
+			yield from send(configuration_request(TLPType.CfgRd0, 0x50))
+			yield from wait_for_completions(1)
+			assert (completions[0][3] >> 16) & 0xF == encoding, hex(completions[0][3])
+			assert (completions[0][3] >> 20) & 0x3F == link_width, hex(completions[0][3])
+
+		data = [0x03020100, 0x07060504, 0x0B0A0908, 0x0F0E0D0C]
+		yield from send(memory_request(TLPType.MWr32, 0x100, 4, 0xF, 0xF, data))
+		fields, payload = yield from read(0x100, 4, tag = 5)
+		assert fields["type"] == TLPType.CplD
+		assert fields["completer_id"] == (3 << 8) | (1 << 3) | 2, hex(fields["completer_id"])
+		assert fields["requester_id"] == 0x0100
+		assert fields["tag"] == 5
+		assert fields["length"] == 4
+		assert fields["byte_count"] == 16
+		assert fields["lower_address"] == 0
+		assert payload == data, [hex(word) for word in payload]
+
+		# Byte enables
+		yield from send(memory_request(TLPType.MWr32, 0x204, 2, 0b1100, 0b0011, [0xAAAAAAAA, 0xBBBBBBBB]))
+		fields, payload = yield from read(0x204, 2)
+		assert payload == [0xAAAA0000, 0x0000BBBB], [hex(word) for word in payload]
+
+		fields, payload = yield from read(0x10, 1, 0b0110)
+		assert fields["byte_count"] == 2
+		assert fields["lower_address"] == 0x11
+
+		fields, payload = yield from read(0x40, 3, 0b1110, 0b0111)
+		assert fields["byte_count"] == 10
+		assert fields["lower_address"] == 0x41
+
+		fields, payload = yield from read(0x7C, 1, 0)
+		assert fields["byte_count"] == 1
+
+		# 64 bit addresses, the address is taken modulo the size of the BAR
+		yield from send(memory_request(TLPType.MWr64, 0x1_2345_6300, 1, 0xF, 0, [0x12345678]))
+		fields, payload = yield from read(0x300, 1, fmt_type = TLPType.MRd64)
+		assert payload == [0x12345678]
+
+		# Aborted requests are dropped
+		yield from send(memory_request(TLPType.MWr32, 0x300, 2, 0xF, 0xF, [0xDEADBEEF, 0xDEADBEEF]), abort = True)
+		completions.clear()
+		yield from send(memory_request(TLPType.MRd32, 0x300, 1), abort = True)
+		for i in range(50):
+			yield
+		assert completions == []
+
+		fields, payload = yield from read(0x300, 2)
+		assert payload == [0x12345678, 0], [hex(word) for word in payload]
+
+		# Writes followed by reads are processed in order
+		completions.clear()
+		for i in range(4):
+			yield from send(memory_request(TLPType.MWr32, 0x400 + i * 4, 1, 0xF, 0, [i + 1]))
+			yield from send(memory_request(TLPType.MRd32, 0x400, 4, 0xF, 0xF, tag = i))
+
+		yield from wait_for_completions(4)
+		for i in range(4):
+			fields, payload = completion(completions[i])
+			assert fields["tag"] == i
+			assert payload == [j + 1 if j <= i else 0 for j in range(4)], [hex(word) for word in payload]
+
+		# Reads larger than Max_Payload_Size are split at the Read Completion Boundary
+		data = [0x10000 + i for i in range(256)]
+		for i in range(0, 256, 64):
+			yield from send(memory_request(TLPType.MWr32, 0x800 + i * 4, 64, 0xF, 0xF, data[i : i + 64]))
+
+		for rcb, mps, address, length, first_be, splits in [
+			(0, 0b000, 0x830, 80, 0b1000, [(20, 0x30 + 3), (32, 0x00), (28, 0x00)]), # 64 byte RCB, 128 byte MPS
+			(1, 0b000, 0x830, 80, 0b1111, [(20, 0x30), (32, 0x00), (28, 0x00)]), # 128 byte RCB
+			(1, 0b001, 0x904, 100, 0b1111, [(63, 0x04), (37, 0x00)]), # 256 byte MPS
+			(1, 0b010, 0x904, 100, 0b1111, [(63, 0x04), (37, 0x00)]), # 512 byte MPS is limited to the supported 256 bytes
+			(0, 0b000, 0x800, 256, 0b1111, [(32, 0x00)] * 8),
+		]:
+			completions.clear()
+			yield from send(configuration_request(TLPType.CfgWr0, 0x50, rcb << 3, bus = 3, device = 1, function = 2))
+			yield from send(configuration_request(TLPType.CfgWr0, 0x48, mps << 5, bus = 3, device = 1, function = 2))
+			yield from send(memory_request(TLPType.MRd32, address, length, first_be, 0b0111, tag = 9))
+			yield from wait_for_completions(2 + len(splits))
+			assert len(completions) == 2 + len(splits)
+
+			byte_count = length * 4 - (4 - bin(first_be).count("1")) - 1 # The last DW has 3 bytes
+			payload = []
+			for (fields, words), (split_length, lower_address) in zip([completion(words) for words in completions[2:]], splits):
+				assert fields["type"] == TLPType.CplD
+				assert fields["tag"] == 9
+				assert fields["length"] == split_length, (fields, split_length)
+				assert fields["lower_address"] == lower_address, (fields, lower_address)
+				assert fields["byte_count"] == byte_count % 4096, (fields, byte_count)
+				byte_count -= split_length * 4 - (lower_address & 0b11)
+				payload += words
+
+			assert payload == data[(address - 0x800) // 4 : (address - 0x800) // 4 + length]
+
+		print("Test passed")
+
+	sim.add_sync_process(process, domain="rx")
+	sim.add_sync_process(receive, domain="rx")
+
+	sim.run()
@@ -102,6 +102,38 @@ if __name__ == "__main__":
 	sim.run()
 
 
+	print("Test pipelined")
+
+	# The pipelined LCRC gives the same values as the combinatorial one, one cycle later
+	m = Module()
+	in_symbol = Signal(32)
+	reset_crc = Signal(reset=1)
+	m.submodules.crc = crc = LCRC(in_symbol, reset_crc)
+	m.submodules.crc_pipelined = crc_pipelined = LCRC(in_symbol, reset_crc, pipeline=True)
+
+	sim = Simulator(m)
+
+	sim.add_clock(1, domain="sync")
+
+	def process():
+		crc_values = []
+		crc_pipelined_values = []
+
+		for i in range(len(test_bytes) // 4 + 4):
+			yield in_symbol.eq(Cat(Const(test_bytes[(4 * i + j) % len(test_bytes)], 8) for j in range(4)))
+			yield reset_crc.eq(i == 0)
+			yield
+			crc_values.append((yield crc.output))
+			crc_pipelined_values.append((yield crc_pipelined.output))
+
+		assert crc_values[:-1] == crc_pipelined_values[1:]
+		print("Test passed! Pipelined LCRC matches")
+
+	sim.add_sync_process(process, domain="sync")
+
+	sim.run()
+
+
 	print("Test 2")
 
 	if True:
@@ -138,4 +170,4 @@ if __name__ == "__main__":
 
 		sim.add_sync_process(process, domain="sync")
 
-		sim.run()
\ No newline at end of file
+		sim.run()
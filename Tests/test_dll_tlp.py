@@ -0,0 +1,328 @@
+from amaranth import *
+from amaranth.sim import Simulator, Delay, Settle, Passive
+from ecp5_pcie.dll import PCIeDLL
+from ecp5_pcie.dll_tlp import PCIeDLLTLPTransmitter, PCIeDLLTLPReceiver, ack_nak_latency_limit, replay_timeout
+from ecp5_pcie.dllp import PCIeDLLPTransmitter, PCIeDLLPReceiver, DLLPType
+from ecp5_pcie.serdes import Ctrl, LinkSpeed
+
+def tlp(index, data_words):
+	"""
+	Memory Read Request without data or Memory Write Request with data, every word is unique
+	"""
+	fmt_type = 0x40 if data_words else 0x00
+	header = [
+		fmt_type | (max(data_words, 1) << 24), # Format and type in the first symbol, length in the last one
+		0x0F00_0001 | (index << 16), # Requester ID, tag and byte enables
+		0x0010_0000 | (index << 8), # Address
+	]
+	return header + [(index << 16) | i for i in range(data_words)]
+
+if __name__ == "__main__":
+	# Values from Table 3-4 and Table 3-6 in PCIe Base 1.1 and Table 3-5 and Table 3-7 in PCIe Base 2.0
+	for max_payload_size, link_width, speed_5GTps, ack_nak, replay in [
+		(128, 1, False, 237, 711),
+		(256, 1, False, 416, 1248),
+		(512, 1, False, 559, 1677),
+		(4096, 1, False, 4143, 12429),
+		(256, 2, False, 217, 651),
+		(512, 4, False, 154, 462),
+		(128, 8, False, 67, 201),
+		(1024, 16, False, 150, 450),
+		(128, 1, True, 288, 864),
+		(512, 1, True, 610, 1830),
+	]:
+		assert ack_nak_latency_limit(max_payload_size, link_width, speed_5GTps) == ack_nak
+		assert replay_timeout(max_payload_size, link_width, speed_5GTps) == replay
+
+	m = Module()
+
+	# The links layers are only used for their signals, the link is up with infinite credits
+	dll_tx = PCIeDLL(None, None, None, 125e6, False)
+	dll_rx = PCIeDLL(None, None, None, 125e6, False)
+	m.submodules.tx = tx = PCIeDLLTLPTransmitter(dll_tx)
+	m.submodules.rx = rx = PCIeDLLTLPReceiver(dll_rx)
+	m.submodules.dllp_tx = dllp_tx = PCIeDLLPTransmitter()
+	m.submodules.dllp_rx = dllp_rx = PCIeDLLPReceiver()
+
+	tx.dllp_source.connect(dllp_tx.dllp_sink, m.d.comb)
+	dllp_rx.dllp_source.connect(rx.dllp_sink, m.d.comb)
+
+	# Idle data is sent as 0 like the physical layer does
+	for i in range(4):
+		m.d.comb += dllp_rx.phy_sink.symbol[i].eq(Mux(dllp_tx.phy_source.valid[i], dllp_tx.phy_source.symbol[i], 0))
+		m.d.comb += dllp_rx.phy_sink.valid[i].eq(1)
+
+	sim = Simulator(m)
+	sim.add_clock(1, domain="rx")
+
+	sent = []
+	received = []
+	words = []
+	acks = []
+
+	def send(words):
+		for i in range(4):
+			yield tx.tlp_sink.valid[i].eq(1)
+		yield Cat(tx.tlp_sink.symbol).eq(words[0])
+
+		while True: # The first word is held until it is accepted
+			yield Settle()
+			if (yield tx.tlp_sink.ready):
+				break
+			yield
+
+		for word in words[1:]:
+			yield
+			yield Cat(tx.tlp_sink.symbol).eq(word)
+
+		yield
+		for i in range(4):
+			yield tx.tlp_sink.valid[i].eq(0)
+		yield
+
+	def receive():
+		yield Passive()
+		yield rx.tlp_source.ready.eq(1)
+		current = []
+
+		while True:
+			if (yield rx.tlp_source.all_valid):
+				current.append((yield Cat(rx.tlp_source.symbol)))
+
+			elif current:
+				received.append(current)
+				current = []
+
+			yield
+
+	def monitor():
+		"""
+		Records the words which go over the link, None if nothing is sent
+		"""
+		yield Passive()
+
+		while True:
+			if (yield dllp_tx.phy_source.all_valid):
+				word = yield Cat(dllp_tx.phy_source.symbol)
+				words.append([(word >> (9 * i)) & 0x1FF for i in range(4)])
+
+			else:
+				words.append(None)
+
+			yield
+
+	def receive_dllps():
+		yield Passive()
+
+		while True:
+			if (yield dllp_rx.dllp.valid):
+				assert (yield dllp_rx.dllp.type) == DLLPType.Ack
+				acks.append((yield dllp_rx.dllp.data))
+
+			yield
+
+	def send_acks(count, interval):
+		"""
+		Sends Acks like the Data Link Layer does, returns the longest time it took until an Ack was sent
+		"""
+		latency = 0
+
+		for i in range(count):
+			for j in range(interval):
+				yield
+
+			yield dllp_tx.dllp.type.eq(DLLPType.Ack)
+			yield dllp_tx.dllp.data.eq(i)
+			yield dllp_tx.dllp.valid.eq(1)
+			yield dllp_tx.send.eq(1)
+
+			cycles = 0
+			while True:
+				yield Settle()
+				if (yield dllp_tx.started_sending):
+					break
+				cycles += 1
+				yield
+
+			yield
+			yield dllp_tx.send.eq(0)
+			latency = max(latency, cycles)
+
+		return latency
+
+	def framing(words):
+		"""
+		Splits the words which were sent into TLPs and DLLPs, a packet has to start in the first and end in the last symbol of a word
+		"""
+		packets = []
+		current = None
+
+		for word in words:
+			if word is None:
+				assert current is None
+				continue
+
+			if current is None:
+				assert word[0] in [Ctrl.STP, Ctrl.SDP], word
+				current = word[0]
+
+			else:
+				assert Ctrl.STP not in word and Ctrl.SDP not in word, word
+
+			if word[3] == Ctrl.END:
+				packets.append(current)
+				current = None
+
+		return packets
+
+	forward = []
+	forwarded_acks = []
+
+	def forward_ack_naks():
+		"""
+		Passes the Acks and Naks of the receiver to the transmitter like the link partner would, once the test asks for it
+		"""
+		yield Passive()
+
+		while True:
+			if forward and (yield dll_rx.schedule_ack_nak):
+				yield
+				ack = yield dll_rx.scheduled_ack
+				ack_nak_id = yield dll_rx.scheduled_ack_nak_id
+				if ack:
+					forwarded_acks.append(ack_nak_id)
+
+				yield dll_tx.received_ack_nak.eq(1)
+				yield dll_tx.received_ack.eq(ack)
+				yield dll_tx.received_ack_nak_id.eq(ack_nak_id)
+				yield
+				yield dll_tx.received_ack_nak.eq(0)
+
+			yield
+
+	saturate = []
+
+	def send_tlps():
+		"""
+		Sends TLPs back to back once the test asks for it
+		"""
+		while not saturate:
+			yield
+
+		for index in range(12, 36):
+			packet = tlp(index, 8)
+			sent.append(packet)
+			yield from send(packet)
+
+	def process():
+		# The limits follow the Max_Payload_Size and speed, in clock cycles of 4 symbol times
+		for dll in [dll_tx, dll_rx]:
+			yield dll.max_payload_size.eq(0)
+			yield dll.speed.eq(LinkSpeed.S2_5)
+
+		yield Settle()
+		assert (yield tx.replay_timeout) == 178
+		assert (yield rx.ack_nak_latency_limit) == 59
+
+		# Larger than the supported 512 bytes
+		yield dll_tx.max_payload_size.eq(3)
+		yield dll_rx.max_payload_size.eq(3)
+		yield Settle()
+		assert (yield tx.replay_timeout) == 420
+		assert (yield rx.ack_nak_latency_limit) == 139
+
+		yield dll_tx.up.eq(1)
+		yield dll_rx.up.eq(1)
+		yield dllp_tx.phy_source.ready.eq(1)
+		yield
+
+		# Small TLPs are sent with as little time between them as possible
+		for index in range(12):
+			packet = tlp(index, index % 3)
+			sent.append(packet)
+			yield from send(packet)
+
+		for i in range(100):
+			yield
+
+		assert received == sent, (received, sent)
+
+		# TLPs follow each other on the link without a gap and always start in the first symbol of a word
+		framed = [word for word in words if word is not None]
+		starts = [i for i, word in enumerate(framed) if word[0] == Ctrl.STP]
+		ends = [i for i, word in enumerate(framed) if word[3] == Ctrl.END]
+		assert len(starts) == len(ends) == len(sent)
+		assert all(end + 1 == start for end, start in zip(ends, starts[1:]))
+		assert all(end - start == len(packet) + 1 for start, end, packet in zip(starts, ends, sent))
+
+		first = words.index(framed[0])
+		assert None not in words[first : first + len(framed)], words[first : first + len(framed)]
+
+		# All TLPs were received correctly
+		assert (yield dll_rx.status.rx_seq_num) == len(sent) - 1
+		assert (yield rx.next_receive_seq) == len(sent)
+
+		# Acks are sent between TLPs even if there always is a TLP to send, they wait at most for one TLP
+		sent.clear()
+		received.clear()
+		words.clear()
+
+		saturate.append(True)
+		latency = yield from send_acks(12, 7)
+
+		for i in range(1000):
+			yield
+
+		assert received == sent
+		assert acks == list(range(12)), acks
+		assert latency <= len(tlp(0, 8)) + 2 + 2, latency # A framed TLP and 2 cycles in which no TLP is started
+
+		packets = framing(words)
+		assert packets.count(Ctrl.STP) >= len(sent) # The transmitter doesn't get these Acks, so it also replays TLPs
+		assert packets.count(Ctrl.SDP) == 12
+
+		assert (yield rx.next_receive_seq) == 36
+
+		# The sink isn't ready for a while, so the buffer runs full. TLPs without a free slot aren't acknowledged and get replayed,
+		# every TLP is delivered once and in order.
+		sent.clear()
+		received.clear()
+		words.clear()
+		forward.append(True)
+
+		yield rx.tlp_source.ready.eq(0)
+
+		for index in range(36, 50):
+			packet = tlp(index, index % 2)
+			sent.append(packet)
+			yield from send(packet)
+
+		for i in range(300):
+			yield
+
+		yield rx.tlp_source.ready.eq(1)
+
+		# TLPs of 0 and 1 DW back to back arrive faster than they are taken out of the buffer, so the next TLP often ends up without a slot
+		for index in range(50, 80):
+			packet = tlp(index, index % 2)
+			sent.append(packet)
+			yield from send(packet)
+
+		for i in range(3000):
+			yield
+
+		assert received == sent, ([(packet[1] >> 16) & 0xFF for packet in received], [(packet[1] >> 16) & 0xFF for packet in sent])
+		assert (yield rx.next_receive_seq) == 80
+		assert max(forwarded_acks) == 79, forwarded_acks
+		assert len([word for word in words if word is not None and word[0] == Ctrl.STP]) > len(sent) # Some TLPs were replayed
+
+		print("Test passed")
+
+	sim.add_sync_process(process, domain="rx")
+	sim.add_sync_process(receive, domain="rx")
+	sim.add_sync_process(monitor, domain="rx")
+	sim.add_sync_process(receive_dllps, domain="rx")
+	sim.add_sync_process(send_tlps, domain="rx")
+	sim.add_sync_process(forward_ack_naks, domain="rx")
+
+	sim.run()
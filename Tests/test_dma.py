@@ -0,0 +1,226 @@
+from amaranth import *
+from amaranth.sim import Simulator, Delay, Settle, Passive
+from ecp5_pcie.tlp import TLP, TLPType
+from ecp5_pcie.dma import PCIeDMA
+
+def configuration_write(register, data):
+	return [TLPType.CfgWr0, 0, 0, 1, 0x00, 0x00, 0, 0x0F, 3, (1 << 3) | 2, 0, register & 0xFC] + list(data.to_bytes(4, byteorder = "little"))
+
+def request(words):
+	"""
+	Decodes a memory request, returns its type, address, length in DW, tag and data
+	"""
+	symbols = [byte for word in words for byte in word.to_bytes(4, byteorder = "little")]
+	fmt_type = symbols[0]
+	length = ((symbols[2] & 0b11) << 8) | symbols[3]
+	length = 1024 if length == 0 else length
+	four_dw = fmt_type in [TLPType.MRd64, TLPType.MWr64]
+	header_length = 16 if four_dw else 12
+	address = int.from_bytes(bytes(symbols[8:header_length]), byteorder = "big")
+	data = symbols[header_length:]
+	return fmt_type, address, length, symbols[6], (symbols[4] << 8) | symbols[5], data
+
+def completion(data, byte_count, tag = 0, status = 0, requester_id = 0x030A):
+	fmt_type = TLPType.CplD if data else TLPType.Cpl
+	length = len(data) // 4
+	return [fmt_type, 0, (length >> 8) & 0b11, length & 0xFF, 0, 0, (status << 5) | ((byte_count >> 8) & 0xF), byte_count & 0xFF, *requester_id.to_bytes(2, byteorder = "big"), tag, 0] + data
+
+if __name__ == "__main__":
+	m = Module()
+
+	local_memory = Memory(width = 32, depth = 1024, init = [0x01000000 * (i & 0xFF) + i for i in range(1024)])
+	completion_tlps = 10
+	dma = PCIeDMA(local_memory, tags = 64, completion_timeout = 4096, completion_tlps = completion_tlps)
+	m.submodules.tlp = tlp = TLP(dma = dma)
+
+	sim = Simulator(m)
+	sim.add_clock(1, domain="rx")
+
+	requests = []
+	max_outstanding = [0]
+	host_memory = {}
+
+	def host_write(address, data):
+		for i, byte in enumerate(data):
+			host_memory[address + i] = byte
+
+	def host_read(address, length):
+		return [host_memory.get(address + i, 0) for i in range(length)]
+
+	def descriptor(host_address, length, to_card, local_address):
+		return list(host_address.to_bytes(8, byteorder = "little")) + list((length | (to_card << 31)).to_bytes(4, byteorder = "little")) + list(local_address.to_bytes(4, byteorder = "little"))
+
+	def send(symbols, abort = False):
+		while not (yield tlp.tlp_sink.ready):
+			yield
+
+		for i in range(0, len(symbols), 4):
+			for j in range(4):
+				yield tlp.tlp_sink.symbol[j].eq(symbols[i + j])
+				yield tlp.tlp_sink.valid[j].eq(1)
+			yield
+
+		for j in range(4):
+			yield tlp.tlp_sink.valid[j].eq(0)
+		yield tlp.abort.eq(abort)
+		yield
+		yield tlp.abort.eq(0)
+		yield
+
+	def receive():
+		"""
+		Collects the requests sent by the transaction layer
+		"""
+		yield Passive()
+		yield tlp.tlp_source.ready.eq(1)
+		words = []
+
+		while True:
+			if (yield tlp.tlp_source.all_valid):
+				words.append((yield Cat(tlp.tlp_source.symbol)))
+
+			elif words:
+				requests.append(request(words))
+				words = []
+
+			yield
+
+	def host(corrupt = False, error = False, drop = False):
+		"""
+		Stores writes and answers reads like a host with a Read Completion Boundary of 64 bytes, until a descriptor has been written back.
+		Reads are collected until no more requests arrive and their completions are interleaved, starting with the last read
+		"""
+		reads = []
+		idle = 0
+
+		while True:
+			if not requests:
+				idle += 1
+				yield
+
+				if idle < 20 or not reads:
+					continue
+
+				assert len({tag for tag, address, byte_count in reads}) == len(reads) # Tags of outstanding requests are unique
+				assert all(tag < 32 for tag, address, byte_count in reads) # Extended tags aren't enabled
+				assert sum((address % 64 + byte_count + 63) // 64 for tag, address, byte_count in reads) <= completion_tlps # The completions fit into the receive buffer
+				max_outstanding[0] = max(max_outstanding[0], len(reads))
+
+				if drop:
+					reads.pop(1)
+					drop = False
+
+				if error:
+					for tag, address, byte_count in reads:
+						yield from send(completion([], byte_count, tag, status = 0b001))
+					reads = []
+
+				reads.reverse()
+
+				while reads:
+					tag, address, byte_count = reads.pop(0)
+					chunk = min(byte_count, 64 - address % 64)
+
+					if corrupt:
+						yield from send(completion([0xEE] * chunk, byte_count, tag), abort = True)
+						corrupt = False
+
+					yield from send(completion(host_read(address, chunk), byte_count, tag))
+
+					if byte_count > chunk:
+						reads.append((tag, address + chunk, byte_count - chunk))
+
+				continue
+
+			idle = 0
+			fmt_type, address, length, tag, requester_id, data = requests.pop(0)
+			if fmt_type == TLPType.Cpl: # Of configuration writes
+				continue
+
+			assert requester_id == (3 << 8) | (1 << 3) | 2, hex(requester_id)
+			assert (address % 4096) + length * 4 <= 4096 # No 4 KB boundary is crossed
+
+			if fmt_type in [TLPType.MWr32, TLPType.MWr64]:
+				assert length * 4 <= 128 # Max_Payload_Size
+				assert len(data) == length * 4
+				assert (fmt_type == TLPType.MWr64) == (address >= 2 ** 32)
+				host_write(address, data)
+
+				if address % 16 == 8: # Write back
+					return address
+
+			else:
+				assert length * 4 <= 256 # Max_Read_Request_Size
+
+				if length == 4: # Descriptors are answered right away
+					yield from send(completion(host_read(address, 16), 16, tag))
+
+				else:
+					reads.append((tag, address, length * 4))
+
+	def local_read(address, length):
+		data = []
+		for i in range(address // 4, (address + length) // 4):
+			data += list((yield local_memory[i]).to_bytes(4, byteorder = "little"))
+		return data
+
+	def process():
+		yield from send(configuration_write(0x04, 0b110)) # Memory Space Enable and Bus Master Enable
+		yield from send(configuration_write(0x48, (0b001 << 12) | (0b000 << 5))) # Max_Read_Request_Size 256 bytes, Max_Payload_Size 128 bytes
+
+		ring = 0x1_0000_0000
+		host_write(ring +  0, descriptor(0x1_0000_0F00, 600, False, 0x100)) # Crosses a 4 KB boundary
+		host_write(ring + 16, descriptor(0x2000 + 0x34, 700, True, 0x800))
+		host_write(ring + 32, descriptor(0x3000, 8, True, 0xC00))
+		host_write(ring + 48, descriptor(0x3000, 1024, True, 0xC00))
+
+		host_write(0x2000, [(i * 7) & 0xFF for i in range(1024)])
+		host_write(0x3000, [0xFF] * 8)
+
+		yield dma.ring_address.eq(ring)
+		yield dma.ring_size.eq(4)
+		yield dma.enable.eq(1)
+		yield dma.tail.eq(1)
+
+		# Card to host
+		address = yield from host()
+		assert address == ring + 8
+		assert host_read(ring + 8, 4) == list((600 | (1 << 30)).to_bytes(4, byteorder = "little"))
+		assert host_read(0x1_0000_0F00, 600) == (yield from local_read(0x100, 600))
+		assert (yield dma.head) == 1
+
+		# Host to card with reads in flight and a dropped completion
+		yield dma.tail.eq(2)
+		address = yield from host(corrupt = True)
+		assert address == ring + 16 + 8
+		assert host_read(address, 4) == list((700 | (1 << 30) | (1 << 31)).to_bytes(4, byteorder = "little"))
+		assert host_read(0x2000 + 0x34, 700) == (yield from local_read(0x800, 700))
+		assert (yield dma.head) == 2
+		assert max_outstanding[0] == 2, max_outstanding # Every read can cause up to 5 completions, a third one wouldn't fit into the 10 slots
+
+		# Unsuccessful completion
+		yield dma.tail.eq(3)
+		address = yield from host(error = True)
+		assert address == ring + 32 + 8
+		assert host_read(address, 4) == list((8 | (1 << 29) | (1 << 30) | (1 << 31)).to_bytes(4, byteorder = "little"))
+		yield
+		assert (yield dma.head) == 3
+
+		# Completion timeout
+		yield dma.tail.eq(0)
+		address = yield from host(drop = True)
+		assert address == ring + 48 + 8
+		assert host_read(address, 4) == list((1024 | (1 << 29) | (1 << 30) | (1 << 31)).to_bytes(4, byteorder = "little"))
+		yield
+		assert (yield dma.head) == 0
+
+		for i in range(50):
+			yield
+		assert requests == []
+
+		print("Test passed")
+
+	sim.add_sync_process(process, domain="rx")
+	sim.add_sync_process(receive, domain="rx")
+
+	sim.run()
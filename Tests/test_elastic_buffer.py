@@ -0,0 +1,138 @@
+from amaranth import *
+from amaranth.sim import Simulator, Delay, Settle, Passive
+from ecp5_pcie.serdes import PCIeSERDESInterface, PCIeSERDESAligner, PCIeElasticBuffer, PCIeScrambler, Ctrl, compose
+from ecp5_pcie.lfsr import lfsr_advance
+
+SKP = compose([Ctrl.COM, Ctrl.SKP, Ctrl.SKP, Ctrl.SKP])
+
+def run(recovered_period, words = 2000, skp_interval = 20, shift = None):
+	"""
+	Sends scrambled words with a SKP ordered set every skp_interval words through an elastic buffer whose input is clocked
+	with recovered_period while its output runs with a period of 1 and descrambles them, returns the words which were sent and received.
+	With a shift the symbols are sent shifted by that many symbols and go through an aligner in the recovered domain first, like in LatticeECP5PCIePhy
+	"""
+	m = Module()
+
+	lane = PCIeSERDESInterface(ratio = 4)
+
+	if shift is None:
+		aligned_lane = lane
+
+	else:
+		m.submodules.aligner = aligned_lane = DomainRenamer({"rx": "rx_recovered"})(PCIeSERDESAligner(lane, tx_cdc = "none"))
+		m.d.comb += lane.rx_align.eq(1)
+
+	m.submodules.buffer = buffer = PCIeElasticBuffer(aligned_lane, "rx_recovered")
+	m.submodules.descrambler = descrambler = PCIeScrambler(buffer)
+	m.d.comb += descrambler.enable.eq(1)
+
+	sim = Simulator(m)
+	sim.add_clock(1e-8, domain="rx")
+	sim.add_clock(recovered_period * 1e-8, domain="rx_recovered")
+
+	sent = []
+	received = []
+	levels = []
+	counters = []
+
+	def send():
+		state = 0xFFFF
+		symbols_sent = [0] * (shift or 0)
+
+		for i in range(words):
+			if i % skp_interval == 0:
+				word = SKP
+				scrambled = SKP
+				state = 0xFFFF
+
+			else:
+				symbols = [i & 0xFF, (i >> 8) & 0xFF, 0, 0]
+				word = compose(symbols)
+				scrambled = 0
+
+				for j, symbol in enumerate(symbols):
+					scrambled |= (symbol ^ sum(((state >> (15 - k)) & 1) << k for k in range(8))) << (9 * j)
+					state = lfsr_advance(state)
+
+			sent.append(word)
+			symbols_sent += [(scrambled >> (9 * j)) & 0x1FF for j in range(4)]
+			yield lane.rx_symbol.eq(compose(symbols_sent[4 * i : 4 * i + 4]))
+			yield lane.rx_valid.eq(0xF)
+			yield
+
+	def receive():
+		yield Passive()
+		removed = 0
+
+		while True:
+			# The descrambler takes one cycle
+			if (yield descrambler.rx_valid) == 0xF:
+				received.append(((yield descrambler.rx_symbol), removed))
+				levels.append((yield buffer.fill_level))
+
+			removed = yield buffer.rx_skp_removed
+
+			counters[:] = [(yield buffer.overflows), (yield buffer.underflows)]
+			yield
+
+	sim.add_sync_process(send, domain="rx_recovered")
+	sim.add_sync_process(receive, domain="rx")
+
+	sim.run()
+
+	assert counters == [0, 0], counters
+	return sent, received, levels
+
+def check(sent, received):
+	"""
+	Checks that only SKP ordered sets were removed or added and that the words after removed ones are marked,
+	returns the number of removed and added SKP ordered sets
+	"""
+	data = [word for word in sent if word != SKP]
+	received_data = [word for word, removed in received if word != SKP]
+	assert len(received_data) > len(data) * 3 // 4
+	assert received_data == data[:len(received_data)]
+
+	# Number of SKP ordered sets in front of every data word
+	def skps(words):
+		result = []
+		count = 0
+		for word in words:
+			if word == SKP:
+				count += 1
+
+			else:
+				result.append(count)
+				count = 0
+
+		return result
+
+	# The first data word is left out since reading might have started after the SKP ordered set in front of it
+	sent_skps = skps(sent)[1 : len(received_data)]
+	received_skps = skps([word for word, removed in received])[1:]
+	removed_flags = [removed for word, removed in received if word != SKP][1:]
+	assert removed_flags == [int(r == 0 and s > 0) for s, r in zip(sent_skps, received_skps)]
+
+	return sum(max(s - r, 0) for s, r in zip(sent_skps, received_skps)), sum(max(r - s, 0) for s, r in zip(sent_skps, received_skps))
+
+if __name__ == "__main__":
+	# The recovered clock is faster, SKP ordered sets are removed
+	sent, received, levels = run(0.99)
+	removed, added = check(sent, received)
+	assert removed > 10 and added == 0, (removed, added)
+	assert max(levels) <= 12 and min(levels) >= 2, (min(levels), max(levels))
+
+	# The recovered clock is slower, SKP ordered sets are added. Some are removed at the start, since the buffer fills up until reading starts
+	sent, received, levels = run(1.01)
+	removed, added = check(sent, received)
+	assert added > 10 and removed <= 4, (removed, added)
+	assert max(levels) <= 12 and min(levels) >= 2, (min(levels), max(levels))
+
+	# The aligner in front of the elastic buffer runs in the recovered domain
+	for shift in [1, 2, 3]:
+		for period in [0.99, 1.01]:
+			sent, received, levels = run(period, shift = shift)
+			removed, added = check(sent, received)
+			assert (removed if period < 1 else added) > 10, (shift, period, removed, added)
+
+	print("Test passed")
@@ -0,0 +1,170 @@
+from amaranth import *
+from amaranth.sim import Simulator, Delay, Settle
+from ecp5_pcie.flow_control import PCIeCreditTracker, PCIeCreditAllocator
+from ecp5_pcie.layouts import dll_layout
+
+def header(fmt_type, length = 0):
+	"""
+	First DW of a TLP, fmt_type is Cat(type, fmt) like in TLPType
+	"""
+	return [fmt_type, 0, (length >> 8) & 0b11, length & 0xFF]
+
+MWr32 = 0b1000000
+MRd32 = 0b0000000
+CplD  = 0b1001010
+
+def test_tracker():
+	m = Module()
+
+	limits = Record(dll_layout)
+	symbols = [Signal(8) for i in range(4)]
+	up = Signal()
+
+	m.submodules.credits = credits = PCIeCreditTracker(limits, symbols, up)
+
+	sim = Simulator(m)
+	sim.add_clock(1, domain="rx")
+
+	def set_header(words):
+		for symbol, word in zip(symbols, words):
+			yield symbol.eq(word)
+		yield Settle()
+
+	def send(words):
+		"""
+		Sends a TLP if there are enough credits for it, returns whether it was sent
+		"""
+		yield from set_header(words)
+		sufficient = (yield credits.sufficient)
+
+		if sufficient:
+			yield credits.consume.eq(1)
+			yield
+			yield credits.consume.eq(0)
+
+		yield
+		return sufficient
+
+	def process():
+		# Infinite completion credits, 2 posted headers with 8 data credits and 1 non-posted header
+		yield limits.PH.eq(2)
+		yield limits.PD.eq(8)
+		yield limits.NPH.eq(1)
+		yield limits.NPD.eq(1)
+		yield limits.CPLH.eq(0)
+		yield limits.CPLD.eq(0)
+		yield
+		yield up.eq(1)
+		yield
+
+		assert (yield from send(header(MWr32, 20))) # 5 data credits
+		assert not (yield from send(header(MWr32, 16))) # 4 data credits, only 3 left
+		assert (yield from send(header(MWr32, 12)))
+		assert not (yield from send(header(MWr32, 1))) # No posted headers left
+		assert (yield credits.consumed.PH) == 2
+		assert (yield credits.consumed.PD) == 8
+
+		# Other types aren't affected
+		assert (yield from send(header(MRd32, 1)))
+		assert not (yield from send(header(MRd32, 1)))
+
+		for i in range(300):
+			assert (yield from send(header(CplD, 0))) # 1024 DW
+		assert (yield credits.consumed.CPLH) == 0
+
+		# UpdateFCs, the counters wrap around
+		for i in range(20):
+			yield limits.PH.eq((2 + i + 1) % 256)
+			yield limits.PD.eq((8 + (i + 1) * 256) % 4096)
+			yield
+			assert (yield from send(header(MWr32, 0))) # 256 data credits
+			assert not (yield from send(header(MWr32, 1)))
+		assert (yield credits.consumed.PD) == (8 + 20 * 256) % 4096
+
+		# Resetting while the DLL is down
+		yield up.eq(0)
+		yield
+		yield limits.PH.eq(1)
+		yield limits.PD.eq(1)
+		yield up.eq(1)
+		yield
+		yield
+		assert (yield credits.consumed.PH) == 0
+		assert (yield from send(header(MWr32, 4)))
+		assert not (yield from send(header(MWr32, 4)))
+
+		print("Tracker test passed")
+
+	sim.add_sync_process(process, domain="rx")
+
+	sim.run()
+
+def test_allocator():
+	m = Module()
+
+	symbols = [Signal(8) for i in range(4)]
+	up = Signal()
+
+	initial = {"PH": 4, "PD": 8, "NPH": 2, "NPD": 2, "CPLH": 0, "CPLD": 0}
+	m.submodules.credits = credits = PCIeCreditAllocator(initial, symbols, up)
+
+	sim = Simulator(m)
+	sim.add_clock(1, domain="rx")
+
+	def release(words):
+		"""
+		Returns the credits of a TLP, returns whether an UpdateFC was requested
+		"""
+		for symbol, word in zip(symbols, words):
+			yield symbol.eq(word)
+		yield credits.release.eq(1)
+		yield
+		yield credits.release.eq(0)
+		yield Settle()
+		update = (yield credits.update)
+		yield
+		return update
+
+	def process():
+		for field, value in initial.items():
+			assert (yield credits.credits[field]) == value
+
+		yield up.eq(1)
+		yield
+
+		assert not (yield from release(header(MWr32, 4)))
+		assert (yield from release(header(MWr32, 4))) # Half of the posted header credits
+		assert not (yield from release(header(MWr32, 4)))
+		assert (yield from release(header(MWr32, 16))) # Half of the posted data credits
+		assert (yield credits.credits.PH) == 8
+		assert (yield credits.credits.PD) == 8 + 7
+
+		assert (yield from release(header(MRd32, 1))) # A single non-posted header is half of them
+		assert (yield credits.credits.NPH) == 3
+		assert (yield credits.credits.NPD) == 2
+
+		assert not (yield from release(header(CplD, 16)))
+		assert (yield credits.credits.CPLH) == 0
+		assert (yield credits.credits.CPLD) == 0
+
+		# The credits wrap around
+		for i in range(300):
+			yield from release(header(MWr32, 4))
+		assert (yield credits.credits.PH) == (8 + 300) % 256
+
+		# Initial credits are advertised while the DLL is down
+		yield up.eq(0)
+		yield
+		yield
+		for field, value in initial.items():
+			assert (yield credits.credits[field]) == value
+
+		print("Allocator test passed")
+
+	sim.add_sync_process(process, domain="rx")
+
+	sim.run()
+
+if __name__ == "__main__":
+	test_tracker()
+	test_allocator()
@@ -0,0 +1,109 @@
+from amaranth import *
+from amaranth.sim import Simulator, Delay, Settle, Passive
+from ecp5_pcie.dllp import PCIeDLLPReceiver
+from ecp5_pcie.serdes import Ctrl
+
+# Two DLLPs received from the ROCKPro64, see sim_dllp_rx.py
+dllp_1 = [0x50, 0x08, 0x00, 0x20, 0x12, 0xd9]
+dllp_2 = [0x40, 0x08, 0x00, 0xe0, 0xf5, 0x06]
+
+def framed_dllp(dllp):
+	return [Ctrl.SDP] + dllp + [Ctrl.END]
+
+def framed_tlp(index, end = Ctrl.END):
+	"""
+	Sequence number, a 3 DW header and an LCRC, the contents aren't checked by the DLLP receiver
+	"""
+	return [Ctrl.STP, 0, index] + [(index * 16 + i) & 0xFF for i in range(12)] + [0xAA, 0xBB, 0xCC, 0xDD] + [end]
+
+if __name__ == "__main__":
+	m = Module()
+
+	m.submodules.dllp_rx = dllp_rx = PCIeDLLPReceiver()
+
+	sim = Simulator(m)
+	sim.add_clock(1, domain="rx")
+
+	dllps = []
+	words = []
+
+	def monitor():
+		yield Passive()
+
+		while True:
+			if (yield dllp_rx.dllp.valid):
+				dllps.append((yield dllp_rx.dllp.type))
+
+			word = yield Cat(dllp_rx.dllp_source.symbol)
+			words.append([(word >> (9 * i)) & 0x1FF for i in range(4)])
+			yield
+
+	def packets():
+		"""
+		Splits the aligned words into packets, every packet has to start in symbol 0 and end in symbol 3
+		"""
+		result = []
+		current = None
+
+		for word in words:
+			if current is None:
+				if word[0] in [Ctrl.STP, Ctrl.SDP]:
+					current = []
+
+				else:
+					assert Ctrl.END not in word and Ctrl.EDB not in word, word
+					continue
+
+			current += word
+
+			if word[3] in [Ctrl.END, Ctrl.EDB]:
+				result.append(current)
+				current = None
+
+		return result
+
+	def send(symbols, skip = None):
+		"""
+		Sends the symbols word by word, a SKP ordered set is received as an invalid word before the word with the given index
+		"""
+		symbols = symbols + [0] * (-len(symbols) % 4)
+
+		for index, i in enumerate(range(0, len(symbols), 4)):
+			if index == skip:
+				for j in range(4):
+					yield dllp_rx.phy_sink.symbol[j].eq(0)
+					yield dllp_rx.phy_sink.valid[j].eq(0)
+				yield
+
+			for j in range(4):
+				yield dllp_rx.phy_sink.symbol[j].eq(symbols[i + j])
+				yield dllp_rx.phy_sink.valid[j].eq(1)
+			yield
+
+		for j in range(4):
+			yield dllp_rx.phy_sink.symbol[j].eq(0)
+		for i in range(4):
+			yield
+
+	def process():
+		for offset in range(4):
+			dllps.clear()
+			words.clear()
+
+			# A TLP packed with a DLLP, a DLLP and a nullified TLP after idle data of an odd length and a TLP after a SKP ordered set
+			expected = [framed_tlp(1), framed_dllp(dllp_1), framed_dllp(dllp_2), framed_tlp(2, Ctrl.EDB), framed_tlp(3)]
+			symbols = [0] * offset + expected[0] + expected[1] + [0] * 3 + expected[2] + expected[3] + [0] * 6
+			skip = (len(symbols) + 3) // 4
+			symbols += [0] * (-len(symbols) % 4) + [0] * offset + expected[4]
+
+			yield from send(symbols, skip)
+
+			assert packets() == expected, (offset, packets())
+			assert dllps == [dllp_1[0] >> 4, dllp_2[0] >> 4], dllps
+
+		print("Test passed")
+
+	sim.add_sync_process(process, domain="rx")
+	sim.add_sync_process(monitor, domain="rx")
+
+	sim.run()
@@ -0,0 +1,221 @@
+from amaranth import *
+from amaranth.sim import Simulator, Delay, Settle, Passive
+from ecp5_pcie.tlp import TLP, TLPType
+from ecp5_pcie.interrupts import PCIeInterrupts
+
+def configuration_request(fmt_type, register, data = 0, be = 0xF):
+	header = [fmt_type, 0, 0, 1, 0x01, 0x00, 0, be, 3, (1 << 3) | 2, 0, register & 0xFC]
+
+	if fmt_type == TLPType.CfgWr0:
+		header += list(data.to_bytes(4, byteorder = "little"))
+
+	return header
+
+def memory_write(address, data):
+	return [TLPType.MWr32, 0, 0, len(data), 0x01, 0x00, 0, 0xFF if len(data) > 1 else 0x0F, *address.to_bytes(4, byteorder = "big")] + [byte for word in data for byte in word.to_bytes(4, byteorder = "little")]
+
+def memory_read(address, length = 1):
+	return [TLPType.MRd32, 0, 0, length, 0x01, 0x00, 0, 0xFF if length > 1 else 0x0F, *address.to_bytes(4, byteorder = "big")]
+
+def message(words):
+	"""
+	Decodes a memory write, returns its type, address, requester ID and data DW
+	"""
+	symbols = [byte for word in words for byte in word.to_bytes(4, byteorder = "little")]
+	fmt_type = symbols[0]
+	length = ((symbols[2] & 0b11) << 8) | symbols[3]
+	header_length = 16 if fmt_type == TLPType.MWr64 else 12
+	assert length == 1 and len(symbols) == header_length + 4
+	assert symbols[7] == 0x0F # First DW BE
+	address = int.from_bytes(bytes(symbols[8:header_length]), byteorder = "big")
+	return fmt_type, address, (symbols[4] << 8) | symbols[5], int.from_bytes(bytes(symbols[header_length:]), byteorder = "little")
+
+if __name__ == "__main__":
+	m = Module()
+
+	interrupts = PCIeInterrupts(vectors = 4)
+	m.submodules.tlp = tlp = TLP(bar0_size = 4096, interrupts = interrupts)
+
+	sim = Simulator(m)
+	sim.add_clock(1, domain="rx")
+
+	tlps = []
+
+	def send(symbols):
+		while not (yield tlp.tlp_sink.ready):
+			yield
+
+		for i in range(0, len(symbols), 4):
+			for j in range(4):
+				yield tlp.tlp_sink.symbol[j].eq(symbols[i + j])
+				yield tlp.tlp_sink.valid[j].eq(1)
+			yield
+
+		for j in range(4):
+			yield tlp.tlp_sink.valid[j].eq(0)
+		yield
+		yield
+
+	def receive():
+		"""
+		Collects the TLPs sent by the transaction layer
+		"""
+		yield Passive()
+		yield tlp.tlp_source.ready.eq(1)
+		words = []
+
+		while True:
+			if (yield tlp.tlp_source.all_valid):
+				words.append((yield Cat(tlp.tlp_source.symbol)))
+
+			elif words:
+				tlps.append(words)
+				words = []
+
+			yield
+
+	def messages(cycles = 50):
+		"""
+		Returns the messages sent within the given number of cycles, completions are left out
+		"""
+		for i in range(cycles):
+			yield
+
+		result = [message(words) for words in tlps if words[0] & 0xFF in [TLPType.MWr32, TLPType.MWr64]]
+		tlps.clear()
+		return result
+
+	def strobe(vector):
+		yield interrupts.interrupt.eq(1 << vector)
+		yield
+		yield interrupts.interrupt.eq(0)
+
+	def configuration_read(register):
+		tlps.clear()
+		yield from send(configuration_request(TLPType.CfgRd0, register))
+		for i in range(50):
+			if tlps:
+				break
+			yield
+		return tlps.pop(0)[3]
+
+	def configuration_write(register, data, be = 0xF):
+		yield from send(configuration_request(TLPType.CfgWr0, register, data, be))
+
+	def bar_read(address, length = 1):
+		"""
+		Reads DWs from BAR 0, returns the data of the completion
+		"""
+		tlps.clear()
+		yield from send(memory_read(address, length))
+		for i in range(50):
+			if [words for words in tlps if words[0] & 0xFF == TLPType.CplD]:
+				break
+			yield
+		words = [words for words in tlps if words[0] & 0xFF == TLPType.CplD][0]
+		tlps.clear()
+		return words[3:]
+
+	def process():
+		# Both capabilities follow the PCI Express Capability
+		capabilities = {}
+		pointer = (yield from configuration_read(0x34)) & 0xFF
+		while pointer:
+			value = yield from configuration_read(pointer)
+			capabilities[value & 0xFF] = pointer
+			pointer = (value >> 8) & 0xFF
+
+		assert list(capabilities) == [0x10, 0x05, 0x11], capabilities
+		msi = capabilities[0x05]
+		msix = capabilities[0x11]
+
+		value = yield from configuration_read(msi)
+		assert (value >> 16) & 0xFF == (0b010 << 1) | (1 << 7), hex(value) # 4 vectors, 64 bit capable
+		value = yield from configuration_read(msix)
+		assert (value >> 16) & 0x7FF == 3, hex(value) # Table size
+		assert (yield from configuration_read(msix + 4)) == 4096 - 16 * 4 - 16
+		assert (yield from configuration_read(msix + 8)) == 4096 - 8
+		table = 4096 - 16 * 4 - 16
+
+		# Nothing is sent while messages are disabled, the strobe stays pending
+		yield from strobe(2)
+		assert (yield from messages()) == []
+		assert (yield interrupts.pending) == 0b0100
+
+		yield from configuration_write(msi + 4, 0xFEE0_0000)
+		yield from configuration_write(msi + 12, 0x4020)
+		yield from configuration_write(msi, ((0b001 << 4) | 1) << 16, 0b0100) # 2 vectors and MSI Enable
+		assert (yield from messages()) == []
+
+		# Vector 2 wasn't allocated, it shares the last one
+		yield from configuration_write(0x04, 0b110) # Memory Space Enable and Bus Master Enable
+		assert (yield from messages()) == [(TLPType.MWr32, 0xFEE0_0000, (3 << 8) | (1 << 3) | 2, 0x4021)]
+		assert (yield interrupts.pending) == 0
+
+		yield from strobe(0)
+		yield from strobe(1)
+		assert (yield from messages()) == [(TLPType.MWr32, 0xFEE0_0000, (3 << 8) | (1 << 3) | 2, 0x4020), (TLPType.MWr32, 0xFEE0_0000, (3 << 8) | (1 << 3) | 2, 0x4021)]
+
+		# Coalescing by count
+		yield interrupts.coalesce_count.eq(3)
+		for i in range(2):
+			yield from strobe(0)
+		assert (yield from messages()) == []
+		yield from strobe(0)
+		assert len((yield from messages())) == 1
+
+		# Coalescing by time
+		yield interrupts.coalesce_time.eq(100)
+		yield from strobe(0)
+		assert (yield from messages(90)) == []
+		assert len((yield from messages(20))) == 1
+
+		yield interrupts.coalesce_count.eq(1)
+		yield interrupts.coalesce_time.eq(0)
+
+		# 64 bit addresses
+		yield from configuration_write(msi + 8, 0x1)
+		yield from strobe(1)
+		assert (yield from messages()) == [(TLPType.MWr64, 0x1_FEE0_0000, (3 << 8) | (1 << 3) | 2, 0x4021)]
+
+		# With MSI-X the vectors are masked after reset, which reads back from the table in BAR 0
+		yield from configuration_write(msi, 0, 0b0100)
+		yield from configuration_write(msix, 1 << 31, 0b1000)
+		for i in range(4):
+			assert (yield from bar_read(table + i * 16 + 12)) == [1]
+		yield from strobe(3)
+		yield from strobe(1)
+		assert (yield from messages()) == []
+
+		# The Pending Bit Array follows the pending vectors
+		assert (yield from bar_read(4096 - 8, 2)) == [0b1010, 0]
+
+		yield from send(memory_write(table + 3 * 16, [0xFEE0_1000, 0, 0xABCD_0003, 0]))
+		assert (yield from messages()) == [(TLPType.MWr32, 0xFEE0_1000, (3 << 8) | (1 << 3) | 2, 0xABCD_0003)]
+		assert (yield from bar_read(table + 3 * 16, 4)) == [0xFEE0_1000, 0, 0xABCD_0003, 0]
+		assert (yield from bar_read(4096 - 8, 2)) == [0b0010, 0]
+
+		yield from send(memory_write(table + 1 * 16, [0xFEE0_2000, 0x2, 0xABCD_0001]))
+		assert (yield from messages()) == []
+		yield from send(memory_write(table + 1 * 16 + 12, [0]))
+		assert (yield from messages()) == [(TLPType.MWr64, 0x2_FEE0_2000, (3 << 8) | (1 << 3) | 2, 0xABCD_0001)]
+
+		# The Function Mask holds all vectors
+		yield from configuration_write(msix, (1 << 31) | (1 << 30), 0b1000)
+		yield from strobe(1)
+		yield from strobe(3)
+		assert (yield from messages()) == []
+		yield from configuration_write(msix, 1 << 31, 0b1000)
+		assert [address for fmt_type, address, requester_id, data in (yield from messages())] == [0x2_FEE0_2000, 0xFEE0_1000]
+
+		# So does Bus Master Enable
+		yield from configuration_write(0x04, 0b010)
+		yield from strobe(3)
+		assert (yield from messages()) == []
+
+		print("Test passed")
+
+	sim.add_sync_process(process, domain="rx")
+	sim.add_sync_process(receive, domain="rx")
+
+	sim.run()
@@ -0,0 +1,55 @@
+from amaranth import *
+from amaranth.sim import Simulator, Delay, Settle
+from ecp5_pcie.lfsr import PCIeLFSR
+from ecp5_pcie.serdes import Ctrl
+
+# Scrambling data for the first 16 data symbols after a COM, see PCIe Base 1.1 Appendix C
+expected = [0xFF, 0x17, 0xC0, 0x14, 0xB2, 0xE7, 0x02, 0x82, 0x72, 0x6E, 0x28, 0xA6, 0xBE, 0x6D, 0xBF, 0x8D]
+
+def scrambling_data(ratio, stream):
+	"""
+	Simulates a PCIeLFSR with the given symbols and returns the scrambling data for each symbol
+	"""
+	symbols = Signal(9 * ratio)
+
+	m = Module()
+	m.submodules.lfsr = lfsr = PCIeLFSR(ratio,
+		Cat(symbols.word_select(i, 9) == Ctrl.COM for i in range(ratio)),
+		Cat(symbols.word_select(i, 9) != Ctrl.SKP for i in range(ratio)))
+
+	sim = Simulator(m)
+	sim.add_clock(1, domain="rx")
+
+	result = []
+
+	def process():
+		for i in range(0, len(stream), ratio):
+			yield symbols.eq(sum(symbol << (9 * j) for j, symbol in enumerate(stream[i : i + ratio])))
+			yield Settle()
+
+			output = (yield lfsr.output)
+			for j in range(ratio):
+				result.append((output >> (9 * j)) & 0xFF)
+
+			yield
+
+	sim.add_sync_process(process, domain="rx")
+
+	sim.run()
+
+	return result
+
+
+if __name__ == "__main__":
+	for ratio in [1, 2, 4, 8]:
+		for position in range(ratio):
+			# COM at any position within the word, followed by data with a SKP in between
+			stream = [0] * position + [Ctrl.COM, 0, Ctrl.SKP] + [0] * 15
+			stream += [0] * (-len(stream) % ratio)
+
+			result = scrambling_data(ratio, stream)
+			data = [value for symbol, value in zip(stream[position + 1:], result[position + 1:]) if symbol == 0][:16]
+
+			assert data == expected, (ratio, position, [hex(value) for value in data])
+
+		print("Test passed for", ratio, "symbols per cycle")
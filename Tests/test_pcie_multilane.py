@@ -0,0 +1,232 @@
+from amaranth import *
+from amaranth.build import *
+from amaranth.sim import Simulator, Delay, Settle
+from ecp5_pcie.virtual_serdes import VirtualPCIeSERDESx4
+from ecp5_pcie.serdes import PCIeSERDESAligner
+from amaranth.sim import Passive
+from ecp5_pcie.phy_multilane import PCIeMultiLanePhy
+from ecp5_pcie.phy import PCIePhy
+from ecp5_pcie.ltssm import State
+from ecp5_pcie.tlp import TLPType
+from test_wide_datapath import collect_narrow, receive
+
+LANES = 2
+SKEW = 1 # Words by which the last lane is delayed from downstream to upstream
+
+class VirtualMultiLanePhy(Elaboratable):
+	"""
+	Virtual lanes with a PCIeMultiLanePhy, or with full_stack a PCIePhy with the Data Link and Transaction Layer on top of them
+	"""
+	def __init__(self, lanes, upstream = True, full_stack = False):
+		self.serdes = [VirtualPCIeSERDESx4(speed_5GTps=False) for _ in range(lanes)]
+		self.aligners = [DomainRenamer({"rx" : "sync", "tx" : "sync"})(PCIeSERDESAligner(serdes.lane)) for serdes in self.serdes]
+
+		if full_stack:
+			self.phy = DomainRenamer({"rx" : "sync", "tx" : "sync"})(PCIePhy(self.aligners, upstream=upstream, support_5GTps=False))
+
+		else:
+			self.phy = DomainRenamer({"rx" : "sync", "tx" : "sync"})(PCIeMultiLanePhy(self.aligners, upstream=upstream, support_5GTps=False))
+
+	def elaborate(self, platform):
+		m = Module()
+
+		for i in range(len(self.serdes)):
+			m.submodules[f"serdes_{i}"] = self.serdes[i]
+			m.submodules[f"aligner_{i}"] = self.aligners[i]
+
+		m.submodules.phy = self.phy
+
+		return m
+
+class VirtualMultiLaneTestbench(Elaboratable):
+	def __init__(self, full_stack = False):
+		self.phy_u = VirtualMultiLanePhy(LANES, upstream=True, full_stack=full_stack)
+		self.phy_d = VirtualMultiLanePhy(LANES, upstream=False, full_stack=full_stack)
+
+		for phy in [self.phy_u.phy, self.phy_d.phy]:
+			phy.ltssm.clocks_per_ms = 128
+			phy.ltssm.simulate = True
+
+			if full_stack:
+				phy.dll_tlp_tx.clocks_per_ms = 128
+
+	def elaborate(self, platform):
+		m = Module()
+
+		m.submodules.phy_u = self.phy_u
+		m.submodules.phy_d = self.phy_d
+
+		for i in range(LANES):
+			serdes_u = self.phy_u.serdes[i]
+			serdes_d = self.phy_d.serdes[i]
+
+			m.d.comb += serdes_d.lane.rx_symbol.eq(serdes_u.lane.tx_symbol)
+
+			# Skew the last lane
+			delayed = serdes_d.lane.tx_symbol
+			if i == LANES - 1:
+				for _ in range(SKEW):
+					last = Signal.like(delayed)
+					m.d.sync += last.eq(delayed)
+					delayed = last
+
+			m.d.comb += serdes_u.lane.rx_symbol.eq(delayed)
+
+		return m
+
+# -------------------------------------------------------------------------------------------------
+
+def test_phy():
+	"""
+	The link trains to the full width and a counting pattern is striped across the lanes
+	"""
+	m = Module()
+	m.submodules.pcie = pcie = VirtualMultiLaneTestbench()
+
+	phy_u = pcie.phy_u.phy
+	phy_d = pcie.phy_d.phy
+
+	sim = Simulator(m)
+	sim.add_clock(1e-8, domain="sync")
+
+	def process():
+		last_state = None
+		counter = 1
+		sent = []
+		received = []
+		first_skp = None
+
+		for i in range(3000):
+			state = (State((yield phy_d.ltssm.debug_state)).name, State((yield phy_u.ltssm.debug_state)).name)
+
+			if state != last_state:
+				print(i, "D:", state[0], "U:", state[1])
+				last_state = state
+
+			# Send a counting pattern once the link is up
+			l0 = (yield phy_d.ltssm.debug_state) == State.L0 and (yield phy_u.ltssm.debug_state) == State.L0
+
+			for k in range(len(phy_d.sink.symbol)):
+				yield phy_d.sink.symbol[k].eq((counter + k) % 255 + 1 if l0 else 0)
+				yield phy_d.sink.valid[k].eq(l0)
+
+			yield phy_u.source.ready.eq(1)
+
+			yield Settle()
+
+			if l0 and (first_skp is None) and (yield phy_d.txs[0].insert_skp):
+				first_skp = len(sent)
+
+			if l0 and (yield phy_d.sink.ready):
+				sent += [(counter + k) % 255 + 1 for k in range(len(phy_d.sink.symbol))]
+				counter += len(phy_d.sink.symbol)
+
+			# The virtual SERDES doesn't drive rx_valid, idle data is 0
+			for k in range(len(phy_u.source.symbol)):
+				if (yield phy_u.source.symbol[k]) != 0:
+					received.append((yield phy_u.source.symbol[k]))
+
+			yield
+
+		assert (yield phy_u.ltssm.status.link.width) == LANES
+		assert (yield phy_d.ltssm.status.link.width) == LANES
+		assert (yield phy_u.deskew.aligned)
+		delays = []
+		for delay in phy_u.deskew.delays:
+			delays.append((yield delay))
+		print("Delays:", delays)
+
+		assert len(received) > 0
+		start = sent.index(received[0])
+		# Words next to SKP ordered sets are not descrambled correctly yet, only compare the data before the first one
+		checked = sent[start : start + 32 * len(phy_d.sink.symbol)]
+		assert first_skp > start + len(checked)
+		assert received[:len(checked)] == checked
+		print("Received", len(checked), "symbols in order")
+
+	sim.add_sync_process(process, domain="sync")
+
+	sim.run()
+
+def test_link():
+	"""
+	PCIePhy on the lanes, the link trains to the full width and TLPs are exchanged in both directions.
+	The virtual TLP generator of the downstream PHY sends configuration requests which the upstream Transaction Layer completes.
+	"""
+	m = Module()
+	m.submodules.pcie = pcie = VirtualMultiLaneTestbench(full_stack=True)
+
+	phys = {"u": pcie.phy_u.phy, "d": pcie.phy_d.phy}
+
+	sim = Simulator(m)
+	sim.add_clock(1e-8, domain="sync")
+
+	received = {name: [] for name in phys}
+	record = {"naks": 0, "link_down": 0, "states": {name: set() for name in phys}}
+
+	def monitor():
+		"""
+		Records Naks and whether the link went down once it is up
+		"""
+		yield Passive()
+
+		while True:
+			for name, phy in phys.items():
+				if (yield phy.dll.received_ack_nak) and not (yield phy.dll.received_ack):
+					record["naks"] += 1
+
+				record["link_down"] += not (yield phy.dll.up)
+				record["states"][name].add(State((yield phy.ltssm.debug_state)))
+
+			yield
+
+	def process():
+		for i in range(10000):
+			if (yield phys["u"].dll.up) and (yield phys["d"].dll.up):
+				break
+			yield
+
+		else:
+			assert False, "Link didn't come up"
+
+		assert (yield phys["u"].ltssm.status.link.width) == LANES
+		assert (yield phys["d"].ltssm.status.link.width) == LANES
+		assert (yield phys["u"].tlp.link_width) == LANES
+
+		record["naks"] = 0
+		record["link_down"] = 0
+		record["states"] = {name: set() for name in phys}
+		received["u"].clear()
+		received["d"].clear()
+
+		for i in range(2500):
+			yield
+
+		# The virtual TLP generator sends a configuration write and a configuration read every 512 cycles
+		configuration_write = [0x01000044, 0x0F000000, 0x24000001, 0xFFFFFFFF]
+		configuration_read = [0x01000004, 0x0F000000, 0x24000001]
+		assert len(received["u"]) >= 4, received["u"]
+		for packet in received["u"]:
+			assert packet in [configuration_write, configuration_read], packet
+
+		# Every request is completed successfully, the write without and the read with 1 DW of data
+		assert len(received["d"]) >= len(received["u"]) - 1, (received["d"], received["u"])
+		for packet in received["d"]:
+			assert (packet[0] & 0xFF, len(packet)) in [(TLPType.Cpl, 3), (TLPType.CplD, 4)], packet
+			assert (packet[1] >> 21) & 0b111 == 0, packet
+
+		assert record["naks"] == 0 and record["link_down"] == 0, record
+		assert all(states == {State.L0} for states in record["states"].values()), record["states"]
+
+		print(f"Link test passed, x{LANES}")
+
+	sim.add_sync_process(process, domain="sync")
+	sim.add_sync_process(monitor, domain="sync")
+	sim.add_sync_process(lambda: (yield from collect_narrow(phys["u"].tlp.tlp_sink, received["u"])), domain="sync")
+	sim.add_sync_process(lambda: (yield from receive(phys["d"].dll_tlp_rx.tlp_source, received["d"])), domain="sync")
+
+	sim.run()
+
+if __name__ == "__main__":
+	test_phy()
+	test_link()
@@ -0,0 +1,74 @@
+from amaranth import *
+from amaranth.build import *
+from amaranth.sim import Simulator, Delay, Settle
+from ecp5_pcie.virtual_phy_Gen1_x1 import VirtualPCIePhy
+from ecp5_pcie.ltssm import State
+from ecp5_pcie.serdes import LinkSpeed
+
+class VirtualSpeedChangeTestbench(Elaboratable):
+	def __init__(self):
+		self.phy_virtual_u = VirtualPCIePhy(upstream=True, support_5GTps=True)
+		self.phy_virtual_d = VirtualPCIePhy(upstream=False, support_5GTps=True)
+		self.phy_u = self.phy_virtual_u.phy
+		self.phy_d = self.phy_virtual_d.phy
+
+		for phy in [self.phy_u, self.phy_d]:
+			phy.ltssm.clocks_per_ms = 128
+			phy.ltssm.simulate = True
+
+	def elaborate(self, platform):
+		m = Module()
+
+		m.submodules.phy_u = self.phy_virtual_u
+		m.submodules.phy_d = self.phy_virtual_d
+
+		m.d.comb += self.phy_virtual_u.serdes.lane.rx_symbol.eq(self.phy_virtual_d.serdes.lane.tx_symbol)
+		m.d.comb += self.phy_virtual_d.serdes.lane.rx_symbol.eq(self.phy_virtual_u.serdes.lane.tx_symbol)
+
+		return m
+
+# -------------------------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+	m = Module()
+	m.submodules.pcie = pcie = VirtualSpeedChangeTestbench()
+
+	ltssm_u = pcie.phy_u.ltssm
+	ltssm_d = pcie.phy_d.ltssm
+
+	sim = Simulator(m)
+	sim.add_clock(1e-8, domain="sync")
+
+	def process():
+		last_state = None
+		states = []
+
+		for i in range(3000):
+			state = (State((yield ltssm_d.debug_state)).name, State((yield ltssm_u.debug_state)).name)
+
+			if state != last_state:
+				print(i, "D:", state[0], "U:", state[1], "Speed:", (yield ltssm_d.status.link.speed), (yield ltssm_u.status.link.speed))
+				states.append(state)
+				last_state = state
+
+			yield
+
+		# Both sides went through Recovery.Speed and the link came back up at 5 GT/s
+		assert any(state[0] == "Recovery_Speed" for state in states)
+		assert any(state[1] == "Recovery_Speed" for state in states)
+		assert last_state == ("L0", "L0")
+
+		for ltssm in [ltssm_u, ltssm_d]:
+			assert (yield ltssm.status.link.speed) == 1
+			assert (yield ltssm.lane.speed) == LinkSpeed.S5_0
+			assert (yield ltssm.status.link.up)
+			assert not (yield ltssm.status.directed_speed_change)
+
+		# The configuration space reports the speed as the Current Link Speed
+		assert (yield pcie.phy_u.tlp.link_speed) == 1
+
+		print("Link is up at 5 GT/s")
+
+	sim.add_sync_process(process, domain="sync")
+
+	sim.run()
@@ -0,0 +1,137 @@
+from amaranth import *
+from amaranth.sim import Simulator, Delay, Settle
+from ecp5_pcie.memory import RetryBuffer
+
+if __name__ == "__main__":
+	m = Module()
+
+	m.submodules.buffer = buffer = RetryBuffer(depth = 64, max_tlps = 8, tlp_bytes = 64)
+
+	sim = Simulator(m)
+	sim.add_clock(1, domain="rx")
+
+	def tlp(seq, words):
+		"""
+		Contents of a TLP, every word is unique
+		"""
+		return [(seq << 16) | i for i in range(words)]
+
+	def store(seq, words):
+		yield buffer.store_seq.eq(seq)
+		for word in words:
+			yield Cat(buffer.tlp_sink.symbol).eq(word)
+			yield Cat(buffer.tlp_sink.valid).eq(0b1111)
+			yield
+		yield Cat(buffer.tlp_sink.valid).eq(0)
+		yield
+		yield
+
+	def ack(seq):
+		yield buffer.ack_seq.eq(seq)
+		yield buffer.ack.eq(1)
+		yield Settle()
+		valid = (yield buffer.ack_valid)
+		yield
+		yield buffer.ack.eq(0)
+		yield
+		return valid
+
+	def replay():
+		"""
+		Replays the buffer like the transmitter does, with a few cycles between TLPs, returns the TLPs and their sequence numbers
+		"""
+		tlps = []
+		yield buffer.replay.eq(1)
+		yield
+		yield buffer.replay.eq(0)
+		yield buffer.tlp_source.ready.eq(1)
+		yield
+
+		while (yield buffer.replaying):
+			if (yield buffer.tlp_source.all_valid):
+				seq = (yield buffer.replay_seq)
+				words = []
+				while (yield buffer.tlp_source.all_valid):
+					words.append((yield Cat(buffer.tlp_source.symbol)))
+					yield buffer.tlp_source.ready.eq(0)
+					yield
+
+				tlps.append((seq, words))
+
+				for i in range(3):
+					yield
+				yield buffer.tlp_source.ready.eq(1)
+
+			yield
+
+		return tlps
+
+	def process():
+		lengths = {0xFFE: 3, 0xFFF: 4, 0: 8, 1: 3}
+		for seq, words in lengths.items():
+			yield from store(seq, tlp(seq, words))
+
+		assert (yield buffer.occupied) == 4
+		assert (yield buffer.head_seq) == 0xFFE
+
+		tlps = yield from replay()
+		assert tlps == [(seq, tlp(seq, words)) for seq, words in lengths.items()], tlps
+
+		# Acknowledging frees all TLPs up to the acknowledged one
+		assert not (yield from ack(0xFFD))
+		assert (yield from ack(0xFFF))
+		assert (yield buffer.occupied) == 2
+		assert (yield buffer.head_seq) == 0
+
+		tlps = yield from replay()
+		assert tlps == [(0, tlp(0, 8)), (1, tlp(1, 3))], tlps
+
+		# A discarded TLP isn't stored
+		yield buffer.store_seq.eq(2)
+		for word in tlp(2, 4):
+			yield Cat(buffer.tlp_sink.symbol).eq(word)
+			yield Cat(buffer.tlp_sink.valid).eq(0b1111)
+			yield
+		yield Cat(buffer.tlp_sink.valid).eq(0)
+		yield buffer.discard.eq(1)
+		yield
+		yield buffer.discard.eq(0)
+		yield
+		assert (yield buffer.occupied) == 2
+
+		# Small TLPs are stored densely, the buffer is full when the number of TLPs reaches max_tlps
+		seq = 2
+		while not (yield buffer.full):
+			yield from store(seq, tlp(seq, 3))
+			seq += 1
+		assert seq == 8
+
+		assert (yield from ack(4))
+		for i in range(3):
+			assert not (yield buffer.full)
+			yield from store(seq, tlp(seq, 16))
+			seq += 1
+
+		# Not enough space for a TLP with the maximum size of 16 words
+		assert (yield buffer.full)
+		assert (yield buffer.occupied) == 6
+
+		tlps = yield from replay()
+		assert tlps == [(i, tlp(i, 3)) for i in range(5, 8)] + [(i, tlp(i, 16)) for i in range(8, 11)], tlps
+
+		assert (yield from ack(10))
+		assert (yield buffer.empty)
+
+		# Wrapping around the memory
+		for i in range(5):
+			yield from store(seq, tlp(seq, 13))
+			tlps = yield from replay()
+			assert tlps == [(seq, tlp(seq, 13))], tlps
+			assert (yield from ack(seq))
+			seq += 1
+
+		print("Test passed")
+
+	sim.add_sync_process(process, domain="rx")
+
+	sim.run()
@@ -0,0 +1,172 @@
+from amaranth import *
+from amaranth.sim import Simulator, Delay, Settle, Passive
+from ecp5_pcie.dll import PCIeDLL
+from ecp5_pcie.dll_tlp import PCIeDLLTLPTransmitter
+from ecp5_pcie.dllp import PCIeDLLPTransmitter, DLLPType
+from ecp5_pcie.phy_tx import PCIePhyTX
+from ecp5_pcie.serdes import PCIeSERDESInterface, Ctrl, LinkSpeed
+from test_dll_tlp import tlp
+
+SKP = [Ctrl.COM, Ctrl.SKP, Ctrl.SKP, Ctrl.SKP]
+
+if __name__ == "__main__":
+	m = Module()
+
+	# The link layer is only used for its signals, the link is up with infinite credits
+	dll = PCIeDLL(None, None, None, 125e6, False)
+	lane = PCIeSERDESInterface(ratio = 4)
+	m.submodules.tlp_tx = tlp_tx = PCIeDLLTLPTransmitter(dll)
+	m.submodules.dllp_tx = dllp_tx = PCIeDLLPTransmitter()
+	m.submodules.phy_tx = phy_tx = PCIePhyTX(lane, skp_handshake = True)
+
+	tlp_tx.dllp_source.connect(dllp_tx.dllp_sink, m.d.comb)
+	dllp_tx.phy_source.connect(phy_tx.sink, m.d.comb)
+	m.d.comb += dllp_tx.skp_request.eq(phy_tx.skp_request)
+	m.d.comb += phy_tx.skp_slot.eq(dllp_tx.skp_slot)
+
+	sim = Simulator(m)
+	sim.add_clock(1, domain="rx")
+
+	words = []
+	sent = []
+
+	def send(words):
+		for i in range(4):
+			yield tlp_tx.tlp_sink.valid[i].eq(1)
+		yield Cat(tlp_tx.tlp_sink.symbol).eq(words[0])
+
+		while True: # The first word is held until it is accepted
+			yield Settle()
+			if (yield tlp_tx.tlp_sink.ready):
+				break
+			yield
+
+		for word in words[1:]:
+			yield
+			yield Cat(tlp_tx.tlp_sink.symbol).eq(word)
+
+		yield
+		for i in range(4):
+			yield tlp_tx.tlp_sink.valid[i].eq(0)
+		yield
+
+	def monitor():
+		"""
+		Records the words which are sent on the lane
+		"""
+		yield Passive()
+
+		while True:
+			word = yield lane.tx_symbol
+			words.append([(word >> (9 * i)) & 0x1FF for i in range(4)])
+			yield
+
+	def acknowledge():
+		"""
+		Acknowledges the sent TLPs like the other side would, so they aren't replayed
+		"""
+		yield Passive()
+
+		while True:
+			for i in range(20):
+				yield
+
+			yield dll.received_ack_nak.eq(1)
+			yield dll.received_ack.eq(1)
+			yield dll.received_ack_nak_id.eq(((yield tlp_tx.next_transmit_seq) - 1) & 0xFFF)
+			yield
+			yield dll.received_ack_nak.eq(0)
+
+	def send_acks():
+		"""
+		Sends DLLPs every now and then like the Data Link Layer does
+		"""
+		yield Passive()
+
+		while True:
+			for i in range(150):
+				yield
+
+			yield dllp_tx.dllp.type.eq(DLLPType.Ack)
+			yield dllp_tx.dllp.valid.eq(1)
+			yield dllp_tx.send.eq(1)
+
+			while True:
+				yield Settle()
+				if (yield dllp_tx.started_sending):
+					break
+				yield
+
+			yield
+			yield dllp_tx.send.eq(0)
+
+	def process():
+		yield dll.max_payload_size.eq(0)
+		yield dll.speed.eq(LinkSpeed.S2_5)
+		yield dll.up.eq(1)
+		yield phy_tx.ltssm_L0.eq(1)
+		yield phy_tx.ready.eq(1)
+		yield
+
+		# TLPs of different lengths are sent back to back
+		for index in range(300):
+			packet = tlp(index, (index * 5) % 13)
+			sent.append(packet)
+			yield from send(packet)
+
+		for i in range(50):
+			yield
+
+		# Split the words on the lane into packets, SKP ordered sets and idle words
+		packets = []
+		skps = []
+		idle = []
+		current = None
+
+		for i, word in enumerate(words):
+			if word == SKP:
+				assert current is None, (i, words[i - 4 : i + 1])
+				skps.append(i)
+
+			elif current is not None:
+				assert Ctrl.STP not in word and Ctrl.SDP not in word, (i, word)
+				current.append(word)
+				if word[3] == Ctrl.END:
+					packets.append(current)
+					current = None
+
+			elif word[0] in [Ctrl.STP, Ctrl.SDP]:
+				current = [word]
+				if word[3] == Ctrl.END:
+					packets.append(current)
+					current = None
+
+			else:
+				assert word == [0] * 4, (i, word)
+				idle.append(i)
+
+		# Every TLP is sent completely, along with the DLLPs
+		tlps = [packet for packet in packets if packet[0][0] == Ctrl.STP]
+		dllps = [packet for packet in packets if packet[0][0] == Ctrl.SDP]
+		assert [len(packet) for packet in tlps] == [len(packet) + 2 for packet in sent], ([len(packet) for packet in tlps], [len(packet) + 2 for packet in sent])
+		assert all(len(packet) == 2 for packet in dllps)
+		assert len(dllps) >= len(words) // 150 - 1
+
+		# SKP ordered sets are scheduled every 326 cycles and sent after the current packet
+		first = next(i for i, word in enumerate(words) if word[0] == Ctrl.STP)
+		last = max(i for i, word in enumerate(words) if word[3] == Ctrl.END)
+		assert len(skps) == (len(words) - 1) // 326, skps
+		for i, skp in enumerate(skps):
+			assert 326 * (i + 1) <= skp <= 326 * (i + 1) + len(max(sent, key = len)) + 2, skps
+
+		# At full load there are no gaps other than the SKP ordered sets
+		assert [i for i in idle if first < i < last] == [], idle
+
+		print("Test passed")
+
+	sim.add_sync_process(process, domain="rx")
+	sim.add_sync_process(monitor, domain="rx")
+	sim.add_sync_process(acknowledge, domain="rx")
+	sim.add_sync_process(send_acks, domain="rx")
+
+	sim.run()
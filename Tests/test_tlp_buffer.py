@@ -0,0 +1,149 @@
+from amaranth import *
+from amaranth.sim import Simulator, Delay, Settle
+from ecp5_pcie.memory import TLPBuffer
+
+if __name__ == "__main__":
+	m = Module()
+
+	m.submodules.buffer = buffer = TLPBuffer(max_tlps = 32, tlp_bytes = 64)
+
+	sim = Simulator(m)
+	sim.add_clock(1, domain="rx")
+
+	def tlp(tlp_id, words):
+		"""
+		Contents of a TLP, every word is unique
+		"""
+		return [(tlp_id << 16) | i for i in range(words)]
+
+	def store(tlp_id, words, discard = False, chained = False):
+		"""
+		With chained the next TLP is stored in the first cycle in which the buffer is done with this one
+		"""
+		yield buffer.store_tlp.eq(1)
+		yield
+		yield buffer.store_tlp.eq(0)
+		yield buffer.store_tlp_id.eq(tlp_id)
+		yield
+		for word in words:
+			yield Cat(buffer.tlp_sink.symbol).eq(word)
+			yield Cat(buffer.tlp_sink.valid).eq(0b1111)
+			yield
+		yield Cat(buffer.tlp_sink.valid).eq(0)
+		yield buffer.discard_tlp.eq(discard)
+		yield
+		yield buffer.discard_tlp.eq(0)
+		yield
+		if not chained:
+			yield
+
+	def send(tlp_id):
+		"""
+		Returns the words of the TLP with the given ID
+		"""
+		yield buffer.tlp_source.ready.eq(1)
+		yield buffer.send_tlp.eq(1)
+		yield
+		yield buffer.send_tlp.eq(0)
+		yield buffer.send_tlp_id.eq(tlp_id)
+		yield
+
+		words = []
+		while (yield buffer.sending_tlp) or (yield buffer.tlp_source.all_valid):
+			if (yield buffer.tlp_source.all_valid):
+				words.append((yield Cat(buffer.tlp_source.symbol)))
+			yield
+
+		return words
+
+	def delete(tlp_id):
+		yield buffer.delete_tlp_id.eq(tlp_id)
+		yield buffer.delete_tlp.eq(1)
+		yield
+		yield buffer.delete_tlp.eq(0)
+		yield
+
+	def in_buffer(tlp_id):
+		yield buffer.in_buffer_id.eq(tlp_id)
+		yield Settle()
+		return (yield buffer.in_buffer)
+
+	def process():
+		ids = [(i * 0x123) % 4096 for i in range(32)]
+
+		for i, tlp_id in enumerate(ids):
+			assert not (yield buffer.slots_full)
+			yield from store(tlp_id, tlp(tlp_id, 3 + i % 5))
+
+		assert (yield buffer.slots_full)
+		assert (yield buffer.slots_occupied) == 32
+
+		# Any TLP can be found, no matter in which slot it is
+		for i, tlp_id in reversed(list(enumerate(ids))):
+			words = yield from send(tlp_id)
+			assert words == tlp(tlp_id, 3 + i % 5), (hex(tlp_id), words)
+
+		# TLPs which aren't in the buffer aren't sent
+		assert (yield from send(0xFFF)) == []
+		assert not (yield from in_buffer(0xFFF))
+		assert (yield from in_buffer(ids[7]))
+
+		# Deleted slots are used again
+		yield from delete(ids[7])
+		yield from delete(ids[20])
+		assert not (yield from in_buffer(ids[7]))
+		assert (yield buffer.slots_occupied) == 30
+
+		yield from store(0xFFF, tlp(0xFFF, 4))
+		yield from store(0xFFE, tlp(0xFFE, 4), discard = True)
+		assert (yield buffer.slots_occupied) == 31
+		assert not (yield from in_buffer(0xFFE))
+
+		# A TLP with an ID which is already in the buffer isn't stored twice
+		yield from store(0xFFF, tlp(0xFFD, 4))
+		assert (yield buffer.slots_occupied) == 31
+		assert (yield from send(0xFFF)) == tlp(0xFFF, 4)
+
+		yield from store(0xFFD, tlp(0xFFD, 5))
+		assert (yield buffer.slots_full)
+		assert (yield buffer.tlp_stored)
+
+		# Without a free slot a TLP is dropped and tlp_stored tells the receiver not to acknowledge it
+		yield from store(0xFFA, tlp(0xFFA, 4))
+		assert not (yield buffer.tlp_stored)
+		assert not (yield from in_buffer(0xFFA))
+		assert (yield buffer.slots_occupied) == 32
+
+		assert (yield from send(0xFFD)) == tlp(0xFFD, 5)
+		assert (yield from send(ids[19])) == tlp(ids[19], 3 + 19 % 5)
+
+		# A slot which was freed by discarding a TLP can be used by the next one right away, the other slots stay untouched
+		yield from delete(ids[3])
+		yield from store(0xFFC, tlp(0xFFC, 4), discard = True, chained = True)
+		yield from store(0xFFB, tlp(0xFFB, 4))
+		assert (yield buffer.slots_full)
+
+		# A TLP chained to one which takes the last slot is dropped
+		yield from delete(0xFFB)
+		yield from store(0xFFB, tlp(0xFFB, 4), chained = True)
+		assert (yield buffer.tlp_stored)
+		yield from store(0xFF9, tlp(0xFF9, 4))
+		assert not (yield buffer.tlp_stored)
+		assert not (yield from in_buffer(0xFF9))
+		assert (yield buffer.slots_full)
+		assert (yield from send(0xFFB)) == tlp(0xFFB, 4)
+		for i, tlp_id in enumerate(ids):
+			if i not in [3, 7, 20]: # Deleted
+				assert (yield from send(tlp_id)) == tlp(tlp_id, 3 + i % 5), hex(tlp_id)
+
+		for tlp_id in ids + [0xFFF, 0xFFD, 0xFFB]:
+			yield from delete(tlp_id)
+
+		assert (yield buffer.slots_empty)
+		assert (yield buffer.slots_occupied) == 0
+
+		print("Test passed")
+
+	sim.add_sync_process(process, domain="rx")
+
+	sim.run()
@@ -0,0 +1,71 @@
+from amaranth import *
+from amaranth.sim import Simulator, Delay, Settle, Passive
+from ecp5_pcie.serdes import PCIeSERDESInterface, PCIeSERDESAligner
+
+def run(tx_cdc, tx_period = 1, tx_phase = 0.3, words = 200):
+	"""
+	Sends a counter through the TX CDC of an aligner, returns the words which arrived in the tx domain
+	with the number of cycles they took and the occupancies of the phase compensation FIFO
+	"""
+	m = Module()
+
+	lane = PCIeSERDESInterface(ratio = 4)
+	m.submodules.aligner = aligner = DomainRenamer("rx")(PCIeSERDESAligner(lane, tx_cdc = tx_cdc))
+
+	sim = Simulator(m)
+	sim.add_clock(1e-8, domain="rx")
+	sim.add_clock(tx_period * 1e-8, phase = tx_phase * 1e-8, domain="tx")
+
+	received = []
+	occupancies = []
+
+	def send():
+		for i in range(words):
+			yield aligner.tx_symbol.eq(i)
+			yield
+
+	def receive():
+		yield Passive()
+		cycle = 0
+
+		while True:
+			yield Settle()
+			value = yield lane.tx_symbol
+			if not received or received[-1][0] != value:
+				received.append((value, cycle - value))
+
+			occupancies.append((yield aligner.tx_occupancy))
+			cycle += 1
+			yield
+
+	sim.add_sync_process(send, domain="rx")
+	sim.add_sync_process(receive, domain="tx")
+
+	sim.run()
+
+	return received, occupancies
+
+if __name__ == "__main__":
+	for tx_phase in [0, 0.3, 0.7]:
+		latencies = {}
+
+		for tx_cdc in ["async", "phase"]:
+			received, occupancies = run(tx_cdc, tx_phase = tx_phase)
+
+			# Every word arrives exactly once and in order
+			values = [value for value, latency in received if value != 0]
+			assert values == list(range(1, values[-1] + 1)), (tx_cdc, values)
+			assert values[-1] > 190
+
+			latencies[tx_cdc] = max(latency for value, latency in received[5:])
+
+			if tx_cdc == "phase":
+				assert set(occupancies[10:]) == {2}, occupancies
+
+		assert latencies["phase"] == 2 and latencies["async"] == 4, (tx_phase, latencies)
+
+	# If the tx clock isn't locked to the rx clock the phase compensation FIFO drifts and starts over in the middle
+	received, occupancies = run("phase", tx_period = 1.05, words = 400)
+	assert occupancies[10:].count(0) >= 5, occupancies
+
+	print("Test passed")
@@ -0,0 +1,507 @@
+from amaranth import *
+from amaranth.sim import Simulator, Delay, Settle, Passive
+from ecp5_pcie.dll import PCIeDLL
+from ecp5_pcie.dll_tlp import PCIeDLLTLPTransmitter, PCIeDLLTLPReceiver
+from ecp5_pcie.dllp import PCIeDLLPTransmitter, PCIeDLLPReceiver, DLLPType
+from ecp5_pcie.virtual_phy_Gen1_x1 import VirtualPCIePhy
+from ecp5_pcie.serdes import Ctrl, LinkSpeed
+from ecp5_pcie.ltssm import State
+from ecp5_pcie.tlp import TLPType
+from ecp5_pcie.tlp_adapter import TLPWidthAdapter
+from test_dll_tlp import tlp
+
+RATIO = 8
+
+class WideLinkTestbench(Elaboratable):
+	"""
+	Two virtual PHYs with 8 symbols per word connected to each other, the symbols from the upstream to the downstream PHY are delayed by shift symbols.
+	The Transaction Layer of the upstream PHY runs in tl_domain
+	"""
+	def __init__(self, shift, tl_domain = "sync"):
+		self.shift = shift
+		self.tl_domain = tl_domain
+
+		self.phy_virtual_u = VirtualPCIePhy(upstream=True, gearing=RATIO, tl_domain=tl_domain)
+		self.phy_virtual_d = VirtualPCIePhy(upstream=False, gearing=RATIO)
+		self.phy_u = self.phy_virtual_u.phy
+		self.phy_d = self.phy_virtual_d.phy
+
+		for phy in [self.phy_u, self.phy_d]:
+			phy.ltssm.clocks_per_ms = 128
+			phy.dll_tlp_tx.clocks_per_ms = 128
+			phy.ltssm.simulate = True
+
+	def elaborate(self, platform):
+		m = Module()
+
+		m.submodules.phy_u = self.phy_virtual_u
+		m.submodules.phy_d = self.phy_virtual_d
+
+		if self.tl_domain != "sync":
+			m.domains.tl = ClockDomain(self.tl_domain)
+
+		lane_u = self.phy_virtual_u.serdes.lane
+		lane_d = self.phy_virtual_d.serdes.lane
+
+		last_symbols = Signal.like(lane_u.tx_symbol)
+		m.d.sync += last_symbols.eq(lane_u.tx_symbol)
+
+		m.d.comb += lane_u.rx_symbol.eq(lane_d.tx_symbol)
+		m.d.comb += lane_d.rx_symbol.eq(Cat(last_symbols, lane_u.tx_symbol)[9 * (RATIO - self.shift) : 9 * (2 * RATIO - self.shift)])
+
+		# The virtual SERDES doesn't drive rx_valid, like a SERDES without coding errors all symbols are valid so the aligner can find commas
+		m.d.comb += lane_u.rx_valid.eq(2 ** RATIO - 1)
+		m.d.comb += lane_d.rx_valid.eq(2 ** RATIO - 1)
+
+		return m
+
+def words_of(packet):
+	"""
+	Packs the DW of a TLP into words of 8 symbols, the last word of a TLP of an odd number of DW is padded
+	"""
+	packet = packet + [0] * (len(packet) % 2)
+	return [packet[i] | (packet[i + 1] << 32) for i in range(0, len(packet), 2)]
+
+def send(sink, packet, half_last = False, abort = None):
+	"""
+	Sends a TLP into a tlp_sink with 8 symbols per word. With half_last only the first half of the last word of a TLP of an odd number of DW is valid,
+	like the Data Link Layer sends it. abort is set like PCIeDLLTLPReceiver.abort if it isn't None
+	"""
+	half = half_last and len(packet) % 2
+	words = words_of(packet)
+
+	for i in range(RATIO):
+		yield sink.valid[i].eq(1)
+	yield Cat(sink.symbol).eq(words[0])
+
+	while True: # The first word is held until it is accepted
+		yield Settle()
+		if (yield sink.ready):
+			break
+		yield
+
+	for word in words[1:]:
+		yield
+		yield Cat(sink.symbol).eq(word)
+
+	if half:
+		for i in range(4, RATIO):
+			yield sink.valid[i].eq(0)
+
+		if abort is not None:
+			yield abort.eq(1)
+
+	yield
+	for i in range(RATIO):
+		yield sink.valid[i].eq(0)
+
+	if abort is not None:
+		yield abort.eq(not half)
+
+	yield
+	if abort is not None:
+		yield abort.eq(0)
+
+def send_narrow(sink, packet):
+	"""
+	Sends a TLP into a tlp_sink with 4 symbols per word
+	"""
+	for i in range(4):
+		yield sink.valid[i].eq(1)
+	yield Cat(sink.symbol).eq(packet[0])
+
+	while True: # The first word is held until it is accepted
+		yield Settle()
+		if (yield sink.ready):
+			break
+		yield
+
+	for word in packet[1:]:
+		yield
+		yield Cat(sink.symbol).eq(word)
+
+	yield
+	for i in range(4):
+		yield sink.valid[i].eq(0)
+	yield
+
+def collect_narrow(source, received):
+	"""
+	Collects the TLPs from a tlp_source with 4 symbols per word as lists of DW without driving ready
+	"""
+	yield Passive()
+	current = []
+
+	while True:
+		if (yield source.all_valid):
+			current.append((yield Cat(source.symbol)))
+
+		elif current:
+			received.append(current)
+			current = []
+
+		yield
+
+def receive(source, received):
+	"""
+	Collects the TLPs from a tlp_source with 8 symbols per word as lists of DW, only the valid half of the last word of a TLP of an odd number of DW is taken
+	"""
+	yield Passive()
+	yield source.ready.eq(1)
+	current = []
+
+	while True:
+		if (yield source.all_valid):
+			word = yield Cat(source.symbol)
+			current.append(word & 0xFFFFFFFF)
+
+			if (yield source.valid[RATIO - 1]):
+				current.append(word >> 32)
+
+		elif current:
+			received.append(current)
+			current = []
+
+		yield
+
+def test_dll(delay):
+	"""
+	Transmitter and receiver of the Data Link Layer connected to each other. With delay the symbols are delayed by 4 symbols,
+	so packets are received in the other half of a word than they were sent in.
+	"""
+	m = Module()
+
+	# The links layers are only used for their signals, the link is up with infinite credits
+	dll_tx = PCIeDLL(None, None, None, 125e6, False)
+	dll_rx = PCIeDLL(None, None, None, 125e6, False)
+	m.submodules.tx = tx = PCIeDLLTLPTransmitter(dll_tx, ratio = RATIO)
+	m.submodules.rx = rx = PCIeDLLTLPReceiver(dll_rx, ratio = RATIO)
+	m.submodules.dllp_tx = dllp_tx = PCIeDLLPTransmitter(ratio = RATIO)
+	m.submodules.dllp_rx = dllp_rx = PCIeDLLPReceiver(ratio = RATIO)
+
+	tx.dllp_source.connect(dllp_tx.dllp_sink, m.d.comb)
+	dllp_rx.dllp_source.connect(rx.dllp_sink, m.d.comb)
+
+	# Idle data is sent as 0 like the physical layer does
+	sent_symbols = [Mux(dllp_tx.phy_source.valid[i], dllp_tx.phy_source.symbol[i], 0) for i in range(RATIO)]
+	last_symbols = [Signal(9) for i in range(RATIO)]
+	m.d.rx += Cat(last_symbols).eq(Cat(sent_symbols))
+	received_symbols = last_symbols[4 : 8] + sent_symbols[0 : 4] if delay else sent_symbols
+
+	for i in range(RATIO):
+		m.d.comb += dllp_rx.phy_sink.symbol[i].eq(received_symbols[i])
+		m.d.comb += dllp_rx.phy_sink.valid[i].eq(1)
+
+	sim = Simulator(m)
+	sim.add_clock(1, domain="rx")
+
+	sent = []
+	received = []
+	words = []
+	acks = []
+
+	def monitor():
+		"""
+		Records the words which go over the link, None if nothing is sent
+		"""
+		yield Passive()
+
+		while True:
+			if (yield dllp_tx.phy_source.all_valid):
+				word = yield Cat(dllp_tx.phy_source.symbol)
+				words.append([(word >> (9 * i)) & 0x1FF for i in range(RATIO)])
+
+			else:
+				words.append(None)
+
+			yield
+
+	def receive_dllps():
+		yield Passive()
+
+		while True:
+			if (yield dllp_rx.dllp.valid):
+				assert (yield dllp_rx.dllp.type) == DLLPType.Ack
+				acks.append((yield dllp_rx.dllp.data))
+
+			yield
+
+	def send_acks():
+		"""
+		Sends Acks like the Data Link Layer does
+		"""
+		yield Passive()
+
+		for i in range(1000):
+			for j in range(23):
+				yield
+
+			yield dllp_tx.dllp.type.eq(DLLPType.Ack)
+			yield dllp_tx.dllp.data.eq(i)
+			yield dllp_tx.dllp.valid.eq(1)
+			yield dllp_tx.send.eq(1)
+
+			while True:
+				yield Settle()
+				if (yield dllp_tx.started_sending):
+					break
+				yield
+
+			yield
+			yield dllp_tx.send.eq(0)
+
+	def acknowledge():
+		"""
+		Acknowledges the received TLPs like the Data Link Layer does, so they aren't replayed
+		"""
+		yield Passive()
+
+		while True:
+			for i in range(20):
+				yield
+
+			yield dll_tx.received_ack_nak.eq(1)
+			yield dll_tx.received_ack.eq(1)
+			yield dll_tx.received_ack_nak_id.eq(((yield rx.next_receive_seq) - 1) & 0xFFF)
+			yield
+			yield dll_tx.received_ack_nak.eq(0)
+
+	def process():
+		for dll in [dll_tx, dll_rx]:
+			yield dll.max_payload_size.eq(0)
+			yield dll.speed.eq(LinkSpeed.S2_5)
+
+		yield dll_tx.up.eq(1)
+		yield dll_rx.up.eq(1)
+		yield dllp_tx.phy_source.ready.eq(1)
+		yield
+
+		# TLPs of an odd and even number of DW are sent back to back. The link has infinite credits,
+		# so they are sent in bursts which fit into the receive buffer of the other side.
+		for index in range(40):
+			packet = tlp(index, (index * 3) % 10)
+			sent.append(packet)
+			yield from send(tx.tlp_sink, packet)
+
+			if index % 8 == 7:
+				for i in range(50):
+					yield
+
+		for i in range(100):
+			yield
+
+		assert received == sent, (received, sent)
+		assert (yield dll_rx.status.rx_seq_num) == len(sent) - 1
+		assert (yield rx.next_receive_seq) == len(sent)
+
+		# A TLP of an odd number of DW starts in the second half of a word, so every TLP ends in the last symbol of a word
+		framed = [word for word in words if word is not None]
+		tlps = [(i, word) for i, word in enumerate(framed) if Ctrl.STP in word]
+		assert len(tlps) == len(sent), (len(tlps), len(sent))
+		for (start, word), packet in zip(tlps, sent):
+			assert word.index(Ctrl.STP) == 4 * (len(packet) % 2), (word, packet)
+
+		# TLPs follow each other without a free word, with delay the END of a TLP of an even number of DW and the STP of the next one are received in the same word
+		back_to_back = [i for i, word in enumerate(words) if word is not None and Ctrl.STP in word and words[i - 1] is not None and words[i - 1][-1] == Ctrl.END]
+		assert len(back_to_back) >= len(sent) // 2, (len(back_to_back), len(sent))
+
+		# The Acks are sent between the TLPs
+		assert len(acks) >= 10 and acks == list(range(len(acks))), acks
+
+		print(f"Data Link Layer test passed, delay {delay}")
+
+	sim.add_sync_process(process, domain="rx")
+	sim.add_sync_process(monitor, domain="rx")
+	sim.add_sync_process(lambda: (yield from receive(rx.tlp_source, received)), domain="rx")
+	sim.add_sync_process(receive_dllps, domain="rx")
+	sim.add_sync_process(send_acks, domain="rx")
+	sim.add_sync_process(acknowledge, domain="rx")
+
+	sim.run()
+
+def test_adapter(tl_domain):
+	"""
+	Width adapter between the Data Link Layer and the Transaction Layer. Received TLPs of an odd and even number of DW are passed on
+	in words of 4 symbols, the aborted ones are dropped. Sent TLPs are passed on in words of 8 symbols, once the first word has been accepted
+	all others follow without gaps. The Transaction Layer has a faster clock than rx if tl_domain isn't rx.
+	"""
+	m = Module()
+	m.submodules.adapter = adapter = TLPWidthAdapter(max_payload_size = 128, tl_domain = tl_domain)
+
+	sim = Simulator(m)
+	sim.add_clock(1e-8, domain="rx")
+	if tl_domain != "rx":
+		sim.add_clock(0.45e-8, domain=tl_domain)
+
+	good = []
+	received = []
+	sent = []
+	transmitted = []
+
+	def send_received():
+		for index in range(30):
+			packet = tlp(index, (index * 3) % 10)
+			aborted = index % 4 == 3
+			if not aborted:
+				good.append(packet)
+
+			yield from send(adapter.dll_sink, packet, half_last = True, abort = adapter.abort if aborted else None)
+
+			if index % 8 == 7:
+				for i in range(100):
+					yield
+
+		for i in range(1000):
+			if len(received) == len(good):
+				break
+			yield
+
+		assert received == good, (received, good)
+
+	def accept():
+		"""
+		The Transaction Layer is only ready to receive TLPs some of the time
+		"""
+		yield Passive()
+
+		while True:
+			for ready in [1, 0]:
+				yield adapter.tlp_source.ready.eq(ready)
+				for i in range(7):
+					yield
+
+	def send_sent():
+		for index in range(30):
+			packet = tlp(index, (index * 5) % 9)
+			sent.append(packet)
+			yield from send_narrow(adapter.tlp_sink, packet)
+
+		for i in range(2000):
+			if len(transmitted) == len(sent):
+				break
+			yield
+
+		assert transmitted == [packet + [0] * (len(packet) % 2) for packet in sent], (transmitted, sent)
+
+	def transmit():
+		"""
+		Takes TLPs like the Data Link Layer does, the first word is accepted every third cycle and all others in the cycles after it
+		"""
+		yield Passive()
+		source = adapter.dll_source
+		current = []
+		cycle = 0
+
+		while True:
+			yield source.ready.eq(not current and cycle % 3 == 0)
+			yield Settle()
+
+			if (yield source.all_valid) and (current or (yield source.ready)):
+				word = yield Cat(source.symbol)
+				current += [word & 0xFFFFFFFF, word >> 32]
+
+			elif current:
+				transmitted.append(current)
+				current = []
+
+			cycle += 1
+			yield
+
+	sim.add_sync_process(send_received, domain="rx")
+	sim.add_sync_process(lambda: (yield from collect_narrow(adapter.tlp_source, received)), domain=tl_domain)
+	sim.add_sync_process(accept, domain=tl_domain)
+	sim.add_sync_process(send_sent, domain=tl_domain)
+	sim.add_sync_process(transmit, domain="rx")
+
+	sim.run()
+
+	print(f"Width adapter test passed, domain {tl_domain}")
+
+def test_link(shift, tl_domain = "sync"):
+	"""
+	The link trains and TLPs are exchanged in both directions. The virtual TLP generator of the downstream PHY sends configuration requests,
+	the Transaction Layer of the upstream PHY receives them through the width adapter and the completions are received by the downstream PHY.
+	"""
+	m = Module()
+	m.submodules.pcie = pcie = WideLinkTestbench(shift, tl_domain)
+
+	phys = {"u": pcie.phy_u, "d": pcie.phy_d}
+
+	sim = Simulator(m)
+	sim.add_clock(1e-8, domain="sync")
+	if tl_domain != "sync":
+		sim.add_clock(0.5e-8, domain=tl_domain)
+
+	received = {name: [] for name in phys}
+	record = {"naks": 0, "link_down": 0, "states": {name: set() for name in phys}}
+
+	def monitor():
+		"""
+		Records Naks and whether the link went down once it is up
+		"""
+		yield Passive()
+
+		while True:
+			for name, phy in phys.items():
+				if (yield phy.dll.received_ack_nak) and not (yield phy.dll.received_ack):
+					record["naks"] += 1
+
+				record["link_down"] += not (yield phy.dll.up)
+				record["states"][name].add(State((yield phy.ltssm.debug_state)))
+
+			yield
+
+	def process():
+		for i in range(10000):
+			if (yield pcie.phy_u.dll.up) and (yield pcie.phy_d.dll.up):
+				break
+			yield
+
+		else:
+			assert False, "Link didn't come up"
+
+		record["naks"] = 0
+		record["link_down"] = 0
+		record["states"] = {name: set() for name in phys}
+		received["u"].clear()
+		received["d"].clear()
+
+		for i in range(2500):
+			yield
+
+		# The virtual TLP generator sends a configuration write and a configuration read every 512 cycles
+		configuration_write = [0x01000044, 0x0F000000, 0x24000001, 0xFFFFFFFF]
+		configuration_read = [0x01000004, 0x0F000000, 0x24000001]
+		assert len(received["u"]) >= 4, received["u"]
+		for packet in received["u"]:
+			assert packet in [configuration_write, configuration_read], packet
+
+		# Every request is completed successfully, the write without and the read with 1 DW of data
+		assert len(received["d"]) >= len(received["u"]) - 1, (received["d"], received["u"])
+		for packet in received["d"]:
+			assert (packet[0] & 0xFF, len(packet)) in [(TLPType.Cpl, 3), (TLPType.CplD, 4)], packet
+			assert (packet[1] >> 21) & 0b111 == 0, packet
+
+		assert record["naks"] == 0 and record["link_down"] == 0, record
+		assert all(states == {State.L0} for states in record["states"].values()), record["states"]
+
+		print(f"Link test passed, shift {shift}, domain {tl_domain}")
+
+	sim.add_sync_process(process, domain="sync")
+	sim.add_sync_process(monitor, domain="sync")
+	sim.add_sync_process(lambda: (yield from collect_narrow(pcie.phy_u.tlp.tlp_sink, received["u"])), domain=tl_domain)
+	sim.add_sync_process(lambda: (yield from receive(pcie.phy_d.dll_tlp_rx.tlp_source, received["d"])), domain="sync")
+
+	sim.run()
+
+if __name__ == "__main__":
+	test_dll(False)
+	test_dll(True)
+
+	test_adapter("rx")
+	test_adapter("tl")
+
+	for shift in [0, 3, 4, 7]:
+		test_link(shift)
+
+	test_link(4, "tl")